@@ -9,7 +9,7 @@ from django.contrib.sites.models import Site
 
 from base.models import Organization, Resource
 from helpers.email_utils import send_email
-from helpers.utils import get_jinja_template
+from helpers.utils import get_jinja_template, get_email_subject
 
 
 class Workflow(models.Model):
@@ -172,7 +172,7 @@ class AnalysisProject(models.Model):
                 email_html = email_template.render(context)
                 email_plaintxt_template = get_jinja_template('email_templates/new_project.txt')
                 email_plaintxt = email_plaintxt_template.render(context)
-                email_subject = open('email_templates/new_project_subject.txt').readline().strip()
+                email_subject = get_email_subject('email_templates/new_project_subject.txt')
                 #send_email(email_plaintxt, \
                 #    email_html, \
                 #    email_address, \
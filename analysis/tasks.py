@@ -19,7 +19,10 @@ import google
 from google.cloud import storage
 
 from helpers import utils
-from helpers.utils import get_jinja_template
+from helpers import google_clients
+from helpers import storage_utils
+from helpers import runtime_settings
+from helpers.utils import get_jinja_template, get_email_subject
 from helpers.email_utils import notify_admins, send_email
 import analysis.models
 from analysis.models import Workflow, \
@@ -31,7 +34,7 @@ from analysis.models import Workflow, \
     JobClientError, \
     ProjectConstraint, \
     WorkflowContainer
-from base.models import Resource, Issue, CurrentZone
+from base.models import Resource, Issue
 
 THIS_DIR = os.path.dirname(os.path.abspath(__file__))
 ZIPNAME = 'depenencies.zip'
@@ -380,10 +383,10 @@ def get_zone_as_string():
     '''
     Returns the current zone as a string
     '''
-    try:
-        current_zone = CurrentZone.objects.all()[0]
-        return current_zone.zone.zone
-    except IndexError:
+    current_zone = runtime_settings.get_current_zone()
+    if current_zone:
+        return current_zone.zone
+    else:
         message = 'A current zone has not set.  Please check that a single zone has been selected in the database'
         handle_exception(None, message=message)
         return None
@@ -530,12 +533,12 @@ def get_resource_size(path):
     TODO: abstract this for different cloud providers!!
     '''
     if settings.CONFIG_PARAMS['cloud_environment'] == settings.GOOGLE:
-        storage_client = storage.Client()
+        storage_client = google_clients.get_storage_client()
         bucket_prefix = settings.CONFIG_PARAMS['google_storage_gs_prefix']
         p = path[len(bucket_prefix):]
         bucketname = p.split('/')[0]
         objectname = '/'.join(p.split('/')[1:])
-        bucket_obj = storage_client.get_bucket(bucketname)
+        bucket_obj = storage_utils.get_bucket(bucketname, storage_client)
         blob = bucket_obj.get_blob(objectname)
         size = blob.size
         if size:
@@ -585,7 +588,7 @@ def move_resource_to_user_bucket(job, resource_path):
     '''
     Copies the final job output from the cromwell bucket to the user's bucket/folder
     '''
-    storage_client = storage.Client()
+    storage_client = google_clients.get_storage_client()
 
     # Creates the necessary items for the destination of this file
     # strip the prefix (e.g. "gs://")
@@ -606,7 +609,7 @@ def move_resource_to_user_bucket(job, resource_path):
     # typically this bucket would already exist due to a previous upload, but 
     # we create the bucket if it does not exist 
     try:
-        destination_bucket = storage_client.get_bucket(destination_bucket_name)
+        destination_bucket = storage_utils.get_bucket(destination_bucket_name, storage_client)
         print('Destination bucket at %s existed.' % destination_bucket_name)
     except google.api_core.exceptions.NotFound:
         b = storage.Bucket(destination_bucket_name)
@@ -615,13 +618,13 @@ def move_resource_to_user_bucket(job, resource_path):
         # if zone_str was None, b.location=None, which is the default (and the created bucket is multi-regional)
         if zone_str:
             b.location = '-'.join(zone_str.split('-')[:-1]) # e.g. makes 'us-east4-c' into 'us-east4'
-        destination_bucket = storage_client.create_bucket(b)
+        destination_bucket = storage_utils.create_bucket(b, storage_client, exist_ok=True)
 
     # now handle the source side of things:
     full_source_location_without_prefix = resource_path[len(settings.CONFIG_PARAMS['google_storage_gs_prefix']):]
     source_bucket_name = full_source_location_without_prefix.split('/')[0]
     source_object_name = '/'.join(full_source_location_without_prefix.split('/')[1:])
-    source_bucket = storage_client.get_bucket(source_bucket_name)
+    source_bucket = storage_utils.get_bucket(source_bucket_name, storage_client)
     source_blob = storage.Blob(source_object_name, source_bucket)
 
     # if somehow the destination bucket is in another region, larger transfers can fail
@@ -733,7 +736,7 @@ def copy_pipeline_components(job):
     additional_files.append(version_file)
 
     environment = settings.CONFIG_PARAMS['cloud_environment']
-    storage_client = storage.Client()
+    storage_client = google_clients.get_storage_client()
 
     for p in additional_files:
         stat_info = os.stat(p)
@@ -747,7 +750,7 @@ def copy_pipeline_components(job):
 
         # perform the upload to the bucket:
         bucket_name = destination_bucket[len(settings.CONFIG_PARAMS['google_storage_gs_prefix']):]
-        bucket = storage_client.get_bucket(bucket_name)
+        bucket = storage_utils.get_bucket(bucket_name, storage_client)
         blob = bucket.blob(object_name)
         blob.upload_from_filename(p)
 
@@ -805,7 +808,7 @@ def handle_success(job):
         email_html = email_template.render(context)
         email_plaintxt_template = get_jinja_template('email_templates/analysis_success.txt')
         email_plaintxt = email_plaintxt_template.render(context)
-        email_subject = open('email_templates/analysis_success_subject.txt').readline().strip()
+        email_subject = get_email_subject('email_templates/analysis_success_subject.txt')
         send_email(email_plaintxt, email_html, email_address, email_subject)
 
         # delete the staging dir where the files were:
@@ -867,7 +870,7 @@ def handle_failure(job):
         recipient = project.owner.email
         email_html = open('email_templates/analysis_fail.html').read()
         email_plaintext = open('email_templates/analysis_fail.txt').read()
-        email_subject = open('email_templates/analysis_fail_subject.txt').readline().strip()
+        email_subject = get_email_subject('email_templates/analysis_fail_subject.txt')
         send_email(email_plaintext, email_html, recipient, email_subject)
 
     # notify admins:
@@ -905,14 +908,14 @@ def log_client_errors(job, stderr_file_list):
     stderr_folder = os.path.join(job.job_staging_dir, foldername)
     os.mkdir(stderr_folder)
 
-    storage_client = storage.Client()
+    storage_client = google_clients.get_storage_client()
     bucket_prefix = settings.CONFIG_PARAMS['google_storage_gs_prefix']
     local_file_list = []
     for i, stderr_path in enumerate(stderr_file_list):
         path_without_prefix = stderr_path[len(bucket_prefix):]
         bucket_name = path_without_prefix.split('/')[0]
         object_name = '/'.join(path_without_prefix.split('/')[1:])
-        bucket = storage_client.get_bucket(bucket_name)
+        bucket = storage_utils.get_bucket(bucket_name, storage_client)
         blob = bucket.blob(object_name)
         file_location = os.path.join(stderr_folder, 'stderr_%d' % i)
         local_file_list.append(file_location)
@@ -995,7 +998,7 @@ def handle_precheck_failure(job):
         email_html = email_template.render(context)
         email_plaintxt_template = get_jinja_template(email_plaintxt_path)
         email_plaintxt = email_plaintxt_template.render(context)
-        email_subject = open(email_subject).readline().strip()
+        email_subject = get_email_subject(email_subject)
         send_email(email_plaintxt, email_html, email_address, email_subject)
 
         if not project.restart_allowed:
@@ -192,9 +192,10 @@ class TasksTestCase(TestCase):
             register_outputs(job)
 
 
+    @mock.patch('analysis.tasks.google_clients')
     @mock.patch('analysis.tasks.time')
     @mock.patch('analysis.tasks.storage')
-    def test_handle_error_with_resource_interbucket_copy(self, mock_storage, mock_time):
+    def test_handle_error_with_resource_interbucket_copy(self, mock_storage, mock_time, mock_google_clients):
         '''
         This test covers the case where an inter-bucket copy fails due to some
         reason on google's end.  Test that we try multiple times and eventually
@@ -215,7 +216,7 @@ class TasksTestCase(TestCase):
 
         # add the mocks to the callers:
         mock_client.get_bucket.return_value = mock_bucket
-        mock_storage.Client.return_value = mock_client
+        mock_google_clients.get_storage_client.return_value = mock_client
         mock_storage.Blob.return_value = mock_blob
 
         mock_time.sleep = mock.MagicMock()
@@ -232,9 +233,10 @@ class TasksTestCase(TestCase):
             )
 
 
+    @mock.patch('analysis.tasks.google_clients')
     @mock.patch('analysis.tasks.time')
     @mock.patch('analysis.tasks.storage')
-    def test_interbucket_copy_recovers_from_initial_failure(self, mock_storage, mock_time):
+    def test_interbucket_copy_recovers_from_initial_failure(self, mock_storage, mock_time, mock_google_clients):
         '''
         This test covers the case where an inter-bucket copy fails due to some
         reason on google's end.  Eventually it works, however.
@@ -259,7 +261,7 @@ class TasksTestCase(TestCase):
 
         # add the mocks to the callers:
         mock_client.get_bucket.return_value = mock_bucket
-        mock_storage.Client.return_value = mock_client
+        mock_google_clients.get_storage_client.return_value = mock_client
         mock_storage.Blob.return_value = mock_blob
 
         mock_time.sleep = mock.MagicMock()
@@ -284,9 +286,10 @@ class TasksTestCase(TestCase):
         self.assertTrue(r == expected_r)
 
 
+    @mock.patch('analysis.tasks.google_clients')
     @mock.patch('analysis.tasks.time')
     @mock.patch('analysis.tasks.storage')
-    def test_interbucket_copy_success(self, mock_storage, mock_time):
+    def test_interbucket_copy_success(self, mock_storage, mock_time, mock_google_clients):
         '''
         This test covers the case where an inter-bucket copy works the first time.
         we assert that the sleep function is not called.
@@ -302,7 +305,7 @@ class TasksTestCase(TestCase):
 
         # add the mocks to the callers:
         mock_client.get_bucket.return_value = mock_bucket
-        mock_storage.Client.return_value = mock_client
+        mock_google_clients.get_storage_client.return_value = mock_client
         mock_storage.Blob.return_value = mock_blob
 
         mock_time.sleep = mock.MagicMock()
@@ -51,7 +51,7 @@ from .view_utils import query_workflow, \
     start_job_on_gcp, \
     test_workflow
 from helpers.email_utils import send_email
-from helpers.utils import get_jinja_template
+from helpers.utils import get_jinja_template, get_email_subject
 
 THIS_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -343,7 +343,7 @@ class AnalysisProjectApplyConstraints(View):
                 email_html = email_template.render(context)
                 email_plaintxt_template = get_jinja_template('email_templates/new_project.txt')
                 email_plaintxt = email_plaintxt_template.render(context)
-                email_subject = open('email_templates/new_project_subject.txt').readline().strip()
+                email_subject = get_email_subject('email_templates/new_project_subject.txt')
                 send_email(email_plaintxt, \
                     email_html, \
                     email_address, \
@@ -771,14 +771,14 @@ class AutomatedAnalysisCreateEndpoint(APIView):
                     email_html = email_template.render(context)
                     email_plaintxt_template = get_jinja_template('email_templates/new_project.txt')
                     email_plaintxt = email_plaintxt_template.render(context)
-                    email_subject = open('email_templates/new_project_subject.txt').readline().strip()
+                    email_subject = get_email_subject('email_templates/new_project_subject.txt')
                 else:
                     context = {'site': url, 'user_email': email_address, 'pwd': random_pwd}
                     email_template = get_jinja_template('email_templates/new_project_for_new_user.html')
                     email_html = email_template.render(context)
                     email_plaintxt_template = get_jinja_template('email_templates/new_project_for_new_user.txt')
                     email_plaintxt = email_plaintxt_template.render(context)
-                    email_subject = open('email_templates/new_project_subject.txt').readline().strip()
+                    email_subject = get_email_subject('email_templates/new_project_subject.txt')
 
                 send_email(email_plaintxt, \
                     email_html, \
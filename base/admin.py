@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Resource, Issue, AvailableZones, CurrentZone
+from .models import Resource, Issue, AvailableZones, CurrentZone, BucketImport, QueuedEmail
 
 class ResourceAdmin(admin.ModelAdmin):
     list_display = ('name', 'path', 'source')
@@ -21,7 +21,17 @@ class CurrentZoneAdmin(admin.ModelAdmin):
     list_display = ('zone',)
 
 
+class BucketImportAdmin(admin.ModelAdmin):
+    list_display = ('source_bucket', 'owner', 'objects_imported', 'start_time', 'completed')
+
+
+class QueuedEmailAdmin(admin.ModelAdmin):
+    list_display = ('recipient', 'subject', 'created', 'sent', 'failed', 'attempts')
+
+
 admin.site.register(Resource, ResourceAdmin)
 admin.site.register(Issue, IssueAdmin)
 admin.site.register(AvailableZones, AvailableZonesAdmin)
 admin.site.register(CurrentZone, CurrentZoneAdmin)
+admin.site.register(BucketImport, BucketImportAdmin)
+admin.site.register(QueuedEmail, QueuedEmailAdmin)
@@ -3,6 +3,9 @@ import datetime
 from jinja2.filters import do_filesizeformat
 
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
 from django.conf import settings
 from django.contrib.auth import get_user_model
 
@@ -33,6 +36,16 @@ class CurrentZone(models.Model):
     def __str__(self):
         return '%s' % self.zone.zone
 
+@receiver(post_save, sender=CurrentZone)
+@receiver(post_delete, sender=CurrentZone)
+def current_zone_changed(sender, **kwargs):
+    '''
+    The current zone is cached by each process, so they need to reload it
+    '''
+    from helpers import runtime_settings
+    runtime_settings.settings_changed()
+
+
 class ResourceManager(models.Manager):
      '''
      This class provides a nice way to filter Resource objects for a particular user
@@ -83,8 +96,18 @@ class Resource(models.Model):
     # number of downloads can be set in the config file:
     total_downloads = models.PositiveSmallIntegerField(null=False, default=0)
 
+    # once a Resource has expired, the file itself is eventually removed from
+    # storage (see base.tasks.remove_expired_files).  This marks that it was removed.
+    file_deleted = models.BooleanField(null=False, default=False)
+
     objects = ResourceManager()
 
+    class Meta:
+        # users' active resources are checked when transfers are requested
+        indexes = [
+            models.Index(fields=['owner', 'is_active']),
+        ]
+
     def save(self, *args, **kwargs):
         if self._state.adding: # if creating, NOT updating
             if self.expiration_date is None:
@@ -131,3 +154,90 @@ class Issue(models.Model):
     time = models.DateTimeField(auto_now=True)
 
 
+
+
+class BucketImport(models.Model):
+    '''
+    This tracks the import of a user's existing Google bucket into our own
+    storage (see dashboard.tasks.transfer_google_bucket).  The source bucket is 
+    listed a page at a time and the position is saved after each page has been 
+    copied and registered, so an interrupted import resumes from where it stopped.
+    '''
+    # the admin who requested the import (and is informed when it completes)
+    admin = models.ForeignKey(get_user_model(), related_name='requested_imports', on_delete=models.CASCADE)
+
+    # the user who will own the imported files
+    owner = models.ForeignKey(get_user_model(), related_name='bucket_imports', on_delete=models.CASCADE)
+
+    # the name of the bucket we are importing from (no gs:// prefix)
+    source_bucket = models.CharField(max_length=222)
+
+    # the token for the next page of the source bucket's listing.  Blank
+    # before the first page has been completed
+    page_token = models.TextField(blank=True, default='')
+
+    # running totals for the files copied and registered so far
+    objects_imported = models.PositiveIntegerField(default=0)
+    bytes_imported = models.BigIntegerField(default=0)
+
+    # paths which were not imported, one per line.  Conflicts are files which
+    # already existed at the destination (which we do not overwrite) and failures
+    # are those which could not be copied
+    conflicting_paths = models.TextField(blank=True, default='')
+    failed_paths = models.TextField(blank=True, default='')
+
+    # identifies the task which is running the import.  The runner refreshes
+    # the heartbeat as it goes; a claim whose heartbeat has gone stale (e.g.
+    # the worker died) may be taken over by a new request for the import
+    claim = models.CharField(max_length=36, blank=True, default='')
+    heartbeat = models.DateTimeField(null=True, blank=True)
+
+    start_time = models.DateTimeField(auto_now_add=True)
+    finish_time = models.DateTimeField(null=True, blank=True)
+    completed = models.BooleanField(default=False)
+
+    def __str__(self):
+        return '%s (%d files)' % (self.source_bucket, self.objects_imported)
+
+
+class QueuedEmail(models.Model):
+    '''
+    An outgoing email.  Emails are queued here (see helpers.email_utils.send_email)
+    and sent in batches by a periodic task, which retries failed sends
+    with an increasing delay.
+    '''
+    recipient = models.CharField(max_length=254)
+    subject = models.CharField(max_length=500)
+    plaintext_message = models.TextField()
+    html_message = models.TextField()
+
+    # notifications for the admins.  Those which are pending for the same 
+    # recipient are combined into a single digest email
+    is_admin_notification = models.BooleanField(default=False)
+
+    created = models.DateTimeField(auto_now_add=True)
+
+    # the email is not sent before this time.  When a send fails, this is
+    # moved back.  A sender also moves it back when it claims the email, which
+    # keeps other senders from sending it at the same time
+    next_attempt = models.DateTimeField(default=timezone.now)
+
+    # identifies the sender which claimed this email
+    claim = models.CharField(max_length=36, blank=True, default='')
+
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+
+    sent = models.BooleanField(default=False)
+    sent_time = models.DateTimeField(null=True, blank=True)
+
+    # set once we have given up on sending it
+    failed = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['sent', 'failed', 'next_attempt']),
+        ]
+
+    def __str__(self):
+        return '%s: %s' % (self.recipient, self.subject)
@@ -1,13 +1,17 @@
 import datetime
 
 from django.conf import settings
+from django.db.models import Q
 from celery.decorators import task
-from django.contrib.auth import get_user_model
 from django.contrib.sites.models import Site
 
+from jinja2.filters import do_filesizeformat
+
 from base.models import Resource
-from helpers.email_utils import send_email
-from helpers.utils import get_jinja_template
+from helpers import email_utils
+from helpers.email_utils import send_email, notify_admins
+from helpers import storage_utils
+from helpers.utils import get_jinja_template, get_email_subject
 
 
 def send_reminder(user, data):
@@ -23,10 +27,56 @@ def send_reminder(user, data):
     email_html = email_template.render(context)
     email_plaintxt_template = get_jinja_template('email_templates/expiration_reminder.txt')
     email_plaintxt = email_plaintxt_template.render(context)
-    email_subject = open('email_templates/expiration_reminder_subject.txt').readline().strip()
+    email_subject = get_email_subject('email_templates/expiration_reminder_subject.txt')
     send_email(email_plaintxt, email_html, email_address, email_subject)
 
 
+def remove_expired_files(today, dry_run):
+    '''
+    Removes the files for expired Resources from storage.  Only files in our own
+    (i.e. the users') buckets are removed, and files which are still part of an 
+    ongoing transfer are left until the next time.
+
+    If dry_run is True, nothing is removed.  In either case, the admins receive
+    a report of the number of files and bytes removed (or which would be).
+    Returns that report as a dict.
+    '''
+    storage_prefix = '%s-' % settings.CONFIG_PARAMS['storage_bucket_prefix']
+
+    # a path can be reused once its Resource has expired (e.g. by a new upload with
+    # the same name), so we leave any path which an unexpired Resource refers to
+    live_paths = Resource.objects.filter(Q(expiration_date__isnull=True) | 
+        Q(expiration_date__gte=today)
+    ).values('path')
+    removable_resources = Resource.objects.filter(expiration_date__lt=today, 
+        file_deleted=False, 
+        path__startswith=storage_prefix
+    ).exclude(transfer__completed=False).exclude(archive_transfers__completed=False).exclude(path__in=live_paths).distinct()
+    removable = list(removable_resources.values_list('pk', 'path', 'size'))
+
+    report = {'dry_run': dry_run, 'files': len(removable), 'bytes': sum([x[2] for x in removable]), 'failed_paths': []}
+    if len(removable) == 0:
+        return report
+
+    if not dry_run:
+        failed_paths = storage_utils.delete_blobs(sorted(set([x[1] for x in removable])))
+        removed_pks = [x[0] for x in removable if not x[1] in failed_paths]
+        Resource.objects.filter(pk__in=removed_pks).update(file_deleted=True)
+        report['failed_paths'] = failed_paths
+        report['files'] -= len(failed_paths)
+        report['bytes'] = sum([x[2] for x in removable if x[0] in removed_pks])
+
+    message = '%s %d expired files (%s).' % ('Would have removed' if dry_run else 'Removed', 
+        report['files'], 
+        do_filesizeformat(report['bytes'], binary=True)
+    )
+    if len(report['failed_paths']) > 0:
+        message += '  The following could not be removed: %s' % ', '.join(report['failed_paths'])
+    print(message)
+    notify_admins(message, 'Expired file removal%s' % (' (dry run)' if dry_run else ''))
+    return report
+
+
 @task(name='manage_files')
 def manage_files():
     '''
@@ -36,22 +86,38 @@ def manage_files():
     
     # find any expired resources and mark them inactive and delete
     today = datetime.date.today()
-    expired_resources = Resource.objects.filter(is_active=True, expiration_date__lt=today)
-    for r in expired_resources:
-        r.is_active = False
-        r.save()
+    Resource.objects.filter(is_active=True, expiration_date__lt=today).update(is_active=False)
+    remove_expired_files(today, not settings.CONFIG_PARAMS['delete_expired_files'])
     
-    # Now find any resources that will be expiring soon- construct a list of dates:
-    target_date_map = {x:today + datetime.timedelta(days=x) for x in settings.EXPIRATION_REMINDER_DAYS}
+    # Now find any resources that will be expiring soon- construct a map of
+    # the dates to the number of days until then:
+    target_date_map = {today + datetime.timedelta(days=x):x for x in settings.EXPIRATION_REMINDER_DAYS}
+
+    # A single query gives the Resources that expire on any of those dates, 
+    # ordered so that each user's Resources are together.  Only users who
+    # appear here are sent a reminder.
+    pending_resources = Resource.objects.filter(is_active=True, 
+        expiration_date__in=list(target_date_map.keys())
+    ).select_related('owner').order_by('owner', 'pk')
 
-    # Go through each user and collect Resources that will expire:
-    for u in get_user_model().objects.all():
+    reminders = []
+    for r in pending_resources:
+        if len(reminders) == 0 or reminders[-1][0].pk != r.owner_id:
+            reminders.append((r.owner, {}))
         # map of number of days to a list of the resources that will expire in that many days
-        pending_expiration_map = {k:list(Resource.objects.filter(is_active=True, expiration_date = v, owner=u)) for k,v in target_date_map.items()}
-        d = {}
-        for num_days, resource_list in pending_expiration_map.items():
-            if len(resource_list)>0:
-                d[num_days] = [x.name for x in resource_list]
-        # email that user:
-        if len(d.keys()) > 0:
-            send_reminder(u, d)
+        d = reminders[-1][1]
+        d.setdefault(target_date_map[r.expiration_date], []).append(r.name)
+
+    # email those users:
+    for user, d in reminders:
+        send_reminder(user, d)
+
+    email_utils.remove_sent_emails()
+
+
+@task(name='send_queued_emails')
+def send_queued_emails():
+    '''
+    Sends the queued emails (see helpers.email_utils)
+    '''
+    return email_utils.send_queued_emails()
@@ -3,6 +3,8 @@ import os
 import string
 import random
 import json
+import base64
+import tempfile
 
 from django.test import TestCase
 from rest_framework.test import APIClient
@@ -13,8 +15,16 @@ from django.urls import reverse
 from django.contrib.auth import get_user_model
 from django.conf import settings
 
-from base.models import Resource
-from base.tasks import manage_files
+from django.utils import timezone
+
+from base.models import Resource, QueuedEmail, AvailableZones, CurrentZone
+from helpers import email_utils
+from helpers import utils
+from helpers import runtime_settings
+from base.tasks import manage_files, remove_expired_files
+from helpers import google_clients
+from helpers import testing
+from transfer_app.models import Transfer, TransferCoordinator
 
 import datetime
 
@@ -421,6 +431,250 @@ class ResourceExpirationTestCase(TestCase):
         }
         mock_reminder.assert_called_with(self.regular_user, expected_data)
 
+    @mock.patch('base.tasks.send_reminder')
+    def test_reminders_use_single_query(self, mock_reminder):
+        '''
+        Users without expiring files do not add any queries or reminders
+        '''
+        other_user = get_user_model().objects.create_user(email=settings.OTHER_TEST_EMAIL, password='abcd123!')
+        for i in range(5):
+            get_user_model().objects.create_user(email='user%d@example.com' % i, password='abcd123!')
+        d = settings.EXPIRATION_REMINDER_DAYS[0]
+        Resource.objects.create(
+            source = 'google_bucket',
+            path='gs://a/b/other.txt',
+            name = 'other.txt',
+            size=500,
+            owner=other_user,
+            expiration_date = datetime.date.today() + datetime.timedelta(days=d)
+        )
+        # one query to expire, one to find removable files, one for the reminders,
+        # and one to remove old emails:
+        with self.assertNumQueries(4):
+            manage_files()
+        self.assertEqual(mock_reminder.call_count, 2)
+        mock_reminder.assert_any_call(other_user, {d: ['other.txt']})
+
+
+class ExpiredFileRemovalTestCase(TestCase):
+
+    def setUp(self):
+        self.regular_user = get_user_model().objects.create_user(email=settings.REGULAR_TEST_EMAIL, password='abcd123!')
+        self.bucket_name = '%s-%s' % (settings.CONFIG_PARAMS['storage_bucket_prefix'][len(settings.CONFIG_PARAMS['google_storage_gs_prefix']):], 
+            str(self.regular_user.user_uuid))
+        self.storage_client = testing.FakeStorageClient()
+        bucket = self.storage_client.create_bucket(self.bucket_name)
+        self.today = datetime.date.today()
+        for i, days in enumerate([-3, -1, 5]):
+            bucket.blob('f%d.txt' % i).upload_from_string('x' * (i+1) * 100)
+            Resource.objects.create(
+                source='google_bucket',
+                path='gs://%s/f%d.txt' % (self.bucket_name, i),
+                name='f%d.txt' % i,
+                size=(i+1) * 100,
+                owner=self.regular_user,
+                expiration_date=self.today + datetime.timedelta(days=days)
+            )
+        # an expired file outside of our storage is not removed:
+        Resource.objects.create(
+            source='dropbox',
+            path='in some user dropbox',
+            name='f.txt',
+            size=1000,
+            owner=self.regular_user,
+            expiration_date=self.today - datetime.timedelta(days=10)
+        )
+
+    @mock.patch('base.tasks.notify_admins')
+    def test_dry_run_only_reports(self, mock_notify):
+        with google_clients.use_fake_clients(storage=self.storage_client):
+            report = remove_expired_files(self.today, True)
+        self.assertEqual(report['files'], 2)
+        self.assertEqual(report['bytes'], 300)
+        self.assertEqual(len(self.storage_client.get_bucket(self.bucket_name).blobs), 3)
+        self.assertEqual(Resource.objects.filter(file_deleted=True).count(), 0)
+        self.assertTrue(mock_notify.called)
+
+    @mock.patch('base.tasks.notify_admins')
+    def test_expired_files_removed(self, mock_notify):
+        # f0.txt was already removed from the bucket, which is not an error:
+        self.storage_client.get_bucket(self.bucket_name).delete_blob('f0.txt')
+        with google_clients.use_fake_clients(storage=self.storage_client):
+            report = remove_expired_files(self.today, False)
+            self.assertEqual(report['files'], 2)
+            self.assertEqual(report['failed_paths'], [])
+            self.assertEqual(list(self.storage_client.get_bucket(self.bucket_name).blobs.keys()), ['f2.txt'])
+            self.assertEqual(sorted(Resource.objects.filter(file_deleted=True).values_list('name', flat=True)), ['f0.txt', 'f1.txt'])
+
+            # once removed, they are not removed again:
+            mock_notify.reset_mock()
+            report = remove_expired_files(self.today, False)
+            self.assertEqual(report['files'], 0)
+            self.assertFalse(mock_notify.called)
+
+    @mock.patch('base.tasks.notify_admins')
+    def test_files_in_ongoing_transfer_are_kept(self, mock_notify):
+        tc = TransferCoordinator.objects.create()
+        Transfer.objects.create(download=True,
+            resource=Resource.objects.get(name='f1.txt'),
+            destination=settings.DROPBOX,
+            coordinator=tc,
+            originator=self.regular_user)
+        with google_clients.use_fake_clients(storage=self.storage_client):
+            report = remove_expired_files(self.today, False)
+        self.assertEqual(report['files'], 1)
+        self.assertEqual(list(Resource.objects.filter(file_deleted=True).values_list('name', flat=True)), ['f0.txt'])
+
+
+class EmailQueueTestCase(TestCase):
+
+    def setUp(self):
+        self.admin_user = get_user_model().objects.create_user(email='admin@example.com', password='abcd123!', is_staff=True)
+        self.config_patcher = mock.patch.dict(settings.CONFIG_PARAMS, {
+            'email_batch_size': '50',
+            'email_max_attempts': '2',
+            'email_retry_delay_seconds': '60'
+        })
+        self.config_patcher.start()
+        self.addCleanup(self.config_patcher.stop)
+
+    def mock_gmail(self, mock_google_clients, failing_ids=[]):
+        '''
+        Sets up a mock Gmail service whose batch requests call back for 
+        each message.  Requests with IDs in failing_ids fail.
+        '''
+        service = mock.MagicMock()
+        mock_google_clients.get_gmail_client.return_value = service
+        self.batches = []
+        def new_batch(callback=None):
+            requests = []
+            batch = mock.MagicMock()
+            batch.add.side_effect = lambda request, request_id=None: requests.append(request_id)
+            def execute():
+                for request_id in requests:
+                    callback(request_id, {}, Exception('rate limited') if request_id in failing_ids else None)
+            batch.execute.side_effect = execute
+            self.batches.append(requests)
+            return batch
+        service.new_batch_http_request.side_effect = new_batch
+        return service
+
+    @mock.patch('helpers.email_utils.google_clients')
+    def test_queued_emails_sent_in_batches(self, mock_google_clients):
+        service = self.mock_gmail(mock_google_clients)
+        for i in range(3):
+            email_utils.send_email('text', '<p>text</p>', 'user%d@example.com' % i, 'Subject')
+        self.assertFalse(service.new_batch_http_request.called)
+        self.assertEqual(QueuedEmail.objects.filter(sent=False).count(), 3)
+
+        with mock.patch.dict(settings.CONFIG_PARAMS, {'email_batch_size': '2'}):
+            num_sent = email_utils.send_queued_emails()
+        self.assertEqual(num_sent, 3)
+        self.assertEqual([len(x) for x in self.batches], [2, 1])
+        self.assertEqual(QueuedEmail.objects.filter(sent=True).count(), 3)
+        self.assertEqual(email_utils.send_queued_emails(), 0)
+
+    @mock.patch('helpers.email_utils.google_clients')
+    def test_admin_notifications_combined_into_digest(self, mock_google_clients):
+        service = self.mock_gmail(mock_google_clients)
+        for i in range(2):
+            email_utils.notify_admins('Job failed', 'Error')
+        email_utils.notify_admins('Something else', 'Warning')
+        email_utils.send_email('text', 'text', 'admin@example.com', 'Hello')
+        email_utils.send_queued_emails()
+
+        # the three notifications were one email, and the regular email another:
+        self.assertEqual([len(x) for x in self.batches], [2])
+        messages = [c[1]['body']['raw'] for c in service.users.return_value.messages.return_value.send.call_args_list]
+        digest = base64.urlsafe_b64decode(messages[0]).decode()
+        self.assertTrue('Notification digest (3 notifications)' in digest)
+        self.assertTrue('Error (2 times)' in digest)
+        self.assertEqual(QueuedEmail.objects.filter(sent=True).count(), 4)
+
+    @mock.patch('helpers.email_utils.google_clients')
+    def test_failed_sends_are_retried_with_backoff(self, mock_google_clients):
+        self.mock_gmail(mock_google_clients, failing_ids=['0'])
+        email_utils.send_email('text', 'text', 'user@example.com', 'Subject')
+        email_utils.send_queued_emails()
+        email = QueuedEmail.objects.get()
+        self.assertFalse(email.sent)
+        self.assertEqual(email.attempts, 1)
+        self.assertTrue(email.next_attempt > timezone.now() + datetime.timedelta(seconds=50))
+
+        # not retried before it is due:
+        self.assertEqual(email_utils.send_queued_emails(), 0)
+        self.assertEqual(len(self.batches), 1)
+
+        QueuedEmail.objects.update(next_attempt=timezone.now())
+        email_utils.send_queued_emails()
+        email = QueuedEmail.objects.get()
+        self.assertEqual(email.attempts, 2)
+        self.assertTrue(email.failed)
+
+
+class JinjaTemplateTestCase(TestCase):
+
+    def test_templates_compiled_once(self):
+        t1 = utils.get_jinja_template('email_templates/expiration_reminder.html')
+        t2 = utils.get_jinja_template(os.path.join(settings.BASE_DIR, 'email_templates', 'expiration_reminder.txt'))
+        self.assertIs(t1.environment, t2.environment)
+        self.assertIs(t1, utils.get_jinja_template('email_templates/expiration_reminder.html'))
+
+    def test_email_subject_read_once(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as fout:
+            fout.write('The subject\nother lines\n')
+            fout.flush()
+            self.assertEqual(utils.get_email_subject(fout.name), 'The subject')
+            with mock.patch('helpers.utils.open') as mock_open:
+                self.assertEqual(utils.get_email_subject(fout.name), 'The subject')
+                self.assertFalse(mock_open.called)
+
+
+class ConfigSnapshotTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.config_path = os.path.join(self.tmp_dir.name, 'test.cfg')
+        with open(self.config_path, 'w') as fout:
+            fout.write('[DEFAULT]\nA = 1\n[extra]\nB = 2\n')
+
+    def test_config_parsed_once_until_modified(self):
+        with mock.patch('helpers.utils.configparser', wraps=utils.configparser) as mock_configparser:
+            d1 = utils.load_config(self.config_path, ['extra'])
+            d1['a'] = 'changed by caller'
+            d2 = utils.load_config(self.config_path, ['extra'])
+            self.assertEqual(d2, {'a': '1', 'b': '2'})
+            self.assertEqual(mock_configparser.ConfigParser.call_count, 1)
+
+            with open(self.config_path, 'w') as fout:
+                fout.write('[DEFAULT]\nA = 10\n[extra]\nB = 2\n')
+            d3 = utils.load_config(self.config_path, ['extra'])
+            self.assertEqual(d3['a'], '10')
+            self.assertEqual(mock_configparser.ConfigParser.call_count, 2)
+
+    def test_current_zone_reloaded_when_changed(self):
+        stamp_path = os.path.join(self.tmp_dir.name, 'stamp')
+        with self.settings(RUNTIME_SETTINGS_STAMP=stamp_path):
+            zone_a = AvailableZones.objects.create(cloud_environment=settings.GOOGLE, zone='us-east1-b')
+            zone_b = AvailableZones.objects.create(cloud_environment=settings.GOOGLE, zone='us-west1-a')
+            CurrentZone.objects.create(zone=zone_a)
+            self.assertEqual(runtime_settings.get_current_zone().zone, 'us-east1-b')
+            with self.assertNumQueries(0):
+                runtime_settings.get_current_zone()
+
+            # the signal receivers touch the stamp file when the zone changes:
+            CurrentZone.objects.all().delete()
+            CurrentZone.objects.create(zone=zone_b)
+            self.assertTrue(os.path.exists(stamp_path))
+            self.assertEqual(runtime_settings.get_current_zone().zone, 'us-west1-a')
+
+            # another process changing the zone is only seen through the stamp file:
+            CurrentZone.objects.filter(zone=zone_b).update(zone=zone_a)
+            self.assertEqual(runtime_settings.get_current_zone().zone, 'us-west1-a')
+            os.utime(stamp_path, ns=(0, 0))
+            self.assertEqual(runtime_settings.get_current_zone().zone, 'us-east1-b')
+
 
 class ResourceRenamingTestCase(TestCase):
 
@@ -526,8 +780,8 @@ class ResourceRenamingTestCase(TestCase):
         self.assertEqual(response.status_code, 400)
 
 
-    @mock.patch('base.views.storage')
-    def test_normalizes_path(self, mock_storage):
+    @mock.patch('base.views.google_clients')
+    def test_normalizes_path(self, mock_google_clients):
         '''
         Tests cases where users put space in the name-- make them underscores
         '''
@@ -536,7 +790,7 @@ class ResourceRenamingTestCase(TestCase):
         mock_bucket.get_blob.return_value = mock.MagicMock()
         mock_bucket.rename_blob.return_value = None
         mock_storage_client.get_bucket.return_value = mock_bucket
-        mock_storage.Client.return_value = mock_storage_client
+        mock_google_clients.get_storage_client.return_value = mock_storage_client
 
         client = APIClient()
         client.login(email=settings.REGULAR_TEST_EMAIL, password='abcd123!')
@@ -597,8 +851,8 @@ class ResourceRenamingTestCase(TestCase):
         self.assertEqual(r.path, resource1.path)
 
 
-    @mock.patch('base.views.storage')
-    def test_successful_change(self, mock_storage):
+    @mock.patch('base.views.google_clients')
+    def test_successful_change(self, mock_google_clients):
         '''
         Tests that the database objects change appropriately
         ''' 
@@ -607,7 +861,7 @@ class ResourceRenamingTestCase(TestCase):
         mock_bucket.get_blob.return_value = mock.MagicMock()
         mock_bucket.rename_blob.return_value = None
         mock_storage_client.get_bucket.return_value = mock_bucket
-        mock_storage.Client.return_value = mock_storage_client
+        mock_google_clients.get_storage_client.return_value = mock_storage_client
 
         client = APIClient()
         client.login(email=settings.REGULAR_TEST_EMAIL, password='abcd123!')
@@ -16,7 +16,8 @@ from base.models import Resource, Organization
 from base.serializers import ResourceSerializer, OrganizationSerializer, TreeObjectSerializer
 from analysis.models import AnalysisProjectResource
 
-from google.cloud import storage
+from helpers import google_clients
+from helpers import storage_utils
 
 from rest_framework.views import APIView
 from django.http import JsonResponse
@@ -74,9 +75,9 @@ class FileRenameView(APIView):
             # this means we are OK-- the database did not have such a record-- go ahead and rename
             # need to rename the object in storage:
             
-            storage_client = storage.Client()
+            storage_client = google_clients.get_storage_client()
             try:
-                bucket = storage_client.get_bucket(current_bucketname)
+                bucket = storage_utils.get_bucket(current_bucketname, storage_client)
                 blob = bucket.get_blob(current_path.split('/')[-1])
                 bucket.rename_blob(blob, new_name)
             except Exception as ex:
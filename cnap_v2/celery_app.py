@@ -23,6 +23,22 @@ app.conf.beat_schedule = {
     'manage_file': {
         'task': 'manage_files',
         'schedule': crontab(hour=8, minute=15)
+    },
+    'reconcile_transfers': {
+        'task': 'reconcile_transfers',
+        'schedule': 600.0
+    },
+    'retry_deferred_downloads': {
+        'task': 'retry_deferred_downloads',
+        'schedule': 900.0
+    },
+    'send_queued_emails': {
+        'task': 'send_queued_emails',
+        'schedule': 30.0
+    },
+    'refill_bucket_pool': {
+        'task': 'refill_bucket_pool',
+        'schedule': 600.0
     }
 }
 
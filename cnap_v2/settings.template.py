@@ -191,6 +191,8 @@ GOOGLE = 'google'
 AWS = 'aws'
 GOOGLE_DRIVE = 'Google Drive'
 DROPBOX = 'Dropbox'
+BROWSER = 'Browser'
+URL = 'URL'
 WDL = 'wdl'
 PY_SUFFIX = '.py'
 ###############################################################################
@@ -207,6 +209,11 @@ PY_SUFFIX = '.py'
 
 additional_sections = [GOOGLE_DRIVE, DROPBOX]
 CONFIG_DIR = os.path.join(BASE_DIR, 'config')
+
+# settings kept in the database (e.g. the current zone) are cached by each process.
+# When they are changed, this file is touched, which tells the other processes
+# (e.g. the celery workers) to reload them.  See helpers/runtime_settings.py
+RUNTIME_SETTINGS_STAMP = os.path.join(CONFIG_DIR, '.runtime_settings_stamp')
 CONFIG_PARAMS = utils.read_general_config(os.path.join(CONFIG_DIR, 'general.cfg'), additional_sections)
 # the jinja templater makes booleans as True, False, which are interpreted as strings
 # thus, we need to cast them to booleans here.  Can't use bool(...) method since it evaluates
@@ -237,7 +244,9 @@ UPLOADER_CONFIG = {
     # header in the config file located at UPLOADER_CONFIG.CONFIG_PATH
     'UPLOAD_SOURCES' : [
         DROPBOX,
-        GOOGLE_DRIVE
+        GOOGLE_DRIVE,
+        BROWSER,
+        URL
     ]
 }
 
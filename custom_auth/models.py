@@ -1,15 +1,14 @@
 import uuid
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.base_user import AbstractBaseUser, BaseUserManager
 from django.contrib.auth.models import PermissionsMixin
 from django.utils.translation import ugettext_lazy as _
 from django.utils import timezone
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save
 from django.dispatch import receiver
 
-from helpers import storage_utils
-from base.models import CurrentZone
+from helpers import runtime_settings
 
 
 class CustomUserManager(BaseUserManager):
@@ -68,6 +67,16 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
         verbose_name = _('user')
         verbose_name_plural = _('users')
 
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            # a new user may claim a bucket from the pool (see assign_pooled_bucket).
+            # The claim and the insert are committed together, so a failed 
+            # insert leaves the bucket in the pool
+            with transaction.atomic(using=kwargs.get('using')):
+                super().save(*args, **kwargs)
+        else:
+            super().save(*args, **kwargs)
+
     def clean(self):
         super().clean()
         print('in clean....')
@@ -89,15 +98,74 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
         pass
 
 
+class PooledBucket(models.Model):
+    '''
+    A storage bucket which was created ahead of time (in the current region)
+    so that a new user does not have to wait for their bucket to be created.
+    The bucket is named as a user's bucket would be (<prefix>-<uuid>) and 
+    the user who claims it is given its UUID.  Claiming a bucket removes its row.
+    '''
+    bucket_uuid = models.UUIDField(unique=True, default=uuid.uuid4)
+    region = models.CharField(max_length=50)
+    created = models.DateTimeField(auto_now_add=True)
+
+
+def get_user_bucket_name(user_uuid):
+    '''
+    Returns the name of the bucket (without the gs:// prefix) for the given user UUID
+    '''
+    bucketname_with_prefix = '%s-%s' % (settings.CONFIG_PARAMS['storage_bucket_prefix'], str(user_uuid))
+    return bucketname_with_prefix[len(settings.CONFIG_PARAMS['google_storage_gs_prefix']):]
+
+
+def get_current_region():
+    '''
+    Returns the current region (e.g. "us-east1"), or None if the current zone is not set
+    '''
+    current_zone = runtime_settings.get_current_zone() # something like "us-east1-c"
+    if current_zone is None:
+        return None
+    return '-'.join(current_zone.zone.split('-')[:2])
+
+
+def claim_pooled_bucket(region):
+    '''
+    Claims one of the pre-created buckets in the region and returns its UUID,
+    or None if there are none available
+    '''
+    for pooled_bucket in PooledBucket.objects.filter(region=region).order_by('created')[:5]:
+        # another process may claim the same bucket, so only the one which
+        # actually deletes the row has claimed it
+        num_deleted, _ = PooledBucket.objects.filter(pk=pooled_bucket.pk).delete()
+        if num_deleted > 0:
+            return pooled_bucket.bucket_uuid
+    return None
+
+
+@receiver(pre_save, sender=CustomUser)
+def assign_pooled_bucket(sender, instance, raw=False, **kwargs):
+    '''
+    If there is a pool of pre-created buckets, a new user is given one of them
+    '''
+    if raw or not instance._state.adding:
+        return
+    if int(settings.CONFIG_PARAMS['user_bucket_pool_size']) > 0:
+        region = get_current_region()
+        bucket_uuid = claim_pooled_bucket(region) if region else None
+        if bucket_uuid is not None:
+            instance.user_uuid = bucket_uuid
+            instance.assigned_pooled_bucket = True
+
+
 @receiver(post_save, sender=CustomUser)
 def user_saved(sender, instance, created, **kwargs):
     '''
     Actions to take when any user is saved.
     '''
     if created:
-        user_instance = instance
-        bucketname_with_prefix = '%s-%s' % (settings.CONFIG_PARAMS['storage_bucket_prefix'], str(user_instance.user_uuid))
-        bucketname = bucketname_with_prefix[len(settings.CONFIG_PARAMS['google_storage_gs_prefix']):]
-        current_zone = CurrentZone.objects.all()[0] # something like "us-east1-c"
-        current_region = '-'.join(current_zone.zone.zone.split('-')[:2])
-        storage_utils.create_regional_bucket(bucketname, current_region)
+        # the user's bucket is created (or, if it came from the pool, labeled)
+        # asynchronously, once the user has been committed
+        from custom_auth import tasks as custom_auth_tasks
+        user_pk = instance.pk
+        from_pool = getattr(instance, 'assigned_pooled_bucket', False)
+        transaction.on_commit(lambda: custom_auth_tasks.provision_user_bucket.delay(user_pk, from_pool))
@@ -0,0 +1,100 @@
+import uuid
+
+import google
+from celery.decorators import task
+from django.conf import settings
+from django.contrib.auth import get_user_model
+
+from custom_auth.models import PooledBucket, get_user_bucket_name, get_current_region
+from helpers import storage_utils
+from helpers.email_utils import notify_admins
+
+# labels given to the buckets in the pool, and to users' buckets
+POOL_LABELS = {'cnap_bucket_pool': 'unassigned'}
+USER_LABEL = 'cnap_user'
+
+
+@task(name='provision_user_bucket')
+def provision_user_bucket(user_pk, from_pool):
+    '''
+    Sets up the storage bucket for a new user.  If the user was given a bucket 
+    from the pool (from_pool=True), it already exists and only needs to be 
+    labeled.  Otherwise (or if the pooled bucket is gone), it is created in 
+    the current region, unless it was already created (e.g. by an upload 
+    which arrived first).
+    '''
+    user = get_user_model().objects.get(pk=user_pk)
+    bucketname = get_user_bucket_name(user.user_uuid)
+    labels = {USER_LABEL: str(user.pk)}
+    if from_pool:
+        try:
+            bucket = storage_utils.get_bucket(bucketname)
+        except google.api_core.exceptions.NotFound:
+            print('Pooled bucket %s was not found.  Creating it.' % bucketname)
+            from_pool = False
+        else:
+            bucket.labels = labels
+            bucket.patch()
+    if not from_pool:
+        region = get_current_region()
+        if region is None:
+            notify_admins('Could not create a bucket for user %s since a current zone has not been set.' % user.email, 
+                'Error with bucket creation')
+            return
+        storage_utils.create_regional_bucket(bucketname, region, labels=labels, exist_ok=True)
+
+    if int(settings.CONFIG_PARAMS['user_bucket_pool_size']) > 0:
+        refill_bucket_pool.delay()
+
+
+@task(name='refill_bucket_pool')
+def refill_bucket_pool():
+    '''
+    Creates buckets in the current region until the pool has 
+    USER_BUCKET_POOL_SIZE of them.  Buckets left from a previous
+    region are removed.  Returns the number of buckets created.
+
+    Several of these may run at once (e.g. after a burst of new users), so
+    the pool is checked again for each bucket, and a run which overfilled
+    the pool removes the bucket it added.
+    '''
+    pool_size = int(settings.CONFIG_PARAMS['user_bucket_pool_size'])
+    region = get_current_region()
+    if region is None:
+        return 0
+
+    for pooled_bucket in PooledBucket.objects.exclude(region=region):
+        # as when claiming, only remove the bucket if we removed the row
+        num_deleted, _ = PooledBucket.objects.filter(pk=pooled_bucket.pk).delete()
+        if num_deleted > 0:
+            try:
+                storage_utils.delete_bucket(get_user_bucket_name(pooled_bucket.bucket_uuid))
+            except google.api_core.exceptions.GoogleAPICallError as ex:
+                print('Could not remove pooled bucket %s: %s' % (pooled_bucket.bucket_uuid, ex))
+
+    num_created = 0
+    for i in range(pool_size):
+        if PooledBucket.objects.filter(region=region).count() >= pool_size:
+            break
+        bucket_uuid = uuid.uuid4()
+        bucketname = get_user_bucket_name(bucket_uuid)
+        bucket = storage_utils.create_regional_bucket(bucketname, region, labels=POOL_LABELS)
+        if bucket is None:
+            # the admins were notified.  Try again the next time
+            break
+        pooled_bucket = PooledBucket.objects.create(bucket_uuid=bucket_uuid, region=region)
+
+        # if another run added a bucket in the meantime, only the first pool_size 
+        # rows (in the order they were added) are kept.  Each run removes its own.
+        kept_pks = PooledBucket.objects.filter(region=region).order_by('pk').values_list('pk', flat=True)[:pool_size]
+        if pooled_bucket.pk in list(kept_pks):
+            num_created += 1
+            continue
+        num_deleted, _ = PooledBucket.objects.filter(pk=pooled_bucket.pk).delete()
+        if num_deleted > 0:
+            try:
+                storage_utils.delete_bucket(bucketname)
+            except google.api_core.exceptions.GoogleAPICallError as ex:
+                print('Could not remove extra pooled bucket %s: %s' % (bucket_uuid, ex))
+        break
+    return num_created
@@ -1,9 +1,20 @@
+import uuid
+import unittest.mock as mock
+
 from django.test import TestCase
+from django.db import IntegrityError
 from rest_framework.test import APIClient
 from django.contrib.auth import get_user_model
 from django.urls import reverse
 from django.conf import settings
 
+from base.models import AvailableZones, CurrentZone
+from custom_auth import tasks
+from custom_auth.models import PooledBucket, user_saved, get_user_bucket_name
+from helpers import google_clients
+from helpers import testing
+from helpers import storage_utils
+
 def create_data(testcase_obj):
 
     # create two users-- one is admin, other is regular
@@ -171,3 +182,148 @@ class UserDeleteTestCase(TestCase):
         response = client.delete(url)  
         self.assertEqual(response.status_code, 403)
 
+
+
+class BucketProvisioningTestCase(TestCase):
+    '''
+    Tests that new users' buckets are created (or taken from the pool of 
+    pre-created buckets) in the background
+    '''
+    def setUp(self):
+        self.storage_client = testing.FakeStorageClient()
+        self.fake_clients = google_clients.use_fake_clients(storage=self.storage_client)
+        self.fake_clients.__enter__()
+        self.addCleanup(self.fake_clients.__exit__, None, None, None)
+        self.cache_patcher = mock.patch('helpers.storage_utils._bucket_cache', storage_utils.BucketCache(300, 100))
+        self.cache_patcher.start()
+        self.addCleanup(self.cache_patcher.stop)
+        self.config_patcher = mock.patch.dict(settings.CONFIG_PARAMS, {'user_bucket_pool_size': '2'})
+        self.config_patcher.start()
+        self.addCleanup(self.config_patcher.stop)
+
+        zone = AvailableZones.objects.create(cloud_environment=settings.GOOGLE, zone='us-east1-b')
+        CurrentZone.objects.create(zone=zone)
+
+    @mock.patch('custom_auth.models.transaction')
+    def test_user_creation_does_not_create_bucket(self, mock_transaction):
+        user = get_user_model().objects.create_user(email=settings.REGULAR_TEST_EMAIL, password='abcd123!')
+        user_saved(get_user_model(), user, True)
+        self.assertEqual(len(self.storage_client.buckets), 0)
+
+        # the bucket is created by a task, once the user has been saved:
+        with mock.patch('custom_auth.tasks.provision_user_bucket') as mock_provision:
+            on_commit_func = mock_transaction.on_commit.call_args[0][0]
+            on_commit_func()
+            mock_provision.delay.assert_called_with(user.pk, False)
+
+    @mock.patch('custom_auth.tasks.refill_bucket_pool.delay')
+    def test_bucket_created_for_user_without_pool(self, mock_refill_delay):
+        user = get_user_model().objects.create_user(email=settings.REGULAR_TEST_EMAIL, password='abcd123!')
+        tasks.provision_user_bucket(user.pk, False)
+        bucket = self.storage_client.get_bucket(get_user_bucket_name(user.user_uuid))
+        self.assertEqual(bucket.location, 'us-east1')
+        self.assertEqual(bucket.labels, {tasks.USER_LABEL: str(user.pk)})
+        self.assertTrue(mock_refill_delay.called)
+
+    @mock.patch('custom_auth.tasks.notify_admins')
+    @mock.patch('helpers.storage_utils.notify_admins')
+    @mock.patch('custom_auth.tasks.refill_bucket_pool.delay')
+    def test_existing_bucket_for_user_without_pool(self, mock_refill_delay, mock_notify, mock_task_notify):
+        '''
+        The user's bucket may already exist (e.g. created by an upload), which
+        is not an error.  It is given the user's label.
+        '''
+        user = get_user_model().objects.create_user(email=settings.REGULAR_TEST_EMAIL, password='abcd123!')
+        bucketname = get_user_bucket_name(user.user_uuid)
+        self.storage_client.create_bucket(bucketname)
+
+        tasks.provision_user_bucket(user.pk, False)
+        self.assertFalse(mock_notify.called)
+        self.assertFalse(mock_task_notify.called)
+        bucket = self.storage_client.get_bucket(bucketname)
+        self.assertEqual(bucket.labels, {tasks.USER_LABEL: str(user.pk)})
+
+    @mock.patch('custom_auth.tasks.refill_bucket_pool.delay')
+    def test_new_user_claims_pooled_bucket(self, mock_refill_delay):
+        self.assertEqual(tasks.refill_bucket_pool(), 2)
+        self.assertEqual(tasks.refill_bucket_pool(), 0)
+        self.assertEqual(len(self.storage_client.buckets), 2)
+        pooled_uuids = [x.bucket_uuid for x in PooledBucket.objects.all()]
+
+        user = get_user_model().objects.create_user(email=settings.REGULAR_TEST_EMAIL, password='abcd123!')
+        self.assertTrue(user.user_uuid in pooled_uuids)
+        self.assertEqual(PooledBucket.objects.count(), 1)
+
+        tasks.provision_user_bucket(user.pk, True)
+        self.assertEqual(len(self.storage_client.buckets), 2)
+        bucket = self.storage_client.get_bucket(get_user_bucket_name(user.user_uuid))
+        self.assertEqual(bucket.labels, {tasks.USER_LABEL: str(user.pk)})
+
+    @mock.patch('custom_auth.tasks.refill_bucket_pool.delay')
+    def test_failed_user_creation_keeps_pooled_bucket(self, mock_refill_delay):
+        '''
+        If the new user cannot be saved, the bucket it claimed stays in the pool
+        '''
+        tasks.refill_bucket_pool()
+        get_user_model().objects.create_user(email=settings.REGULAR_TEST_EMAIL, password='abcd123!')
+        self.assertEqual(PooledBucket.objects.count(), 1)
+
+        # the email is already taken:
+        with self.assertRaises(IntegrityError):
+            get_user_model().objects.create_user(email=settings.REGULAR_TEST_EMAIL, password='abcd123!')
+        self.assertEqual(PooledBucket.objects.count(), 1)
+
+    @mock.patch('custom_auth.tasks.refill_bucket_pool.delay')
+    def test_missing_pooled_bucket_is_created(self, mock_refill_delay):
+        '''
+        If the bucket the user was given from the pool no longer exists, 
+        it is created
+        '''
+        tasks.refill_bucket_pool()
+        user = get_user_model().objects.create_user(email=settings.REGULAR_TEST_EMAIL, password='abcd123!')
+        bucketname = get_user_bucket_name(user.user_uuid)
+        storage_utils.delete_bucket(bucketname)
+
+        tasks.provision_user_bucket(user.pk, True)
+        bucket = self.storage_client.get_bucket(bucketname)
+        self.assertEqual(bucket.location, 'us-east1')
+        self.assertEqual(bucket.labels, {tasks.USER_LABEL: str(user.pk)})
+
+    def test_concurrent_refill_does_not_overfill_pool(self):
+        '''
+        If another run fills the pool while a bucket is being created, the
+        extra bucket is removed
+        '''
+        original_create = storage_utils.create_regional_bucket
+
+        def create_and_fill(bucketname, region, labels=None, exist_ok=False):
+            # simulate a concurrent run filling the pool in the meantime:
+            for i in range(2 - PooledBucket.objects.count()):
+                bucket_uuid = uuid.uuid4()
+                original_create(get_user_bucket_name(bucket_uuid), region, labels=labels)
+                PooledBucket.objects.create(bucket_uuid=bucket_uuid, region=region)
+            return original_create(bucketname, region, labels=labels, exist_ok=exist_ok)
+
+        with mock.patch('custom_auth.tasks.storage_utils.create_regional_bucket', create_and_fill):
+            self.assertEqual(tasks.refill_bucket_pool(), 0)
+        self.assertEqual(PooledBucket.objects.count(), 2)
+        self.assertEqual(len(self.storage_client.buckets), 2)
+
+    def test_pool_moves_with_region(self):
+        tasks.refill_bucket_pool()
+        old_names = set(self.storage_client.buckets.keys())
+
+        CurrentZone.objects.all().delete()
+        zone = AvailableZones.objects.create(cloud_environment=settings.GOOGLE, zone='us-west1-a')
+        CurrentZone.objects.create(zone=zone)
+        self.assertEqual(tasks.refill_bucket_pool(), 2)
+
+        self.assertEqual(len(old_names.intersection(self.storage_client.buckets.keys())), 0)
+        self.assertEqual(set([b.location for b in self.storage_client.buckets.values()]), set(['us-west1']))
+        self.assertEqual(set(PooledBucket.objects.values_list('region', flat=True)), set(['us-west1']))
+
+    def test_no_pool_when_disabled(self):
+        with mock.patch.dict(settings.CONFIG_PARAMS, {'user_bucket_pool_size': '0'}):
+            self.assertEqual(tasks.refill_bucket_pool(), 0)
+            get_user_model().objects.create_user(email=settings.REGULAR_TEST_EMAIL, password='abcd123!')
+        self.assertEqual(len(self.storage_client.buckets), 0)
@@ -2,8 +2,12 @@ import traceback
 import datetime
 import os
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from celery.decorators import task
+from django.db.models import Q
 from django.db.utils import IntegrityError
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 from django.conf import settings
 
@@ -11,16 +15,25 @@ import google
 from google.cloud import storage
 
 from analysis.models import PendingWorkflow
-from base.models import Resource, CurrentZone
+from base.models import Resource, BucketImport
 from workflow_ingestion.ingest_workflow import ingest_main
 
 from helpers.email_utils import send_email
-from helpers.utils import get_jinja_template
+from helpers import google_clients
+from helpers import storage_utils
+from helpers import runtime_settings
+from helpers.utils import get_jinja_template, get_email_subject
 
 
 MAX_COPY_ATTEMPTS = 5
 SLEEP_PERIOD = 5 # seconds
 
+# the task running a bucket import refreshes its claim this often.  A claim
+# which has not been refreshed for IMPORT_CLAIM_SECONDS is considered abandoned
+# (e.g. the worker died) and a new request for the import may take it over
+IMPORT_HEARTBEAT_SECONDS = 60
+IMPORT_CLAIM_SECONDS = 600
+
 class BucketImportException(Exception):
     pass
 
@@ -56,16 +69,16 @@ def get_zone_as_string():
     '''
     Returns the current zone as a string
     '''
-    try:
-        current_zone = CurrentZone.objects.all()[0]
-        return current_zone.zone.zone
-    except IndexError:
+    current_zone = runtime_settings.get_current_zone()
+    if current_zone:
+        return current_zone.zone
+    else:
         message = 'A current zone has not set.  Please check that a single zone has been selected in the database'
         handle_exception(None, message=message)
         return None
 
 
-def do_google_copy(source_blob, destination_bucket, new_blob_name):
+def do_google_copy(source_blob, destination_bucket, new_blob_name, rewrite=False):
     '''
     Handles the "re-try" on the copy process for a bucket-to-bucket transfer
     within google
@@ -73,16 +86,29 @@ def do_google_copy(source_blob, destination_bucket, new_blob_name):
     source_blob is a google.cloud.storage.blob.Blob instance
     destination_bucket is a google.cloud.storage.bucket.Bucket instance
     new_blob_name is a string 
+
+    This is called from the threads of the import pool, so the objects are 
+    addressed with this thread's own storage client.  Copying between locations
+    can take longer than a single request allows, so in that case (rewrite=True)
+    we use the rewrite API, which copies in steps
     '''
+    storage_client = google_clients.get_storage_client()
+    source = storage_client.bucket(source_blob.bucket.name).blob(source_blob.name)
+    destination = storage_client.bucket(destination_bucket.name).blob(new_blob_name)
     copied = False
     attempts = 0
     while ((not copied) and (attempts < MAX_COPY_ATTEMPTS)):
         try:
-            print('Copy %s to %s/%s' % (source_blob, destination_bucket.name, new_blob_name))
-            destination_bucket.copy_blob(source_blob, \
-                destination_bucket, \
-                new_name=new_blob_name \
-            )
+            print('Copy %s to %s/%s' % (source_blob.name, destination_bucket.name, new_blob_name))
+            if rewrite:
+                token, bytes_rewritten, total_bytes = destination.rewrite(source)
+                while token is not None:
+                    token, bytes_rewritten, total_bytes = destination.rewrite(source, token=token)
+            else:
+                storage_client.bucket(source_blob.bucket.name).copy_blob(source, \
+                    storage_client.bucket(destination_bucket.name), \
+                    new_name=new_blob_name \
+                )
             copied = True
         except Exception as ex:
             print('Copy failed.  Sleep and try again.')
@@ -102,24 +128,11 @@ def do_google_copy(source_blob, destination_bucket, new_blob_name):
     else:
         return os.path.join(destination_bucket.name, new_blob_name)
 
-@task(name='transfer_google_bucket')
-def transfer_google_bucket(admin_pk, bucket_user_pk, client_bucket_name):
-    '''
-    Copies files from the provided bucket into the user's bucket.
-    Then adds the copied files to the CNAP database
-
-    Used in situations where a user has files already in a Google bucket.  This 
-    gets copied to our own storage and auto-added to the user's Resources.
 
-    Note that this function assumes the bucket can already be accessed.
+def get_import_destination_bucket(user, storage_client):
+    '''
+    Returns the user's bucket, which is where imported files are copied
     '''
-    storage_client = storage.Client()
-
-    # get the user object.  This is the person who will eventually
-    # 'own' the files. It was previously verified to be a valid PK
-    user = get_user_model().objects.get(pk=bucket_user_pk)
-
-    # get the destination bucket (to where we are moving the files)
     destination_bucket_prefix = settings.CONFIG_PARAMS[ \
         'storage_bucket_prefix' \
         ][len(settings.CONFIG_PARAMS['google_storage_gs_prefix']):]
@@ -128,7 +141,7 @@ def transfer_google_bucket(admin_pk, bucket_user_pk, client_bucket_name):
     # typically this bucket would already exist due to a previous upload, but 
     # we create the bucket if it does not exist 
     try:
-        destination_bucket = storage_client.get_bucket(destination_bucket_name)
+        destination_bucket = storage_utils.get_bucket(destination_bucket_name, storage_client)
         print('Destination bucket at %s existed.' % destination_bucket_name)
     except google.api_core.exceptions.NotFound:
         b = storage.Bucket(destination_bucket_name)
@@ -137,51 +150,307 @@ def transfer_google_bucket(admin_pk, bucket_user_pk, client_bucket_name):
         # if zone_str was None, b.location=None, which is the default (and the created bucket is multi-regional)
         if zone_str:
             b.location = '-'.join(zone_str.split('-')[:-1]) # e.g. makes 'us-east4-c' into 'us-east4'
-        destination_bucket = storage_client.create_bucket(b)
+        destination_bucket = storage_utils.create_bucket(b, storage_client, exist_ok=True)
+    return destination_bucket
+
+
+def blob_fingerprint(blob):
+    '''
+    Used to decide whether an object at the destination is the same file as
+    the one we are importing.  Composite objects do not have an MD5 hash, so 
+    we fall back to the CRC32C checksum
+    '''
+    return (blob.size, blob.md5_hash or blob.crc32c)
 
-    # get a list of the names of the files within the destination bucket.
-    # This is how we will check against overwriting.
-    destination_bucket_objects = [x.name for x in list(destination_bucket.list_blobs())]
 
-    # Now iterate through the files we are transferring:
-    blobs = storage_client.list_blobs(client_bucket_name)
-    failed_filepaths = []
+def list_blob_page(storage_client, bucket_name, page_token, page_size):
+    '''
+    Returns a single page of the bucket listing (a list of blobs) and the 
+    token for the following page, which is None for the last page.
+    '''
+    iterator = storage_client.list_blobs(bucket_name, 
+        max_results=page_size, 
+        page_token=page_token or None
+    )
+    blobs = list(iterator)
+    return blobs, iterator.next_page_token
+
+
+def build_import_index(destination_bucket, storage_client):
+    '''
+    Returns a dict of the objects in the user's uploads folder, mapping the
+    object name to its fingerprint.  This is how we check against 
+    overwriting, and how we recognize files copied by an interrupted import.
+    '''
+    prefix = settings.CONFIG_PARAMS['uploads_folder_name'] + '/'
+    index = {}
+    for blob in storage_client.list_blobs(destination_bucket.name, prefix=prefix):
+        index[blob.name] = blob_fingerprint(blob)
+    return index
+
+
+def register_imported_resources(imported, user, batch_size):
+    '''
+    Adds Resources for the imported files, which are given as a list of
+    (path, size) tuples.  Paths which already have an active Resource (e.g.
+    a file which was already uploaded previously, or registered before an 
+    interrupted import) are skipped.  Returns the Resources which were added.
+    '''
+    paths = [path for path, size in imported]
+    existing = {}
+    for i in range(0, len(paths), batch_size):
+        for resource in Resource.objects.filter(path__in=paths[i:i+batch_size]):
+            existing[resource.path] = resource
+
+    # bulk_create does not call save(), so we set the expiration date here
+    expiration_date = datetime.date.today() + settings.EXPIRATION_PERIOD
+    new_resources = []
+    reused_resources = []
+    for path, size in imported:
+        resource = existing.get(path)
+        if resource is None:
+            resource = Resource(
+                source = 'google_bucket',
+                path=path,
+                size=size,
+                name=os.path.basename(path),
+                owner=user,
+                expiration_date=expiration_date
+            )
+            existing[path] = resource
+            new_resources.append(resource)
+        elif not resource.is_active:
+            # e.g. an expired file or an upload which did not complete.  Paths
+            # are unique, so the imported file takes over that Resource
+            resource.source = 'google_bucket'
+            resource.source_path = ''
+            resource.size = size
+            resource.name = os.path.basename(path)
+            resource.owner = user
+            resource.is_active = True
+            resource.originated_from_upload = False
+            resource.expiration_date = expiration_date
+            resource.total_downloads = 0
+            resource.file_deleted = False
+            resource.save()
+            reused_resources.append(resource)
+    Resource.objects.bulk_create(new_resources, batch_size=batch_size)
+    return new_resources + reused_resources
+
+
+def import_blob_page(blobs, destination_bucket, index, rewrite, executor):
+    '''
+    Starts copies for a page of the source bucket.  The copies themselves
+    are run by the thread pool (executor); this function only decides what
+    to do with each blob and returns a list of (blob, target path, future)
+    tuples (where future is None if there is nothing to copy) along with
+    the paths of conflicting files.
+
+    The index is updated as new names are claimed, so two source files which
+    have the same name do not both end up at the same path.
+    '''
+    gs_prefix = settings.CONFIG_PARAMS['google_storage_gs_prefix']
+    pending = []
+    conflicts = []
     for source_blob in blobs:
         basename = os.path.basename(source_blob.name)
+        if not basename:
+            # a "directory" placeholder
+            continue
         new_blob_name = os.path.join(settings.CONFIG_PARAMS['uploads_folder_name'], basename)
-        target_path = settings.CONFIG_PARAMS['google_storage_gs_prefix'] + os.path.join(destination_bucket.name, new_blob_name)
+        target_path = gs_prefix + os.path.join(destination_bucket.name, new_blob_name)
 
-        # we do NOT want to overwrite.  We check the destination bucket to see if the file is there.
-        # If we find it, we consider that a "failure" and will report it to the admins
-        if new_blob_name in destination_bucket_objects:
-            failed_filepaths.append(target_path)
+        fingerprint = blob_fingerprint(source_blob)
+        existing_fingerprint = index.get(new_blob_name)
+        if existing_fingerprint is None:
+            index[new_blob_name] = fingerprint
+            future = executor.submit(do_google_copy, source_blob, destination_bucket, new_blob_name, rewrite)
+            pending.append((source_blob, target_path, future))
+        elif existing_fingerprint == fingerprint:
+            # the same file is already there (e.g. copied before this import
+            # was interrupted), so we only need to register it
+            pending.append((source_blob, target_path, None))
         else:
-            p = do_google_copy(source_blob, destination_bucket, new_blob_name)
-    
-        # now register the resources to this user:
-        try:
-            Resource.objects.create(
-                source = 'google_bucket',
-                path=target_path,
-                size=source_blob.size,
-                name = basename,
-                owner=user,
-            )
-        except IntegrityError as ex:
-            # OK to pass, because regardless of whether the file was in the bucket
-            # previously, we acknowledge it now and need it to be in the db.
-            pass
+            # we do NOT want to overwrite.  This is a "failure" which will be
+            # reported to the admins
+            conflicts.append(target_path)
+    return pending, conflicts
 
 
-    # done.  Inform the admin user:
+def append_paths(existing, paths):
+    return '\n'.join([x for x in existing.split('\n') if x] + paths)
+
+
+def claim_bucket_import(bucket_import):
+    '''
+    Claims the import for this task, so that a second request for the same 
+    import does not run alongside it.  Returns the claim, or None if another 
+    task holds a claim which is still being refreshed.
+    '''
+    claim = str(uuid.uuid4())
+    now = timezone.now()
+    stale_time = now - datetime.timedelta(seconds=IMPORT_CLAIM_SECONDS)
+    claimed = BucketImport.objects.filter(Q(heartbeat__isnull=True) | Q(heartbeat__lt=stale_time),
+        pk=bucket_import.pk,
+        completed=False
+    ).update(claim=claim, heartbeat=now)
+    if claimed == 0:
+        return None
+    bucket_import.claim = claim
+    bucket_import.heartbeat = now
+    return claim
+
+
+def save_bucket_import(bucket_import, fields):
+    '''
+    Saves the given fields of the import (and refreshes the heartbeat), provided
+    this task still holds the claim.  Returns False if the claim was lost, in
+    which case nothing is saved.
+    '''
+    bucket_import.heartbeat = timezone.now()
+    values = {f: getattr(bucket_import, f) for f in fields + ['heartbeat']}
+    updated = BucketImport.objects.filter(pk=bucket_import.pk, 
+        claim=bucket_import.claim
+    ).update(**values)
+    return updated > 0
+
+
+def release_bucket_import(bucket_import):
+    '''
+    Gives up the claim (e.g. when the import failed), so the import may be 
+    requested again right away
+    '''
+    BucketImport.objects.filter(pk=bucket_import.pk, 
+        claim=bucket_import.claim
+    ).update(claim='', heartbeat=None)
+
+
+@task(name='transfer_google_bucket')
+def transfer_google_bucket(admin_pk, bucket_user_pk, client_bucket_name):
+    '''
+    Copies files from the provided bucket into the user's bucket.
+    Then adds the copied files to the CNAP database
+
+    Used in situations where a user has files already in a Google bucket.  This 
+    gets copied to our own storage and auto-added to the user's Resources.
+
+    Note that this function assumes the bucket can already be accessed.
+
+    The source bucket is listed one page at a time.  While the copies for one
+    page run in a thread pool, the next page is fetched.  Once all the copies
+    for a page have finished, the Resources are added and the position in the
+    listing is saved (in a BucketImport).  If the import is interrupted, 
+    it may be requested again and it continues from the last saved page.
+
+    Only one task runs a given import at a time: the task claims the 
+    BucketImport and refreshes the claim while it works (see claim_bucket_import).
+    '''
+    storage_client = google_clients.get_storage_client()
+
+    # get the user object.  This is the person who will eventually
+    # 'own' the files. It was previously verified to be a valid PK
+    user = get_user_model().objects.get(pk=bucket_user_pk)
     admin_user = get_user_model().objects.get(pk=admin_pk)
-    email_address = admin_user.email
-    context = {'original_bucket': client_bucket_name, 'failed_paths': failed_filepaths}
+
+    bucket_import, created = BucketImport.objects.get_or_create(owner=user,
+        source_bucket=client_bucket_name,
+        completed=False,
+        defaults={'admin': admin_user}
+    )
+
+    # get the destination bucket (to where we are moving the files)
+    destination_bucket = get_import_destination_bucket(user, storage_client)
+
+    # copies between locations use the rewrite API.  If we cannot read the
+    # location of the source bucket, we assume it is elsewhere.
+    try:
+        source_bucket = storage_utils.lookup_bucket(client_bucket_name, storage_client)
+        source_location = source_bucket.location if source_bucket else None
+    except google.api_core.exceptions.GoogleAPICallError:
+        source_location = None
+    rewrite = (source_location is None) or (destination_bucket.location is None) \
+        or (source_location.upper() != destination_bucket.location.upper())
+
+    if claim_bucket_import(bucket_import) is None:
+        print('The import of %s is already running.  Skipping.' % client_bucket_name)
+        return
+    if not created:
+        print('Resuming import of %s (%d files imported so far)' % (client_bucket_name, bucket_import.objects_imported))
+
+    page_size = int(settings.CONFIG_PARAMS['bucket_import_page_size'])
+    batch_size = int(settings.CONFIG_PARAMS['bucket_import_batch_size'])
+    num_workers = int(settings.CONFIG_PARAMS['bucket_import_workers'])
+
+    progress_fields = ['page_token', 'objects_imported', 'bytes_imported', 'conflicting_paths', 'failed_paths']
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    try:
+        index = build_import_index(destination_bucket, storage_client)
+        blobs, next_page_token = list_blob_page(storage_client, client_bucket_name, bucket_import.page_token, page_size)
+        while True:
+            pending, conflicts = import_blob_page(blobs, destination_bucket, index, rewrite, executor)
+
+            # fetch the following page while the copies are running:
+            if next_page_token:
+                next_blobs, following_page_token = list_blob_page(storage_client, client_bucket_name, next_page_token, page_size)
+
+            imported = []
+            failures = []
+            last_heartbeat = time.time()
+            for source_blob, target_path, future in pending:
+                if future is not None:
+                    try:
+                        future.result()
+                    except BucketImportException:
+                        failures.append(target_path)
+                        continue
+                imported.append((target_path, source_blob.size))
+
+                # copies can take a while, so keep the claim fresh as they finish
+                if time.time() - last_heartbeat > IMPORT_HEARTBEAT_SECONDS:
+                    if not save_bucket_import(bucket_import, []):
+                        print('Lost the claim on the import of %s.  Stopping.' % client_bucket_name)
+                        return
+                    last_heartbeat = time.time()
+
+            # on a resume, files of this page may have been registered
+            # already, so only those added now count toward the totals
+            new_resources = register_imported_resources(imported, user, batch_size)
+
+            # the page is complete, so save the position.  
+            bucket_import.page_token = next_page_token or ''
+            bucket_import.objects_imported += len(new_resources)
+            bucket_import.bytes_imported += sum([r.size or 0 for r in new_resources])
+            bucket_import.conflicting_paths = append_paths(bucket_import.conflicting_paths, conflicts)
+            bucket_import.failed_paths = append_paths(bucket_import.failed_paths, failures)
+            if not save_bucket_import(bucket_import, progress_fields):
+                print('Lost the claim on the import of %s.  Stopping.' % client_bucket_name)
+                return
+
+            if not next_page_token:
+                break
+            blobs, next_page_token = next_blobs, following_page_token
+    except Exception:
+        release_bucket_import(bucket_import)
+        raise
+    finally:
+        executor.shutdown(wait=True)
+
+    bucket_import.completed = True
+    bucket_import.finish_time = datetime.datetime.now()
+    bucket_import.claim = ''
+    bucket_import.heartbeat = None
+    bucket_import.save()
+
+    # done.  Inform the admin user:
+    email_address = bucket_import.admin.email
+    context = {'original_bucket': client_bucket_name, 
+        'failed_paths': [x for x in bucket_import.conflicting_paths.split('\n') if x],
+        'copy_failures': [x for x in bucket_import.failed_paths.split('\n') if x]
+    }
     email_template = get_jinja_template('email_templates/bucket_transfer_success.html')
     email_html = email_template.render(context)
     email_plaintxt_template = get_jinja_template('email_templates/bucket_transfer_success.txt')
     email_plaintxt = email_plaintxt_template.render(context)
-    email_subject = open('email_templates/bucket_transfer_success_subject.txt').readline().strip()
+    email_subject = get_email_subject('email_templates/bucket_transfer_success_subject.txt')
     send_email(email_plaintxt, email_html, email_address, email_subject)
 
-
@@ -1,9 +1,17 @@
+import datetime
+import unittest.mock as mock
+
 from django.test import TestCase
 from django.conf import settings
 from django.http import HttpResponseForbidden, JsonResponse, HttpResponseNotAllowed
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 
 
+from base.models import Resource, BucketImport
+from helpers import google_clients
+from helpers import testing
+from . import tasks as dashboard_tasks
 from .tasks import transfer_google_bucket
 from .views import import_bucket
 
@@ -39,7 +47,7 @@ class TestGoogleBucketImport(TestCase):
         }
         r = import_bucket(request)
         self.assertTrue(type(r) is JsonResponse)
-        self.assertTrue(r.status == 400)
+        self.assertEqual(r.status_code, 400)
 
 
     def test_bad_user_pk_returns400(self):
@@ -58,14 +66,22 @@ class TestGoogleBucketImport(TestCase):
         }
         r = import_bucket(request)
         self.assertTrue(type(r) is JsonResponse)
-        self.assertTrue(r.status == 400)
+        self.assertEqual(r.status_code, 400)
 
 
     def test_bad_payload_returns400(self):
         '''
         The payload does not include the "bucket_url key
         '''
-        pass
+        request = Request()
+        request.user = self.admin_user
+        request.method = 'POST'
+        request.POST = {
+            'bucket_user': self.regular_user.pk
+        }
+        r = import_bucket(request)
+        self.assertTrue(type(r) is JsonResponse)
+        self.assertEqual(r.status_code, 400)
 
     def test_nonadmin_request_is_denied(self):
         '''
@@ -98,171 +114,272 @@ class TestGoogleBucketImport(TestCase):
         '''
         pass
 
-    @mock.patch('dashboard.tasks.get_zone_as_string')
-    @mock.patch('dashboard.tasks.send_email')
-    @mock.patch('dashboard.tasks.do_google_copy')
-    @mock.patch('analysis.tasks.storage')
-    def test_user_bucket_created_if_not_existing(self, 
-        mock_storage, mock_copy, mock_email_send, mock_zone_as_str):
+    def make_source_bucket(self, names, location=None):
+        '''
+        Creates the bucket (in the fake storage) we are importing from.  
+        Each file's content is its name.
+        '''
+        bucket = self.storage_client.create_bucket('junk')
+        bucket.location = location
+        for name in names:
+            bucket.blob(name).upload_from_string(name)
+        return bucket
+
+    def user_bucket_name(self):
+        prefix = settings.CONFIG_PARAMS['storage_bucket_prefix'][len(settings.CONFIG_PARAMS['google_storage_gs_prefix']):]
+        return '%s-%s' % (prefix, str(self.regular_user.user_uuid))
+
+    def run_import(self):
+        with mock.patch('dashboard.tasks.google_clients') as mock_google_clients, \
+            mock.patch('dashboard.tasks.send_email') as mock_email_send, \
+            mock.patch('dashboard.tasks.get_zone_as_string') as mock_zone_as_str:
+            mock_google_clients.get_storage_client.return_value = self.storage_client
+            mock_zone_as_str.return_value = 'us-east4-c'
+            transfer_google_bucket(self.admin_user.pk, 
+                self.regular_user.pk, 
+                'junk'
+            )
+            self.assertTrue(mock_email_send.called)
+            return mock_email_send
+
+    def setup_import_config(self):
+        self.storage_client = testing.FakeStorageClient()
+        self.config_patcher = mock.patch.dict(settings.CONFIG_PARAMS, {
+            'bucket_import_page_size': '2',
+            'bucket_import_workers': '2',
+            'bucket_import_batch_size': '2'
+        })
+        self.config_patcher.start()
+        self.addCleanup(self.config_patcher.stop)
+
+    def test_user_bucket_created_if_not_existing(self):
         '''
         We are effectively adding files for a user.  If that user does not
         already have a bucket, test that we create one here.
         '''
-        import google
-
-        mock_client = mock.MagicMock()
-        mock_storage.Client.return_value = mock_client
-
-        mock_dest_bucket = mock.MagicMock()
-        mock_get_bucket = mock.MagicMock()
-        mock_get_bucket.side_effect=google.api_core.exceptions.NotFound()
-        mock_client.get_bucket = mock_get_bucket
-        mock_client.create_bucket.return_value = mock_dest_bucket
-
-        # the mock storage bucket we will create
-        mock_bucket_create = mock.MagicMock()
-        mock_storage.Bucket.return_value = mock_bucket_create
-        mock_zone_as_str.return_value = 'junk-zone'
-
-        
-        # mock_blobs will represent the files we are transferring
-        mock_blob1 = mock.MagicMock()
-        mock_blob1.name = 'something.txt'
-        mock_blob2 = mock.MagicMock()
-        mock_blob2.name = 'baz.txt'
-        mock_blobs = [mock_blob1, mock_blob2]
-        mock_client.list_blobs.return_value = mock_blobs
+        self.setup_import_config()
+        self.make_source_bucket(['something.txt', 'baz.txt'])
 
         # confirm that we have no initial Resources in the database:
-        # Note that even though we are mocking adding to a bucket
-        # that already has some files, we don't care whether those
-        # are in the database or not.  All we care is that the new
-        # resource is added.
         existing_resources = Resource.objects.all()
         self.assertTrue(len(existing_resources) == 0)
 
-        # call the function we are testing:
-        transfer_google_bucket(self.admin_user.pk, 
-            self.regular_user.pk, 
-            'junk'
-        ):
-        self.assertTrue(mock_copy.call_count == 2)
-        self.assertTrue(mock_email_send.called)
+        self.run_import()
+
+        user_bucket = self.storage_client.get_bucket(self.user_bucket_name())
+        self.assertEqual(user_bucket.location, 'us-east4')
+        uploads_folder = settings.CONFIG_PARAMS['uploads_folder_name']
+        self.assertEqual(sorted(user_bucket.blobs.keys()), 
+            ['%s/baz.txt' % uploads_folder, '%s/something.txt' % uploads_folder])
 
-        # check that we created a Resource for the
-        # file that was not already there
         existing_resources = Resource.objects.all()
         self.assertTrue(len(existing_resources) == 2)
+        self.assertTrue(all([r.expiration_date is not None for r in existing_resources]))
 
-    @mock.patch('dashboard.tasks.send_email')
     @mock.patch('dashboard.tasks.do_google_copy')
-    @mock.patch('analysis.tasks.storage')
-    def test_calls_copy_and_adds_resources(self, 
-        mock_storage, mock_copy, mock_email_send):
+    def test_calls_copy_and_adds_resources(self, mock_copy):
         '''
         By mocking out the blobs that are in another bucket, check that
         the proper calls are made to the copy function, the resources
-        are added to the database, and the email is sent
+        are added to the database, and the progress is saved.  There are 
+        5 files, so the listing is 3 pages.
         '''
-        uploads_folder = settings.CONFIG_PARAMS['uploads_folder_name']
-        class SimpleObject(object):
-            def __init__(self, name):
-                self.name = name
-
-        mock_client = mock.MagicMock()
-        mock_storage.Client.return_value = mock_client
-
-        mock_dest_bucket = mock.MagicMock()
-        mock_dest_bucket.list_blobs.return_value = [
-            SimpleObject('%s/foo.txt' % uploads_folder),
-            SimpleObject('%s/bar.txt' % uploads_folder)
-        ]
-        mock_get_bucket = mock.MagicMock(side_effect=[mock_dest_bucket, ])
-        mock_client.get_bucket = mock_get_bucket
-        
-        # mock_blobs will represent the files we are transferring
-        mock_blob1 = mock.MagicMock()
-        mock_blob1.name = 'something.txt'
-        mock_blob2 = mock.MagicMock()
-        mock_blob2.name = 'baz.txt'
-        mock_blobs = [mock_blob1, mock_blob2]
-        mock_client.list_blobs.return_value = mock_blobs
-
-        # confirm that we have no initial Resources in the database:
-        # Note that even though we are mocking adding to a bucket
-        # that already has some files, we don't care whether those
-        # are in the database or not.  All we care is that the new
-        # resource is added.
-        existing_resources = Resource.objects.all()
-        self.assertTrue(len(existing_resources) == 0)
+        self.setup_import_config()
+        names = ['a.txt', 'dir/b.txt', 'dir/c.txt', 'd.txt', 'e.txt']
+        self.make_source_bucket(names, location='US-EAST4')
 
-        # call the function we are testing:
-        transfer_google_bucket(self.admin_user.pk, 
-            self.regular_user.pk, 
-            'junk'
-        ):
-        self.assertTrue(mock_copy.call_count == 2)
-        self.assertTrue(mock_email_send.called)
+        self.run_import()
+        self.assertEqual(mock_copy.call_count, 5)
+        # source and destination are in the same location, so no rewrite:
+        self.assertFalse(any([c[0][3] for c in mock_copy.call_args_list]))
 
-        # check that we created a Resource for the
-        # file that was not already there
         existing_resources = Resource.objects.all()
-        self.assertTrue(len(existing_resources) == 2)
+        self.assertEqual(sorted([r.name for r in existing_resources]), 
+            ['a.txt', 'b.txt', 'c.txt', 'd.txt', 'e.txt'])
 
+        bucket_import = BucketImport.objects.get(source_bucket='junk')
+        self.assertTrue(bucket_import.completed)
+        self.assertEqual(bucket_import.objects_imported, 5)
+        self.assertEqual(bucket_import.bytes_imported, sum([len(x) for x in names]))
+        self.assertEqual(bucket_import.page_token, '')
 
-    @mock.patch('dashboard.tasks.send_email')
-    @mock.patch('dashboard.tasks.do_google_copy')
-    @mock.patch('analysis.tasks.storage')
-    def test_avoids_overwrite(self, mock_storage, 
-        mock_copy, 
-        mock_email_send):
+    def test_avoids_overwrite(self):
         '''
         Each time we copy a file, we are checking to see if a file of the same
         name already exists at the destination.  If it does, we do NOT transfer
         so we do not overwrite.  In that case, we want to ensure that the copy
-        function is not called and that we add this entry to the "failed" paths
+        function is not called and that we add this entry to the "failed" paths.
+        Two source files with the same name are also not copied to the same path.
         '''
+        self.setup_import_config()
         uploads_folder = settings.CONFIG_PARAMS['uploads_folder_name']
-        class SimpleObject(object):
-            def __init__(self, name):
-                self.name = name
-
-        mock_client = mock.MagicMock()
-        mock_storage.Client.return_value = mock_client
-
-        mock_dest_bucket = mock.MagicMock()
-        mock_dest_bucket.list_blobs.return_value = [
-            SimpleObject('%s/foo.txt' % uploads_folder),
-            SimpleObject('%s/bar.txt' % uploads_folder)
-        ]
-        mock_get_bucket = mock.MagicMock(side_effect=[mock_dest_bucket, ])
-        mock_client.get_bucket = mock_get_bucket
-        
-        # mock_blobs will represent the files we are transferring
-        mock_blob1 = mock.MagicMock()
-        mock_blob1.name = 'something.txt'
-        mock_blob2 = mock.MagicMock()
-        mock_blob2.name = 'foo.txt' # this will end up matching an "existing file"
-        mock_blobs = [mock_blob1, mock_blob2]
-        mock_client.list_blobs.return_value = mock_blobs
-
-        # confirm that we have no initial Resources in the database:
-        existing_resources = Resource.objects.all()
-        self.assertTrue(len(existing_resources) == 0)
+        user_bucket = self.storage_client.create_bucket(self.user_bucket_name())
+        user_bucket.blob('%s/foo.txt' % uploads_folder).upload_from_string('original')
+        self.make_source_bucket(['something.txt', 'foo.txt', 'dir/something.txt'])
 
-        # call the function we are testing:
-        transfer_google_bucket(self.admin_user.pk, 
-            self.regular_user.pk, 
-            'junk'
-        ):
-        self.assertTrue(mock_copy.call_count == 1)
-        self.assertTrue(mock_email_send.called)
+        mock_email_send = self.run_import()
 
-        # check that we created a Resource for the
-        # file that was not already there
         existing_resources = Resource.objects.all()
         self.assertTrue(len(existing_resources) == 1)
         self.assertTrue(existing_resources[0].name == 'something.txt')
+        self.assertEqual(user_bucket.get_blob('%s/foo.txt' % uploads_folder).download_as_string(), b'original')
+        self.assertEqual(user_bucket.get_blob('%s/something.txt' % uploads_folder).download_as_string(), b'dir/something.txt')
+
+        bucket_import = BucketImport.objects.get(source_bucket='junk')
+        self.assertEqual(len(bucket_import.conflicting_paths.split('\n')), 2)
+        email_plaintxt = mock_email_send.call_args[0][0]
+        self.assertTrue('gs://%s/%s/foo.txt' % (self.user_bucket_name(), uploads_folder) in email_plaintxt)
+
+    def test_interrupted_import_resumes(self):
+        '''
+        An import which failed partway through continues from the last saved 
+        page, and files copied before the interruption are registered without
+        being copied again or reported as conflicts
+        '''
+        self.setup_import_config()
+        self.make_source_bucket(['a.txt', 'b.txt', 'c.txt', 'd.txt'])
+
+        # the second page fails after c.txt and d.txt have been copied
+        register = dashboard_tasks.register_imported_resources
+        calls = []
+        def interrupt_second_page(*args):
+            calls.append(args)
+            if len(calls) == 2:
+                raise Exception('interrupted')
+            return register(*args)
+        with mock.patch('dashboard.tasks.register_imported_resources', side_effect=interrupt_second_page):
+            with self.assertRaises(Exception):
+                self.run_import()
+
+        bucket_import = BucketImport.objects.get(source_bucket='junk')
+        self.assertFalse(bucket_import.completed)
+        self.assertEqual(bucket_import.page_token, 'c.txt')
+
+        with mock.patch('dashboard.tasks.do_google_copy', wraps=dashboard_tasks.do_google_copy) as mock_copy:
+            self.run_import()
+        self.assertEqual(mock_copy.call_count, 0)
+        self.assertEqual(BucketImport.objects.count(), 1)
+        bucket_import = BucketImport.objects.get(source_bucket='junk')
+        self.assertTrue(bucket_import.completed)
+        self.assertEqual(bucket_import.conflicting_paths, '')
+        self.assertEqual(sorted([r.name for r in Resource.objects.all()]), ['a.txt', 'b.txt', 'c.txt', 'd.txt'])
+
+    def make_claimed_import(self, heartbeat):
+        '''
+        Creates an import which another task has claimed, last refreshing
+        the claim at the given time
+        '''
+        return BucketImport.objects.create(owner=self.regular_user,
+            admin=self.admin_user,
+            source_bucket='junk',
+            claim='another-task',
+            heartbeat=heartbeat
+        )
+
+    def test_running_import_is_not_run_twice(self):
+        '''
+        If the import is requested again while a task is still working on it
+        (its claim is fresh), the second request does nothing
+        '''
+        self.setup_import_config()
+        self.make_source_bucket(['a.txt', 'b.txt'])
+        self.make_claimed_import(timezone.now())
+
+        with mock.patch('dashboard.tasks.google_clients') as mock_google_clients, \
+            mock.patch('dashboard.tasks.send_email') as mock_email_send, \
+            mock.patch('dashboard.tasks.do_google_copy') as mock_copy, \
+            mock.patch('dashboard.tasks.get_zone_as_string') as mock_zone_as_str:
+            mock_google_clients.get_storage_client.return_value = self.storage_client
+            mock_zone_as_str.return_value = 'us-east4-c'
+            transfer_google_bucket(self.admin_user.pk, self.regular_user.pk, 'junk')
+            self.assertFalse(mock_copy.called)
+            self.assertFalse(mock_email_send.called)
+
+        bucket_import = BucketImport.objects.get(source_bucket='junk')
+        self.assertFalse(bucket_import.completed)
+        self.assertEqual(bucket_import.claim, 'another-task')
+        self.assertEqual(Resource.objects.count(), 0)
+
+    def test_abandoned_import_is_taken_over(self):
+        '''
+        A claim which has not been refreshed (e.g. the worker died) does not
+        block a new request for the import
+        '''
+        self.setup_import_config()
+        self.make_source_bucket(['a.txt', 'b.txt'])
+        stale_time = timezone.now() - datetime.timedelta(seconds=dashboard_tasks.IMPORT_CLAIM_SECONDS + 1)
+        self.make_claimed_import(stale_time)
+
+        self.run_import()
 
+        self.assertEqual(BucketImport.objects.count(), 1)
+        bucket_import = BucketImport.objects.get(source_bucket='junk')
+        self.assertTrue(bucket_import.completed)
+        self.assertEqual(bucket_import.claim, '')
+        self.assertEqual(bucket_import.objects_imported, 2)
 
-    
\ No newline at end of file
+    def test_import_stops_if_claim_lost(self):
+        '''
+        If another task has taken over the import, this one stops without
+        saving its progress over the other's
+        '''
+        self.setup_import_config()
+        self.make_source_bucket(['a.txt', 'b.txt', 'c.txt'])
+
+        register = dashboard_tasks.register_imported_resources
+        def take_over(*args):
+            BucketImport.objects.filter(source_bucket='junk').update(claim='another-task')
+            return register(*args)
+        with mock.patch('dashboard.tasks.google_clients') as mock_google_clients, \
+            mock.patch('dashboard.tasks.send_email') as mock_email_send, \
+            mock.patch('dashboard.tasks.register_imported_resources', side_effect=take_over), \
+            mock.patch('dashboard.tasks.get_zone_as_string') as mock_zone_as_str:
+            mock_google_clients.get_storage_client.return_value = self.storage_client
+            mock_zone_as_str.return_value = 'us-east4-c'
+            transfer_google_bucket(self.admin_user.pk, self.regular_user.pk, 'junk')
+            self.assertFalse(mock_email_send.called)
+
+        bucket_import = BucketImport.objects.get(source_bucket='junk')
+        self.assertFalse(bucket_import.completed)
+        self.assertEqual(bucket_import.page_token, '')
+        self.assertEqual(bucket_import.objects_imported, 0)
+
+    def test_only_added_resources_are_counted(self):
+        '''
+        A file which already has an active Resource (e.g. it was uploaded 
+        before) is not registered or counted again.  An inactive Resource
+        at the same path (e.g. an expired file) is replaced by the import.
+        '''
+        self.setup_import_config()
+        uploads_folder = settings.CONFIG_PARAMS['uploads_folder_name']
+        user_bucket = self.storage_client.create_bucket(self.user_bucket_name())
+        user_bucket.blob('%s/a.txt' % uploads_folder).upload_from_string('a.txt')
+        self.make_source_bucket(['a.txt', 'b.txt'])
+        path_template = 'gs://%s/%s/%%s' % (self.user_bucket_name(), uploads_folder)
+        Resource.objects.create(source='google_storage',
+            path=path_template % 'a.txt',
+            name='a.txt',
+            size=5,
+            owner=self.regular_user
+        )
+        Resource.objects.create(source='dropbox',
+            path=path_template % 'b.txt',
+            name='b.txt',
+            size=100,
+            owner=self.regular_user,
+            is_active=False,
+            file_deleted=True
+        )
+
+        self.run_import()
+
+        bucket_import = BucketImport.objects.get(source_bucket='junk')
+        self.assertEqual(bucket_import.objects_imported, 1)
+        self.assertEqual(bucket_import.bytes_imported, len('b.txt'))
+        self.assertEqual(Resource.objects.count(), 2)
+        r = Resource.objects.get(path=path_template % 'b.txt')
+        self.assertTrue(r.is_active)
+        self.assertFalse(r.file_deleted)
+        self.assertEqual(r.size, len('b.txt'))
+        self.assertEqual(r.source, 'google_bucket')
+        self.assertEqual(Resource.objects.get(path=path_template % 'a.txt').source, 'google_storage')
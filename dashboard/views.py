@@ -3,10 +3,11 @@ from django.http import HttpResponseForbidden, JsonResponse, HttpResponseNotAllo
 from django.urls import reverse
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ObjectDoesNotExist
 
 import google
-from google.cloud import storage
 
+from helpers import google_clients
 from base.models import Issue, AvailableZones, CurrentZone
 from analysis.models import AnalysisProject, Warning, PendingWorkflow, CompletedJob, SubmittedJob
 
@@ -121,18 +122,20 @@ def import_bucket(request):
 
     if request.method == 'POST':
         payload = request.POST
-        print(payload)
-        bucket_url = payload['bucket_url']
+        try:
+            bucket_url = payload['bucket_url']
+        except KeyError:
+            return JsonResponse({'error': 'The request did not include the bucket_url.'}, status=400)
         try:
             bucket_user_pk = int(payload['bucket_user'])
-            print(bucket_user_pk)
+        except KeyError:
+            return JsonResponse({'error': 'The request did not include the bucket_user.'}, status=400)
         except ValueError:
             return JsonResponse({'error': 'This endpoint expects that the user is specified with an integer primary key.'}, status=400)
 
         # check that user exists:
         try:
             bucket_user = get_user_model().objects.get(pk=bucket_user_pk)
-            print(bucket_user)
         except ObjectDoesNotExist as ex:
             return JsonResponse({'error': 'User with PK=%d does not exist' % bucket_user_pk}, status=400)
 
@@ -140,7 +143,7 @@ def import_bucket(request):
         if bucket_url[:5] == settings.CONFIG_PARAMS['google_storage_gs_prefix']:
             # attempt to list the provided bucket.  Need to ensure that we have read access
             # and it may fail if we do not.
-            storage_client = storage.Client()
+            storage_client = google_clients.get_storage_client()
 
             # get the bucket name without the prefix:
             # this is the bucket FROM which we are grabbing files
@@ -161,6 +164,8 @@ def import_bucket(request):
 
 
         return JsonResponse({'message': 'Bucket import process has started.'})
+    else:
+        return HttpResponseNotAllowed(['POST'])
 
 
 def change_region(request):
@@ -19,6 +19,10 @@ cd $REPOSITORY_DIR/transfer_app/docker_containers/google/uploads/google_drive
 docker build -t blawney/drive_upload_to_google .
 docker push blawney/drive_upload_to_google
 
+cd $REPOSITORY_DIR/transfer_app/docker_containers/google/uploads/url
+docker build -t blawney/url_upload_to_google .
+docker push blawney/url_upload_to_google
+
 cd $REPOSITORY_DIR/transfer_app/docker_containers/google/downloads/dropbox
 docker build -t blawney/dropbox_in_google .
 docker push blawney/dropbox_in_google
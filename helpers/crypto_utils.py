@@ -0,0 +1,62 @@
+'''
+Credentials which we keep in the database for a while (e.g. OAuth2 access
+tokens used to retry or relaunch transfers) are encrypted with the functions
+here.  The keys are derived from the application's SECRET_KEY and the ENC_KEY
+(see config/general.cfg), so the database alone is not enough to recover them.
+
+Values are encrypted with AES (CBC mode) and authenticated with an HMAC, so a
+value which was altered is rejected rather than decrypted to garbage.
+'''
+import os
+import hmac
+import base64
+import hashlib
+
+from Crypto.Cipher import AES
+
+from django.conf import settings
+
+import base.exceptions as exceptions
+
+MAC_SIZE = hashlib.sha256().digest_size
+
+
+def _get_keys():
+    '''
+    Returns a tuple of the encryption key and the HMAC key
+    '''
+    secret = ('%s:%s' % (settings.SECRET_KEY, settings.CONFIG_PARAMS['enc_key'])).encode('utf-8')
+    return hashlib.sha256(b'encrypt:' + secret).digest(), hashlib.sha256(b'authenticate:' + secret).digest()
+
+
+def encrypt(plaintext):
+    '''
+    Returns the encrypted form of the string, itself a (url-safe) string
+    '''
+    encryption_key, mac_key = _get_keys()
+    data = plaintext.encode('utf-8')
+    padding = AES.block_size - (len(data) % AES.block_size)
+    data += bytes([padding]) * padding
+    iv = os.urandom(AES.block_size)
+    ciphertext = iv + AES.new(encryption_key, AES.MODE_CBC, iv).encrypt(data)
+    mac = hmac.new(mac_key, ciphertext, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(ciphertext + mac).decode('ascii')
+
+
+def decrypt(encrypted):
+    '''
+    Returns the original string.  Raises an ExceptionWithMessage if the
+    value was not produced by encrypt (with the current keys)
+    '''
+    encryption_key, mac_key = _get_keys()
+    try:
+        raw = base64.urlsafe_b64decode(encrypted.encode('ascii'))
+    except (ValueError, TypeError, AttributeError) as ex:
+        raise exceptions.ExceptionWithMessage('Could not decode the encrypted value: %s' % ex)
+    ciphertext, mac = raw[:-MAC_SIZE], raw[-MAC_SIZE:]
+    expected_mac = hmac.new(mac_key, ciphertext, hashlib.sha256).digest()
+    if (len(ciphertext) < 2*AES.block_size) or (not hmac.compare_digest(mac, expected_mac)):
+        raise exceptions.ExceptionWithMessage('The encrypted value is not valid.')
+    iv, ciphertext = ciphertext[:AES.block_size], ciphertext[AES.block_size:]
+    data = AES.new(encryption_key, AES.MODE_CBC, iv).decrypt(ciphertext)
+    return data[:-data[-1]].decode('utf-8')
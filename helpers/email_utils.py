@@ -1,8 +1,10 @@
-import os
-import json
+import uuid
 import base64
+import datetime
+import collections
 
 from django.conf import settings
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 
 from email.mime.multipart import MIMEMultipart
@@ -10,44 +12,201 @@ from email.mime.text import MIMEText
 from email.header import Header
 from email.utils import formataddr
 
-from googleapiclient import discovery
-from google.oauth2.credentials import Credentials
+from helpers import google_clients
+
+SENDER = 'qbrc@g.harvard.edu'
+
+# a sender "claims" the emails it is about to send for this long, so that
+# concurrent senders do not send the same emails
+CLAIM_SECONDS = 300
+
+# sent emails are kept (e.g. for troubleshooting) for this long
+SENT_EMAIL_RETENTION = datetime.timedelta(days=30)
+
+# Note that QueuedEmail is imported within the functions below.  This module is
+# imported while the models are loading (e.g. by custom_auth.models), so it
+# cannot import base.models at the top.
 
 
 def notify_admins(message, subject):
+    '''
+    Queues the message for each of the admins.  Notifications which are
+    still waiting to be sent when the queue is next processed are combined
+    into a single digest for each admin.
+    '''
+    from base.models import QueuedEmail
     admin_users = get_user_model().objects.filter(is_staff=True)
-    for u in admin_users:
-        send_email(message, message, u.email, subject)
+    QueuedEmail.objects.bulk_create([QueuedEmail(recipient=u.email,
+        subject=subject,
+        plaintext_message=message,
+        html_message=message,
+        is_admin_notification=True) for u in admin_users])
+
 
 def send_email(plaintext_msg, message_html, recipient, subject):
+    '''
+    Queues the email.  It is sent by the send_queued_emails task, so this
+    does not wait on the mail service.
+    '''
+    from base.models import QueuedEmail
+    QueuedEmail.objects.create(recipient=recipient,
+        subject=subject,
+        plaintext_message=plaintext_msg,
+        html_message=message_html)
+
+
+def create_message(plaintext_msg, message_html, recipient, subject):
+    '''
+    Returns the message body expected by the Gmail API
+    '''
+    message = MIMEMultipart('alternative')
+
+    # create the plaintext portion
+    part1 = MIMEText(plaintext_msg, 'plain')
+
+    # create the html:
+    part2 = MIMEText(message_html, 'html')
+
+    message.attach(part1)
+    message.attach(part2)
+
+    message['To'] = recipient
+    message['From'] = formataddr((str(Header('QBRC', 'utf-8')), SENDER))
+    message['subject'] = subject
+    return {'raw': base64.urlsafe_b64encode(message.as_string().encode()).decode()}
+
 
-    if recipient in settings.TEST_EMAIL_ADDRESSES:
-        print('Sending mock email to %s' % recipient)
+def create_digest(emails):
+    '''
+    Combines several admin notifications (QueuedEmail instances for the same
+    recipient) into one.  Repeated notifications are included once, with
+    the number of times they occurred.  Returns a tuple of the plaintext
+    message, the html message, and the subject.
+    '''
+    if len(emails) == 1:
+        return emails[0].plaintext_message, emails[0].html_message, emails[0].subject
+
+    counts = collections.OrderedDict()
+    for e in emails:
+        key = (e.subject, e.plaintext_message, e.html_message)
+        counts[key] = counts.get(key, 0) + 1
+
+    plaintext_sections = []
+    html_sections = []
+    for (subject, plaintext_message, html_message), count in counts.items():
+        if count > 1:
+            subject = '%s (%d times)' % (subject, count)
+        plaintext_sections.append('%s\n\n%s' % (subject, plaintext_message))
+        html_sections.append('<h3>%s</h3>\n<div>%s</div>' % (subject, html_message))
+    subject = 'Notification digest (%d notifications)' % len(emails)
+    return '\n\n----------\n\n'.join(plaintext_sections), '\n<hr>\n'.join(html_sections), subject
+
+
+def claim_emails(batch_size):
+    '''
+    Claims up to batch_size emails which are due to be sent and returns them
+    '''
+    from base.models import QueuedEmail
+    now = timezone.now()
+    pending_pks = list(QueuedEmail.objects.filter(sent=False,
+        failed=False,
+        next_attempt__lte=now
+    ).order_by('next_attempt', 'pk').values_list('pk', flat=True)[:batch_size])
+    if len(pending_pks) == 0:
+        return []
+    claim = str(uuid.uuid4())
+    QueuedEmail.objects.filter(pk__in=pending_pks,
+        sent=False,
+        failed=False,
+        next_attempt__lte=now
+    ).update(claim=claim, next_attempt=now + datetime.timedelta(seconds=CLAIM_SECONDS))
+    return list(QueuedEmail.objects.filter(claim=claim, sent=False).order_by('pk'))
+
+
+def record_failure(email, ex):
+    '''
+    Schedules another attempt for an email which could not be sent, with the
+    delay doubling after each failure
+    '''
+    email.attempts += 1
+    email.error = str(ex)
+    if email.attempts >= int(settings.CONFIG_PARAMS['email_max_attempts']):
+        print('Giving up on email to %s (%s) after %d attempts: %s' % (email.recipient, email.subject, email.attempts, ex))
+        email.failed = True
     else:
-        j = json.load(open(settings.EMAIL_CREDENTIALS_FILE))
-        credentials = Credentials(j['token'],
-                      refresh_token=j['refresh_token'], 
-                      token_uri=j['token_uri'], 
-                      client_id=j['client_id'], 
-                      client_secret=j['client_secret'], 
-                      scopes=j['scopes'])
+        delay = int(settings.CONFIG_PARAMS['email_retry_delay_seconds']) * 2**(email.attempts - 1)
+        email.next_attempt = timezone.now() + datetime.timedelta(seconds=delay)
+    email.save()
+
+
+def send_email_batch(emails):
+    '''
+    Sends the (claimed) emails using a single batch request to the Gmail API.
+    Admin notifications for the same recipient are sent as one digest.
+    '''
+    from base.models import QueuedEmail
+    groups = collections.OrderedDict()
+    for e in emails:
+        key = ('digest', e.recipient) if e.is_admin_notification else e.pk
+        groups.setdefault(key, []).append(e)
+
+    results = {}
+    outgoing = {}
+    for i, group in enumerate(groups.values()):
+        recipient = group[0].recipient
+        if recipient in settings.TEST_EMAIL_ADDRESSES:
+            print('Sending mock email to %s' % recipient)
+            results[str(i)] = None
+        else:
+            plaintext_msg, message_html, subject = create_digest(group)
+            outgoing[str(i)] = create_message(plaintext_msg, message_html, recipient, subject)
+
+    if len(outgoing) > 0:
+        service = google_clients.get_gmail_client()
+
+        def callback(request_id, response, exception):
+            results[request_id] = exception
 
-        service = discovery.build('gmail', 'v1', credentials = credentials)
+        batch = service.new_batch_http_request(callback=callback)
+        for request_id, msg in outgoing.items():
+            batch.add(service.users().messages().send(userId='me', body=msg), request_id=request_id)
+        try:
+            batch.execute()
+        except Exception as ex:
+            # the batch request as a whole failed
+            for request_id in outgoing.keys():
+                results.setdefault(request_id, ex)
 
-        sender = 'qbrc@g.harvard.edu'
-        message = MIMEMultipart('alternative')
+    sent_pks = []
+    for i, group in enumerate(groups.values()):
+        ex = results.get(str(i), Exception('No response was received for this email'))
+        if ex is None:
+            sent_pks.extend([e.pk for e in group])
+        else:
+            for e in group:
+                record_failure(e, ex)
+    QueuedEmail.objects.filter(pk__in=sent_pks).update(sent=True, sent_time=timezone.now())
+    return len(sent_pks)
 
-        # create the plaintext portion
-        part1 = MIMEText(plaintext_msg, 'plain')
 
-        # create the html:
-        part2 = MIMEText(message_html, 'html')
+def send_queued_emails():
+    '''
+    Sends the emails which are due, in batches, until there are none left.
+    Returns the number sent.
+    '''
+    batch_size = int(settings.CONFIG_PARAMS['email_batch_size'])
+    num_sent = 0
+    while True:
+        emails = claim_emails(batch_size)
+        if len(emails) == 0:
+            return num_sent
+        num_sent += send_email_batch(emails)
 
-        message.attach(part1)
-        message.attach(part2)
 
-        message['To'] = recipient
-        message['From'] = formataddr((str(Header('QBRC', 'utf-8')), sender))
-        message['subject'] = subject
-        msg = {'raw': base64.urlsafe_b64encode(message.as_string().encode()).decode()}
-        sent_message = service.users().messages().send(userId='me', body=msg).execute()
+def remove_sent_emails():
+    '''
+    Removes emails which were sent (or given up on) longer ago than SENT_EMAIL_RETENTION
+    '''
+    from base.models import QueuedEmail
+    cutoff = timezone.now() - SENT_EMAIL_RETENTION
+    QueuedEmail.objects.filter(created__lt=cutoff).exclude(sent=False, failed=False).delete()
@@ -37,6 +37,9 @@ def take_inputs():
         params['google_project_number'] = google_project_number 
         params['available_google_zones'] = ','.join(google_zones)
         params['default_google_zone'] = default_zone
+        params['google_signing_credentials'] = input('Enter the path to a JSON key for a service account '
+            'that can read the storage buckets.  This is used to sign URLs so users can download '
+            'files directly in their browser.  Leave blank to disable browser downloads: ').strip()
 
     elif cloud_environment == 'aws':
         print('Have not implemented AWS config')
@@ -0,0 +1,150 @@
+"""
+Creating the Google API clients is not free: each storage.Client obtains
+credentials and opens a new HTTP session, and each service created with
+googleapiclient's discovery.build fetches the API's discovery document over
+the network before it can be used.  Creating them for every request or task
+adds latency and needless API traffic.
+
+The functions here create each client once and reuse it.  The underlying HTTP
+transports are not safe to share across threads (or forked processes), so
+clients are cached per thread and are recreated after a fork.  The discovery
+documents are plain JSON, so those are fetched once and shared by the whole
+process; services built from them do not touch the network until they are used.
+
+For tests and benchmarks, in-memory fakes (see helpers/testing.py) may be 
+installed in place of the real clients (see use_fake_clients).
+"""
+import os
+import json
+import threading
+import contextlib
+
+import httplib2
+from google.cloud import storage
+from googleapiclient import discovery
+from google.oauth2.credentials import Credentials
+
+from django.conf import settings
+
+STORAGE = 'storage'
+COMPUTE = 'compute'
+GMAIL = 'gmail'
+DRIVE = 'drive'
+
+# the API versions used throughout the application:
+API_VERSIONS = {
+    COMPUTE: 'v1',
+    GMAIL: 'v1',
+    DRIVE: 'v3'
+}
+
+_local = threading.local()
+
+_documents = {}
+_documents_lock = threading.Lock()
+
+# clients installed by use_fake_clients, keyed by the names above
+_fake_clients = {}
+
+
+def _thread_clients():
+    '''
+    Returns the dict of clients created by this thread (in this process)
+    '''
+    pid = os.getpid()
+    if getattr(_local, 'pid', None) != pid:
+        _local.pid = pid
+        _local.clients = {}
+    return _local.clients
+
+
+def _get_client(key, factory):
+    if key in _fake_clients:
+        return _fake_clients[key]
+    clients = _thread_clients()
+    try:
+        return clients[key]
+    except KeyError:
+        client = factory()
+        clients[key] = client
+        return client
+
+
+def get_discovery_document(api, version):
+    '''
+    Returns the discovery document (a JSON string) for the API, which is only
+    fetched the first time it is requested by this process
+    '''
+    key = (api, version)
+    with _documents_lock:
+        if key in _documents:
+            return _documents[key]
+        http = httplib2.Http()
+        for uri_template in [discovery.DISCOVERY_URI, discovery.V2_DISCOVERY_URI]:
+            uri = uri_template.replace('{api}', api).replace('{apiVersion}', version)
+            response, content = http.request(uri)
+            if response.status < 400:
+                document = content.decode('utf-8')
+                _documents[key] = document
+                return document
+        raise Exception('Could not retrieve the discovery document for %s (%s)' % (api, version))
+
+
+def build_service(api, credentials=None):
+    '''
+    Builds a googleapiclient service from the (cached) discovery document
+    '''
+    version = API_VERSIONS[api]
+    return discovery.build_from_document(get_discovery_document(api, version), credentials=credentials)
+
+
+def get_storage_client():
+    return _get_client(STORAGE, storage.Client)
+
+
+def get_compute_client():
+    return _get_client(COMPUTE, lambda: build_service(COMPUTE))
+
+
+def get_gmail_client():
+    '''
+    Returns a client for the Gmail API, authorized with the credentials
+    used to send the application's emails
+    '''
+    def factory():
+        j = json.load(open(settings.EMAIL_CREDENTIALS_FILE))
+        credentials = Credentials(j['token'],
+                      refresh_token=j['refresh_token'],
+                      token_uri=j['token_uri'],
+                      client_id=j['client_id'],
+                      client_secret=j['client_secret'],
+                      scopes=j['scopes'])
+        return build_service(GMAIL, credentials)
+    return _get_client(GMAIL, factory)
+
+
+def get_drive_client(access_token):
+    '''
+    Drive is accessed with the user's own access token, so that client is
+    not cached.  It is built from the cached discovery document, however.
+    '''
+    if DRIVE in _fake_clients:
+        return _fake_clients[DRIVE]
+    return build_service(DRIVE, Credentials(access_token))
+
+
+@contextlib.contextmanager
+def use_fake_clients(**clients):
+    '''
+    Within this context, the getters above return the given clients instead
+    of the real ones, e.g.
+        with use_fake_clients(storage=testing.FakeStorageClient()):
+            ...
+    '''
+    previous = dict(_fake_clients)
+    _fake_clients.update(clients)
+    try:
+        yield clients
+    finally:
+        _fake_clients.clear()
+        _fake_clients.update(previous)
@@ -0,0 +1,71 @@
+"""
+Some settings are kept in the database so that admins may change them while
+the application is running (e.g. the current zone, which is changed from the
+dashboard).  They are read often (e.g. for every transfer and analysis) but
+rarely change, so each process keeps a snapshot of them here.
+
+When one of these settings changes, settings_changed() is called (see the
+signal receivers in base/models.py).  That clears this process's snapshot and
+touches the file at settings.RUNTIME_SETTINGS_STAMP.  Other processes (e.g. the
+celery workers or other web server workers) compare the modification time of
+that file with the one they saw when they took their snapshot, and reload if
+it has changed.
+"""
+import os
+import threading
+
+from django.conf import settings
+
+from helpers.utils import _file_version
+
+_lock = threading.Lock()
+
+# the snapshot of the settings (a dict) and the version of the stamp file
+# at the time it was taken
+_snapshot = None
+_snapshot_version = None
+
+
+def _load():
+    from base.models import CurrentZone
+    current_zone = CurrentZone.objects.select_related('zone').first()
+    return {
+        'current_zone': current_zone.zone if current_zone else None
+    }
+
+
+def get_snapshot():
+    '''
+    Returns the dict of settings, reloading them from the database if
+    they have changed since they were last loaded
+    '''
+    global _snapshot, _snapshot_version
+    version = _file_version(settings.RUNTIME_SETTINGS_STAMP)
+    with _lock:
+        if (_snapshot is None) or (version != _snapshot_version):
+            _snapshot = _load()
+            _snapshot_version = version
+        return _snapshot
+
+
+def settings_changed():
+    '''
+    Called when any of the settings are changed, so that they are
+    reloaded by all processes
+    '''
+    global _snapshot
+    with _lock:
+        _snapshot = None
+    try:
+        with open(settings.RUNTIME_SETTINGS_STAMP, 'a'):
+            os.utime(settings.RUNTIME_SETTINGS_STAMP, None)
+    except OSError as ex:
+        print('Could not update %s: %s' % (settings.RUNTIME_SETTINGS_STAMP, ex))
+
+
+def get_current_zone():
+    '''
+    Returns the current zone (an AvailableZones instance), or None if
+    a current zone has not been set
+    '''
+    return get_snapshot()['current_zone']
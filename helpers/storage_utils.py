@@ -1,20 +1,227 @@
+import time
+import threading
+import collections
+
 import google
 from google.cloud import storage
 
+from django.conf import settings
+
 from helpers.email_utils import notify_admins
+from helpers import google_clients
+
+# the number of requests sent in each batch request.  Google allows up to 1000, 
+# but recommends no more than 100
+MAX_BATCH_SIZE = 100
 
 
-def create_regional_bucket(bucketname, region):
+class BucketCache(object):
     '''
-    Creates a storage bucket in the current region.
+    A small, thread-safe LRU cache of bucket handles with a time-to-live.  The 
+    handles are loaded with the bucket's metadata (e.g. location), so once a bucket
+    has been looked up, those attributes are available without further API calls.
+    Buckets that do not exist are not cached, since they may be created at any
+    time by other processes (e.g. the transfer VMs or other workers).
+
+    A handle is only returned to the client that loaded it, since the handle
+    makes its requests through that client's (thread-specific) HTTP session.
+    '''
+    def __init__(self, ttl_seconds, max_entries):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, storage_client, bucket_name):
+        '''
+        Returns a tuple of (found, bucket)
+        '''
+        key = (id(storage_client), bucket_name)
+        with self._lock:
+            try:
+                client, bucket, expiration = self._entries[key]
+            except KeyError:
+                return False, None
+            if (client is not storage_client) or (time.time() >= expiration):
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, bucket
+
+    def put(self, storage_client, bucket_name, bucket):
+        key = (id(storage_client), bucket_name)
+        with self._lock:
+            # the client is held so that its id is not reused while cached
+            self._entries[key] = (storage_client, bucket, time.time() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, bucket_name):
+        '''
+        Removes the bucket for all clients, e.g. once it has been created
+        '''
+        with self._lock:
+            for key in [k for k in self._entries.keys() if k[1] == bucket_name]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_bucket_cache = None
+_bucket_cache_lock = threading.Lock()
+
+
+def get_bucket_cache():
+    global _bucket_cache
+    with _bucket_cache_lock:
+        if _bucket_cache is None:
+            _bucket_cache = BucketCache(int(settings.CONFIG_PARAMS['bucket_cache_ttl_seconds']),
+                int(settings.CONFIG_PARAMS['bucket_cache_max_entries']))
+        return _bucket_cache
+
+
+def lookup_bucket(bucket_name, storage_client=None):
+    '''
+    Returns the bucket (with its metadata loaded), or None if it does not exist.
+    Buckets which exist are cached (see BucketCache)
+    '''
+    if storage_client is None:
+        storage_client = google_clients.get_storage_client()
+    cache = get_bucket_cache()
+    found, bucket = cache.get(storage_client, bucket_name)
+    if not found:
+        bucket = storage_client.lookup_bucket(bucket_name)
+        if bucket is not None:
+            cache.put(storage_client, bucket_name, bucket)
+    return bucket
+
+
+def get_bucket(bucket_name, storage_client=None):
+    '''
+    As with storage.Client.get_bucket, raises google.api_core.exceptions.NotFound
+    if the bucket does not exist, but uses the cached metadata if available.
+    '''
+    if storage_client is None:
+        storage_client = google_clients.get_storage_client()
+    cache = get_bucket_cache()
+    found, bucket = cache.get(storage_client, bucket_name)
+    if not found:
+        bucket = storage_client.get_bucket(bucket_name)
+        cache.put(storage_client, bucket_name, bucket)
+    return bucket
+
+
+def create_bucket(bucket, storage_client=None, exist_ok=False):
+    '''
+    Creates the bucket (a storage.Bucket with its name and location set) and
+    replaces any cached entries for that name.  Returns the new bucket.
+
+    If the bucket already exists, google.api_core.exceptions.Conflict is raised
+    unless exist_ok is True, in which case the existing bucket is returned.  
+    This handles another process creating the bucket first.
+    '''
+    if storage_client is None:
+        storage_client = google_clients.get_storage_client()
+    cache = get_bucket_cache()
+    cache.invalidate(bucket.name)
+    try:
+        new_bucket = storage_client.create_bucket(bucket)
+    except google.api_core.exceptions.Conflict:
+        if not exist_ok:
+            raise
+        print('Bucket %s was already created.' % bucket.name)
+        return get_bucket(bucket.name, storage_client)
+    cache.put(storage_client, bucket.name, new_bucket)
+    return new_bucket
+
+
+def delete_blobs(paths, storage_client=None):
+    '''
+    Deletes the objects at the given paths (e.g. gs://bucket/dir/object.txt),
+    sending up to MAX_BATCH_SIZE deletions in each batch request.  Objects 
+    which do not exist are considered deleted.  Returns a list of the paths which
+    could not be deleted.
+    '''
+    if storage_client is None:
+        storage_client = google_clients.get_storage_client()
+    gs_prefix = settings.CONFIG_PARAMS['google_storage_gs_prefix']
+    failed_paths = []
+    for i in range(0, len(paths), MAX_BATCH_SIZE):
+        batch_paths = paths[i:i+MAX_BATCH_SIZE]
+        blobs = []
+        for p in batch_paths:
+            contents = p[len(gs_prefix):].split('/')
+            blobs.append(storage_client.bucket(contents[0]).blob('/'.join(contents[1:])))
+        try:
+            with storage_client.batch():
+                for blob in blobs:
+                    blob.delete()
+        except google.api_core.exceptions.GoogleAPICallError:
+            # the batch raises if any of the deletions failed (commonly, because the
+            # object was already removed).  Retry those individually to find out which
+            for p, blob in zip(batch_paths, blobs):
+                try:
+                    blob.delete()
+                except google.api_core.exceptions.NotFound:
+                    pass
+                except google.api_core.exceptions.GoogleAPICallError as ex:
+                    print('Could not delete %s: %s' % (p, ex))
+                    failed_paths.append(p)
+    return failed_paths
+
+
+def get_object_size(path, storage_client=None):
+    '''
+    Returns the size (in bytes) of the object at the given path (e.g.
+    gs://bucket/dir/object.txt), or None if it could not be found
+    '''
+    gs_prefix = settings.CONFIG_PARAMS['google_storage_gs_prefix']
+    contents = path[len(gs_prefix):].split('/')
+    try:
+        if storage_client is None:
+            storage_client = google_clients.get_storage_client()
+        blob = storage_client.bucket(contents[0]).get_blob('/'.join(contents[1:]))
+    except Exception as ex:
+        print('Could not get the size of %s: %s' % (path, ex))
+        return None
+    if blob is None:
+        return None
+    return blob.size
+
+
+def delete_bucket(bucket_name, storage_client=None):
+    '''
+    Deletes the (empty) bucket and removes it from the cache
+    '''
+    if storage_client is None:
+        storage_client = google_clients.get_storage_client()
+    bucket = get_bucket(bucket_name, storage_client)
+    get_bucket_cache().invalidate(bucket_name)
+    bucket.delete()
+
+
+def create_regional_bucket(bucketname, region, labels=None, exist_ok=False):
+    '''
+    Creates a storage bucket in the current region.  Returns the new bucket,
+    or None if it could not be created (in which case the admins are notified).
+
+    If exist_ok is True and the bucket already exists, that bucket is given 
+    the labels and returned.
     '''
-    client = storage.Client()
     b = storage.Bucket(bucketname)
     b.name = bucketname
     b.location = region
+    if labels:
+        b.labels = labels
     try:
-        final_bucket = client.create_bucket(b)
-        return
+        final_bucket = create_bucket(b, exist_ok=exist_ok)
+        if labels and (final_bucket.labels != labels):
+            final_bucket.labels = labels
+            final_bucket.patch()
+        return final_bucket
     except google.api_core.exceptions.Conflict as ex:
         message = '''
             An attempt was made to create a bucket at %s.  However, the storage API indicated
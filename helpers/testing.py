@@ -0,0 +1,177 @@
+"""
+In-memory stand-ins for the Google API clients, for use in tests (and
+benchmarks).  Install them with helpers.google_clients.use_fake_clients.
+"""
+import base64
+import hashlib
+import contextlib
+
+import google.api_core.exceptions
+
+
+class FakeStorageClient(object):
+    '''
+    An in-memory stand-in for google.cloud.storage.Client, implementing the
+    subset of the API used by this application.
+    '''
+    def __init__(self):
+        self.buckets = {}
+
+    def bucket(self, bucket_name):
+        try:
+            return self.buckets[bucket_name]
+        except KeyError:
+            return FakeBucket(self, bucket_name)
+
+    def get_bucket(self, bucket_name):
+        try:
+            return self.buckets[bucket_name]
+        except KeyError:
+            raise google.api_core.exceptions.NotFound('Bucket %s not found' % bucket_name)
+
+    def lookup_bucket(self, bucket_name):
+        return self.buckets.get(bucket_name)
+
+    def create_bucket(self, bucket_or_name):
+        if isinstance(bucket_or_name, str):
+            bucket_name, location = bucket_or_name, None
+        else:
+            bucket_name, location = bucket_or_name.name, bucket_or_name.location
+        if bucket_name in self.buckets:
+            raise google.api_core.exceptions.Conflict('Bucket %s already exists' % bucket_name)
+        bucket = FakeBucket(self, bucket_name, location)
+        if not isinstance(bucket_or_name, str):
+            bucket.labels = dict(bucket_or_name.labels)
+        self.buckets[bucket_name] = bucket
+        return bucket
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''
+        Requests made within a batch are simply made right away
+        '''
+        yield self
+
+    def list_blobs(self, bucket_or_name, max_results=None, page_token=None, prefix=None):
+        '''
+        As with the real client, max_results and page_token give a single
+        page of the listing.  The page token is simply the next object's name.
+        '''
+        if not isinstance(bucket_or_name, str):
+            bucket_or_name = bucket_or_name.name
+        blobs = self.get_bucket(bucket_or_name).list_blobs(prefix=prefix)
+        if page_token:
+            blobs = [b for b in blobs if b.name >= page_token]
+        iterator = FakeBlobIterator(blobs[:max_results])
+        if max_results and len(blobs) > max_results:
+            iterator.next_page_token = blobs[max_results].name
+        return iterator
+
+
+class FakeBlobIterator(list):
+    next_page_token = None
+
+
+class FakeBucket(object):
+
+    def __init__(self, client, name, location=None):
+        self.client = client
+        self.name = name
+        self.location = location
+        self.labels = {}
+        self.blobs = {}
+
+    def exists(self):
+        return self.name in self.client.buckets
+
+    def patch(self):
+        pass
+
+    def delete(self, force=False):
+        if self.blobs and not force:
+            raise google.api_core.exceptions.Conflict('Bucket %s is not empty' % self.name)
+        self.client.get_bucket(self.name)
+        del self.client.buckets[self.name]
+
+    def blob(self, blob_name, chunk_size=None):
+        return FakeBlob(self, blob_name)
+
+    def get_blob(self, blob_name):
+        return self.blobs.get(blob_name)
+
+    def list_blobs(self, prefix=None):
+        return [self.blobs[name] for name in sorted(self.blobs.keys()) if name.startswith(prefix or '')]
+
+    def delete_blob(self, blob_name):
+        try:
+            del self.blobs[blob_name]
+        except KeyError:
+            raise google.api_core.exceptions.NotFound('Object %s not found' % blob_name)
+
+    def copy_blob(self, blob, destination_bucket, new_name=None):
+        new_blob = FakeBlob(destination_bucket, new_name or blob.name)
+        new_blob.upload_from_string(blob.download_as_string())
+        return new_blob
+
+    def rename_blob(self, blob, new_name):
+        new_blob = self.copy_blob(blob, self, new_name)
+        self.delete_blob(blob.name)
+        return new_blob
+
+
+class FakeBlob(object):
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.size = None
+        self.md5_hash = None
+        self.crc32c = None
+        self._content = None
+
+    def _store(self, content):
+        self._content = content
+        self.size = len(content)
+        self.md5_hash = base64.b64encode(hashlib.md5(content).digest()).decode('ascii')
+        # a bucket which was not created beforehand is created as needed
+        self.bucket.client.buckets.setdefault(self.bucket.name, self.bucket)
+        self.bucket.client.buckets[self.bucket.name].blobs[self.name] = self
+
+    def exists(self):
+        return self.name in self.bucket.blobs
+
+    def upload_from_string(self, content, content_type=None):
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        self._store(content)
+
+    def upload_from_file(self, file_obj, size=None, content_type=None):
+        self._store(file_obj.read())
+
+    def upload_from_filename(self, filename, content_type=None):
+        with open(filename, 'rb') as fin:
+            self._store(fin.read())
+
+    def download_as_string(self, start=None, end=None):
+        stored = self.bucket.blobs.get(self.name)
+        if stored is None:
+            raise google.api_core.exceptions.NotFound('Object %s not found' % self.name)
+        content = stored._content
+        if start is not None or end is not None:
+            # as with the real client, end is inclusive
+            content = content[(start or 0):(end + 1 if end is not None else None)]
+        return content
+
+    def download_to_filename(self, filename):
+        with open(filename, 'wb') as fout:
+            fout.write(self.download_as_string())
+
+    def delete(self):
+        self.bucket.delete_blob(self.name)
+
+    def rewrite(self, source, token=None):
+        self.upload_from_string(source.download_as_string())
+        return None, self.size, self.size
+
+    def create_resumable_upload_session(self, content_type=None, size=None, origin=None):
+        return 'https://fake-upload-session/%s/%s' % (self.bucket.name, self.name)
@@ -1,36 +1,108 @@
 import os
+import functools
+import threading
 import configparser
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 import requests
 
 from django.conf import settings
 
 
+# parsed config files, keyed by the path and sections (see load_config)
+_config_cache = {}
+_config_lock = threading.Lock()
+
+# Jinja environments, one per template directory.  An environment keeps the 
+# templates it has compiled (recompiling only if the file changes), and the 
+# compiled code is also cached on disk so that new processes can skip compilation
+_jinja_environments = {}
+_jinja_lock = threading.Lock()
+_jinja_bytecode_cache = FileSystemBytecodeCache()
+
+
+def get_jinja_environment(template_dir):
+    '''
+    Returns the (shared) jinja environment for templates in template_dir
+    '''
+    template_dir = os.path.realpath(os.path.abspath(template_dir))
+    with _jinja_lock:
+        try:
+            return _jinja_environments[template_dir]
+        except KeyError:
+            env = Environment(loader=FileSystemLoader(template_dir), 
+                bytecode_cache=_jinja_bytecode_cache)
+            _jinja_environments[template_dir] = env
+            return env
+
+
 def get_jinja_template(template_path):
 
     if template_path[0] != '/':
         template_path = os.path.join(settings.BASE_DIR, template_path)
 
     # load the environment/template for the jinja template engine: 
-    template_dir = os.path.realpath(
-        os.path.abspath(
-            os.path.dirname(
-                template_path
-            )
-        )
-    )
-    env = Environment(loader=FileSystemLoader(template_dir))
+    env = get_jinja_environment(os.path.dirname(template_path))
     return env.get_template(
         os.path.basename(template_path)
     )
 
+
+@functools.lru_cache(maxsize=None)
+def _read_subject(subject_path):
+    with open(subject_path) as fin:
+        return fin.readline().strip()
+
+
+def get_email_subject(subject_path):
+    '''
+    Returns the subject line (the first line of the file at subject_path),
+    which is only read from the file the first time
+    '''
+    if subject_path[0] != '/':
+        subject_path = os.path.join(settings.BASE_DIR, subject_path)
+    return _read_subject(os.path.realpath(subject_path))
+
+
+def _file_version(path):
+    '''
+    Returns something which changes when the file is modified (or None
+    if the file does not exist)
+    '''
+    try:
+        stat_result = os.stat(path)
+        return (stat_result.st_mtime_ns, stat_result.st_size)
+    except OSError:
+        return None
+
+
 def load_config(config_filepath, config_sections=[]):
     '''
     config_filepath is the path to a config/ini file
     config_sections is a list of names for sections in that file
     if None, then just return the [DEFAULT] section
+
+    The parsed config is kept for the life of the process and is only
+    parsed again if the file is modified (or clear_config_cache is called).
+    Each call returns a new dict, so callers may modify it.
     '''
+    key = (os.path.realpath(config_filepath), tuple(config_sections))
+    version = _file_version(key[0])
+    with _config_lock:
+        cached = _config_cache.get(key)
+    if (cached is not None) and (cached[0] == version):
+        return dict(cached[1])
+    config_dict = _parse_config(config_filepath, config_sections)
+    with _config_lock:
+        _config_cache[key] = (version, config_dict)
+    return dict(config_dict)
+
+
+def clear_config_cache():
+    with _config_lock:
+        _config_cache.clear()
+
 
+def _parse_config(config_filepath, config_sections):
     config = configparser.ConfigParser()
     config.read(config_filepath)
     main_dict = {}
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from transfer_app.models import Transfer, FailedTransfer
+from transfer_app.models import Transfer, FailedTransfer, DeferredDownload
 
 class TransferAdmin(admin.ModelAdmin):
     list_display = ('destination',)
@@ -8,6 +8,10 @@ class TransferAdmin(admin.ModelAdmin):
 class FailedTransferAdmin(admin.ModelAdmin):
     list_display = ('was_download','intended_path', 'resource_name')
 
+class DeferredDownloadAdmin(admin.ModelAdmin):
+    list_display = ('resource', 'destination', 'originator', 'created')
+
 
 admin.site.register(Transfer, TransferAdmin)
 admin.site.register(FailedTransfer, FailedTransferAdmin)
+admin.site.register(DeferredDownload, DeferredDownloadAdmin)
@@ -0,0 +1,420 @@
+"""
+Rather than sending each of many files as its own transfer (and its own file in
+the user's Dropbox/Drive), users may request that the files be delivered as a
+single zip archive.
+
+The archive is generated on the fly: each file is read from storage in chunks
+and written into the zip stream, which is pushed straight into the destination's
+upload session.  Nothing is assembled on disk or held entirely in memory.  Since
+the compressed sizes are not known until each file has been written, each entry
+is followed by a data descriptor.  ZIP64 records are used for entries (or archives)
+which exceed the limits of the original zip format.
+
+A manifest listing the archived files is added as the final entry.
+"""
+import os
+import time
+import zlib
+import struct
+
+import requests
+import dropbox.dropbox as dropbox_module
+import dropbox.files as dropbox_files
+
+from helpers import google_clients
+import base.exceptions as exceptions
+from transfer_app import streaming
+
+STORED = 'stored'
+DEFLATED = 'deflated'
+COMPRESSION_METHODS = {STORED: 0, DEFLATED: 8}
+
+MANIFEST_NAME = 'MANIFEST.txt'
+
+# for starting a resumable upload to Google Drive
+DRIVE_RESUMABLE_URL = 'https://www.googleapis.com/upload/drive/v3/files?uploadType=resumable'
+
+# chunks sent to a Drive resumable upload must be a multiple of this (except the last)
+DRIVE_CHUNK_MULTIPLE = 256*1024
+
+# limits of the original zip format.  Beyond these, ZIP64 records are required.
+ZIP32_LIMIT = 0xFFFFFFFF
+ZIP32_MAX_ENTRIES = 0xFFFF
+
+# the size of an entry is known prior to compressing it, but deflate can (slightly)
+# expand incompressible data.  Entries within this margin of the limit use ZIP64.
+ZIP64_MARGIN = 0x1000000
+
+# the general purpose flags: sizes/crc in a data descriptor and UTF-8 names
+FLAGS = 0x0008 | 0x0800
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+DATA_DESCRIPTOR = struct.Struct('<IIII')
+DATA_DESCRIPTOR64 = struct.Struct('<IIQQ')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+END_RECORD = struct.Struct('<IHHHHIIH')
+END_RECORD64 = struct.Struct('<IQHHIIQQQQ')
+END_LOCATOR64 = struct.Struct('<IIQI')
+
+
+def check_archive_options(archive_options, default_name):
+    '''
+    Checks the archive request sent by the front-end, e.g.
+        {'name': 'project_outputs.zip', 'compression': 'deflated'}
+    Returns a dict with the name (with a .zip suffix) and compression method.
+    '''
+    if not isinstance(archive_options, dict):
+        archive_options = {}
+    name = archive_options.get('name') or default_name
+    name = os.path.basename(str(name).strip())
+    if not name:
+        raise exceptions.ExceptionWithMessage('The archive name was not valid.')
+    if not name.lower().endswith('.zip'):
+        name += '.zip'
+    compression = archive_options.get('compression') or DEFLATED
+    if compression not in COMPRESSION_METHODS:
+        raise exceptions.ExceptionWithMessage('The compression for the archive must be one of: %s'
+            % ', '.join(sorted(COMPRESSION_METHODS.keys())))
+    return {'name': name, 'compression': compression}
+
+
+def unique_member_names(names):
+    '''
+    Two files may share a name (e.g. in different folders of the bucket).
+    Returns a list of names which are unique within the archive by adding a
+    numeric suffix, e.g. a.txt, a(1).txt.  The manifest's name is reserved.
+    '''
+    seen = set([MANIFEST_NAME])
+    unique_names = []
+    for name in names:
+        candidate = name
+        stem, ext = os.path.splitext(name)
+        i = 1
+        while candidate in seen:
+            candidate = '%s(%d)%s' % (stem, i, ext)
+            i += 1
+        seen.add(candidate)
+        unique_names.append(candidate)
+    return unique_names
+
+
+def dos_datetime(timestamp):
+    '''
+    Returns the (time, date) pair used in the zip headers
+    '''
+    t = time.localtime(timestamp)
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((max(t.tm_year, 1980) - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+class ZipStream(object):
+    '''
+    A read-only, file-like zip archive of the objects in storage.  The archive
+    is generated as it is read.  members is a list of dicts, each with the
+    keys 'name' (the name within the archive), 'path' and 'size_in_bytes'.
+
+    The content of each member is obtained from open_member(path), which returns
+    a file-like object.  By default, objects are read from Google storage.
+    '''
+
+    def __init__(self, members, compression=DEFLATED, compression_level=6,
+        read_size=8388608, open_member=None, force_zip64=False):
+        self.members = members
+        self.method = COMPRESSION_METHODS[compression]
+        self.compression_level = compression_level
+        self.read_size = read_size
+        self.force_zip64 = force_zip64
+        if open_member is None:
+            storage_client = google_clients.get_storage_client()
+            open_member = lambda path: streaming.GoogleStorageRangeReader(path, storage_client)
+        self.open_member = open_member
+        self.dos_time, self.dos_date = dos_datetime(time.time())
+
+        # the entries written so far and the number of bytes produced:
+        self.entries = []
+        self.offset = 0
+        self._buffer = bytearray()
+        self._generator = self._generate()
+        self._exhausted = False
+
+    def read(self, size=-1):
+        '''
+        Returns the next size bytes of the archive (fewer only at the end).
+        '''
+        while (not self._exhausted) and ((size is None) or (size < 0) or (len(self._buffer) < size)):
+            try:
+                self._buffer.extend(next(self._generator))
+            except StopIteration:
+                self._exhausted = True
+        if (size is None) or (size < 0):
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def tell(self):
+        '''
+        The number of bytes of the archive which have been read
+        '''
+        return self.offset - len(self._buffer)
+
+    def _emit(self, data):
+        self.offset += len(data)
+        return data
+
+    def _generate(self):
+        for member in self.members:
+            reader = self.open_member(member['path'])
+            for data in self._write_entry(member['name'], reader, member['size_in_bytes']):
+                yield data
+        manifest = self.manifest().encode('utf-8')
+        for data in self._write_entry(MANIFEST_NAME, ManifestReader(manifest), len(manifest)):
+            yield data
+        yield self._end_records()
+
+    def manifest(self):
+        '''
+        A tab-delimited listing of the archived files, with their sizes and CRC-32
+        checksums so the user may check the extracted files.
+        '''
+        lines = ['name\tsize_in_bytes\tcrc32']
+        for entry in self.entries:
+            lines.append('%s\t%d\t%08x' % (entry['name'],
+                entry['uncompressed_size'],
+                entry['crc']))
+        return '\n'.join(lines) + '\n'
+
+    def _write_entry(self, name, reader, expected_size):
+        encoded_name = name.encode('utf-8')
+        zip64 = self.force_zip64 or (expected_size >= (ZIP32_LIMIT - ZIP64_MARGIN))
+        entry = {
+            'name': name,
+            'encoded_name': encoded_name,
+            'header_offset': self.offset,
+            'zip64': zip64
+        }
+        if zip64:
+            # the actual sizes are in the data descriptor
+            extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0)
+            sizes = ZIP32_LIMIT
+            version = 45
+        else:
+            extra = b''
+            sizes = 0
+            version = 20
+        entry['version'] = version
+        yield self._emit(LOCAL_HEADER.pack(0x04034b50,
+            version,
+            FLAGS,
+            self.method,
+            self.dos_time,
+            self.dos_date,
+            0,
+            sizes,
+            sizes,
+            len(encoded_name),
+            len(extra)) + encoded_name + extra)
+
+        crc = 0
+        uncompressed_size = 0
+        compressed_size = 0
+        compressor = None
+        if self.method == COMPRESSION_METHODS[DEFLATED]:
+            compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, -15)
+        while True:
+            data = reader.read(self.read_size)
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            uncompressed_size += len(data)
+            if compressor:
+                data = compressor.compress(data)
+            if data:
+                compressed_size += len(data)
+                yield self._emit(data)
+        if compressor:
+            data = compressor.flush()
+            compressed_size += len(data)
+            yield self._emit(data)
+
+        if uncompressed_size != expected_size:
+            raise Exception('Expected %d bytes for %s, but read %d' % (expected_size, name, uncompressed_size))
+
+        crc = crc & 0xFFFFFFFF
+        if zip64:
+            descriptor = DATA_DESCRIPTOR64.pack(0x08074b50, crc, compressed_size, uncompressed_size)
+        else:
+            descriptor = DATA_DESCRIPTOR.pack(0x08074b50, crc, compressed_size, uncompressed_size)
+        yield self._emit(descriptor)
+
+        entry['crc'] = crc
+        entry['compressed_size'] = compressed_size
+        entry['uncompressed_size'] = uncompressed_size
+        self.entries.append(entry)
+
+    def _central_header(self, entry):
+        # values which do not fit are moved into the ZIP64 extra field:
+        zip64_fields = []
+        uncompressed_size = entry['uncompressed_size']
+        compressed_size = entry['compressed_size']
+        header_offset = entry['header_offset']
+        if entry['zip64'] or (uncompressed_size >= ZIP32_LIMIT):
+            zip64_fields.append(uncompressed_size)
+            uncompressed_size = ZIP32_LIMIT
+        if entry['zip64'] or (compressed_size >= ZIP32_LIMIT):
+            zip64_fields.append(compressed_size)
+            compressed_size = ZIP32_LIMIT
+        if self.force_zip64 or (header_offset >= ZIP32_LIMIT):
+            zip64_fields.append(header_offset)
+            header_offset = ZIP32_LIMIT
+        version = entry['version']
+        extra = b''
+        if zip64_fields:
+            version = 45
+            extra = struct.pack('<HH', 0x0001, 8*len(zip64_fields)) + \
+                struct.pack('<%dQ' % len(zip64_fields), *zip64_fields)
+        return CENTRAL_HEADER.pack(0x02014b50,
+            version,
+            version,
+            FLAGS,
+            self.method,
+            self.dos_time,
+            self.dos_date,
+            entry['crc'],
+            compressed_size,
+            uncompressed_size,
+            len(entry['encoded_name']),
+            len(extra),
+            0,
+            0,
+            0,
+            0,
+            header_offset) + entry['encoded_name'] + extra
+
+    def _end_records(self):
+        directory_offset = self.offset
+        directory = b''.join([self._central_header(entry) for entry in self.entries])
+        directory_size = len(directory)
+        entry_count = len(self.entries)
+        records = [directory]
+        if self.force_zip64 or \
+            (entry_count >= ZIP32_MAX_ENTRIES) or \
+            (directory_offset >= ZIP32_LIMIT) or \
+            (directory_size >= ZIP32_LIMIT):
+            end_record64_offset = directory_offset + directory_size
+            records.append(END_RECORD64.pack(0x06064b50,
+                END_RECORD64.size - 12,
+                45,
+                45,
+                0,
+                0,
+                entry_count,
+                entry_count,
+                directory_size,
+                directory_offset))
+            records.append(END_LOCATOR64.pack(0x07064b50, 0, end_record64_offset, 1))
+            records.append(END_RECORD.pack(0x06054b50,
+                0,
+                0,
+                min(entry_count, ZIP32_MAX_ENTRIES),
+                min(entry_count, ZIP32_MAX_ENTRIES),
+                min(directory_size, ZIP32_LIMIT),
+                min(directory_offset, ZIP32_LIMIT),
+                0))
+        else:
+            records.append(END_RECORD.pack(0x06054b50,
+                0,
+                0,
+                entry_count,
+                entry_count,
+                directory_size,
+                directory_offset,
+                0))
+        return self._emit(b''.join(records))
+
+
+class ManifestReader(object):
+    '''
+    Serves the (in-memory) manifest through the same read interface as the
+    readers for the archived files
+    '''
+    def __init__(self, content):
+        self.content = content
+        self.position = 0
+
+    def read(self, size):
+        data = self.content[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+
+def archive_to_dropbox(members, archive_options, access_token, dropbox_folderpath, chunk_size, compression_level):
+    '''
+    Streams a zip archive of the members (see ZipStream) into the user's Dropbox
+    using an upload session.  Returns the size of the archive.
+    '''
+    archive = ZipStream(members, archive_options['compression'], compression_level, chunk_size)
+    client = dropbox_module.Dropbox(access_token, timeout=streaming.DEFAULT_TIMEOUT)
+    path_in_dropbox = '%s/%s' % (dropbox_folderpath, archive_options['name'])
+    commit = dropbox_files.CommitInfo(path=path_in_dropbox)
+
+    # read one chunk ahead so we know which chunk is the last
+    data = archive.read(chunk_size)
+    next_data = archive.read(chunk_size)
+    if not next_data:
+        client.files_upload(data, path_in_dropbox)
+        return len(data)
+    session_start_result = client.files_upload_session_start(data)
+    cursor = dropbox_files.UploadSessionCursor(session_start_result.session_id, offset=len(data))
+    while True:
+        data, next_data = next_data, archive.read(chunk_size)
+        if not next_data:
+            client.files_upload_session_finish(data, cursor, commit)
+            return cursor.offset + len(data)
+        client.files_upload_session_append_v2(data, cursor)
+        cursor.offset += len(data)
+        streaming.heartbeat()
+
+
+def archive_to_drive(members, archive_options, access_token, chunk_size, compression_level):
+    '''
+    Streams a zip archive of the members (see ZipStream) into the user's Google
+    Drive.  The size of the archive is not known until it has been generated,
+    so the resumable upload is performed directly, giving the total size
+    with the final chunk.  Returns the size of the archive.
+    '''
+    chunk_size = max(DRIVE_CHUNK_MULTIPLE, chunk_size - (chunk_size % DRIVE_CHUNK_MULTIPLE))
+    archive = ZipStream(members, archive_options['compression'], compression_level, chunk_size)
+    headers = {'Authorization': 'Bearer %s' % access_token}
+
+    response = requests.post(DRIVE_RESUMABLE_URL, 
+        json={'name': archive_options['name'], 'mimeType': 'application/zip'},
+        headers=headers,
+        timeout=streaming.DEFAULT_TIMEOUT)
+    response.raise_for_status()
+    session_url = response.headers['Location']
+
+    offset = 0
+    data = archive.read(chunk_size)
+    while True:
+        next_data = archive.read(chunk_size)
+        if next_data:
+            total = '*'
+        else:
+            total = str(offset + len(data))
+        chunk_headers = dict(headers)
+        if data:
+            chunk_headers['Content-Range'] = 'bytes %d-%d/%s' % (offset, offset + len(data) - 1, total)
+        else:
+            chunk_headers['Content-Range'] = 'bytes */%s' % total
+        response = requests.put(session_url, data=data, headers=chunk_headers, timeout=streaming.DEFAULT_TIMEOUT)
+        offset += len(data)
+        if not next_data:
+            response.raise_for_status()
+            return offset
+        # Drive responds with 308 once it has received each intermediate chunk
+        if response.status_code != 308:
+            raise Exception('Unexpected response (%d) from Drive: %s' % (response.status_code, response.text))
+        streaming.heartbeat()
+        data = next_data
@@ -0,0 +1,128 @@
+"""
+Users who just want a copy of a file in their browser should not need to go 
+through Dropbox/Drive and a dedicated transfer VM.  The functions here issue 
+short-lived V4 signed URLs which allow the browser to fetch the object directly
+from Google storage.  
+
+Storage honors HTTP range requests on signed URLs, so large downloads can be
+paused/resumed by the browser (or a download manager) until the URL expires.
+Since we cannot know when (or how many times) the browser actually fetches
+the file, a download is counted when its URL is issued.  That accounting goes
+through Transfer.finalize, exactly as for the other downloads.
+"""
+import datetime
+
+from google.cloud import storage
+from google.oauth2 import service_account
+
+from django.conf import settings
+from django.db import transaction
+from django.contrib.auth import get_user_model
+
+import base.exceptions as exceptions
+from base.models import Resource
+from transfer_app import streaming
+from transfer_app.models import Transfer, TransferCoordinator
+
+
+def get_signing_credentials(credentials_path=None):
+    '''
+    Loads the service account key used to sign the URLs.  Signing happens
+    locally with the private key, so no API calls are made.
+    '''
+    if credentials_path is None:
+        credentials_path = settings.CONFIG_PARAMS.get('google_signing_credentials', '')
+    if not credentials_path:
+        raise exceptions.ExceptionWithMessage('Browser downloads are not enabled.')
+    return service_account.Credentials.from_service_account_file(credentials_path)
+
+
+def generate_signed_url(resource, credentials, lifetime_seconds):
+    '''
+    Returns a V4 signed URL for the storage object underlying the Resource.
+    The response prompts the browser to save the file under the Resource name.
+    '''
+    bucket_name, object_name = streaming.split_bucket_path(resource.path)
+
+    # no client is needed since the credentials are given explicitly:
+    blob = storage.Bucket(None, bucket_name).blob(object_name)
+    return blob.generate_signed_url(
+        expiration=datetime.timedelta(seconds=lifetime_seconds),
+        method='GET',
+        version='v4',
+        credentials=credentials,
+        response_disposition='attachment; filename="%s"' % resource.name
+    )
+
+
+def get_downloadable_resources(resource_pks, user):
+    '''
+    Returns the requested Resources, locked for update.  Raises an exception 
+    if ANY of them may not be downloaded (not owned by the user, inactive, 
+    expired, or out of downloads).  Must be called within a transaction.
+    '''
+    resource_pks = set(resource_pks)
+    if len(resource_pks) == 0:
+        raise exceptions.ExceptionWithMessage('There were no resources to download.')
+
+    queryset = Resource.objects.select_for_update().filter(pk__in=resource_pks, 
+        is_active=True, 
+        originated_from_upload=False)
+    if not user.is_staff:
+        queryset = queryset.filter(owner=user)
+    resources = list(queryset)
+    if len(resources) != len(resource_pks):
+        raise exceptions.ExceptionWithMessage('''
+            Requesting to download a resource you do not own, is not active, or not able to be downloaded.
+        ''')
+
+    today = datetime.date.today()
+    maximum_downloads = int(settings.CONFIG_PARAMS['maximum_downloads'])
+    for resource in resources:
+        if (resource.expiration_date is not None) and (resource.expiration_date < today):
+            raise exceptions.ExceptionWithMessage('The file %s has expired.' % resource.name)
+        if resource.total_downloads >= maximum_downloads:
+            raise exceptions.ExceptionWithMessage('The file %s has reached its download limit.' % resource.name)
+    return resources
+
+
+def issue_browser_downloads(resource_pks, user_pk):
+    '''
+    Checks the request, records the downloads, and returns a list of dicts 
+    (one per Resource) which give the signed URL and when it expires.
+    '''
+    if settings.CONFIG_PARAMS['cloud_environment'] != settings.GOOGLE:
+        raise exceptions.ExceptionWithMessage('Browser downloads are only available for Google storage.')
+
+    user = get_user_model().objects.get(pk=user_pk)
+    credentials = get_signing_credentials()
+    lifetime_seconds = int(settings.CONFIG_PARAMS['signed_url_lifetime_seconds'])
+
+    with transaction.atomic():
+        resources = get_downloadable_resources(resource_pks, user)
+
+        # sign everything prior to recording the downloads, so a problem with 
+        # the key does not use up any downloads
+        expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=lifetime_seconds)
+        downloads = []
+        for resource in resources:
+            downloads.append({
+                'resource_pk': resource.pk,
+                'name': resource.name,
+                'size': resource.size,
+                'url': generate_signed_url(resource, credentials, lifetime_seconds),
+                'expires': expires.strftime('%Y-%m-%dT%H:%M:%SZ')
+            })
+
+        tc = TransferCoordinator.objects.create()
+        for resource in resources:
+            transfer_obj = Transfer.objects.create(download=True,
+                resource=resource,
+                destination=settings.BROWSER,
+                coordinator=tc,
+                originator=user,
+                started=True
+            )
+            # the user is waiting on the response, so no notification is sent
+            transfer_obj.finalize(True)
+    return downloads
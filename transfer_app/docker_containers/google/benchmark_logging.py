@@ -0,0 +1,108 @@
+#! /usr/bin/python3
+
+'''
+Compares the throughput of a chunked transfer loop when logging directly to
+Stackdriver (one blocking API call per log_text) against the BatchedLogger
+used by the transfer containers.
+
+The logging API is replaced by a stub sink which sleeps for a fixed latency on
+each request, so no credentials are needed.  The BatchedLogger class is loaded
+from one of the container scripts, so this should be run where that container's
+requirements are installed, e.g.:
+
+	python3 benchmark_logging.py -container downloads/dropbox/container_startup.py
+'''
+
+import os
+import time
+import hashlib
+import argparse
+import importlib.util
+
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+class StubBatch(object):
+	def __init__(self, sink):
+		self.sink = sink
+		self.entries = []
+
+	def log_text(self, text, **kwargs):
+		self.entries.append(text)
+
+	def commit(self):
+		time.sleep(self.sink.latency)
+		self.sink.requests += 1
+		self.sink.entries += len(self.entries)
+
+
+class StubSink(object):
+	'''
+	Stands in for a google.cloud.logging Logger.  Each request (single entry
+	or a batch) takes `latency` seconds.
+	'''
+	def __init__(self, latency):
+		self.latency = latency
+		self.requests = 0
+		self.entries = 0
+
+	def log_text(self, text, **kwargs):
+		time.sleep(self.latency)
+		self.requests += 1
+		self.entries += 1
+
+	def batch(self):
+		return StubBatch(self)
+
+
+def load_container_module(container_path):
+	spec = importlib.util.spec_from_file_location('container_startup', container_path)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+
+def run_chunk_loop(logger, num_chunks, logs_per_chunk, chunk_size):
+	'''
+	Mimics the transfer loops: some work on each chunk, with a few log
+	messages per chunk.  Returns the elapsed time.
+	'''
+	data = os.urandom(chunk_size)
+	start = time.time()
+	for i in range(num_chunks):
+		for j in range(logs_per_chunk):
+			logger.log_text('Chunk %d, message %d' % (i, j))
+		hashlib.md5(data).hexdigest()
+	return time.time() - start
+
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-container", help="Path (relative to this script) of a container script providing BatchedLogger", dest='container', default='downloads/dropbox/container_startup.py')
+	parser.add_argument("-chunks", help="Number of chunks in the loop", dest='num_chunks', type=int, default=2000)
+	parser.add_argument("-logs", help="Log messages per chunk", dest='logs_per_chunk', type=int, default=3)
+	parser.add_argument("-size", help="Size of each chunk of work (bytes)", dest='chunk_size', type=int, default=64*1024)
+	parser.add_argument("-latency", help="Seconds per logging API request", dest='latency', type=float, default=0.02)
+	return parser.parse_args()
+
+
+if __name__ == '__main__':
+	args = parse_args()
+	module = load_container_module(os.path.join(THIS_DIR, args.container))
+
+	direct_sink = StubSink(args.latency)
+	direct_time = run_chunk_loop(direct_sink, args.num_chunks, args.logs_per_chunk, args.chunk_size)
+
+	batched_sink = StubSink(args.latency)
+	batched_logger = module.BatchedLogger(batched_sink)
+	batched_time = run_chunk_loop(batched_logger, args.num_chunks, args.logs_per_chunk, args.chunk_size)
+	close_start = time.time()
+	batched_logger.close()
+	close_time = time.time() - close_start
+
+	print('Direct:  %.2f chunks/s (%.2fs, %d logging requests)'
+		% (args.num_chunks/direct_time, direct_time, direct_sink.requests))
+	print('Batched: %.2f chunks/s (%.2fs, %d logging requests, %.2fs to flush at close)'
+		% (args.num_chunks/batched_time, batched_time, batched_sink.requests, close_time))
+	print('Entries received: direct=%d, batched=%d' % (direct_sink.entries, batched_sink.entries))
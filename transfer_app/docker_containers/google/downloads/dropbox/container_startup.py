@@ -2,56 +2,218 @@
 
 import os
 import io
-import subprocess as sp
 import argparse
+import signal
+import atexit
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import dropbox
 import datetime
 from Crypto.Cipher import DES
 import base64
 import requests
 from google.cloud import logging
+from google.cloud import storage
 from apiclient.discovery import build
 
-MOUNT_DIR = '/gcs_mount'
 DEFAULT_TIMEOUT = 60
 DEFAULT_CHUNK_SIZE = 150*1024*1024 # dropbox says <150MB per chunk
 HOSTNAME_REQUEST_URL = 'http://metadata/computeMetadata/v1/instance/hostname'
 GOOGLE_BUCKET_PREFIX = 'gs://'
+LOG_BATCH_SIZE = 100 # max number of log entries sent in a single request
+LOG_FLUSH_INTERVAL = 5 # seconds between sending queued log entries
+LOG_CLOSE_TIMEOUT = 30 # seconds to wait for the remaining entries to be sent
+PROGRESS_INTERVAL = 30 # minimum seconds between reporting progress samples
+CHECKPOINT_INTERVAL = 60 # minimum seconds between reporting checkpoints
 MAX_CONSECUTIVE_ERRORS = 5
-
-
-def fuse_mount(bucketname, logger):
+RANGE_SIZE = 16*1024*1024 # size of each ranged read from storage
+PARALLEL_READS = 8 # number of ranged reads made concurrently (i.e. how far we read ahead)
+MAX_READ_ATTEMPTS = 5
+
+# For files larger than DEFAULT_CHUNK_SIZE, we use a concurrent upload session.  
+# Each append (except the last) must be a multiple of CHUNK_UNIT.  The chunk size 
+# starts at INITIAL_CHUNK_SIZE and is adjusted (within the min/max) from the measured 
+# throughput so that each append takes roughly TARGET_APPEND_SECONDS
+PARALLEL_APPENDS = 4
+CHUNK_UNIT = 4*1024*1024
+INITIAL_CHUNK_SIZE = 8*1024*1024
+MIN_CHUNK_SIZE = CHUNK_UNIT
+MAX_CHUNK_SIZE = 128*1024*1024
+TARGET_APPEND_SECONDS = 10
+
+# Chunks are planned (and their boundaries reported with a checkpoint) this many 
+# at a time, before any of them are sent.  A worker which resumes the session 
+# sends on the same boundaries, so a chunk which was already received is never
+# sent again with a different size.
+PLANNED_CHUNKS = 2*PARALLEL_APPENDS
+
+
+class GoogleStorageStream(object):
 	'''
-	Mounts the bucket to MOUNT_DIR
+	A read-only, seekable file-like object for a single object in Google storage.
+	Rather than mounting the bucket, the object is read with ranged requests of
+	RANGE_SIZE bytes.  Up to PARALLEL_READS ranges ahead of the current position
+	are fetched concurrently, so the next chunk is typically in memory by the time 
+	the current one has been sent.  Nothing is written to disk.
 	'''
-	cmd = 'gcsfuse --implicit-dirs %s %s' % (bucketname, MOUNT_DIR)
-	logger.log_text('Mount bucket with: %s' % cmd) 
-	p = sp.Popen(cmd, shell=True, stdout=sp.PIPE, stderr=sp.STDOUT)
-	stdout, stderr = p.communicate()
-	if p.returncode != 0:
-		logger.log_text('There was a problem with running the following: %s' % cmd)
-		logger.log_text('stdout: %s' % stdout)
-		logger.log_text('stderr: %s' % stderr)
-		raise Exception('gcsfuse mount failed.')
-	else:
-		logger.log_text('Successfully mounted bucket.')
-
 
-def unmount_fuse(logger):
+	def __init__(self, resource_path, logger):
+		split_resource_path_no_prefix = resource_path[len(GOOGLE_BUCKET_PREFIX):].split('/')
+		self.bucketname = split_resource_path_no_prefix[0]
+		self.object_name = '/'.join(split_resource_path_no_prefix[1:])
+		self.logger = logger
+
+		# the storage client is not guaranteed to be thread-safe, so each
+		# thread that reads gets its own (see _get_blob)
+		self.local = threading.local()
+		blob = self._get_blob()
+		blob.reload()
+		self.size = blob.size
+		self.name = os.path.basename(self.object_name)
+		self.position = 0
+		self.executor = ThreadPoolExecutor(max_workers=PARALLEL_READS)
+		self.pending = {}
+		self.last_index = (self.size - 1) // RANGE_SIZE
+
+	def _get_blob(self):
+		if not hasattr(self.local, 'blob'):
+			storage_client = storage.Client()
+			self.local.blob = storage_client.bucket(self.bucketname).blob(self.object_name)
+		return self.local.blob
+
+	def _fetch(self, index):
+		'''
+		Performs the ranged read for the index-th range of the object
+		'''
+		start = index * RANGE_SIZE
+		end = min(start + RANGE_SIZE, self.size) - 1
+		attempt = 0
+		while True:
+			try:
+				return self._get_blob().download_as_string(start=start, end=end)
+			except Exception as ex:
+				attempt += 1
+				if attempt >= MAX_READ_ATTEMPTS:
+					raise ex
+				self.logger.log_text('Ranged read of bytes %d-%d failed.  Retrying.' % (start, end))
+
+	def _schedule(self, index):
+		'''
+		Ensures the ranges from index onwards are requested, and drops any
+		that are no longer needed (e.g. those we have already passed)
+		'''
+		window = range(index, min(index + PARALLEL_READS, self.last_index + 1))
+		for i in list(self.pending.keys()):
+			if i not in window:
+				self.pending.pop(i).cancel()
+		for i in window:
+			if i not in self.pending:
+				self.pending[i] = self.executor.submit(self._fetch, i)
+
+	def read(self, size=-1):
+		if self.position >= self.size:
+			return b''
+		if (size is None) or (size < 0):
+			size = self.size - self.position
+		end = min(self.position + size, self.size)
+		pieces = []
+		while self.position < end:
+			index = self.position // RANGE_SIZE
+			self._schedule(index)
+			data = self.pending[index].result()
+			offset = self.position - index * RANGE_SIZE
+			n = min(end - self.position, len(data) - offset)
+			pieces.append(data[offset:offset + n])
+			self.position += n
+		return b''.join(pieces)
+
+	def tell(self):
+		return self.position
+
+	def seek(self, offset, whence=io.SEEK_SET):
+		if whence == io.SEEK_SET:
+			self.position = offset
+		elif whence == io.SEEK_CUR:
+			self.position += offset
+		elif whence == io.SEEK_END:
+			self.position = self.size + offset
+		return self.position
+
+	def close(self):
+		for future in self.pending.values():
+			future.cancel()
+		self.pending = {}
+		self.executor.shutdown(wait=False)
+
+
+class BatchedLogger(object):
 	'''
-	UNmounts the bucket mounted at MOUNT_DIR
+	Wraps a Stackdriver logger so that calls to log_text do not block on the
+	logging API.  Entries are queued and sent in batches by a background thread
+	once LOG_BATCH_SIZE entries have accumulated or every LOG_FLUSH_INTERVAL seconds.
+	Remaining entries are sent when close() is called (or at exit).  If the 
+	logging API fails, the entries are printed to stdout instead.
 	'''
-	cmd = 'fusermount -u %s ' % MOUNT_DIR
-	logger.log_text('UNmount bucket with: %s' % cmd) 
-	p = sp.Popen(cmd, shell=True, stdout=sp.PIPE, stderr=sp.STDOUT)
-	stdout, stderr = p.communicate()
-	if p.returncode != 0:
-		logger.log_text('There was a problem with running the following: %s' % cmd)
-		logger.log_text('stdout: %s' % stdout)
-		logger.log_text('stderr: %s' % stderr)
-		raise Exception('Failed when attempting to mount bucket with gcsfuse')
-	else:
-		logger.log_text('Successfully unmounted the temporary bucket.')
+
+	def __init__(self, cloud_logger):
+		self.cloud_logger = cloud_logger
+		self.queue = queue.Queue()
+		self.closed = False
+		self.worker = threading.Thread(target=self._run)
+		self.worker.daemon = True
+		self.worker.start()
+		atexit.register(self.close)
+
+	def log_text(self, text):
+		entry = (text, datetime.datetime.utcnow())
+		if self.closed:
+			self._send([entry,])
+		else:
+			self.queue.put(entry)
+
+	def _send(self, entries):
+		try:
+			batch = self.cloud_logger.batch()
+			for text, timestamp in entries:
+				batch.log_text(text, timestamp=timestamp)
+			batch.commit()
+		except Exception as ex:
+			print('Could not send log entries (%s).  Printing instead.' % ex)
+			for text, timestamp in entries:
+				print('%s %s' % (timestamp.isoformat(), text))
+
+	def _run(self):
+		while True:
+			entries = []
+			deadline = time.time() + LOG_FLUSH_INTERVAL
+			while len(entries) < LOG_BATCH_SIZE:
+				timeout = deadline - time.time()
+				if timeout <= 0:
+					break
+				try:
+					entry = self.queue.get(timeout=timeout)
+				except queue.Empty:
+					break
+				if entry is None:
+					# close() was called.  Send what remains and stop.
+					if entries:
+						self._send(entries)
+					return
+				entries.append(entry)
+			if entries:
+				self._send(entries)
+
+	def close(self):
+		'''
+		Sends any queued entries.  Should be called prior to removing the VM.
+		'''
+		if self.closed:
+			return
+		self.closed = True
+		self.queue.put(None)
+		self.worker.join(LOG_CLOSE_TIMEOUT)
 
 
 def create_logger():
@@ -62,7 +224,137 @@ def create_logger():
 	logname = '%s.log' % instance_name
 	logging_client = logging.Client()
 	logger = logging_client.logger(logname)
-	return logger
+	return BatchedLogger(logger)
+
+
+class PreemptedException(Exception):
+	pass
+
+
+def handle_sigterm(signum, frame):
+	'''
+	When a (preemptible) VM is stopped, the container receives SIGTERM
+	and has a short time to exit.  Raising here ends the transfer so that
+	we can report the failure, allowing the transfer to be relaunched.
+	'''
+	raise PreemptedException('Received SIGTERM.  The VM is likely being preempted.')
+
+
+def get_encoded_token(params):
+	'''
+	Prepares the token which identifies the VM as a 'known' sender
+	'''
+	token = params['token']
+	obj=DES.new(params['enc_key'], DES.MODE_ECB)
+	enc_token = obj.encrypt(token)
+	return base64.encodestring(enc_token)
+
+
+class Checkpointer(object):
+	'''
+	Reports the upload session and the number of bytes committed to it back to
+	the main application (at most every CHECKPOINT_INTERVAL seconds), along with
+	the boundaries of the chunks which may have been sent beyond that.  If this VM 
+	fails or is preempted, a new worker is started which resumes from the 
+	last checkpoint.
+	'''
+
+	def __init__(self, params, logger):
+		self.params = params
+		self.logger = logger
+		self.last_report_time = 0
+		self.latest = None
+		self.latest_reported = None
+		self.boundaries = []
+
+	def report(self, session, offset, force=False):
+		self.boundaries = [b for b in self.boundaries if b > offset]
+		self.latest = (session, offset, tuple(self.boundaries))
+		if force or ((time.time() - self.last_report_time) >= CHECKPOINT_INTERVAL):
+			return self.flush()
+		return True
+
+	def plan(self, session, offset, boundaries):
+		'''
+		Records the boundaries of chunks we are about to send.  These are reported
+		immediately, since a chunk may not be sent before its boundaries are known
+		to the main application.
+		'''
+		self.boundaries.extend(boundaries)
+		if not self.report(session, offset, force=True):
+			raise Exception('Could not report the boundaries of the next chunks.')
+
+	def flush(self):
+		'''
+		Sends the most recent checkpoint, if it has not been sent already.  Returns
+		False if it could not be sent.
+		'''
+		if (self.latest is None) or (self.latest == self.latest_reported) or (not self.params['checkpoint_url']):
+			return True
+		session, offset, boundaries = self.latest
+		d = {}
+		d['token'] = get_encoded_token(self.params)
+		d['transfer_pk'] = self.params['transfer_pk']
+		d['session'] = session
+		d['offset'] = offset
+		d['boundaries'] = ','.join([str(b) for b in boundaries])
+		reported = False
+		try:
+			response = requests.post(self.params['checkpoint_url'], data=d, timeout=DEFAULT_TIMEOUT)
+			self.logger.log_text('Checkpoint at offset %d.  Status code: %s' % (offset, response.status_code))
+			self.latest_reported = self.latest
+			reported = True
+		except requests.exceptions.RequestException as ex:
+			# not fatal-- we can continue the transfer and report next time
+			self.logger.log_text('Could not report checkpoint: %s' % ex)
+		self.last_report_time = time.time()
+		return reported
+
+
+class ProgressReporter(object):
+	'''
+	Posts samples of our progress (the bytes transferred so far, the throughput 
+	since the previous sample, and the number of chunks which had to be retried) 
+	to the main application, at most every PROGRESS_INTERVAL seconds.
+	'''
+
+	def __init__(self, params, logger):
+		self.params = params
+		self.logger = logger
+		self.bytes_transferred = 0
+		self.retries = 0
+		self.lock = threading.Lock()
+		self.last_report_time = time.time()
+		self.last_report_bytes = 0
+
+	def add_retry(self):
+		# chunks may be retried from several threads at once
+		with self.lock:
+			self.retries += 1
+
+	def update(self, bytes_transferred):
+		self.bytes_transferred = bytes_transferred
+		if (time.time() - self.last_report_time) >= PROGRESS_INTERVAL:
+			self.report()
+
+	def report(self):
+		if not self.params['progress_url']:
+			return
+		now = time.time()
+		elapsed = now - self.last_report_time
+		d = {}
+		d['token'] = get_encoded_token(self.params)
+		d['transfer_pk'] = self.params['transfer_pk']
+		d['bytes_transferred'] = self.bytes_transferred
+		d['bytes_per_second'] = (self.bytes_transferred - self.last_report_bytes) / elapsed if elapsed > 0 else 0
+		d['retries'] = self.retries
+		try:
+			requests.post(self.params['progress_url'], data=d, timeout=DEFAULT_TIMEOUT)
+		except requests.exceptions.RequestException as ex:
+			# not fatal-- progress is only informational
+			self.logger.log_text('Could not report progress: %s' % ex)
+		self.last_report_time = now
+		self.last_report_bytes = self.bytes_transferred
 
 
 def notify_master(params, logger, error=False):
@@ -75,11 +367,7 @@ def notify_master(params, logger, error=False):
 	d = {}
 
 	# prepare the token which identifies the VM as a 'known' sender
-	token = params['token']
-	obj=DES.new(params['enc_key'], DES.MODE_ECB)
-	enc_token = obj.encrypt(token)
-	b64_str = base64.encodestring(enc_token)
-	d['token'] = b64_str
+	d['token'] = get_encoded_token(params)
 
 	# Other required params to return:
 	d['transfer_pk'] = params['transfer_pk']
@@ -90,60 +378,168 @@ def notify_master(params, logger, error=False):
 	logger.log_text('Response text: %s' % response.text)
 
 
-def send_to_dropbox(local_filepath, params, logger):
+def get_dropbox_client(params, local_storage):
+	'''
+	Each thread sending data gets its own client, since the 
+	underlying session is not guaranteed to be thread-safe
+	'''
+	if not hasattr(local_storage, 'client'):
+		local_storage.client = dropbox.dropbox.Dropbox(params['access_token'], timeout=DEFAULT_TIMEOUT)
+	return local_storage.client
+
+
+def append_chunk(data, session_id, offset, close, params, local_storage, progress, logger):
+	'''
+	Sends a single chunk of the file to the concurrent upload session, retrying on
+	connection problems.  Returns a tuple of the number of bytes sent and the 
+	time it took, so the caller can adjust the chunk size.
+	'''
+	client = get_dropbox_client(params, local_storage)
+	cursor = dropbox.files.UploadSessionCursor(session_id, offset=offset)
+	consecutive_errors = 0
+	while True:
+		start = time.time()
+		try:
+			client.files_upload_session_append_v2(data, cursor, close=close)
+			return len(data), time.time() - start
+		except dropbox.exceptions.ApiError as ex:
+			logger.log_text('ERROR: Raised ApiError for chunk at offset %d' % offset)
+			if ex.error.is_incorrect_offset():
+				# If a previous attempt timed out on our end but was actually received,
+				# Dropbox reports the offset following this chunk.  In that case, we are done.
+				correct_offset = ex.error.get_incorrect_offset().correct_offset
+				if correct_offset == offset + len(data):
+					logger.log_text('Chunk at offset %d was already received.' % offset)
+					return len(data), time.time() - start
+				logger.log_text('ERROR: The offset error could not be reconciled (correct offset=%d)' % correct_offset)
+				raise ex
+			else:
+				logger.log_text('ERROR: API error was raised, but was not offset error')
+				raise ex
+		except requests.exceptions.ConnectionError as ex:
+			# we still hold the data, so just send the same chunk again
+			consecutive_errors += 1
+			progress.add_retry()
+			logger.log_text('ERROR: Caught a ConnectionError exception for chunk at offset %d' % offset)
+			if consecutive_errors >= MAX_CONSECUTIVE_ERRORS:
+				raise ex
+			logger.log_text('Go try that chunk again')
+		except requests.exceptions.RequestException as ex:
+			logger.log_text('ERROR: Caught an exception during chunk transfer at offset %d' % offset)
+			raise ex
+
+
+def adjust_chunk_size(num_bytes, elapsed):
 	'''
-	local_filepath is the path on the VM/container of the file that
-	was already downloaded.
+	Given the measured time to send a chunk, returns a chunk size that should 
+	take approximately TARGET_APPEND_SECONDS, rounded to a multiple of CHUNK_UNIT
+	'''
+	throughput = num_bytes / max(elapsed, 1e-3)
+	target = int(throughput * TARGET_APPEND_SECONDS)
+	target = (target // CHUNK_UNIT) * CHUNK_UNIT
+	return max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, target))
+
+
+def plan_chunks(start, chunk_size, file_size):
+	'''
+	Returns the end offsets of the next (up to PLANNED_CHUNKS) chunks, starting
+	at start.  If the rest of the file fits in a single chunk, that is the final
+	chunk, so the last boundary is the file size.
+	'''
+	boundaries = []
+	position = start
+	while (position < file_size) and (len(boundaries) < PLANNED_CHUNKS):
+		if (file_size - position) <= chunk_size:
+			position = file_size
+		else:
+			position += chunk_size
+		boundaries.append(position)
+	return boundaries
+
+
+def send_to_dropbox(stream, params, checkpointer, progress, logger):
+	'''
+	stream is a GoogleStorageStream instance which reads the file
+	directly from storage.  checkpointer is a Checkpointer instance
+	which reports where we may resume from, and progress is a 
+	ProgressReporter instance
 	'''
 	token = params['access_token']
 	client = dropbox.dropbox.Dropbox(token, timeout=DEFAULT_TIMEOUT)
-	file_size = os.path.getsize(local_filepath)
+	file_size = stream.size
 
-	stream = open(local_filepath, 'rb')
-	path_in_dropbox = '%s/%s' % (params['dropbox_destination_folderpath'], os.path.basename(local_filepath))
+	path_in_dropbox = '%s/%s' % (params['dropbox_destination_folderpath'], stream.name)
 	if file_size <= DEFAULT_CHUNK_SIZE:
 		client.files_upload(stream.read(), path_in_dropbox)
+		stream.close()
+		return
+
+	committed = 0
+	planned = []
+	if params['session_id']:
+		# resume the session started by a previous worker, keeping to the chunk
+		# boundaries it planned (some of those chunks may already be received)
+		session_id = params['session_id']
+		committed = params['offset']
+		planned = [b for b in params['boundaries'] if committed < b <= file_size]
+		checkpointer.boundaries = list(planned)
+		stream.seek(committed)
+		logger.log_text('Resuming session %s at offset %d' % (session_id, committed))
 	else:
-		i = 1
-		session_start_result = client.files_upload_session_start(stream.read(DEFAULT_CHUNK_SIZE))
-		cursor=dropbox.files.UploadSessionCursor(session_start_result.session_id, offset=stream.tell())
-		commit=dropbox.files.CommitInfo(path=path_in_dropbox)
+		# A concurrent session allows chunks to be appended in parallel (and in any order).  
+		# No data may be sent with the start or finish requests.
+		session_start_result = client.files_upload_session_start(b'', 
+			session_type=dropbox.files.UploadSessionType.concurrent
+		)
+		session_id = session_start_result.session_id
+	local_storage = threading.local()
+	executor = ThreadPoolExecutor(max_workers=PARALLEL_APPENDS)
+	in_flight = []
+	chunk_size = INITIAL_CHUNK_SIZE
+	i = 1
+	try:
 		while stream.tell() < file_size:
-			logger.log_text('Sending chunk %s' % i)
-			try:
-				if (file_size-stream.tell()) <= DEFAULT_CHUNK_SIZE:
-					logger.log_text('Finishing transfer and committing')
-					client.files_upload_session_finish(stream.read(DEFAULT_CHUNK_SIZE), cursor, commit)
-				else:
-					logger.log_text('About to send chunk')
-					logger.log_text('Prior to chunk transfer, cursor=%d, stream=%d' % (cursor.offset, stream.tell()))
-					client.files_upload_session_append_v2(stream.read(DEFAULT_CHUNK_SIZE), cursor)
-					cursor.offset = stream.tell()
-					logger.log_text('Done with sending chunk %s' % i)
-			except dropbox.exceptions.ApiError as ex:
-				logger.log_text('ERROR: Raised ApiError!')
-				if ex.error.is_incorrect_offset():
-					logger.log_text('ERROR: The error raised was an offset error.  Correcting the cursor and stream offset')
-					correct_offset = ex.error.get_incorrect_offset().correct_offset
-					cursor.offset = correct_offset
-					stream.seek(correct_offset)
-				else:
-					logger.log_text('ERROR: API error was raised, but was not offset error')
-					raise ex
-			except requests.exceptions.ConnectionError as ex:
-				logger.log_text('ERROR: Caught a ConnectionError exception')
-				# need to rewind the stream
-				logger.log_text('At this point, cursor=%d, stream=%d' % (cursor.offset, stream.tell()))
-				cursor_offset = cursor.offset
-				stream.seek(cursor_offset)
-				logger.log_text('After rewind, cursor=%d, stream=%d' % (cursor.offset, stream.tell()))
-				logger.log_text('Go try that chunk again')
-			except requests.exceptions.RequestException as ex:
-				logger.log_text('ERROR: Caught an exception during chunk transfer')
-				logger.log_text('ERROR: Following FAILED chunk transfer, cursor=%d, stream=%d' % (cursor.offset, stream.tell()))
-				raise ex
+			if len(planned) == 0:
+				planned = plan_chunks(stream.tell(), chunk_size, file_size)
+				checkpointer.plan(session_id, committed, planned)
+			offset = stream.tell()
+			end = planned.pop(0)
+			if end == file_size:
+				# the final chunk closes the session, so all the others need to be
+				# received before it is sent.
+				for chunk_offset, future in in_flight:
+					num_bytes, elapsed = future.result()
+					committed = chunk_offset + num_bytes
+					checkpointer.report(session_id, committed)
+					progress.update(committed)
+				in_flight = []
+				logger.log_text('Sending final chunk %s and closing session' % i)
+				append_chunk(stream.read(end - offset), session_id, offset, True, params, local_storage, progress, logger)
+			else:
+				# limit the number of chunks held in memory:
+				if len(in_flight) >= PARALLEL_APPENDS:
+					chunk_offset, future = in_flight.pop(0)
+					num_bytes, elapsed = future.result()
+					chunk_size = adjust_chunk_size(num_bytes, elapsed)
+
+					# the chunks are waited on in order, so everything prior to the 
+					# end of this chunk has been received:
+					committed = chunk_offset + num_bytes
+					checkpointer.report(session_id, committed)
+					progress.update(committed)
+				logger.log_text('Sending chunk %s (%d bytes) at offset %d' % (i, end - offset, offset))
+				data = stream.read(end - offset)
+				in_flight.append((offset, executor.submit(append_chunk, 
+					data, session_id, offset, False, params, local_storage, progress, logger)))
 			i += 1
-	stream.close()
+	finally:
+		executor.shutdown(wait=True)
+		stream.close()
+
+	logger.log_text('Finishing transfer and committing')
+	cursor = dropbox.files.UploadSessionCursor(session_id, offset=file_size)
+	commit = dropbox.files.CommitInfo(path=path_in_dropbox)
+	client.files_upload_session_finish(b'', cursor, commit)
 
 
 def get_hostname():
@@ -176,6 +572,11 @@ def parse_args():
 	parser.add_argument("-d", help="The folder in Dropbox where the file will go", dest='dropbox_destination_folderpath', required=True)
 	parser.add_argument("-proj", help="Google project ID", dest='google_project_id', required=True)
 	parser.add_argument("-zone", help="Google project zone", dest='google_zone', required=True)
+	parser.add_argument("-progress_url", help="The URL for reporting progress samples to the main application", dest='progress_url', required=False)
+	parser.add_argument("-checkpoint_url", help="The URL for reporting progress to the main application", dest='checkpoint_url', required=False)
+	parser.add_argument("-session", help="If resuming, the upload session started by a previous worker", dest='session_id', required=False)
+	parser.add_argument("-offset", help="If resuming, the number of bytes already committed to the upload session", dest='offset', type=int, default=0, required=False)
+	parser.add_argument("-boundaries", help="If resuming, the (comma-separated) chunk boundaries planned by a previous worker", dest='boundaries', default='', required=False)
 	args = parser.parse_args()
 	params = {}
 	params['token'] = args.token
@@ -187,6 +588,11 @@ def parse_args():
 	params['dropbox_destination_folderpath'] = args.dropbox_destination_folderpath
 	params['google_project_id'] = args.google_project_id
 	params['google_zone'] = args.google_zone
+	params['progress_url'] = args.progress_url
+	params['checkpoint_url'] = args.checkpoint_url
+	params['session_id'] = args.session_id
+	params['offset'] = args.offset
+	params['boundaries'] = [int(x) for x in args.boundaries.split(',') if x]
 	return params
 
 
@@ -196,32 +602,26 @@ if __name__ == '__main__':
 		# get the arguments passed to this script
 		params = parse_args()
 
-		# the directory where the bucket will be mounted to:
-		os.mkdir(MOUNT_DIR)
-
 		# create the logger so we can see what goes wrong...
 		logger = create_logger()
 
-		split_resource_path_no_prefix = params['resource_path'][len(GOOGLE_BUCKET_PREFIX):].split('/')
-		bucketname = split_resource_path_no_prefix[0]
-		object_name = '/'.join(split_resource_path_no_prefix[1:])
-
-		# now mount that bucket
-		fuse_mount(bucketname, logger)
-
-		# get the location of the mounted file and send it off.
-		local_filepath = os.path.join(MOUNT_DIR, object_name)
-		send_to_dropbox(local_filepath, params, logger)
+		# if this VM is preempted, we end the transfer and report back
+		checkpointer = Checkpointer(params, logger)
+		progress = ProgressReporter(params, logger)
+		signal.signal(signal.SIGTERM, handle_sigterm)
 
-		# unmount the bucket and cleanup:
-		unmount_fuse(logger)
+		# stream the file directly from storage and send it off.
+		stream = GoogleStorageStream(params['resource_path'], logger)
+		send_to_dropbox(stream, params, checkpointer, progress, logger)
 
 		# send notifications and kill this VM:
 		notify_master(params, logger)
+		logger.close()
 		kill_instance(params)
 
 	except Exception as ex:
 		logger.log_text('ERROR: Caught some unexpected exception.')
 		logger.log_text(str(type(ex)))
 		logger.log_text(str(ex))
+		checkpointer.flush()
 		notify_master(params, logger, error=True)
@@ -1,61 +1,209 @@
 #! /usr/bin/python3
 
 import os
+import io
 import argparse
+import signal
+import atexit
+import queue
+import mimetypes
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import time
 import random
 import datetime
 from Crypto.Cipher import DES
 import base64
 import requests
-import subprocess as sp
 import googleapiclient
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.http import MediaIoBaseUpload
 import google.oauth2.credentials
 from google.cloud import logging
+from google.cloud import storage
 
 
-MOUNT_DIR = '/gcs_mount'
 HOSTNAME_REQUEST_URL = 'http://metadata/computeMetadata/v1/instance/hostname'
 GOOGLE_BUCKET_PREFIX = 'gs://'
+DEFAULT_TIMEOUT = 60
+LOG_BATCH_SIZE = 100 # max number of log entries sent in a single request
+LOG_FLUSH_INTERVAL = 5 # seconds between sending queued log entries
+LOG_CLOSE_TIMEOUT = 30 # seconds to wait for the remaining entries to be sent
+PROGRESS_INTERVAL = 30 # minimum seconds between reporting progress samples
+CHECKPOINT_INTERVAL = 60 # minimum seconds between reporting checkpoints
 MAX_FAILS = 10
 BACKOFF_CONST = 1e-4 # for exponential backoff.  See function
+RANGE_SIZE = 16*1024*1024 # size of each ranged read from storage
+PARALLEL_READS = 8 # number of ranged reads made concurrently (i.e. how far we read ahead)
+MAX_READ_ATTEMPTS = 5
+DRIVE_CHUNK_SIZE = 100*1024*1024 # size of each chunk sent in the resumable upload.  Multiple of 256KB
 
 
 
-def fuse_mount(bucketname, logger):
+class GoogleStorageStream(object):
 	'''
-	Mounts the bucket to MOUNT_DIR
+	A read-only, seekable file-like object for a single object in Google storage.
+	Rather than mounting the bucket, the object is read with ranged requests of
+	RANGE_SIZE bytes.  Up to PARALLEL_READS ranges ahead of the current position
+	are fetched concurrently, so the next chunk is typically in memory by the time 
+	the current one has been sent.  Nothing is written to disk.
 	'''
-	cmd = 'gcsfuse --implicit-dirs %s %s' % (bucketname, MOUNT_DIR)
-	logger.log_text('Mount bucket with: %s' % cmd) 
-	p = sp.Popen(cmd, shell=True, stdout=sp.PIPE, stderr=sp.STDOUT)
-	stdout, stderr = p.communicate()
-	if p.returncode != 0:
-		logger.log_text('There was a problem with running the following: %s' % cmd)
-		logger.log_text('stdout: %s' % stdout)
-		logger.log_text('stderr: %s' % stderr)
-		raise Exception('gcsfuse mount failed.')
-	else:
-		logger.log_text('Successfully mounted bucket.')
-
 
-def unmount_fuse(logger):
+	def __init__(self, resource_path, logger):
+		split_resource_path_no_prefix = resource_path[len(GOOGLE_BUCKET_PREFIX):].split('/')
+		self.bucketname = split_resource_path_no_prefix[0]
+		self.object_name = '/'.join(split_resource_path_no_prefix[1:])
+		self.logger = logger
+
+		# the storage client is not guaranteed to be thread-safe, so each
+		# thread that reads gets its own (see _get_blob)
+		self.local = threading.local()
+		blob = self._get_blob()
+		blob.reload()
+		self.size = blob.size
+		self.name = os.path.basename(self.object_name)
+		self.position = 0
+		self.executor = ThreadPoolExecutor(max_workers=PARALLEL_READS)
+		self.pending = {}
+		self.last_index = (self.size - 1) // RANGE_SIZE
+
+	def _get_blob(self):
+		if not hasattr(self.local, 'blob'):
+			storage_client = storage.Client()
+			self.local.blob = storage_client.bucket(self.bucketname).blob(self.object_name)
+		return self.local.blob
+
+	def _fetch(self, index):
+		'''
+		Performs the ranged read for the index-th range of the object
+		'''
+		start = index * RANGE_SIZE
+		end = min(start + RANGE_SIZE, self.size) - 1
+		attempt = 0
+		while True:
+			try:
+				return self._get_blob().download_as_string(start=start, end=end)
+			except Exception as ex:
+				attempt += 1
+				if attempt >= MAX_READ_ATTEMPTS:
+					raise ex
+				self.logger.log_text('Ranged read of bytes %d-%d failed.  Retrying.' % (start, end))
+
+	def _schedule(self, index):
+		'''
+		Ensures the ranges from index onwards are requested, and drops any
+		that are no longer needed (e.g. those we have already passed)
+		'''
+		window = range(index, min(index + PARALLEL_READS, self.last_index + 1))
+		for i in list(self.pending.keys()):
+			if i not in window:
+				self.pending.pop(i).cancel()
+		for i in window:
+			if i not in self.pending:
+				self.pending[i] = self.executor.submit(self._fetch, i)
+
+	def read(self, size=-1):
+		if self.position >= self.size:
+			return b''
+		if (size is None) or (size < 0):
+			size = self.size - self.position
+		end = min(self.position + size, self.size)
+		pieces = []
+		while self.position < end:
+			index = self.position // RANGE_SIZE
+			self._schedule(index)
+			data = self.pending[index].result()
+			offset = self.position - index * RANGE_SIZE
+			n = min(end - self.position, len(data) - offset)
+			pieces.append(data[offset:offset + n])
+			self.position += n
+		return b''.join(pieces)
+
+	def tell(self):
+		return self.position
+
+	def seek(self, offset, whence=io.SEEK_SET):
+		if whence == io.SEEK_SET:
+			self.position = offset
+		elif whence == io.SEEK_CUR:
+			self.position += offset
+		elif whence == io.SEEK_END:
+			self.position = self.size + offset
+		return self.position
+
+	def close(self):
+		for future in self.pending.values():
+			future.cancel()
+		self.pending = {}
+		self.executor.shutdown(wait=False)
+
+
+class BatchedLogger(object):
 	'''
-	UNmounts the bucket mounted at MOUNT_DIR
+	Wraps a Stackdriver logger so that calls to log_text do not block on the
+	logging API.  Entries are queued and sent in batches by a background thread
+	once LOG_BATCH_SIZE entries have accumulated or every LOG_FLUSH_INTERVAL seconds.
+	Remaining entries are sent when close() is called (or at exit).  If the 
+	logging API fails, the entries are printed to stdout instead.
 	'''
-	cmd = 'fusermount -u %s ' % MOUNT_DIR
-	logger.log_text('UNmount bucket with: %s' % cmd) 
-	p = sp.Popen(cmd, shell=True, stdout=sp.PIPE, stderr=sp.STDOUT)
-	stdout, stderr = p.communicate()
-	if p.returncode != 0:
-		logger.log_text('There was a problem with running the following: %s' % cmd)
-		logger.log_text('stdout: %s' % stdout)
-		logger.log_text('stderr: %s' % stderr)
-		raise Exception('gcsfuse unmount failed.')
-	else:
-		logger.log_text('Successfully unmounted the temporary bucket.')
+
+	def __init__(self, cloud_logger):
+		self.cloud_logger = cloud_logger
+		self.queue = queue.Queue()
+		self.closed = False
+		self.worker = threading.Thread(target=self._run)
+		self.worker.daemon = True
+		self.worker.start()
+		atexit.register(self.close)
+
+	def log_text(self, text):
+		entry = (text, datetime.datetime.utcnow())
+		if self.closed:
+			self._send([entry,])
+		else:
+			self.queue.put(entry)
+
+	def _send(self, entries):
+		try:
+			batch = self.cloud_logger.batch()
+			for text, timestamp in entries:
+				batch.log_text(text, timestamp=timestamp)
+			batch.commit()
+		except Exception as ex:
+			print('Could not send log entries (%s).  Printing instead.' % ex)
+			for text, timestamp in entries:
+				print('%s %s' % (timestamp.isoformat(), text))
+
+	def _run(self):
+		while True:
+			entries = []
+			deadline = time.time() + LOG_FLUSH_INTERVAL
+			while len(entries) < LOG_BATCH_SIZE:
+				timeout = deadline - time.time()
+				if timeout <= 0:
+					break
+				try:
+					entry = self.queue.get(timeout=timeout)
+				except queue.Empty:
+					break
+				if entry is None:
+					# close() was called.  Send what remains and stop.
+					if entries:
+						self._send(entries)
+					return
+				entries.append(entry)
+			if entries:
+				self._send(entries)
+
+	def close(self):
+		'''
+		Sends any queued entries.  Should be called prior to removing the VM.
+		'''
+		if self.closed:
+			return
+		self.closed = True
+		self.queue.put(None)
+		self.worker.join(LOG_CLOSE_TIMEOUT)
 
 
 def create_logger():
@@ -66,7 +214,118 @@ def create_logger():
 	logname = '%s.log' % instance_name
 	logging_client = logging.Client()
 	logger = logging_client.logger(logname)
-	return logger
+	return BatchedLogger(logger)
+
+
+class PreemptedException(Exception):
+	pass
+
+
+def handle_sigterm(signum, frame):
+	'''
+	When a (preemptible) VM is stopped, the container receives SIGTERM
+	and has a short time to exit.  Raising here ends the transfer so that
+	we can report the failure, allowing the transfer to be relaunched.
+	'''
+	raise PreemptedException('Received SIGTERM.  The VM is likely being preempted.')
+
+
+def get_encoded_token(params):
+	'''
+	Prepares the token which identifies the VM as a 'known' sender
+	'''
+	token = params['token']
+	obj=DES.new(params['enc_key'], DES.MODE_ECB)
+	enc_token = obj.encrypt(token)
+	return base64.encodestring(enc_token)
+
+
+class Checkpointer(object):
+	'''
+	Reports the upload session and the number of bytes committed to it back to
+	the main application (at most every CHECKPOINT_INTERVAL seconds).  If this VM 
+	fails or is preempted, a new worker is started which resumes from the 
+	last checkpoint.
+	'''
+
+	def __init__(self, params, logger):
+		self.params = params
+		self.logger = logger
+		self.last_report_time = 0
+		self.latest = None
+		self.latest_reported = None
+
+	def report(self, session, offset):
+		self.latest = (session, offset)
+		if (time.time() - self.last_report_time) >= CHECKPOINT_INTERVAL:
+			self.flush()
+
+	def flush(self):
+		'''
+		Sends the most recent checkpoint, if it has not been sent already
+		'''
+		if (self.latest is None) or (self.latest == self.latest_reported) or (not self.params['checkpoint_url']):
+			return
+		session, offset = self.latest
+		d = {}
+		d['token'] = get_encoded_token(self.params)
+		d['transfer_pk'] = self.params['transfer_pk']
+		d['session'] = session
+		d['offset'] = offset
+		try:
+			response = requests.post(self.params['checkpoint_url'], data=d, timeout=DEFAULT_TIMEOUT)
+			self.logger.log_text('Checkpoint at offset %d.  Status code: %s' % (offset, response.status_code))
+			self.latest_reported = self.latest
+		except requests.exceptions.RequestException as ex:
+			# not fatal-- we can continue the transfer and report next time
+			self.logger.log_text('Could not report checkpoint: %s' % ex)
+		self.last_report_time = time.time()
+
+
+class ProgressReporter(object):
+	'''
+	Posts samples of our progress (the bytes transferred so far, the throughput 
+	since the previous sample, and the number of chunks which had to be retried) 
+	to the main application, at most every PROGRESS_INTERVAL seconds.
+	'''
+
+	def __init__(self, params, logger):
+		self.params = params
+		self.logger = logger
+		self.bytes_transferred = 0
+		self.retries = 0
+		self.lock = threading.Lock()
+		self.last_report_time = time.time()
+		self.last_report_bytes = 0
+
+	def add_retry(self):
+		# chunks may be retried from several threads at once
+		with self.lock:
+			self.retries += 1
+
+	def update(self, bytes_transferred):
+		self.bytes_transferred = bytes_transferred
+		if (time.time() - self.last_report_time) >= PROGRESS_INTERVAL:
+			self.report()
+
+	def report(self):
+		if not self.params['progress_url']:
+			return
+		now = time.time()
+		elapsed = now - self.last_report_time
+		d = {}
+		d['token'] = get_encoded_token(self.params)
+		d['transfer_pk'] = self.params['transfer_pk']
+		d['bytes_transferred'] = self.bytes_transferred
+		d['bytes_per_second'] = (self.bytes_transferred - self.last_report_bytes) / elapsed if elapsed > 0 else 0
+		d['retries'] = self.retries
+		try:
+			requests.post(self.params['progress_url'], data=d, timeout=DEFAULT_TIMEOUT)
+		except requests.exceptions.RequestException as ex:
+			# not fatal-- progress is only informational
+			self.logger.log_text('Could not report progress: %s' % ex)
+		self.last_report_time = now
+		self.last_report_bytes = self.bytes_transferred
 
 
 def notify_master(params, logger, error=False):
@@ -79,11 +338,7 @@ def notify_master(params, logger, error=False):
 	d = {}
 
 	# prepare the token which identifies the VM as a 'known' sender
-	token = params['token']
-	obj=DES.new(params['enc_key'], DES.MODE_ECB)
-	enc_token = obj.encrypt(token)
-	b64_str = base64.encodestring(enc_token)
-	d['token'] = b64_str
+	d['token'] = get_encoded_token(params)
 
 	# Other required params to return:
 	d['transfer_pk'] = params['transfer_pk']
@@ -126,23 +381,35 @@ def backoff(fail_num, logger):
 	return
 
 
-def send_to_drive(local_filepath, params, logger):
+def send_to_drive(stream, params, checkpointer, progress, logger):
 	'''
-	local_filepath is the path on the VM/container of the file that
-	was already downloaded.
+	stream is a GoogleStorageStream instance which reads the file
+	directly from storage.  checkpointer is a Checkpointer instance
+	which reports where we may resume from, and progress is a 
+	ProgressReporter instance
 	'''
 	access_token = params['access_token']
 	credentials = google.oauth2.credentials.Credentials(access_token)
 	logger.log_text('About to build Google Drive service')
 	drive_service = build('drive', 'v3', credentials=credentials)
 	logger.log_text('Drive service built.  Instantiate upload.')
-	upload = MediaFileUpload(local_filepath, resumable=True)
-	logger.log_text('Make initial request to upload %s to Drive' % local_filepath)
+	mimetype = mimetypes.guess_type(stream.name)[0] or 'application/octet-stream'
+	upload = MediaIoBaseUpload(stream, 
+		mimetype=mimetype, 
+		chunksize=DRIVE_CHUNK_SIZE, 
+		resumable=True
+	)
+	logger.log_text('Make initial request to upload %s to Drive' % stream.name)
 
 	request = make_request(drive_service, 
-		os.path.basename(local_filepath), 
+		stream.name, 
 		upload
 	)
+	if params['session_id']:
+		# resume the resumable upload started by a previous worker
+		logger.log_text('Resuming upload at offset %d' % params['offset'])
+		request.resumable_uri = params['session_id']
+		request.resumable_progress = params['offset']
 	response = None
 	consecutive_fails = 0
 	chunk_number = 0
@@ -153,18 +420,22 @@ def send_to_drive(local_filepath, params, logger):
 			logger.log_text('Completed sending chunk %d to Drive' % chunk_number)
 			consecutive_fails = 0 # reset the fail counter since a chunk successfully transferred
 			chunk_number += 1
+			if response is None:
+				checkpointer.report(request.resumable_uri, request.resumable_progress)
+				progress.update(request.resumable_progress)
 		except googleapiclient.errors.HttpError as e:
 			logger.log_text('Caught an API exception!')
 			if e.resp.status in [404]:
 				# Start the upload all over again.
 				logger.log_text('The response was a 404.  Restart everything.')
 				request = make_request(drive_service, 
-					os.path.basename(local_filepath), 
+					stream.name, 
 					upload 
 				)
 			elif e.resp.status in [500, 502, 503, 504]:
 				# Call next_chunk() again, but use an exponential backoff for repeated errors.
 				logger.log_text('The response was 5xx.  Try a backoff to see if the problem resolves.')
+				progress.add_retry()
 				backoff(consecutive_fails, logger)
 				if consecutive_fails > MAX_FAILS:
 					logger.log_text('Too many consecutive failures happened.  Bailing.')
@@ -177,6 +448,7 @@ def send_to_drive(local_filepath, params, logger):
 				raise e
 		if status:
 			logger.log_text('Uploaded %d%%.' % int(status.progress() * 100))
+	stream.close()
 
 
 def kill_instance(params):
@@ -200,6 +472,10 @@ def parse_args():
 	parser.add_argument("-access_token", help="The access token for Drive API", dest='access_token', required=True)
 	parser.add_argument("-proj", help="Google project ID", dest='google_project_id', required=True)
 	parser.add_argument("-zone", help="Google project zone", dest='google_zone', required=True)
+	parser.add_argument("-progress_url", help="The URL for reporting progress samples to the main application", dest='progress_url', required=False)
+	parser.add_argument("-checkpoint_url", help="The URL for reporting progress to the main application", dest='checkpoint_url', required=False)
+	parser.add_argument("-session", help="If resuming, the upload session started by a previous worker", dest='session_id', required=False)
+	parser.add_argument("-offset", help="If resuming, the number of bytes already committed to the upload session", dest='offset', type=int, default=0, required=False)
 	args = parser.parse_args()
 	params = {}
 	params['token'] = args.token
@@ -210,6 +486,10 @@ def parse_args():
 	params['access_token'] = args.access_token
 	params['google_project_id'] = args.google_project_id
 	params['google_zone'] = args.google_zone
+	params['progress_url'] = args.progress_url
+	params['checkpoint_url'] = args.checkpoint_url
+	params['session_id'] = args.session_id
+	params['offset'] = args.offset
 	return params
 
 
@@ -217,32 +497,26 @@ if __name__ == '__main__':
 	try:
 		params = parse_args()
 
-		# create the location where we mount the bucket:
-		os.mkdir(MOUNT_DIR)
-
 		# instantiate the stackdriver logger:
 		logger = create_logger()
 
-		split_resource_path_no_prefix = params['resource_path'][len(GOOGLE_BUCKET_PREFIX):].split('/')
-		bucketname = split_resource_path_no_prefix[0]
-		object_name = '/'.join(split_resource_path_no_prefix[1:])
-
-		# now mount that bucket
-		fuse_mount(bucketname, logger)
-
-		# get the location of the mounted file and send it off.
-		local_filepath = os.path.join(MOUNT_DIR, object_name)
-		send_to_drive(local_filepath, params, logger)
+		# if this VM is preempted, we end the transfer and report back
+		checkpointer = Checkpointer(params, logger)
+		progress = ProgressReporter(params, logger)
+		signal.signal(signal.SIGTERM, handle_sigterm)
 
-		# unmount the bucket and cleanup:
-		unmount_fuse(logger)
+		# stream the file directly from storage and send it off.
+		stream = GoogleStorageStream(params['resource_path'], logger)
+		send_to_drive(stream, params, checkpointer, progress, logger)
 
 		# notify head node and kill the instance
 		notify_master(params, logger)
+		logger.close()
 		kill_instance(params)
 
 	except Exception as ex:
 		logger.log_text('ERROR: Caught some unexpected exception.')
 		logger.log_text(str(type(ex)))
 		logger.log_text(str(ex))
+		checkpointer.flush()
 		notify_master(params, logger, error=True)
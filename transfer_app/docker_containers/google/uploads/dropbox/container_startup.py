@@ -2,20 +2,99 @@
 
 import os
 import io
-import subprocess
 import argparse
+import atexit
+import queue
+import threading
+import time
 import datetime
+import hashlib
 from Crypto.Cipher import DES
 import base64
 import requests
 import google
+import google_crc32c
 from google.cloud import storage, logging
 from apiclient.discovery import build
 
 
-WORKING_DIR = '/workspace'
 HOSTNAME_REQUEST_URL = 'http://metadata/computeMetadata/v1/instance/hostname'
 GOOGLE_BUCKET_PREFIX = 'gs://'
+LOG_BATCH_SIZE = 100 # max number of log entries sent in a single request
+LOG_FLUSH_INTERVAL = 5 # seconds between sending queued log entries
+LOG_CLOSE_TIMEOUT = 30 # seconds to wait for the remaining entries to be sent
+PROGRESS_INTERVAL = 30 # minimum seconds between reporting progress samples
+DEFAULT_TIMEOUT = 60
+UPLOAD_CHUNK_SIZE = 64*1024*1024 # size of each request in the resumable upload.  Must be a multiple of 256KB
+MAX_CHUNK_ATTEMPTS = 5 # attempts at sending a chunk before giving up on the upload
+
+class BatchedLogger(object):
+	'''
+	Wraps a Stackdriver logger so that calls to log_text do not block on the
+	logging API.  Entries are queued and sent in batches by a background thread
+	once LOG_BATCH_SIZE entries have accumulated or every LOG_FLUSH_INTERVAL seconds.
+	Remaining entries are sent when close() is called (or at exit).  If the 
+	logging API fails, the entries are printed to stdout instead.
+	'''
+
+	def __init__(self, cloud_logger):
+		self.cloud_logger = cloud_logger
+		self.queue = queue.Queue()
+		self.closed = False
+		self.worker = threading.Thread(target=self._run)
+		self.worker.daemon = True
+		self.worker.start()
+		atexit.register(self.close)
+
+	def log_text(self, text):
+		entry = (text, datetime.datetime.utcnow())
+		if self.closed:
+			self._send([entry,])
+		else:
+			self.queue.put(entry)
+
+	def _send(self, entries):
+		try:
+			batch = self.cloud_logger.batch()
+			for text, timestamp in entries:
+				batch.log_text(text, timestamp=timestamp)
+			batch.commit()
+		except Exception as ex:
+			print('Could not send log entries (%s).  Printing instead.' % ex)
+			for text, timestamp in entries:
+				print('%s %s' % (timestamp.isoformat(), text))
+
+	def _run(self):
+		while True:
+			entries = []
+			deadline = time.time() + LOG_FLUSH_INTERVAL
+			while len(entries) < LOG_BATCH_SIZE:
+				timeout = deadline - time.time()
+				if timeout <= 0:
+					break
+				try:
+					entry = self.queue.get(timeout=timeout)
+				except queue.Empty:
+					break
+				if entry is None:
+					# close() was called.  Send what remains and stop.
+					if entries:
+						self._send(entries)
+					return
+				entries.append(entry)
+			if entries:
+				self._send(entries)
+
+	def close(self):
+		'''
+		Sends any queued entries.  Should be called prior to removing the VM.
+		'''
+		if self.closed:
+			return
+		self.closed = True
+		self.queue.put(None)
+		self.worker.join(LOG_CLOSE_TIMEOUT)
+
 
 def create_logger():
 	"""
@@ -25,7 +104,64 @@ def create_logger():
 	logname = '%s.log' % instance_name
 	logging_client = logging.Client()
 	logger = logging_client.logger(logname)
-	return logger
+	return BatchedLogger(logger)
+
+
+def get_encoded_token(params):
+	'''
+	Prepares the token which identifies the VM as a 'known' sender
+	'''
+	token = params['token']
+	obj=DES.new(params['enc_key'], DES.MODE_ECB)
+	enc_token = obj.encrypt(token)
+	return base64.encodestring(enc_token)
+
+
+class ProgressReporter(object):
+	'''
+	Posts samples of our progress (the bytes transferred so far, the throughput 
+	since the previous sample, and the number of chunks which had to be retried) 
+	to the main application, at most every PROGRESS_INTERVAL seconds.
+	'''
+
+	def __init__(self, params, logger):
+		self.params = params
+		self.logger = logger
+		self.bytes_transferred = 0
+		self.retries = 0
+		self.lock = threading.Lock()
+		self.last_report_time = time.time()
+		self.last_report_bytes = 0
+
+	def add_retry(self):
+		# chunks may be retried from several threads at once
+		with self.lock:
+			self.retries += 1
+
+	def update(self, bytes_transferred):
+		self.bytes_transferred = bytes_transferred
+		if (time.time() - self.last_report_time) >= PROGRESS_INTERVAL:
+			self.report()
+
+	def report(self):
+		if not self.params['progress_url']:
+			return
+		now = time.time()
+		elapsed = now - self.last_report_time
+		d = {}
+		d['token'] = get_encoded_token(self.params)
+		d['transfer_pk'] = self.params['transfer_pk']
+		d['bytes_transferred'] = self.bytes_transferred
+		d['bytes_per_second'] = (self.bytes_transferred - self.last_report_bytes) / elapsed if elapsed > 0 else 0
+		d['retries'] = self.retries
+		try:
+			requests.post(self.params['progress_url'], data=d, timeout=DEFAULT_TIMEOUT)
+		except requests.exceptions.RequestException as ex:
+			# not fatal-- progress is only informational
+			self.logger.log_text('Could not report progress: %s' % ex)
+		self.last_report_time = now
+		self.last_report_bytes = self.bytes_transferred
+
 
 def notify_master(params, logger, error=False):
 	'''
@@ -37,11 +173,7 @@ def notify_master(params, logger, error=False):
 	d = {}
 
 	# prepare the token which identifies the VM as a 'known' sender
-	token = params['token']
-	obj=DES.new(params['enc_key'], DES.MODE_ECB)
-	enc_token = obj.encrypt(token)
-	b64_str = base64.encodestring(enc_token)
-	d['token'] = b64_str
+	d['token'] = get_encoded_token(params)
 
 	# Other required params to return:
 	d['transfer_pk'] = params['transfer_pk']
@@ -52,90 +184,240 @@ def notify_master(params, logger, error=False):
 	logger.log_text('Response text: %s' % response.text)
 
 
-def send_to_bucket(local_filepath, params, logger):
+class HashingStream(object):
 	'''
-	Uploads the local file to the bucket
+	Reads the (non-seekable) stream of the file coming from Dropbox a chunk at
+	a time.  The current chunk is kept in memory, so any part of it which 
+	storage has not committed can be sent again.  The MD5 and CRC32C checksums 
+	(and the ProgressReporter, if given) are only updated as bytes are committed,
+	so the file only needs to be read once and a resent part is not counted twice.
 	'''
-	full_destination_w_prefix = params['destination']
-	full_destination = full_destination_w_prefix[len(GOOGLE_BUCKET_PREFIX):]
-	contents = full_destination.split('/')
-	bucket_name = contents[0]
-	object_name = '/'.join(contents[1:])
 
-	storage_client = storage.Client()
+	def __init__(self, fileobj, chunk_size, progress=None):
+		self.fileobj = fileobj
+		self.chunk_size = chunk_size
+		self.progress = progress
+		self.md5 = hashlib.md5()
+		self.crc32c = google_crc32c.Checksum()
+		self.chunk = b''
+		self.chunk_start = 0
+		self.committed = 0
+		self.exhausted = False
+
+	@property
+	def chunk_end(self):
+		return self.chunk_start + len(self.chunk)
+
+	def read_chunk(self):
+		'''
+		Replaces the current chunk (which must have been committed) with the
+		next one.  A read may return fewer bytes than asked for, so we keep 
+		reading until the chunk is full or the stream is exhausted.
+		'''
+		if self.committed != self.chunk_end:
+			raise Exception('The current chunk has not been committed.')
+		pieces = []
+		remaining = self.chunk_size
+		while remaining > 0:
+			data = self.fileobj.read(remaining)
+			if not data:
+				self.exhausted = True
+				break
+			pieces.append(data)
+			remaining -= len(data)
+		self.chunk_start = self.chunk_end
+		self.chunk = b''.join(pieces)
+
+	def pending(self, offset):
+		'''
+		Returns the part of the current chunk from offset onward
+		'''
+		if offset < self.chunk_start or offset > self.chunk_end:
+			raise Exception('Offset %d is outside of the current chunk.' % offset)
+		return self.chunk[offset - self.chunk_start:]
+
+	def commit(self, offset):
+		'''
+		Marks the bytes before offset as committed by storage
+		'''
+		if offset <= self.committed:
+			return
+		data = self.pending(self.committed)[:offset - self.committed]
+		self.md5.update(data)
+		self.crc32c.update(data)
+		self.committed = offset
+		if self.progress:
+			self.progress.update(self.committed)
+
+	def get_hashes(self):
+		'''
+		Returns the checksums base64-encoded, which is the format 
+		reported by Google storage
+		'''
+		return {
+			'md5': base64.b64encode(self.md5.digest()).decode('utf-8'),
+			'crc32c': base64.b64encode(self.crc32c.digest()).decode('utf-8')
+		}
+
+
+def committed_offset(response):
+	'''
+	Returns the number of bytes storage has committed, as given by the Range 
+	header of a 308 response from a resumable upload session.  There is no 
+	Range header if nothing has been committed.
+	'''
+	bytes_range = response.headers.get('Range')
+	if not bytes_range:
+		return 0
+	return int(bytes_range.split('-')[-1]) + 1
+
+
+def query_upload_offset(session_url, total):
+	'''
+	Asks storage how much of the upload it has committed.  Returns None if the
+	upload is already complete.
+	'''
+	headers = {'Content-Range': 'bytes */%s' % ('*' if total is None else total)}
+	response = requests.put(session_url, headers=headers, timeout=DEFAULT_TIMEOUT)
+	if response.status_code in (200, 201):
+		return None
+	if response.status_code != 308:
+		raise Exception('Could not query the upload session (%d): %s' % (response.status_code, response.text))
+	return committed_offset(response)
+
+
+def upload_chunks(session_url, stream, progress, logger):
+	'''
+	Sends the stream to the resumable upload session a chunk at a time.  If a 
+	request fails, we ask storage how much it has committed and send the 
+	rest of the chunk again from there.
+	'''
+	offset = 0
+	total = None
+	attempts = 0
+	while True:
+		if offset == stream.chunk_end and not stream.exhausted:
+			stream.read_chunk()
+		if stream.exhausted:
+			total = stream.chunk_end
+		data = stream.pending(offset)
+		if len(data) == 0:
+			content_range = 'bytes */%d' % total
+		else:
+			content_range = 'bytes %d-%d/%s' % (offset, offset + len(data) - 1, '*' if total is None else total)
+		try:
+			response = requests.put(session_url, data=data, 
+				headers={'Content-Range': content_range}, 
+				timeout=DEFAULT_TIMEOUT)
+			if response.status_code in (200, 201):
+				stream.commit(stream.chunk_end)
+				return stream.committed
+			if response.status_code != 308:
+				raise Exception('Chunk was not accepted (%d): %s' % (response.status_code, response.text))
+			offset = committed_offset(response)
+			attempts = 0
+		except Exception as ex:
+			attempts += 1
+			if attempts >= MAX_CHUNK_ATTEMPTS:
+				raise
+			logger.log_text('Error sending %s (attempt %d): %s' % (content_range, attempts, ex))
+			progress.add_retry()
+			time.sleep(2 ** attempts)
+			try:
+				offset = query_upload_offset(session_url, total)
+			except Exception as query_ex:
+				logger.log_text('Could not query the upload: %s' % query_ex)
+				continue
+			if offset is None:
+				# the last request went through after all
+				stream.commit(stream.chunk_end)
+				return stream.committed
+		stream.commit(offset)
+
+
+def get_or_create_bucket(storage_client, bucket_name, params, logger):
+	'''
+	Returns the bucket, creating it if it does not exist
+	'''
 	# trying to get an existing bucket.  If raises exception, means bucket did not exist (or similar)
 	try:
 		logger.log_text('See if bucket at %s exists' % bucket_name)
-		destination_bucket = storage_client.get_bucket(bucket_name)
+		return storage_client.get_bucket(bucket_name)
 	except (google.api_core.exceptions.NotFound, google.api_core.exceptions.BadRequest) as ex:
 		logger.log_text('Bucket did not exist.  Creating now...')
 		# try to create the bucket:
 		try:
-			b = storage.Bucket(bucket_name)
-			b.name = bucket_name
+			b = storage.Bucket(storage_client, name=bucket_name)
 			b.location = '-'.join(params['google_zone'].split('-')[:-1])
-			destination_bucket = storage_client.create_bucket(b)
+			return storage_client.create_bucket(b)
 		except google.api_core.exceptions.BadRequest as ex2:
 			logger.log_text('Still could not create the bucket.  Error was %s' % ex2)
-			raise Exception('Could not find or create bucket.  Error was ' % ex2)
+			raise Exception('Could not find or create bucket.  Error was %s' % ex2)
+
+
+def stream_to_bucket(params, progress, logger):
+	'''
+	Streams the file at the Dropbox link directly into a resumable upload, 
+	calculating the checksums along the way.  Nothing is written to disk
+	(only the chunk being sent is held in memory).
+
+	Returns a tuple of dicts giving the local checksums and those 
+	reported by Google storage.
+	'''
+	full_destination_w_prefix = params['destination']
+	full_destination = full_destination_w_prefix[len(GOOGLE_BUCKET_PREFIX):]
+	contents = full_destination.split('/')
+	bucket_name = contents[0]
+	object_name = '/'.join(contents[1:])
+
+	storage_client = storage.Client()
+	destination_bucket = get_or_create_bucket(storage_client, bucket_name, params, logger)
+
+	source_link = params['resource_path']
+	logger.log_text('Stream from Dropbox link %s' % source_link)
+	response = requests.get(source_link, stream=True, timeout=DEFAULT_TIMEOUT)
+	if response.status_code != 200:
+		logger.log_text('Failed on transfering %s' % source_link.split('/')[-1])
+		raise Exception('Download from Dropbox has failed.  Is it possible that this file is restricted?')
+	response.raw.decode_content = True
+	stream = HashingStream(response.raw, UPLOAD_CHUNK_SIZE, progress)
+
 	try:
-		logger.log_text('Upload %s to %s' % (local_filepath, object_name))
+		logger.log_text('Upload to %s' % object_name)
 		destination_blob = destination_bucket.blob(object_name)
-		logger.log_text('Just before upload...')
-		destination_blob.upload_from_filename(local_filepath)
-		logger.log_text('Successful upload to bucket')
+		session_url = destination_blob.create_resumable_upload_session()
+		num_bytes = upload_chunks(session_url, stream, progress, logger)
+		logger.log_text('Successful upload to bucket (%d bytes)' % num_bytes)
 	except Exception as ex:
 		logger.log_text('Error with upload process.')
-		logger.log_text(ex)
+		logger.log_text(str(ex))
 		raise Exception('Could not create or upload the blob with name %s' % object_name)
 
-	# calculate the hash in storage:
-	storage_client = build('storage', 'v1')
+	local_hashes = stream.get_hashes()
+	logger.log_text('Local hashes: %s' % local_hashes)
+
+	# query the hashes calculated by storage:
 	try:
-		response = storage_client.objects().list(bucket=bucket_name, prefix=object_name).execute()
-		object_hash = response['items'][0]['md5Hash']
-		logger.log_text('Hash from within bucket: %s' % object_hash)
-	except:
+		destination_blob.reload()
+		bucket_hashes = {'md5': destination_blob.md5_hash, 'crc32c': destination_blob.crc32c}
+		logger.log_text('Hashes from within bucket: %s' % bucket_hashes)
+	except Exception:
 		logger.log_text('Error with querying hash in the bucket.')
-		object_hash = None
-	return object_hash
+		bucket_hashes = {}
+	return local_hashes, bucket_hashes
 
 
-def download_to_disk(params, logger):
+def hashes_match(local_hashes, bucket_hashes, logger):
 	'''
-	local_filepath is the path on the VM/container of the file that
-	will be downloaded.
+	Compares any checksums that are available in both.  If we could not 
+	get a checksum, we do not treat that as an error.
 	'''
-	source_link = params['resource_path']
-	local_path = os.path.join(WORKING_DIR, 'download')
-	cmd = 'wget -q -O %s "%s"' % (local_path, source_link)
-	logger.log_text('Download from Dropbox with %s' % cmd)
-	p = subprocess.Popen(cmd, shell=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-	stdout, stderr = p.communicate()
-	if p.returncode != 0:
-		logger.log_text('Failed on transfering %s' % source_link.split('/')[-1])
-		raise Exception('Download from Dropbox has failed.  Is it possible that this file is restricted?')
-	else:
-		logger.log_text('Success in download to local disk.')
-		return local_path
-
-
-def get_local_hash(local_path, logger):
-	'''
-	Given the local path, uses gsutil to calculate the hash and returns that
-	If the hash fails, just continue, returning None
-	'''
-	cmd = 'gsutil hash -m %s | grep md5' % local_path
-	p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	stdout,stderr = p.communicate()
-	if p.returncode != 0:
-		logger.log_text('Calculating local hash did not succeed.')
-		h = None
-	else:
-		s = stdout.decode('utf-8')
-		h = s.strip().split('\t')[-1]
-		logger.log_text('Local hash: %s' % h)
-	return h
+	for k in ['md5', 'crc32c']:
+		if bucket_hashes.get(k) and local_hashes.get(k):
+			if bucket_hashes[k] != local_hashes[k]:
+				logger.log_text('The %s hashes did not match!' % k)
+				return False
+	return True
 
 
 def get_hostname():
@@ -169,6 +451,7 @@ def parse_args():
 	parser.add_argument("-destination", help="The bucket/object where the upload will be stored.  Include the gs:// prefix", dest='destination', required=True)
 	parser.add_argument("-proj", help="Google project ID", dest='google_project_id', required=True)
 	parser.add_argument("-zone", help="Google project zone", dest='google_zone', required=True)
+	parser.add_argument("-progress_url", help="The URL for reporting progress samples to the main application", dest='progress_url', required=False)
 	args = parser.parse_args()
 	params = {}
 	params['token'] = args.token
@@ -179,28 +462,21 @@ def parse_args():
 	params['destination'] = args.destination
 	params['google_project_id'] = args.google_project_id
 	params['google_zone'] = args.google_zone
+	params['progress_url'] = args.progress_url
 	return params
 
 
 if __name__ == '__main__':
 	try:
 		params = parse_args()
-		os.mkdir(WORKING_DIR)
 		logger = create_logger()
-		local_filepath = download_to_disk(params, logger)
-		local_hash = get_local_hash(local_filepath, logger)
-		hash_in_bucket = send_to_bucket(local_filepath, params, logger)
-		if local_hash and hash_in_bucket:
-			# if both hashes were successfully acquired, compare
-			if local_hash == hash_in_bucket:
-				notify_master(params, logger)
-			else:
-				# we were able to get both hashes and they do NOT match, so error
-				logger.log_text('Hashes did not match!')
-				notify_master(params, logger, error=True)
-		else:
-			# missing one of the hashes, so just continue on as if no error
+		progress = ProgressReporter(params, logger)
+		local_hashes, bucket_hashes = stream_to_bucket(params, progress, logger)
+		if hashes_match(local_hashes, bucket_hashes, logger):
 			notify_master(params, logger)
+		else:
+			# we were able to get both hashes and they do NOT match, so error
+			notify_master(params, logger, error=True)
 
 	except Exception as ex:
 		logger.log_text('Caught some unexpected exception.')
@@ -208,5 +484,6 @@ if __name__ == '__main__':
 		logger.log_text(str(ex))
 		notify_master(params, logger, error=True)
 
+	logger.close()
 	kill_instance(params)
 
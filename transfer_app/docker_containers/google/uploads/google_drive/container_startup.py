@@ -4,6 +4,10 @@ import os
 import io
 import subprocess
 import argparse
+import atexit
+import queue
+import threading
+import time
 import datetime
 from Crypto.Cipher import DES
 import base64
@@ -17,6 +21,79 @@ import google.oauth2.credentials
 WORKING_DIR = '/workspace'
 HOSTNAME_REQUEST_URL = 'http://metadata/computeMetadata/v1/instance/hostname'
 GOOGLE_BUCKET_PREFIX = 'gs://'
+LOG_BATCH_SIZE = 100 # max number of log entries sent in a single request
+LOG_FLUSH_INTERVAL = 5 # seconds between sending queued log entries
+LOG_CLOSE_TIMEOUT = 30 # seconds to wait for the remaining entries to be sent
+PROGRESS_INTERVAL = 30 # minimum seconds between reporting progress samples
+DEFAULT_TIMEOUT = 60 # seconds to wait for a response from the main application
+
+
+class BatchedLogger(object):
+	'''
+	Wraps a Stackdriver logger so that calls to log_text do not block on the
+	logging API.  Entries are queued and sent in batches by a background thread
+	once LOG_BATCH_SIZE entries have accumulated or every LOG_FLUSH_INTERVAL seconds.
+	Remaining entries are sent when close() is called (or at exit).  If the 
+	logging API fails, the entries are printed to stdout instead.
+	'''
+
+	def __init__(self, cloud_logger):
+		self.cloud_logger = cloud_logger
+		self.queue = queue.Queue()
+		self.closed = False
+		self.worker = threading.Thread(target=self._run)
+		self.worker.daemon = True
+		self.worker.start()
+		atexit.register(self.close)
+
+	def log_text(self, text):
+		entry = (text, datetime.datetime.utcnow())
+		if self.closed:
+			self._send([entry,])
+		else:
+			self.queue.put(entry)
+
+	def _send(self, entries):
+		try:
+			batch = self.cloud_logger.batch()
+			for text, timestamp in entries:
+				batch.log_text(text, timestamp=timestamp)
+			batch.commit()
+		except Exception as ex:
+			print('Could not send log entries (%s).  Printing instead.' % ex)
+			for text, timestamp in entries:
+				print('%s %s' % (timestamp.isoformat(), text))
+
+	def _run(self):
+		while True:
+			entries = []
+			deadline = time.time() + LOG_FLUSH_INTERVAL
+			while len(entries) < LOG_BATCH_SIZE:
+				timeout = deadline - time.time()
+				if timeout <= 0:
+					break
+				try:
+					entry = self.queue.get(timeout=timeout)
+				except queue.Empty:
+					break
+				if entry is None:
+					# close() was called.  Send what remains and stop.
+					if entries:
+						self._send(entries)
+					return
+				entries.append(entry)
+			if entries:
+				self._send(entries)
+
+	def close(self):
+		'''
+		Sends any queued entries.  Should be called prior to removing the VM.
+		'''
+		if self.closed:
+			return
+		self.closed = True
+		self.queue.put(None)
+		self.worker.join(LOG_CLOSE_TIMEOUT)
 
 
 def create_logger():
@@ -27,7 +104,87 @@ def create_logger():
 	logname = '%s.log' % instance_name
 	logging_client = logging.Client()
 	logger = logging_client.logger(logname)
-	return logger
+	return BatchedLogger(logger)
+
+
+def get_encoded_token(params):
+	'''
+	Prepares the token which identifies the VM as a 'known' sender
+	'''
+	token = params['token']
+	obj=DES.new(params['enc_key'], DES.MODE_ECB)
+	enc_token = obj.encrypt(token)
+	return base64.encodestring(enc_token)
+
+
+class ProgressReporter(object):
+	'''
+	Posts samples of our progress (the bytes transferred so far, the throughput 
+	since the previous sample, and the number of chunks which had to be retried) 
+	to the main application, at most every PROGRESS_INTERVAL seconds.
+
+	The main application considers the transfer lost if it does not hear from us,
+	so once started, a background thread also reports every PROGRESS_INTERVAL 
+	seconds.  This covers the steps which do not report on their own (computing 
+	the hash and uploading the file to the bucket).
+	'''
+
+	def __init__(self, params, logger):
+		self.params = params
+		self.logger = logger
+		self.bytes_transferred = 0
+		self.retries = 0
+		self.lock = threading.Lock()
+		self.report_lock = threading.Lock()
+		self.last_report_time = time.time()
+		self.last_report_bytes = 0
+		self.stopped = threading.Event()
+
+	def start(self):
+		worker = threading.Thread(target=self._run)
+		worker.daemon = True
+		worker.start()
+
+	def stop(self):
+		self.stopped.set()
+
+	def _run(self):
+		while not self.stopped.wait(PROGRESS_INTERVAL):
+			if (time.time() - self.last_report_time) >= PROGRESS_INTERVAL:
+				self.report()
+
+	def add_retry(self):
+		# chunks may be retried from several threads at once
+		with self.lock:
+			self.retries += 1
+
+	def update(self, bytes_transferred):
+		self.bytes_transferred = bytes_transferred
+		if (time.time() - self.last_report_time) >= PROGRESS_INTERVAL:
+			self.report()
+
+	def report(self):
+		if not self.params['progress_url']:
+			return
+		with self.report_lock:
+			self._report()
+
+	def _report(self):
+		now = time.time()
+		elapsed = now - self.last_report_time
+		d = {}
+		d['token'] = get_encoded_token(self.params)
+		d['transfer_pk'] = self.params['transfer_pk']
+		d['bytes_transferred'] = self.bytes_transferred
+		d['bytes_per_second'] = (self.bytes_transferred - self.last_report_bytes) / elapsed if elapsed > 0 else 0
+		d['retries'] = self.retries
+		try:
+			requests.post(self.params['progress_url'], data=d, timeout=DEFAULT_TIMEOUT)
+		except requests.exceptions.RequestException as ex:
+			# not fatal-- progress is only informational
+			self.logger.log_text('Could not report progress: %s' % ex)
+		self.last_report_time = now
+		self.last_report_bytes = self.bytes_transferred
 
 
 def notify_master(params, logger, error=False):
@@ -40,11 +197,7 @@ def notify_master(params, logger, error=False):
 	d = {}
 
 	# prepare the token which identifies the VM as a 'known' sender
-	token = params['token']
-	obj=DES.new(params['enc_key'], DES.MODE_ECB)
-	enc_token = obj.encrypt(token)
-	b64_str = base64.encodestring(enc_token)
-	d['token'] = b64_str
+	d['token'] = get_encoded_token(params)
 
 	# Other required params to return:
 	d['transfer_pk'] = params['transfer_pk']
@@ -104,10 +257,10 @@ def send_to_bucket(local_filepath, params, logger):
 	return object_hash
 
 
-def download_to_disk(params, logger):
+def download_to_disk(params, progress, logger):
 	'''
 	local_filepath is the path on the VM/container of the file that
-	will be downloaded.
+	will be downloaded.  progress is a ProgressReporter instance
 	'''
 	local_path = os.path.join(WORKING_DIR, 'download')
 	access_token = params['access_token']
@@ -121,6 +274,7 @@ def download_to_disk(params, logger):
 	while done is False:
 		status, done = downloader.next_chunk()
 		logger.log_text("Download %d%%." % int(status.progress() * 100))
+		progress.update(status.resumable_progress)
 
 	logger.log_text('Download completed.')
 	return local_path
@@ -174,6 +328,7 @@ def parse_args():
 	parser.add_argument("-destination", help="The bucket/object where the upload will be stored.  Include the gs:// prefix", dest='destination', required=True)
 	parser.add_argument("-proj", help="Google project ID", dest='google_project_id', required=True)
 	parser.add_argument("-zone", help="Google project zone", dest='google_zone', required=True)
+	parser.add_argument("-progress_url", help="The URL for reporting progress samples to the main application", dest='progress_url', required=False)
 	args = parser.parse_args()
 	params = {}
 	params['token'] = args.token
@@ -185,6 +340,7 @@ def parse_args():
 	params['destination'] = args.destination
 	params['google_project_id'] = args.google_project_id
 	params['google_zone'] = args.google_zone
+	params['progress_url'] = args.progress_url
 	return params
 
 
@@ -193,7 +349,9 @@ if __name__ == '__main__':
 		params = parse_args()
 		os.mkdir(WORKING_DIR)
 		logger = create_logger()
-		local_filepath = download_to_disk(params, logger)
+		progress = ProgressReporter(params, logger)
+		progress.start()
+		local_filepath = download_to_disk(params, progress, logger)
 		local_hash = get_local_hash(local_filepath, logger)
 		hash_in_bucket = send_to_bucket(local_filepath, params, logger)
 		if local_hash and hash_in_bucket:
@@ -214,4 +372,6 @@ if __name__ == '__main__':
 		logger.log_text(str(ex))
 		notify_master(params, logger, error=True)
 	
+	progress.stop()
+	logger.close()
 	kill_instance(params)
@@ -0,0 +1,508 @@
+#! /usr/bin/python3
+
+import os
+import io
+import argparse
+import atexit
+import queue
+import threading
+import time
+import datetime
+import hashlib
+import collections
+import concurrent.futures
+from Crypto.Cipher import DES
+import base64
+import requests
+import google
+import google_crc32c
+from google.cloud import storage, logging
+from apiclient.discovery import build
+
+
+HOSTNAME_REQUEST_URL = 'http://metadata/computeMetadata/v1/instance/hostname'
+GOOGLE_BUCKET_PREFIX = 'gs://'
+LOG_BATCH_SIZE = 100 # max number of log entries sent in a single request
+LOG_FLUSH_INTERVAL = 5 # seconds between sending queued log entries
+LOG_CLOSE_TIMEOUT = 30 # seconds to wait for the remaining entries to be sent
+PROGRESS_INTERVAL = 30 # minimum seconds between reporting progress samples
+DEFAULT_TIMEOUT = 60
+UPLOAD_CHUNK_SIZE = 64*1024*1024 # size of each request in the resumable upload.  Must be a multiple of 256KB
+RANGE_CHUNK_SIZE = 16*1024*1024 # size of each range request when fetching the source in parallel
+MAX_RANGE_ATTEMPTS = 5 # number of times a range is requested before giving up
+
+class BatchedLogger(object):
+	'''
+	Wraps a Stackdriver logger so that calls to log_text do not block on the
+	logging API.  Entries are queued and sent in batches by a background thread
+	once LOG_BATCH_SIZE entries have accumulated or every LOG_FLUSH_INTERVAL seconds.
+	Remaining entries are sent when close() is called (or at exit).  If the 
+	logging API fails, the entries are printed to stdout instead.
+	'''
+
+	def __init__(self, cloud_logger):
+		self.cloud_logger = cloud_logger
+		self.queue = queue.Queue()
+		self.closed = False
+		self.worker = threading.Thread(target=self._run)
+		self.worker.daemon = True
+		self.worker.start()
+		atexit.register(self.close)
+
+	def log_text(self, text):
+		entry = (text, datetime.datetime.utcnow())
+		if self.closed:
+			self._send([entry,])
+		else:
+			self.queue.put(entry)
+
+	def _send(self, entries):
+		try:
+			batch = self.cloud_logger.batch()
+			for text, timestamp in entries:
+				batch.log_text(text, timestamp=timestamp)
+			batch.commit()
+		except Exception as ex:
+			print('Could not send log entries (%s).  Printing instead.' % ex)
+			for text, timestamp in entries:
+				print('%s %s' % (timestamp.isoformat(), text))
+
+	def _run(self):
+		while True:
+			entries = []
+			deadline = time.time() + LOG_FLUSH_INTERVAL
+			while len(entries) < LOG_BATCH_SIZE:
+				timeout = deadline - time.time()
+				if timeout <= 0:
+					break
+				try:
+					entry = self.queue.get(timeout=timeout)
+				except queue.Empty:
+					break
+				if entry is None:
+					# close() was called.  Send what remains and stop.
+					if entries:
+						self._send(entries)
+					return
+				entries.append(entry)
+			if entries:
+				self._send(entries)
+
+	def close(self):
+		'''
+		Sends any queued entries.  Should be called prior to removing the VM.
+		'''
+		if self.closed:
+			return
+		self.closed = True
+		self.queue.put(None)
+		self.worker.join(LOG_CLOSE_TIMEOUT)
+
+
+def create_logger():
+	"""
+	Creates a log in Stackdriver
+	"""
+	instance_name = get_hostname()
+	logname = '%s.log' % instance_name
+	logging_client = logging.Client()
+	logger = logging_client.logger(logname)
+	return BatchedLogger(logger)
+
+
+def get_encoded_token(params):
+	'''
+	Prepares the token which identifies the VM as a 'known' sender
+	'''
+	token = params['token']
+	obj=DES.new(params['enc_key'], DES.MODE_ECB)
+	enc_token = obj.encrypt(token)
+	return base64.encodestring(enc_token)
+
+
+class ProgressReporter(object):
+	'''
+	Posts samples of our progress (the bytes transferred so far, the throughput 
+	since the previous sample, and the number of chunks which had to be retried) 
+	to the main application, at most every PROGRESS_INTERVAL seconds.
+	'''
+
+	def __init__(self, params, logger):
+		self.params = params
+		self.logger = logger
+		self.bytes_transferred = 0
+		self.retries = 0
+		self.lock = threading.Lock()
+		self.last_report_time = time.time()
+		self.last_report_bytes = 0
+
+	def add_retry(self):
+		# chunks may be retried from several threads at once
+		with self.lock:
+			self.retries += 1
+
+	def update(self, bytes_transferred):
+		self.bytes_transferred = bytes_transferred
+		if (time.time() - self.last_report_time) >= PROGRESS_INTERVAL:
+			self.report()
+
+	def report(self):
+		if not self.params['progress_url']:
+			return
+		now = time.time()
+		elapsed = now - self.last_report_time
+		d = {}
+		d['token'] = get_encoded_token(self.params)
+		d['transfer_pk'] = self.params['transfer_pk']
+		d['bytes_transferred'] = self.bytes_transferred
+		d['bytes_per_second'] = (self.bytes_transferred - self.last_report_bytes) / elapsed if elapsed > 0 else 0
+		d['retries'] = self.retries
+		try:
+			requests.post(self.params['progress_url'], data=d, timeout=DEFAULT_TIMEOUT)
+		except requests.exceptions.RequestException as ex:
+			# not fatal-- progress is only informational
+			self.logger.log_text('Could not report progress: %s' % ex)
+		self.last_report_time = now
+		self.last_report_bytes = self.bytes_transferred
+
+
+def notify_master(params, logger, error=False):
+	'''
+	This calls back to the head machine to let it know the work is finished.
+	'''
+	logger.log_text('Notifying the master that this job has completed')
+
+	# the payload dictinary:
+	d = {}
+
+	# prepare the token which identifies the VM as a 'known' sender
+	d['token'] = get_encoded_token(params)
+
+	# Other required params to return:
+	d['transfer_pk'] = params['transfer_pk']
+	d['success'] = 0 if error else 1
+	base_url = params['callback_url']
+	response = requests.post(base_url, data=d)
+	logger.log_text('Status code: %s' % response.status_code)
+	logger.log_text('Response text: %s' % response.text)
+
+
+class HashingStream(object):
+	'''
+	Wraps the (non-seekable) stream of the file coming from the URL.  As the 
+	resumable upload reads from it, the MD5 and CRC32C checksums are updated,
+	so the file only needs to be read once.  If a ProgressReporter is given,
+	it is updated with the number of bytes read.
+	'''
+
+	def __init__(self, fileobj, progress=None):
+		self.fileobj = fileobj
+		self.progress = progress
+		self.md5 = hashlib.md5()
+		self.crc32c = google_crc32c.Checksum()
+		self.bytes_read = 0
+
+	def read(self, size=-1):
+		data = self.fileobj.read(size)
+		self.md5.update(data)
+		self.crc32c.update(data)
+		self.bytes_read += len(data)
+		if self.progress:
+			self.progress.update(self.bytes_read)
+		return data
+
+	def tell(self):
+		return self.bytes_read
+
+	def get_hashes(self):
+		'''
+		Returns the checksums base64-encoded, which is the format 
+		reported by Google storage
+		'''
+		return {
+			'md5': base64.b64encode(self.md5.digest()).decode('utf-8'),
+			'crc32c': base64.b64encode(self.crc32c.digest()).decode('utf-8')
+		}
+
+
+def get_or_create_bucket(storage_client, bucket_name, params, logger):
+	'''
+	Returns the bucket, creating it if it does not exist
+	'''
+	# trying to get an existing bucket.  If raises exception, means bucket did not exist (or similar)
+	try:
+		logger.log_text('See if bucket at %s exists' % bucket_name)
+		return storage_client.get_bucket(bucket_name)
+	except (google.api_core.exceptions.NotFound, google.api_core.exceptions.BadRequest) as ex:
+		logger.log_text('Bucket did not exist.  Creating now...')
+		# try to create the bucket:
+		try:
+			b = storage.Bucket(storage_client, name=bucket_name)
+			b.location = '-'.join(params['google_zone'].split('-')[:-1])
+			return storage_client.create_bucket(b)
+		except google.api_core.exceptions.BadRequest as ex2:
+			logger.log_text('Still could not create the bucket.  Error was %s' % ex2)
+			raise Exception('Could not find or create bucket.  Error was %s' % ex2)
+
+
+class ParallelRangeReader(object):
+	'''
+	A file-like object which fetches the file using several concurrent range 
+	requests.  Ranges are fetched ahead of the reader (at most 2*workers are
+	outstanding), but are returned in order, so the resumable upload can read 
+	from this exactly as it would from a stream.
+
+	If the server gave a strong ETag, each range is requested with If-Match so that a
+	file which changes in the middle of the transfer causes an error rather 
+	than a corrupted copy.
+	'''
+
+	def __init__(self, source_url, size, etag, workers, progress, logger):
+		self.source_url = source_url
+		self.size = size
+		self.etag = etag if (etag and not etag.startswith('W/')) else None
+		self.progress = progress
+		self.logger = logger
+		self.max_pending = 2*workers
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+		self.pending = collections.deque()
+		self.next_offset = 0
+		self.buffer = bytearray()
+		self._fill()
+
+	def _fill(self):
+		while (len(self.pending) < self.max_pending) and (self.next_offset < self.size):
+			end = min(self.next_offset + RANGE_CHUNK_SIZE, self.size) - 1
+			self.pending.append(self.executor.submit(self._fetch, self.next_offset, end))
+			self.next_offset = end + 1
+
+	def _fetch(self, start, end):
+		headers = {'Range': 'bytes=%d-%d' % (start, end)}
+		if self.etag:
+			headers['If-Match'] = self.etag
+		for attempt in range(MAX_RANGE_ATTEMPTS):
+			try:
+				response = requests.get(self.source_url, headers=headers, timeout=DEFAULT_TIMEOUT)
+			except requests.exceptions.RequestException as ex:
+				problem = str(ex)
+			else:
+				if response.status_code == 412:
+					raise Exception('The file changed during the transfer.')
+				if response.status_code != 206:
+					problem = 'status code %s' % response.status_code
+				elif len(response.content) != (end - start + 1):
+					problem = 'expected %d bytes, received %d' % (end - start + 1, len(response.content))
+				else:
+					return response.content
+			self.logger.log_text('Problem fetching bytes %d-%d (%s).  Retrying.' % (start, end, problem))
+			self.progress.add_retry()
+			time.sleep(2**attempt)
+		raise Exception('Could not fetch bytes %d-%d after %d attempts' % (start, end, MAX_RANGE_ATTEMPTS))
+
+	def read(self, size=-1):
+		if (size is None) or (size < 0):
+			size = self.size
+		while (len(self.buffer) < size) and (len(self.pending) > 0):
+			self.buffer.extend(self.pending.popleft().result())
+			self._fill()
+		data = bytes(self.buffer[:size])
+		del self.buffer[:size]
+		return data
+
+	def close(self):
+		for future in self.pending:
+			future.cancel()
+		self.executor.shutdown(wait=False)
+
+
+def probe_source(source_url, logger):
+	'''
+	Requests the first byte of the file.  Servers which support range requests
+	respond with 206 and give the full size in the Content-Range header.  Presigned
+	links are typically only valid for GET, so we cannot use a HEAD request.
+
+	Returns a tuple of (size, etag, response).  If the server does not support
+	range requests, response is the (streaming) response for the full file, 
+	which can be read directly.  Otherwise it is None.  The size is None if unknown.
+	'''
+	response = requests.get(source_url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=DEFAULT_TIMEOUT)
+	etag = response.headers.get('ETag')
+	if response.status_code == 206:
+		response.close()
+		total = response.headers.get('Content-Range', '').split('/')[-1]
+		if total.isdigit():
+			return int(total), etag, None
+		# the size is unknown, so we cannot split the file into ranges
+		response = requests.get(source_url, stream=True, timeout=DEFAULT_TIMEOUT)
+
+	if response.status_code != 200:
+		raise Exception('Could not access the file (status code %s).  Is it possible the link has expired?' % response.status_code)
+	size = response.headers.get('Content-Length')
+	if (size is None) or ('Content-Encoding' in response.headers):
+		# if the content is compressed in transit, the length does not match the file
+		size = None
+	else:
+		size = int(size)
+	logger.log_text('The server does not support range requests.  Fetching with a single request.')
+	return size, response.headers.get('ETag', etag), response
+
+
+def verify_source(expected_size, etag, stream, logger):
+	'''
+	Checks the bytes we received against the size and ETag reported by the server.  
+	A strong ETag of 32 hex characters (e.g. from S3 for files not uploaded in parts)
+	is the MD5 of the file.  Other ETags are opaque and are not checked.
+	'''
+	if (expected_size is not None) and (stream.bytes_read != expected_size):
+		raise Exception('Received %d bytes, but the server reported %d' % (stream.bytes_read, expected_size))
+	if etag and not etag.startswith('W/'):
+		etag = etag.strip('"').lower()
+		if (len(etag) == 32) and all([c in '0123456789abcdef' for c in etag]):
+			if etag != stream.md5.hexdigest():
+				raise Exception('The MD5 of the received file (%s) did not match the ETag (%s)' % (stream.md5.hexdigest(), etag))
+			logger.log_text('The MD5 matched the ETag from the server')
+
+
+def stream_to_bucket(params, progress, logger):
+	'''
+	Streams the file at the URL directly into a resumable upload, calculating 
+	the checksums along the way.  Nothing is written to disk.  If the server
+	supports range requests, the file is fetched with several parallel requests.
+
+	Returns a tuple of dicts giving the local checksums and those 
+	reported by Google storage.
+	'''
+	full_destination_w_prefix = params['destination']
+	full_destination = full_destination_w_prefix[len(GOOGLE_BUCKET_PREFIX):]
+	contents = full_destination.split('/')
+	bucket_name = contents[0]
+	object_name = '/'.join(contents[1:])
+
+	storage_client = storage.Client()
+	destination_bucket = get_or_create_bucket(storage_client, bucket_name, params, logger)
+
+	source_url = params['resource_path']
+	logger.log_text('Stream from URL %s' % source_url.split('?')[0])
+	size, etag, response = probe_source(source_url, logger)
+	if response is None:
+		logger.log_text('Fetching %d bytes using %d parallel range requests' % (size, params['workers']))
+		reader = ParallelRangeReader(source_url, size, etag, params['workers'], progress, logger)
+	else:
+		response.raw.decode_content = True
+		reader = response.raw
+	stream = HashingStream(reader, progress)
+
+	try:
+		logger.log_text('Upload to %s' % object_name)
+		destination_blob = destination_bucket.blob(object_name, chunk_size=UPLOAD_CHUNK_SIZE)
+		destination_blob.upload_from_file(stream)
+		logger.log_text('Successful upload to bucket (%d bytes)' % stream.bytes_read)
+	except Exception as ex:
+		logger.log_text('Error with upload process.')
+		logger.log_text(str(ex))
+		raise Exception('Could not create or upload the blob with name %s' % object_name)
+	finally:
+		reader.close()
+
+	try:
+		verify_source(size, etag, stream, logger)
+	except Exception:
+		destination_blob.delete()
+		raise
+
+	local_hashes = stream.get_hashes()
+	logger.log_text('Local hashes: %s' % local_hashes)
+
+	# query the hashes calculated by storage:
+	try:
+		destination_blob.reload()
+		bucket_hashes = {'md5': destination_blob.md5_hash, 'crc32c': destination_blob.crc32c}
+		logger.log_text('Hashes from within bucket: %s' % bucket_hashes)
+	except Exception:
+		logger.log_text('Error with querying hash in the bucket.')
+		bucket_hashes = {}
+	return local_hashes, bucket_hashes
+
+
+def hashes_match(local_hashes, bucket_hashes, logger):
+	'''
+	Compares any checksums that are available in both.  If we could not 
+	get a checksum, we do not treat that as an error.
+	'''
+	for k in ['md5', 'crc32c']:
+		if bucket_hashes.get(k) and local_hashes.get(k):
+			if bucket_hashes[k] != local_hashes[k]:
+				logger.log_text('The %s hashes did not match!' % k)
+				return False
+	return True
+
+
+def get_hostname():
+	headers = {'Metadata-Flavor':'Google'}
+	response = requests.get(HOSTNAME_REQUEST_URL, headers=headers)
+	content = response.content.decode('utf-8')
+	instance_name = content.split('.')[0]
+	return instance_name
+
+
+def kill_instance(params):
+	'''
+	Removes the virtual machine
+	'''
+	instance_name = get_hostname()
+	compute = build('compute', 'v1')
+	compute.instances().delete(project=params['google_project_id'],
+		zone=params['google_zone'], 
+	instance=instance_name).execute()
+
+
+
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-token", help="A token for identifying the container with the main application", dest='token', required=True)
+	parser.add_argument("-key", help="An encryption key for identifying the container with the main application", dest='enc_key', required=True)
+	parser.add_argument("-pk", help="The primary key of the transfer", dest='transfer_pk', required=True)
+	parser.add_argument("-url", help="The callback URL for communicating with the main application", dest='callback_url', required=True)
+	parser.add_argument("-path", help="The URL of the file that is being uploaded", dest='resource_path', required=True)
+	parser.add_argument("-destination", help="The bucket/object where the upload will be stored.  Include the gs:// prefix", dest='destination', required=True)
+	parser.add_argument("-proj", help="Google project ID", dest='google_project_id', required=True)
+	parser.add_argument("-zone", help="Google project zone", dest='google_zone', required=True)
+	parser.add_argument("-progress_url", help="The URL for reporting progress samples to the main application", dest='progress_url', required=False)
+	parser.add_argument("-workers", help="The number of parallel range requests", dest='workers', type=int, default=4)
+	args = parser.parse_args()
+	params = {}
+	params['token'] = args.token
+	params['enc_key'] =  args.enc_key
+	params['transfer_pk'] = args.transfer_pk
+	params['callback_url'] = args.callback_url
+	params['resource_path'] = args.resource_path
+	params['destination'] = args.destination
+	params['google_project_id'] = args.google_project_id
+	params['google_zone'] = args.google_zone
+	params['progress_url'] = args.progress_url
+	params['workers'] = args.workers
+	return params
+
+
+if __name__ == '__main__':
+	try:
+		params = parse_args()
+		logger = create_logger()
+		progress = ProgressReporter(params, logger)
+		local_hashes, bucket_hashes = stream_to_bucket(params, progress, logger)
+		if hashes_match(local_hashes, bucket_hashes, logger):
+			notify_master(params, logger)
+		else:
+			# we were able to get both hashes and they do NOT match, so error
+			notify_master(params, logger, error=True)
+
+	except Exception as ex:
+		logger.log_text('Caught some unexpected exception.')
+		logger.log_text(str(type(ex)))
+		logger.log_text(str(ex))
+		notify_master(params, logger, error=True)
+
+	logger.close()
+	kill_instance(params)
+
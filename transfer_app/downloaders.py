@@ -12,8 +12,11 @@ import urllib
 import json
 import datetime
 import copy
+import math
 
 from django.conf import settings
+from django.utils import timezone
+from django.db.models import Q, Sum
 from django.shortcuts import render
 from django.http import HttpResponseRedirect, HttpResponse, JsonResponse
 from django.urls import reverse
@@ -23,17 +26,19 @@ from django.core.exceptions import ObjectDoesNotExist
 from rest_framework.exceptions import MethodNotAllowed
 
 import dropbox.dropbox as dropbox_module
-import google.oauth2.credentials as google_credentials_module
-from googleapiclient.discovery import build
 
 import helpers.utils as utils
+from helpers import google_clients
+from helpers import runtime_settings
 import transfer_app.utils as transfer_utils
 from helpers.email_utils import notify_admins
 from transfer_app.base import GoogleBase, AWSBase
 from transfer_app import tasks as transfer_tasks
+from transfer_app import streaming
+from transfer_app import archives
 import base.exceptions as exceptions
-from base.models import Resource, Issue, CurrentZone
-from transfer_app.models import Transfer, TransferCoordinator
+from base.models import Resource, Issue
+from transfer_app.models import Transfer, TransferCoordinator, DeferredDownload
 
 
 def handle_exception(ex, message = ''):
@@ -50,6 +55,174 @@ def handle_exception(ex, message = ''):
     notify_admins(message, subject)
 
 
+def _pack_bytes(sizes, space_remaining, resolution):
+    '''
+    Chooses the files which send the most data without exceeding space_remaining
+    (a 0/1 knapsack).  To bound the work, the sizes are expressed in units of 
+    space_remaining/resolution, rounded up so the chosen files are guaranteed
+    to fit.  Any space lost to that rounding is then filled greedily.
+
+    Returns a set of the indices (into sizes) that were chosen.
+    '''
+    unit = max(1, int(math.ceil(space_remaining / resolution)))
+    capacity = space_remaining // unit
+    weights = [int(math.ceil(size / unit)) for size in sizes]
+
+    # best[c] is the most bytes which fit into c units.  keep[i][c] is True if
+    # file i was part of the best packing of c units, considering files 0,...,i
+    best = [0] * (capacity + 1)
+    keep = []
+    for i, w in enumerate(weights):
+        row = [False] * (capacity + 1)
+        for c in range(capacity, w - 1, -1):
+            candidate = best[c - w] + sizes[i]
+            if candidate > best[c]:
+                best[c] = candidate
+                row[c] = True
+        keep.append(row)
+
+    chosen = set()
+    c = capacity
+    for i in range(len(sizes) - 1, -1, -1):
+        if keep[i][c]:
+            chosen.add(i)
+            c -= weights[i]
+
+    total = sum([sizes[i] for i in chosen])
+    for i in sorted(range(len(sizes)), key=lambda i: sizes[i]):
+        if (i not in chosen) and (total + sizes[i] <= space_remaining):
+            chosen.add(i)
+            total += sizes[i]
+    return chosen
+
+
+def select_for_quota(items, sizes, space_remaining, strategy='count', resolution=1000):
+    '''
+    Decides which of the requested downloads to send when the destination may
+    not have room for all of them.  sizes (in bytes) correspond to items and 
+    space_remaining is None if the destination has unlimited storage.
+
+    The strategy is either 'count' (send as many files as possible) or 'bytes'
+    (send as much data as possible).  
+
+    Returns a tuple of two lists (the selected and the deferred items), each
+    of which keeps the original order of the items.
+    '''
+    sizes = [int(size or 0) for size in sizes]
+    if (space_remaining is None) or (sum(sizes) <= space_remaining):
+        return list(items), []
+    space_remaining = max(0, int(space_remaining))
+
+    if strategy == 'count':
+        # taking the smallest files first maximizes the number which fit
+        chosen = set()
+        total = 0
+        for i in sorted(range(len(sizes)), key=lambda i: sizes[i]):
+            if total + sizes[i] > space_remaining:
+                break
+            chosen.add(i)
+            total += sizes[i]
+    elif strategy == 'bytes':
+        chosen = _pack_bytes(sizes, space_remaining, max(1, int(resolution)))
+    else:
+        raise exceptions.ExceptionWithMessage('Unknown quota selection strategy: %s' % strategy)
+
+    selected = [item for i, item in enumerate(items) if i in chosen]
+    deferred = [item for i, item in enumerate(items) if i not in chosen]
+    return selected, deferred
+
+
+def get_in_flight_bytes(originator_pk, destination):
+    '''
+    Returns the total size (in bytes) of the files which the user is
+    downloading to the destination, but which have not yet arrived.
+    '''
+    pending = Transfer.objects.filter(download=True, 
+        completed=False, 
+        originator_id=originator_pk, 
+        destination=destination)
+    single_bytes = pending.filter(archive_name__isnull=True).aggregate(total=Sum('resource__size'))['total']
+    archive_bytes = pending.filter(archive_name__isnull=False).aggregate(total=Sum('archive_resources__size'))['total']
+    return (single_bytes or 0) + (archive_bytes or 0)
+
+
+def retry_deferred_downloads():
+    '''
+    Starts any deferred downloads which now fit in the user's storage.  Deferred
+    downloads are dropped once they are too old, their access token no longer
+    works, or the file is no longer available.  Returns a dict summarizing the outcome.
+    '''
+    summary = {'started': 0, 'still_deferred': 0, 'dropped': 0}
+    config_params = utils.load_config(settings.DOWNLOADER_CONFIG['CONFIG_PATH'])
+    max_age = datetime.timedelta(hours=float(config_params['deferred_download_max_age_hours']))
+    dropped, _ = DeferredDownload.objects.filter(created__lt=timezone.now() - max_age).delete()
+    summary['dropped'] += dropped
+    dropped, _ = DeferredDownload.objects.filter(resource__is_active=False).delete()
+    summary['dropped'] += dropped
+
+    # downloads deferred from the same request share an access token
+    groups = {}
+    unreadable_pks = []
+    for deferred in DeferredDownload.objects.select_related('resource').order_by('pk'):
+        try:
+            access_token = deferred.access_token
+        except exceptions.ExceptionWithMessage as ex:
+            # e.g. the encryption key was changed
+            print('Could not decrypt the token for deferred download %s: %s' % (deferred.pk, ex.message))
+            unreadable_pks.append(deferred.pk)
+            continue
+        key = (deferred.originator_id, deferred.destination, access_token)
+        groups.setdefault(key, []).append(deferred)
+    if len(unreadable_pks) > 0:
+        DeferredDownload.objects.filter(pk__in=unreadable_pks).delete()
+        summary['dropped'] += len(unreadable_pks)
+
+    for (originator_pk, destination, access_token), deferred_list in groups.items():
+        downloader_cls = get_downloader(destination).downloader_cls
+        deferred_pks = [d.pk for d in deferred_list]
+        try:
+            space_remaining = downloader_cls.get_space_remaining(access_token)
+        except Exception as ex:
+            # most likely the token expired, so these can no longer be retried.
+            print('Could not query the space remaining for user %s: %s' % (originator_pk, ex))
+            DeferredDownload.objects.filter(pk__in=deferred_pks).delete()
+            summary['dropped'] += len(deferred_list)
+            continue
+
+        # skip anything the user has already started again themselves
+        resource_pks = [d.resource_id for d in deferred_list]
+        in_progress = set(Transfer.objects.filter(completed=False, 
+            originator_id=originator_pk, 
+            resource_id__in=resource_pks).values_list('resource_id', flat=True))
+        candidates = [d for d in deferred_list if d.resource_id not in in_progress]
+        summary['dropped'] += len(deferred_list) - len(candidates)
+
+        # files which are still on their way will take up some of that space
+        if space_remaining is not None:
+            space_remaining -= get_in_flight_bytes(originator_pk, destination)
+
+        items = [{'resource_pk': d.resource_id, 
+            'originator': originator_pk, 
+            'destination': destination, 
+            'access_token': access_token} for d in candidates]
+        selected, still_deferred = select_for_quota(items, 
+            [d.resource.size for d in candidates], 
+            space_remaining, 
+            config_params['quota_selection_strategy'],
+            config_params['quota_selection_resolution'])
+        if len(selected) > 0:
+            transfer_tasks.download.delay(selected, destination)
+        summary['started'] += len(selected)
+        summary['still_deferred'] += len(still_deferred)
+
+        waiting_pks = set([item['resource_pk'] for item in still_deferred])
+        DeferredDownload.objects.filter(pk__in=[d.pk for d in deferred_list if d.resource_id not in waiting_pks]).delete()
+
+    print('Deferred downloads: %d started, %d still waiting for space, %d dropped' 
+        % (summary['started'], summary['still_deferred'], summary['dropped']))
+    return summary
+
+
 class Downloader(object):
 
     @classmethod
@@ -81,9 +254,12 @@ class Downloader(object):
         except ObjectDoesNotExist as ex:
             raise exceptions.ExceptionWithMessage(ex)
         if not requesting_user.is_staff:
-            all_user_resources = Resource.objects.user_resources(requesting_user)
-            all_user_resource_pks = [x.pk for x in all_user_resources if (x.is_active and not x.originated_from_upload)]
-            if len(set(download_info).difference(set(all_user_resource_pks))) > 0:
+            valid_resource_count = Resource.objects.user_resources(requesting_user).filter(
+                pk__in=download_info, 
+                is_active=True, 
+                originated_from_upload=False
+            ).count()
+            if valid_resource_count != len(set(download_info)):
                 raise exceptions.ExceptionWithMessage('''
                     Requesting to transfer a resource you do not own, is not active, or not able to be downloaded.                
                 ''')    
@@ -101,6 +277,132 @@ class Downloader(object):
                There were no valid resources to download.                
             ''')   
 
+    @classmethod
+    def start_downloads_within_quota(cls, request, download_info, access_token, space_remaining):
+        '''
+        Starts the downloads which fit into space_remaining (None if unlimited) and 
+        reports any which did not.  Depending on the config, those are deferred 
+        and retried once the user frees up some space.
+        '''
+        config_params = cls.get_config(settings.DOWNLOADER_CONFIG['CONFIG_PATH'])
+        resources = Resource.objects.in_bulk([item['resource_pk'] for item in download_info])
+
+        # the Resources may have been removed while the user was authenticating:
+        download_info, missing_warnings = cls._remove_missing_resources(download_info, resources)
+        if len(download_info) == 0:
+            context = {'email_enabled': settings.EMAIL_ENABLED, 
+                'problem': True, 
+                'at_least_one_transfer': False,
+                'warnings': missing_warnings
+            }
+            return render(request, 'transfer_app/download_started.html', context)
+
+        archive_options = request.session.get('download_archive')
+        if archive_options:
+            return cls._start_archive_download(request, download_info, access_token, space_remaining, archive_options, resources, missing_warnings)
+        passing_items, failed_items = select_for_quota(download_info, 
+            [resources[item['resource_pk']].size for item in download_info], 
+            space_remaining, 
+            config_params['quota_selection_strategy'],
+            config_params['quota_selection_resolution'])
+
+        for item in passing_items:
+            item['access_token'] = access_token
+
+        problem = (len(failed_items) > 0) or (len(missing_warnings) > 0)
+        at_least_one_transfer = len(passing_items) > 0
+        if at_least_one_transfer:
+            transfer_tasks.download.delay(passing_items, request.session['download_destination'])
+        context = {'email_enabled': settings.EMAIL_ENABLED, 
+            'problem': problem, 
+            'at_least_one_transfer':at_least_one_transfer
+        }
+        if problem:
+            retry = config_params['retry_deferred_downloads'] in ['True', 'true']
+            if retry and (len(failed_items) > 0):
+                cls._defer_downloads(failed_items, access_token)
+            warning_list = list(missing_warnings)
+            for item in failed_items:
+                resource_name = resources[item['resource_pk']].name
+                msg = 'Not enough space in your %s for file %s' % (cls.service_name, resource_name)
+                if retry:
+                    msg += '.  It will be sent automatically if space becomes available within %s hours.' % config_params['deferred_download_max_age_hours']
+                warning_list.append(msg)
+            context['warnings'] = warning_list
+        return render(request, 'transfer_app/download_started.html', context)
+
+    @staticmethod
+    def _remove_missing_resources(download_info, resources):
+        '''
+        Returns a tuple of the items whose Resource (in the dict resources, keyed 
+        by primary key) still exists, and a list of messages about those that do not
+        '''
+        present_items = []
+        warnings = []
+        for item in download_info:
+            if item['resource_pk'] in resources:
+                present_items.append(item)
+            else:
+                warnings.append('A requested file (ID %s) was removed before it could be sent.' % item['resource_pk'])
+        return present_items, warnings
+
+    @classmethod
+    def check_archive_size(cls, total_size):
+        '''
+        Raises an ExceptionWithMessage if an archive of files totalling 
+        total_size bytes is too large to be streamed by a worker
+        '''
+        config_params = cls.get_config(settings.DOWNLOADER_CONFIG['CONFIG_PATH'])
+        max_size = int(float(config_params['archive_max_size_in_bytes']))
+        if total_size > max_size:
+            raise exceptions.ExceptionWithMessage('The files requested (%d bytes) exceed the maximum size of an archive (%d bytes).'
+                '  Please request them as individual files instead.' % (total_size, max_size))
+
+    @classmethod
+    def _start_archive_download(cls, request, download_info, access_token, space_remaining, archive_options, resources, missing_warnings=None):
+        '''
+        The files are delivered together as a single zip archive, so either the
+        entire archive fits in the space remaining or nothing is sent.  Any files
+        which were removed (see missing_warnings) are left out of the archive.
+        '''
+        total_size = sum([resources[item['resource_pk']].size for item in download_info])
+        warnings = []
+        try:
+            cls.check_archive_size(total_size)
+        except exceptions.ExceptionWithMessage as ex:
+            warnings.append(ex.message)
+        if (space_remaining is not None) and (total_size > space_remaining):
+            warnings.append('Not enough space in your %s for the archive %s' % (cls.service_name, archive_options['name']))
+        problem = len(warnings) > 0
+        context = {'email_enabled': settings.EMAIL_ENABLED, 
+            'problem': problem or bool(missing_warnings), 
+            'at_least_one_transfer': not problem
+        }
+        if problem or missing_warnings:
+            context['warnings'] = (missing_warnings or []) + warnings
+        if not problem:
+            for item in download_info:
+                item['access_token'] = access_token
+            transfer_tasks.download_archive.delay(download_info, request.session['download_destination'], archive_options)
+        return render(request, 'transfer_app/download_started.html', context)
+
+    @classmethod
+    def _defer_downloads(cls, items, access_token):
+        '''
+        Records the downloads which did not fit so they may be retried later.
+        If the same files were already deferred, those are replaced so that
+        the most recent access token is used.
+        '''
+        originator_pk = items[0]['originator']
+        resource_pks = [item['resource_pk'] for item in items]
+        DeferredDownload.objects.filter(originator_id=originator_pk, 
+            destination=cls.destination, 
+            resource_id__in=resource_pks).delete()
+        DeferredDownload.objects.bulk_create([DeferredDownload(resource_id=pk,
+            originator_id=originator_pk,
+            destination=cls.destination,
+            access_token=access_token) for pk in resource_pks])
+
     def __init__(self, download_data):
         self.download_data = download_data
 
@@ -113,15 +415,23 @@ class Downloader(object):
         item in the list is a dict.  Each dict NEEDS to have certain keys (see code)
 
         '''
+        # get all the users and resources with one query each:
+        originators = get_user_model().objects.in_bulk(list(set([item['originator'] for item in self.download_data])))
+        resources = Resource.objects.in_bulk([item['resource_pk'] for item in self.download_data])
+
+        # either may have been removed since the download was requested.  Skip those items
+        self.download_data = self._remove_missing_items(resources, originators)
+
         if len(self.download_data) > 0:
-            tc = TransferCoordinator()
+            # the Transfers are created in bulk below, so set the count here
+            tc = TransferCoordinator(total_transfers=len(self.download_data))
             tc.save()
         else:
             return
 
+        transfers = []
         for item in self.download_data:
-            originator = get_user_model().objects.get(pk=item['originator'])
-            resource = Resource.objects.get(pk=item['resource_pk'])
+            resource = resources[item['resource_pk']]
 
             # we obviously need the path where the resource is:
             item['path'] = resource.path
@@ -130,29 +440,102 @@ class Downloader(object):
             # know how large to size the transfer VM
             item['size_in_bytes'] = resource.size
 
-            t = Transfer(
+            transfers.append(Transfer(
                  download=True,
                  resource=resource,
                  destination=item['destination'],
                  coordinator=tc,
-                 originator = originator
-            )
-            t.save()
-
-            # finally add the transfer primary key to the dictionary so we will
-            # be able to track the transfers
+                 originator = originators[item['originator']]
+            ))
+        transfers = Transfer.objects.bulk_create(transfers)
+
+        # not all databases return the primary keys from a bulk insert.  If not,
+        # get them in a single query (they are assigned in order of insertion)
+        if any([t.pk is None for t in transfers]):
+            transfer_pks = Transfer.objects.filter(coordinator=tc).order_by('pk').values_list('pk', flat=True)
+            for t, pk in zip(transfers, transfer_pks):
+                t.pk = pk
+
+        # finally add the transfer primary key to the dictionary so we will
+        # be able to track the transfers
+        for item, t in zip(self.download_data, transfers):
             item['transfer_pk'] = t.pk
 
+    def _remove_missing_items(self, resources, originators=None):
+        '''
+        Returns the items of self.download_data whose Resource (and originator,
+        if originators is given) still exist.  Both are dicts keyed by primary key.
+        '''
+        present_items = []
+        for item in self.download_data:
+            if item['resource_pk'] not in resources:
+                print('ERROR: Resource %s was removed before its download could start.  Skipping.' % item['resource_pk'])
+            elif (originators is not None) and (item['originator'] not in originators):
+                print('ERROR: User %s was removed before the download of Resource %s could start.  Skipping.' 
+                    % (item['originator'], item['resource_pk']))
+            else:
+                present_items.append(item)
+        return present_items
+
+    def _archive_transfer_setup(self, archive_name):
+        '''
+        Creates a single Transfer (and its TransferCoordinator) for delivering
+        all of the requested Resources as one archive.  Returns the primary key
+        of the Transfer, or None if none of the Resources exist any longer.  Each 
+        item in self.download_data is given the 'name', 'path', and 'size_in_bytes' 
+        keys used to build the archive.
+        '''
+        resources = Resource.objects.in_bulk([item['resource_pk'] for item in self.download_data])
+        self.download_data = self._remove_missing_items(resources)
+        if len(self.download_data) == 0:
+            return None
+        ordered_resources = [resources[item['resource_pk']] for item in self.download_data]
+        names = archives.unique_member_names([r.name for r in ordered_resources])
+        for item, resource, name in zip(self.download_data, ordered_resources, names):
+            item['name'] = name
+            item['path'] = resource.path
+            item['size_in_bytes'] = resource.size
+
+        tc = TransferCoordinator.objects.create()
+        transfer_obj = Transfer.objects.create(
+            download=True,
+            resource=ordered_resources[0],
+            archive_name=archive_name,
+            destination=self.download_data[0]['destination'],
+            coordinator=tc,
+            originator_id=self.download_data[0]['originator'],
+            started=True,
+            in_worker=True
+        )
+        transfer_obj.archive_resources.set(ordered_resources)
+        return transfer_obj.pk
+
 
 class DropboxDownloader(Downloader):
 
     destination = settings.DROPBOX
     config_keys = ['dropbox',]
+    service_name = 'Dropbox'
     
     @classmethod
     def check_format(cls, download_info, user_pk):
         return super()._check_format(download_info, user_pk)
 
+    @classmethod
+    def get_space_remaining(cls, access_token):
+        '''
+        Returns the space remaining (in bytes) in the user's Dropbox account
+        '''
+        dbx = dropbox_module.Dropbox(access_token)
+        space_usage = dbx.users_get_space_usage()
+        if space_usage.allocation.is_team():
+            used_in_bytes = space_usage.allocation.get_team().used
+            space_allocation_in_bytes = space_usage.allocation.get_team().allocated
+        else:
+            used_in_bytes = space_usage.used
+            space_allocation_in_bytes = space_usage.allocation.get_individual().allocated
+        return space_allocation_in_bytes - used_in_bytes
+
     @classmethod
     def authenticate(cls, config_filepath, request):
         #config_params = super().get_config(config_filepath)
@@ -211,62 +594,10 @@ class DropboxDownloader(Downloader):
             except KeyError as ex:
                 raise exceptions.ExceptionWithMessage('There was no download_info registered with the session')
 
-            # need to check that the user has enough space in their Dropbox account
-            dbx = dropbox_module.Dropbox(access_token)
-            space_usage = dbx.users_get_space_usage()
-            if space_usage.allocation.is_team():
-                used_in_bytes = space_usage.allocation.get_team().used
-                space_allocation_in_bytes = space_usage.allocation.get_team().allocated
-                space_remaining_in_bytes = space_allocation_in_bytes - used_in_bytes
-            else:
-                used_in_bytes = space_usage.used
-                space_allocation_in_bytes = space_usage.allocation.get_individual().allocated
-                space_remaining_in_bytes = space_allocation_in_bytes - used_in_bytes
-
-            running_total = 0
-            at_least_one_transfer = False
-
-            # iterate through the transfers, add the token, and check a running total
-            # note that we do not do any optimization to maximize the number of transfers
-            # in the case that the space is not sufficient for all files.
-            passing_items = []
-            failed_items = []
-            problem = False
-            for item in download_info:
-                size_in_bytes = Resource.objects.get(pk=item['resource_pk']).size
-                running_total += size_in_bytes
-                if running_total < space_remaining_in_bytes:
-                    item['access_token'] = access_token
-                    passing_items.append(item)
-                else:
-                    problem = True
-                    failed_items.append(item)
-
-            at_least_one_transfer = len(passing_items) > 0
-            if not problem:
-                # call async method:
-                transfer_tasks.download.delay(passing_items, request.session['download_destination'])
-                context = {'email_enabled': settings.EMAIL_ENABLED, 
-                    'problem': problem, 
-                    'at_least_one_transfer':at_least_one_transfer
-                }
-                return render(request, 'transfer_app/download_started.html', context)
-            else:
-                # if there was a problem-- could not fit all files
-                # Still initiate the good transfers
-                if len(passing_items) > 0:
-                    transfer_tasks.download.delay(passing_items, request.session['download_destination'])
-                warning_list = []
-                for item in failed_items:
-                    resource_name = Resource.objects.get(pk=item['resource_pk']).name
-                    warning_list.append('Not enough space in your Dropbox for file %s' % resource_name)
-                context = {
-                    'email_enabled': settings.EMAIL_ENABLED,
-                    'problem': problem,
-                    'at_least_one_transfer':at_least_one_transfer,
-                    'warnings': warning_list
-                }
-                return render(request, 'transfer_app/download_started.html', context)
+            return cls.start_downloads_within_quota(request, 
+                download_info, 
+                access_token, 
+                cls.get_space_remaining(access_token))
         else:
             raise MethodNotAllowed('Method not allowed.')
 
@@ -281,11 +612,28 @@ class DriveDownloader(Downloader):
 
     config_keys = ['google_drive',]
     destination = settings.GOOGLE_DRIVE
+    service_name = 'Google Drive'
 
     @classmethod
     def check_format(cls, download_info, user_pk):
         return super()._check_format(download_info, user_pk)
 
+    @classmethod
+    def get_space_remaining(cls, access_token):
+        '''
+        Returns the space remaining (in bytes) in the user's Google Drive, or None
+        if their storage is unlimited
+        '''
+        drive_service = google_clients.get_drive_client(access_token)
+        about = drive_service.about().get(fields='storageQuota').execute()
+        try:
+            total_bytes = int(about['storageQuota']['limit'])
+        except KeyError as ex:
+            # per the docs, if the 'limit' field is not there, there is "unlimited" storage
+            return None
+        used_bytes = int(about['storageQuota']['usage'])
+        return total_bytes - used_bytes
+
     @classmethod
     def authenticate(cls, config_filepath, request):
         #config_params = super().get_config(config_filepath)
@@ -346,69 +694,10 @@ class DriveDownloader(Downloader):
             except KeyError as ex:
                 raise exceptions.ExceptionWithMessage('There was no download_info registered with the session')
 
-            # ensure we have enough space to push the file(s):
-            credentials = google_credentials_module.Credentials(access_token)
-            drive_service = build('drive', 'v3', credentials=credentials)
-            about = drive_service.about().get(fields='storageQuota').execute()
-            try:
-                total_bytes = int(about['storageQuota']['limit'])
-                unlimited = False
-            except KeyError as ex:
-                # per the docs, if the 'limit' field is not there, there is "unlimited" storage
-                unlimited = True
-            used_bytes = int(about['storageQuota']['usage'])
-            if not unlimited:
-                space_remaining_in_bytes = total_bytes - used_bytes
-
-            running_total = 0
-            at_least_one_transfer = False
-            failed_items = []
-            passing_items = []
-            problem = False
-
-            if not unlimited:
-                # iterate through the transfers, add the token, and check a running total
-                # note that we do not do any optimization to maximize the number of transfers
-                # in the case that the space is not sufficient for all files.
-                for item in download_info:
-                    size_in_bytes = Resource.objects.get(pk=item['resource_pk']).size
-                    running_total += size_in_bytes
-                    if (running_total < space_remaining_in_bytes):
-                        passing_items.append(item)
-                    else:
-                        problem = True
-                        failed_items.append(item)
-            else: # if unlimited storage, just 'pass' all the downloads through
-                passing_items = download_info
-
-            for item in passing_items:
-                item['access_token'] = access_token
-
-            at_least_one_transfer = len(passing_items) > 0
-            if not problem:
-                # call async method:
-                transfer_tasks.download.delay(passing_items, request.session['download_destination'])
-                context = {'email_enabled': settings.EMAIL_ENABLED, 
-                    'problem': problem, 
-                    'at_least_one_transfer':at_least_one_transfer
-                }
-                return render(request, 'transfer_app/download_started.html', context)
-            else:
-                # if there was a problem-- could not fit all files
-                # Still initiate the good transfers
-                if len(passing_items) > 0:
-                    transfer_tasks.download.delay(passing_items, request.session['download_destination'])
-                warning_list = []
-                for item in failed_items:
-                    resource_name = Resource.objects.get(pk=item['resource_pk']).name
-                    warning_list.append('Not enough space in your Google Drive for file %s' % resource_name)
-                context = {
-                    'email_enabled': settings.EMAIL_ENABLED,
-                    'problem': problem,
-                    'at_least_one_transfer':at_least_one_transfer,
-                    'warnings': warning_list
-                }
-                return render(request, 'transfer_app/download_started.html', context)
+            return cls.start_downloads_within_quota(request, 
+                download_info, 
+                access_token, 
+                cls.get_space_remaining(access_token))
         else:
             raise MethodNotAllowed('Method not allowed.')
 
@@ -418,6 +707,14 @@ class EnvironmentSpecificDownloader(object):
     config_keys = []
     config_file = settings.DOWNLOADER_CONFIG['CONFIG_PATH']
 
+    # if True, small files are streamed by the worker process rather than
+    # on a dedicated VM.  Subclasses that can do this implement stream_single_download
+    in_worker_streaming = False
+
+    # if True, the files may be delivered as a single zip archive.  Subclasses
+    # that can do this implement stream_archive
+    supports_archives = False
+
     def __init__(self, download_data):
         #instantiate the wrapped classes:
         self.downloader = self.downloader_cls(download_data)
@@ -436,12 +733,62 @@ class EnvironmentSpecificDownloader(object):
     @classmethod
     def finish_authentication_and_start_download(cls, request):
         return cls.downloader_cls.finish_authentication_and_start_download(request)
+
+    @classmethod
+    def check_archive_options(cls, archive_options, download_info):
+        '''
+        Checks that the files (download_info as returned by check_format) may be 
+        delivered as an archive.  Returns the archive options (see archives.check_archive_options)
+        '''
+        if not cls.supports_archives:
+            raise exceptions.ExceptionWithMessage('Archive downloads are not available for this destination.')
+        total_size = Resource.objects.filter(pk__in=[item['resource_pk'] for item in download_info]) \
+            .aggregate(total=Sum('size'))['total']
+        cls.downloader_cls.check_archive_size(total_size or 0)
+        config_params = cls.downloader_cls.get_config(cls.config_file)
+        return archives.check_archive_options(archive_options, config_params['default_archive_name'])
     
 
     def download(self):
         transfer_coordinator = self.downloader._transfer_setup()
+        if self.in_worker_streaming:
+            self.start_in_worker_downloads()
         self.config_and_start_downloads()
 
+    def download_archive(self, archive_options):
+        '''
+        Delivers all of the files as a single zip archive, which is generated
+        and streamed by this worker process.  Subclasses implement stream_archive
+        '''
+        # check before creating the Transfer, so nothing is left behind if we cannot continue
+        if not self.supports_archives:
+            raise exceptions.ExceptionWithMessage('Archive downloads are not available for this destination.')
+        resources = Resource.objects.in_bulk([item['resource_pk'] for item in self.downloader.download_data])
+        self.downloader_cls.check_archive_size(sum([r.size for r in resources.values()]))
+        transfer_pk = self.downloader._archive_transfer_setup(archive_options['name'])
+        if transfer_pk is None:
+            print('None of the files for archive %s exist any longer.' % archive_options['name'])
+            return
+        return self.stream_archive(transfer_pk, archive_options)
+
+    def stream_archive(self, transfer_pk, archive_options):
+        raise NotImplementedError('Archive downloads are not available in this environment.')
+
+    def start_in_worker_downloads(self):
+        '''
+        Small files are streamed directly by a worker process, which avoids the
+        overhead of starting a VM.  Those items are removed from the download
+        data so that only the larger files are handled by config_and_start_downloads
+        '''
+        in_worker_items, vm_items = streaming.split_transfer_tiers(
+            self.downloader.download_data, 
+            self.config_params
+        )
+        for item in in_worker_items:
+            Transfer.objects.filter(pk=item['transfer_pk']).update(started=True, in_worker=True)
+            transfer_tasks.stream_download.delay(item, self.downloader.destination)
+        self.downloader.download_data = vm_items
+
 
 class GoogleEnvironmentDownloader(EnvironmentSpecificDownloader, GoogleBase):
 
@@ -453,7 +800,6 @@ class GoogleEnvironmentDownloader(EnvironmentSpecificDownloader, GoogleBase):
                              create-with-container {instance_name} \
                              --zone={google_zone} \
                              --scopes={scopes} \
-                             --container-privileged \
                              --machine-type={machine_type} \
                              --boot-disk-size={disk_size_gb}GB \
                              --metadata=google-logging-enabled=true \
@@ -491,19 +837,28 @@ class GoogleEnvironmentDownloader(EnvironmentSpecificDownloader, GoogleBase):
         # Thus, it's ok to grab the first element of the list and know that 
         # each download has the same originator
         originator_pk = download_data[0]['originator']
-        originator = get_user_model().objects.get(pk=originator_pk)
 
-        # get all the incomplete transfers started by this user:
-        all_incomplete_transfers = Transfer.objects.filter(completed=False, originator=originator)
-        resource_pks_for_incomplete_transfers = [x.resource.pk for x in all_incomplete_transfers]
+        # get the paths of any requested resources which have incomplete transfers started by this user:
+        requested_pks = [item['resource_pk'] for item in download_data]
+        # (including those being sent as part of an archive)
+        rows = Transfer.objects.filter(Q(resource_id__in=requested_pks) | Q(archive_resources__in=requested_pks),
+            completed=False, 
+            originator_id=originator_pk).values_list('resource_id', 
+                'resource__path', 
+                'archive_resources', 
+                'archive_resources__path')
+        paths_in_progress = {}
+        for resource_pk, path, archived_pk, archived_path in rows:
+            paths_in_progress[resource_pk] = path
+            if archived_pk is not None:
+                paths_in_progress[archived_pk] = archived_path
 
         new_transfers = []
         error_messages = []
         for item in download_data:
             # check if this resource is already being transferred:
-            if item['resource_pk'] in resource_pks_for_incomplete_transfers:
-                resource = Resource.objects.get(pk = item['resource_pk'])
-                filename = os.path.basename(resource.path)
+            if item['resource_pk'] in paths_in_progress:
+                filename = os.path.basename(paths_in_progress[item['resource_pk']])
                 msg = '''The file with name %s is already in progress.  
                         If you wish to overwrite, please wait until the download is complete and
                         try again, if available.''' % filename
@@ -513,13 +868,16 @@ class GoogleEnvironmentDownloader(EnvironmentSpecificDownloader, GoogleBase):
         # reassign self.upload_data now that we have checked for existing transfers:
         return new_transfers, error_messages
 
+    in_worker_streaming = True
+
     def __init__(self, download_data):
         super().__init__(download_data)
 
     def _prep_single_download(self, custom_config, index, item):
 
-        disk_size_factor = float(custom_config['disk_size_factor'])
-        min_disk_size = int(float(custom_config['min_disk_size']))
+        # the worker streams the file directly from storage (nothing is written
+        # to disk), so all download VMs can use the minimum disk size
+        target_disk_size = int(float(custom_config['min_disk_size']))
 
         # construct a callback so the worker can communicate back to the application server:
         callback_url = reverse('transfer-complete')
@@ -527,6 +885,12 @@ class GoogleEnvironmentDownloader(EnvironmentSpecificDownloader, GoogleBase):
         domain = current_site.domain
         full_callback_url = 'https://%s%s' % (domain, callback_url)
 
+        # the worker periodically reports its progress here so it may be resumed:
+        full_checkpoint_url = 'https://%s%s' % (domain, reverse('transfer-checkpoint'))
+
+        # and posts samples of its progress and throughput here:
+        full_progress_url = 'https://%s%s' % (domain, reverse('transfer-progress'))
+
         docker_image = custom_config['docker_image']
 
         instance_name = '%s-%s-%s' % (custom_config['instance_name_prefix'], \
@@ -534,38 +898,13 @@ class GoogleEnvironmentDownloader(EnvironmentSpecificDownloader, GoogleBase):
             index
         )
 
-        # when we start the VM, we use GCSfuse to mount the bucket.  
-        # This requires space sufficient to mount the ENTIRE contents of the bucket
-        # Alternative mechanisms were considered (e.g. copying the file to a new, temp bucket)
-        # but that effort is only worth it if a very large file is co-locatded with
-        # other large files (e.g. 1000's of Gb).  Typically, the shorter VM uptime
-        # is worth it.  Also avoids potential errors in the bucket-to-bucket copy
-        # and any associated costs with that.
-        gs_prefix = settings.CONFIG_PARAMS['google_storage_gs_prefix']
-        bucketname = item['path'][len(gs_prefix):].split('/')[0]
-
-        # query the bucket for the full size:
-        total_bucket_contents_in_bytes = 0
-        storage_client = build('storage', 'v1') 
-        try:
-            response = storage_client.objects().list(bucket=bucketname).execute()
-        except Exception as ex:
-            print('Problem when querying the containing bucket.')
-            message = '''When querying storage bucket for size, prior
-                to starting new VM, the API call experienced a problem.
-                Often this indicates the bucket was not accessible.  Check that
-                the resource is in a bucket accessible by this application.'''
-            handle_exception(ex, message)
-            return None
-        for x in response['items']:
-            total_bucket_contents_in_bytes += int(x['size'])
-        size_in_gb = total_bucket_contents_in_bytes/(1024**3)
-        target_disk_size = int(disk_size_factor*size_in_gb)
-        if target_disk_size < min_disk_size:
-            target_disk_size = min_disk_size
+        # record the VM name so the watchdog can match the VM to this transfer:
+        item['instance_name'] = instance_name
 
         # fill out the template command:
-        current_zone = CurrentZone.objects.all()[0].zone
+        current_zone = runtime_settings.get_current_zone()
+        if current_zone is None:
+            raise Exception('A current zone has not been set.')
         if current_zone.cloud_environment != settings.GOOGLE:
             raise Exception('Incorrect configuration-- the current zone does not correspond to your cloud provider')
         zone_str = current_zone.zone
@@ -583,13 +922,25 @@ class GoogleEnvironmentDownloader(EnvironmentSpecificDownloader, GoogleBase):
         # Since these are passed via the gcloud command, the arg strings are a bit strange
         # These should be common to all google-environment activity.  
         # Args specific to the particular downloader should be handled in the subclass
-        cmd += ' --container-arg="-token" --container-arg="%s"' % settings.CONFIG_PARAMS['token']
-        cmd += ' --container-arg="-key" --container-arg="%s"' % settings.CONFIG_PARAMS['enc_key']
-        cmd += ' --container-arg="-pk" --container-arg="%s"' % item['transfer_pk']
-        cmd += ' --container-arg="-url" --container-arg="%s"' % full_callback_url
-        cmd += ' --container-arg="-path" --container-arg="%s"' % item['path']
-        cmd += ' --container-arg="-proj" --container-arg="%s"' % settings.CONFIG_PARAMS['google_project_id']
-        cmd += ' --container-arg="-zone" --container-arg="%s"' % zone_str
+        cmd += transfer_utils.container_arg('-token', settings.CONFIG_PARAMS['token'])
+        cmd += transfer_utils.container_arg('-key', settings.CONFIG_PARAMS['enc_key'])
+        cmd += transfer_utils.container_arg('-pk', item['transfer_pk'])
+        cmd += transfer_utils.container_arg('-url', full_callback_url)
+        cmd += transfer_utils.container_arg('-path', item['path'])
+        cmd += transfer_utils.container_arg('-proj', settings.CONFIG_PARAMS['google_project_id'])
+        cmd += transfer_utils.container_arg('-zone', zone_str)
+        cmd += transfer_utils.container_arg('-checkpoint_url', full_checkpoint_url)
+        cmd += transfer_utils.container_arg('-progress_url', full_progress_url)
+
+        # if this is resuming an interrupted transfer, tell the worker where to pick up:
+        if item.get('resumable_session'):
+            cmd += transfer_utils.container_arg('-session', item['resumable_session'])
+            cmd += transfer_utils.container_arg('-offset', item['committed_offset'])
+            if item.get('chunk_boundaries'):
+                cmd += transfer_utils.container_arg('-boundaries', item['chunk_boundaries'])
+
+        if custom_config['preemptible'] in ['True', 'true']:
+            cmd += ' --preemptible'
         return cmd
 
 class AWSEnvironmentDownloader(EnvironmentSpecificDownloader, AWSBase):
@@ -600,6 +951,7 @@ class GoogleDropboxDownloader(GoogleEnvironmentDownloader):
     downloader_cls = DropboxDownloader
     config_keys = ['dropbox_in_google',]
     config_keys.extend(GoogleEnvironmentDownloader.config_keys)
+    supports_archives = True
 
     def __init__(self, download_data):
         super().__init__(download_data)
@@ -613,14 +965,17 @@ class GoogleDropboxDownloader(GoogleEnvironmentDownloader):
         for i, item in enumerate(self.downloader.download_data):
             cmd = self._prep_single_download(custom_config, i, item)
             if cmd is not None:
-                cmd += ' --container-arg="-dropbox" --container-arg="%s"' % item['access_token']
-                cmd += ' --container-arg="-d" --container-arg="%s"' % custom_config['dropbox_destination_folderpath']
+                cmd += transfer_utils.container_arg('-dropbox', item['access_token'])
+                cmd += transfer_utils.container_arg('-d', custom_config['dropbox_destination_folderpath'])
                 transfer_utils.check_for_transfer_availability(custom_config)
                 self.launcher.go(cmd)
 
-                # mark the Transfer as started
+                # mark the Transfer as started and keep the info needed to relaunch it
                 transfer_obj = Transfer.objects.get(pk = item['transfer_pk'])
                 transfer_obj.started=True
+                transfer_obj.launch_info = json.dumps(item)
+                transfer_obj.instance_name = item['instance_name']
+                transfer_obj.launch_time = timezone.now()
                 transfer_obj.save()
 
                 launch_count += 1
@@ -628,12 +983,35 @@ class GoogleDropboxDownloader(GoogleEnvironmentDownloader):
                 failed_pks.append(item['transfer_pk'])
         transfer_utils.handle_launch_problems(failed_pks, launch_count) 
 
+    def stream_single_download(self, item):
+        chunk_size = int(float(self.config_params['in_worker_chunk_size_in_bytes']))
+        return streaming.run_in_worker_transfer(item['transfer_pk'], 
+            streaming.gcs_to_dropbox,
+            item['path'],
+            item['access_token'],
+            self.config_params['dropbox_destination_folderpath'],
+            chunk_size
+        )
+
+    def stream_archive(self, transfer_pk, archive_options):
+        chunk_size = int(float(self.config_params['in_worker_chunk_size_in_bytes']))
+        return streaming.run_in_worker_transfer(transfer_pk, 
+            archives.archive_to_dropbox,
+            self.downloader.download_data,
+            archive_options,
+            self.downloader.download_data[0]['access_token'],
+            self.config_params['dropbox_destination_folderpath'],
+            chunk_size,
+            int(self.config_params['archive_compression_level'])
+        )
+
 
 class GoogleDriveDownloader(GoogleEnvironmentDownloader):
 
     downloader_cls = DriveDownloader
     config_keys = ['drive_in_google',]
     config_keys.extend(GoogleEnvironmentDownloader.config_keys)
+    supports_archives = True
 
     def __init__(self, download_data):
         super().__init__(download_data)
@@ -645,13 +1023,16 @@ class GoogleDriveDownloader(GoogleEnvironmentDownloader):
         for i, item in enumerate(self.downloader.download_data):
             cmd = self._prep_single_download(custom_config, i, item)
             if cmd is not None:
-                cmd += ' --container-arg="-access_token" --container-arg="%s"' % item['access_token'] # the oauth2 access token
+                cmd += transfer_utils.container_arg('-access_token', item['access_token']) # the oauth2 access token
                 transfer_utils.check_for_transfer_availability(custom_config)
                 self.launcher.go(cmd)
                                 
-                # mark the Transfer as started
+                # mark the Transfer as started and keep the info needed to relaunch it
                 transfer_obj = Transfer.objects.get(pk = item['transfer_pk'])
                 transfer_obj.started=True
+                transfer_obj.launch_info = json.dumps(item)
+                transfer_obj.instance_name = item['instance_name']
+                transfer_obj.launch_time = timezone.now()
                 transfer_obj.save()
                 
                 launch_count += 1
@@ -659,6 +1040,26 @@ class GoogleDriveDownloader(GoogleEnvironmentDownloader):
                 failed_pks.append(item['transfer_pk'])
         transfer_utils.handle_launch_problems(failed_pks, launch_count)
 
+    def stream_single_download(self, item):
+        chunk_size = int(float(self.config_params['in_worker_chunk_size_in_bytes']))
+        return streaming.run_in_worker_transfer(item['transfer_pk'], 
+            streaming.gcs_to_drive,
+            item['path'],
+            item['access_token'],
+            chunk_size
+        )
+
+    def stream_archive(self, transfer_pk, archive_options):
+        chunk_size = int(float(self.config_params['in_worker_chunk_size_in_bytes']))
+        return streaming.run_in_worker_transfer(transfer_pk, 
+            archives.archive_to_drive,
+            self.downloader.download_data,
+            archive_options,
+            self.downloader.download_data[0]['access_token'],
+            chunk_size,
+            int(self.config_params['archive_compression_level'])
+        )
+
 
 class AWSDropboxDownloader(AWSEnvironmentDownloader):
     downloader_cls = DropboxDownloader
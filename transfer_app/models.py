@@ -1,7 +1,12 @@
-from django.db import models
+import datetime
+
+from django.db import models, transaction
+from django.db.models import F
+from django.conf import settings
 from django.contrib.auth import get_user_model
 
 from base.models import Resource 
+from helpers import crypto_utils
 
 class TransferCoordinatorObjectManager(models.Manager):
      '''
@@ -15,6 +20,19 @@ class TransferCoordinatorObjectManager(models.Manager):
          q = all_tc.filter(pk__in = user_tc_pk)
          return q
 
+     def with_progress(self, queryset=None):
+         '''
+         Prefetches the Transfers (and the Resources they move) for the coordinators
+         in the queryset, so that listing their progress does not require queries
+         for each coordinator.  See TransferCoordinator.progress
+         '''
+         if queryset is None:
+             queryset = super(TransferCoordinatorObjectManager, self).get_queryset()
+         transfers = Transfer.objects.select_related('resource').prefetch_related('archive_resources')
+         return queryset.prefetch_related(
+             models.Prefetch('transfer_set', queryset=transfers, to_attr='prefetched_transfers')
+         )
+
 
 
 class TransferCoordinator(models.Model):
@@ -34,8 +52,61 @@ class TransferCoordinator(models.Model):
     # when all the Transfers completed. This does NOT imply success.
     finish_time = models.DateTimeField(null=True)
 
+    # counts of the Transfers managed by this coordinator.  These are only
+    # modified with F() expressions (see Transfer.save and Transfer.finalize) so that 
+    # concurrent callbacks do not clobber each other, and we can tell whether 
+    # the batch is complete without loading all of its Transfers.
+    total_transfers = models.PositiveIntegerField(null=False, default=0)
+    completed_transfers = models.PositiveIntegerField(null=False, default=0)
+    failed_transfers = models.PositiveIntegerField(null=False, default=0)
+
     objects = TransferCoordinatorObjectManager()
 
+    def progress(self):
+        '''
+        Aggregates the progress reported for the Transfers managed by this
+        coordinator.  Successfully completed transfers count their full size.
+        Returns a dict.
+        '''
+        # use the Transfers prefetched by TransferCoordinatorObjectManager.with_progress, if available
+        all_transfers = getattr(self, 'prefetched_transfers', None)
+        if all_transfers is None:
+            all_transfers = Transfer.objects.filter(coordinator = self) \
+                .select_related('resource').prefetch_related('archive_resources')
+        total_bytes = 0
+        bytes_transferred = 0
+        throughput = 0.0
+        chunk_retries = 0
+        completed_count = 0
+        for t in all_transfers:
+            size = t.transfer_size()
+            total_bytes += size
+            if t.completed:
+                completed_count += 1
+                if t.success:
+                    bytes_transferred += size
+            else:
+                bytes_transferred += t.bytes_transferred
+                if t.started and t.throughput:
+                    throughput += t.throughput
+            chunk_retries += t.chunk_retries
+        return {
+            'transfer_count': len(all_transfers),
+            'completed_count': completed_count,
+            'total_bytes': total_bytes,
+            'bytes_transferred': bytes_transferred,
+            'bytes_per_second': throughput,
+            'chunk_retries': chunk_retries
+        }
+
+    def originator_emails(self):
+        '''
+        Returns a list of the (unique) email addresses for the users who
+        originated the Transfers managed by this coordinator
+        '''
+        return list(Transfer.objects.filter(coordinator = self) \
+            .values_list('originator__email', flat=True).distinct())
+
 
 class TransferObjectManager(models.Manager):
      '''
@@ -61,6 +132,12 @@ class Transfer(models.Model):
     # the Resource instance we are moving, as a foreign key
     resource = models.ForeignKey(Resource, on_delete=models.CASCADE)
 
+    # downloads may deliver several Resources as a single zip archive, in
+    # which case this is the name of the archive and archive_resources holds
+    # all of the Resources in it (including the one referenced above)
+    archive_name = models.CharField(max_length=100, null=True, blank=True)
+    archive_resources = models.ManyToManyField(Resource, related_name='archive_transfers', blank=True)
+
     # where the Resource is going (e.g. a URL)
     destination = models.TextField(null=False, max_length=1000)
 
@@ -89,6 +166,45 @@ class Transfer(models.Model):
     # each Transfer is "managed" by a TransferCoordinator, which monitors >=1 Transfers
     coordinator = models.ForeignKey(TransferCoordinator, on_delete=models.CASCADE)
 
+    # True if the transfer was streamed directly by a worker process (small files)
+    # rather than by a dedicated VM.  Allows us to compare the throughput of each tier
+    in_worker = models.BooleanField(null=False, default=False)
+
+    # Workers periodically report the session they are sending to (e.g. a Dropbox 
+    # upload session ID or a Drive resumable upload URI) and the number of bytes
+    # committed to it.  If the worker fails or is preempted, a new worker can
+    # resume from this checkpoint rather than starting over.
+    resumable_session = models.CharField(max_length=2000, null=True, blank=True)
+    committed_offset = models.BigIntegerField(null=False, default=0)
+    checkpoint_time = models.DateTimeField(null=True, blank=True)
+
+    # workers which send chunks concurrently (e.g. Dropbox) also report the
+    # boundaries (comma-separated byte offsets) of the chunks they may have
+    # sent beyond the committed offset.  A resumed worker sends on the same
+    # boundaries, so chunks already received are not sent again overlapping.
+    chunk_boundaries = models.TextField(null=True, blank=True)
+
+    # the name of the VM performing this transfer (null for in-worker transfers
+    # or while waiting to be relaunched) and when it was launched.  This allows 
+    # us to find transfers whose VM has died or become unresponsive.
+    instance_name = models.CharField(max_length=63, null=True, blank=True)
+    launch_time = models.DateTimeField(null=True, blank=True)
+
+    # the number of times this transfer was relaunched after a failure
+    relaunch_count = models.PositiveIntegerField(null=False, default=0)
+
+    # the most recent progress sample reported by the worker.  throughput is
+    # in bytes/second, measured over the most recent reporting interval
+    bytes_transferred = models.BigIntegerField(null=False, default=0)
+    throughput = models.FloatField(null=True, blank=True)
+    chunk_retries = models.PositiveIntegerField(null=False, default=0)
+    last_progress_time = models.DateTimeField(null=True, blank=True)
+
+    # a JSON-format string of the info used to launch the worker, so the
+    # transfer may be relaunched without any user interaction.  This includes
+    # the OAuth2 token, so it is encrypted (use the launch_info property)
+    encrypted_launch_info = models.TextField(null=True, blank=True)
+
     # other users (such as admins) can request transfers on behalf of regular users
     # this allows us to track who started the transfer, while the resource may only be
     # owned by that regular user
@@ -96,17 +212,153 @@ class Transfer(models.Model):
 
     objects = TransferObjectManager()
 
+    class Meta:
+        # the conflict checks look for incomplete transfers (by originator for downloads)
+        indexes = [
+            models.Index(fields=['completed', 'originator']),
+        ]
+
     def __str__(self):
+        if self.archive_name:
+            return 'Transfer of archive %s, download' % self.archive_name
         return 'Transfer of %s, %s' % (self.resource, 'download' if self.download else 'upload')
 
     def get_owner(self):
         return self.resource.owner
 
+    def transferred_resources(self):
+        '''
+        Returns a list of the Resources moved by this Transfer
+        '''
+        if self.archive_name:
+            return list(self.archive_resources.all())
+        return [self.resource,]
+
+    def transfer_size(self):
+        '''
+        Returns the total size (in bytes) of the Resources moved by this Transfer
+        '''
+        return sum([r.size for r in self.transferred_resources()])
+
     def save(self, *args, **kwargs):
         if self.finish_time:
             self.duration = self.finish_time - self.start_time
+        adding = self._state.adding
         super().save(*args, **kwargs)
 
+        # a new Transfer adds to the count of its coordinator:
+        if adding:
+            failed = self.completed and not self.success
+            TransferCoordinator.objects.filter(pk=self.coordinator_id).update(
+                total_transfers = F('total_transfers') + 1,
+                completed_transfers = F('completed_transfers') + (1 if self.completed else 0),
+                failed_transfers = F('failed_transfers') + (1 if failed else 0)
+            )
+
+    @property
+    def launch_info(self):
+        if self.encrypted_launch_info is None:
+            return None
+        return crypto_utils.decrypt(self.encrypted_launch_info)
+
+    @launch_info.setter
+    def launch_info(self, value):
+        self.encrypted_launch_info = None if value is None else crypto_utils.encrypt(value)
+
+    def can_resume(self):
+        '''
+        Returns True if a worker has reported a checkpoint for this Transfer
+        and we have not exceeded the number of allowed relaunches
+        '''
+        return self.download and \
+            (self.resumable_session is not None) and \
+            (self.encrypted_launch_info is not None) and \
+            (self.relaunch_count < int(settings.CONFIG_PARAMS['max_transfer_relaunches']))
+
+    def last_heartbeat(self):
+        '''
+        Returns the most recent time we heard from (or launched) the worker
+        '''
+        times = [x for x in [self.launch_time, self.checkpoint_time, self.last_progress_time] if x]
+        if len(times) == 0:
+            return self.start_time
+        return max(times)
+
+    def finalize(self, success, size=None):
+        '''
+        Marks this Transfer as complete and updates the Resource it wraps.
+        Regardless of whether the transfer was performed by a worker VM or
+        streamed by the application itself, this is where the bookkeeping happens.
+        For uploads, size is the size of the file actually stored, if known
+        (the size given when the upload was requested may be missing or wrong).
+
+        Returns True if this was the final Transfer managed by its
+        TransferCoordinator, in which case the coordinator is also marked complete.
+        This happens exactly once per coordinator, even if callbacks for its
+        Transfers arrive concurrently (or a callback is repeated).
+        '''
+        with transaction.atomic():
+            # lock this Transfer.  If it was already finalized (e.g. a repeated 
+            # callback), there is nothing to do.
+            locked_transfer = Transfer.objects.select_for_update().get(pk=self.pk)
+            if locked_transfer.completed:
+                return False
+            self.completed = True
+            self.success = success
+            tz = self.start_time.tzinfo
+            now = datetime.datetime.now(tz)
+            self.duration = now - self.start_time
+            self.finish_time = now
+            self.save()
+
+            tc = TransferCoordinator.objects.select_for_update().get(pk=self.coordinator_id)
+
+            resource = self.resource
+            if success:
+                if self.download:
+                    # did they use the last download?  If so, set the Resource inactive
+                    for downloaded_resource in self.transferred_resources():
+                        if (downloaded_resource.total_downloads + 1) >= \
+                            int(settings.CONFIG_PARAMS['maximum_downloads']):
+                            downloaded_resource.is_active = False
+                        downloaded_resource.total_downloads += 1
+                        downloaded_resource.save()
+                else: # upload
+                    resource.is_active = True
+                    if size is not None:
+                        resource.size = size
+                    resource.save()
+            else: # failed the transfer process somehow
+                # note this failed transfer:
+                ft = FailedTransfer(
+                    was_download = self.download,
+                    intended_path = self.destination,
+                    start_time = self.start_time,
+                    resource_name = self.archive_name or resource.name,
+                    coordinator = tc
+                )
+                ft.save()
+
+                if not self.download:
+                    # if upload, we need to clean up the Resource since it was previously
+                    # saved as a placeholder.
+                    resource.delete()
+
+            # update the counts and check if all the Transfers belonging to this 
+            # TransferCoordinator are complete:
+            TransferCoordinator.objects.filter(pk=tc.pk).update(
+                completed_transfers = F('completed_transfers') + 1,
+                failed_transfers = F('failed_transfers') + (0 if success else 1)
+            )
+            tc.refresh_from_db(fields=['completed_transfers', 'total_transfers'])
+            if tc.completed_transfers >= tc.total_transfers:
+                marked = TransferCoordinator.objects.filter(pk=tc.pk, completed=False).update(
+                    completed = True,
+                    finish_time = datetime.datetime.now()
+                )
+                return marked == 1
+            return False
+
 
 class FailedTransfer(models.Model):
     '''
@@ -130,3 +382,38 @@ class FailedTransfer(models.Model):
 
     # the coordinator that was handling this failure
     coordinator = models.ForeignKey(TransferCoordinator, on_delete=models.CASCADE)
+
+
+class DeferredDownload(models.Model):
+    '''
+    When the user's Dropbox/Drive does not have room for all of the requested
+    files, the files which did not fit are recorded here.  They are retried
+    periodically, in case the user frees up some space.
+    '''
+    # the file to download
+    resource = models.ForeignKey(Resource, on_delete=models.CASCADE)
+
+    # the storage service the file is destined for (e.g. Dropbox)
+    destination = models.CharField(max_length=100, null=False)
+
+    # the token obtained during the original OAuth2 flow, encrypted (use the
+    # access_token property).  Once this expires, the deferred download can 
+    # no longer be retried.
+    encrypted_access_token = models.TextField(null=False)
+
+    # who requested the download
+    originator = models.ForeignKey(get_user_model(), on_delete=models.CASCADE)
+
+    # when the download was deferred
+    created = models.DateTimeField(null=False, auto_now_add=True)
+
+    @property
+    def access_token(self):
+        return crypto_utils.decrypt(self.encrypted_access_token)
+
+    @access_token.setter
+    def access_token(self, value):
+        self.encrypted_access_token = crypto_utils.encrypt(value)
+
+    def __str__(self):
+        return 'Deferred download of %s to %s' % (self.resource, self.destination)
@@ -8,6 +8,7 @@ class TransferSerializer(serializers.ModelSerializer):
         model = Transfer
         fields = ('id', \
                   'resource', \
+                  'archive_name', \
                   'download', \
                   'destination', \
                   'completed', \
@@ -15,13 +16,22 @@ class TransferSerializer(serializers.ModelSerializer):
                   'start_time', \
                   'finish_time', \
                   'duration', \
-                  'coordinator',
+                  'coordinator', \
+                  'bytes_transferred', \
+                  'throughput', \
+                  'chunk_retries', \
+                  'last_progress_time',
         )
 
 class TransferCoordinatorSerializer(serializers.ModelSerializer):
+    progress = serializers.SerializerMethodField()
+
     class Meta:
         model = TransferCoordinator
-        fields = ('id', 'completed')
+        fields = ('id', 'completed', 'progress')
+
+    def get_progress(self, obj):
+        return obj.progress()
 
 
 class TransferredResourceSerializer(serializers.ModelSerializer):
@@ -29,4 +39,5 @@ class TransferredResourceSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Transfer
-        fields = '__all__'
+        # the launch info contains the user's access tokens
+        exclude = ('encrypted_launch_info', 'resumable_session', 'chunk_boundaries')
@@ -0,0 +1,337 @@
+"""
+For small files, starting a dedicated VM takes far longer than the transfer itself.
+The functions here allow the application's worker processes to stream the bytes
+directly between Google storage and Dropbox/Drive, chunk by chunk, without
+staging anything on local disk.
+
+Larger files continue to go through the VM-based transfers.  The choice is made
+by comparing the file size against a threshold set in the downloader/uploader
+config files.
+"""
+import io
+import os
+import time
+import socket
+import ipaddress
+import threading
+import urllib.parse
+
+import requests
+import dropbox.dropbox as dropbox_module
+import dropbox.files as dropbox_files
+from googleapiclient.http import MediaIoBaseUpload
+
+from django.conf import settings
+from django.utils import timezone
+
+from helpers import google_clients
+from helpers import storage_utils
+import transfer_app.utils as transfer_utils
+from transfer_app.models import Transfer, TransferCoordinator
+
+# the URL used to fetch the raw bytes of a file in Google Drive
+DRIVE_MEDIA_URL = 'https://www.googleapis.com/drive/v3/files/%s?alt=media'
+
+# how long to wait (in seconds) for a response when fetching from a URL
+DEFAULT_TIMEOUT = 60
+
+# while streaming, the Transfer's heartbeat (last_progress_time) is updated at most
+# this often (in seconds).  The watchdog uses it to find in-worker transfers which
+# have stopped (e.g. the worker was killed).
+HEARTBEAT_INTERVAL_SECONDS = 60
+
+# the Transfer being streamed by the current thread (see run_in_worker_transfer)
+_local = threading.local()
+
+
+def split_bucket_path(path):
+    '''
+    Given a path like gs://bucket/dir/object.txt, returns a tuple
+    of the bucket name and the object name ('bucket', 'dir/object.txt')
+    '''
+    gs_prefix = settings.CONFIG_PARAMS['google_storage_gs_prefix']
+    contents = path[len(gs_prefix):].split('/')
+    return contents[0], '/'.join(contents[1:])
+
+
+def split_transfer_tiers(items, config_params):
+    '''
+    Splits the transfer items (dicts, each having a 'size_in_bytes' key) into
+    those which are small enough to be streamed by the worker process and those
+    which require a dedicated VM.  Returns a tuple of two lists.
+
+    Items with an unknown size (zero) are always sent to a VM.
+    '''
+    threshold = int(float(config_params['in_worker_max_size_in_bytes']))
+    in_worker_items = []
+    vm_items = []
+    for item in items:
+        size_in_bytes = item.get('size_in_bytes', 0)
+        if (size_in_bytes > 0) and (size_in_bytes <= threshold):
+            in_worker_items.append(item)
+        else:
+            vm_items.append(item)
+    return in_worker_items, vm_items
+
+
+def heartbeat():
+    '''
+    Called as the in-worker transfers make progress (e.g. for each chunk).  Records
+    that the Transfer being streamed by this thread is still going.
+    '''
+    transfer_pk = getattr(_local, 'transfer_pk', None)
+    if transfer_pk is None:
+        return
+    now = time.time()
+    if (now - _local.last_heartbeat) >= HEARTBEAT_INTERVAL_SECONDS:
+        _local.last_heartbeat = now
+        Transfer.objects.filter(pk=transfer_pk).update(last_progress_time=timezone.now())
+
+
+class HeartbeatReader(object):
+    '''
+    Wraps a file-like object so that each read records a heartbeat.  If
+    max_size is given, reading more than that many bytes raises an exception.
+    '''
+    def __init__(self, fileobj, max_size=None):
+        self.fileobj = fileobj
+        self.max_size = max_size
+        self.num_bytes = 0
+
+    def read(self, *args):
+        data = self.fileobj.read(*args)
+        self.num_bytes += len(data)
+        if (self.max_size is not None) and (self.num_bytes > self.max_size):
+            raise Exception('Received more than the maximum of %d bytes' % self.max_size)
+        heartbeat()
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+class GoogleStorageRangeReader(io.RawIOBase):
+    '''
+    A read-only, seekable file-like object backed by an object in Google storage.
+    Each read is performed as a ranged request, so the object is never
+    held on disk or entirely in memory.
+    '''
+
+    def __init__(self, path, storage_client=None):
+        super().__init__()
+        if storage_client is None:
+            storage_client = google_clients.get_storage_client()
+        bucket_name, object_name = split_bucket_path(path)
+        bucket = storage_utils.get_bucket(bucket_name, storage_client)
+        self.blob = bucket.get_blob(object_name)
+        if self.blob is None:
+            raise Exception('Could not locate the object at %s' % path)
+        self.name = os.path.basename(object_name)
+        self.size = self.blob.size
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        elif whence == io.SEEK_END:
+            self._position = self.size + offset
+        else:
+            raise ValueError('Invalid value for whence: %s' % whence)
+        return self._position
+
+    def read(self, size=-1):
+        if self._position >= self.size:
+            return b''
+        if (size is None) or (size < 0):
+            end = self.size - 1
+        else:
+            end = min(self._position + size, self.size) - 1
+        content = self.blob.download_as_string(start=self._position, end=end)
+        self._position += len(content)
+        heartbeat()
+        return content
+
+
+def gcs_to_dropbox(resource_path, access_token, dropbox_folderpath, chunk_size):
+    '''
+    Streams the object at resource_path into the user's Dropbox.
+    Returns the number of bytes sent.
+    '''
+    reader = GoogleStorageRangeReader(resource_path)
+    client = dropbox_module.Dropbox(access_token, timeout=DEFAULT_TIMEOUT)
+    path_in_dropbox = '%s/%s' % (dropbox_folderpath, reader.name)
+    if reader.size <= chunk_size:
+        client.files_upload(reader.read(), path_in_dropbox)
+    else:
+        session_start_result = client.files_upload_session_start(reader.read(chunk_size))
+        cursor = dropbox_files.UploadSessionCursor(session_start_result.session_id, offset=reader.tell())
+        commit = dropbox_files.CommitInfo(path=path_in_dropbox)
+        while reader.tell() < reader.size:
+            if (reader.size - reader.tell()) <= chunk_size:
+                client.files_upload_session_finish(reader.read(chunk_size), cursor, commit)
+            else:
+                client.files_upload_session_append_v2(reader.read(chunk_size), cursor)
+                cursor.offset = reader.tell()
+    return reader.size
+
+
+def gcs_to_drive(resource_path, access_token, chunk_size):
+    '''
+    Streams the object at resource_path into the user's Google Drive
+    using a resumable upload.  Returns the number of bytes sent.
+    '''
+    reader = GoogleStorageRangeReader(resource_path)
+    drive_service = google_clients.get_drive_client(access_token)
+    upload = MediaIoBaseUpload(reader,
+        mimetype='application/octet-stream',
+        chunksize=chunk_size,
+        resumable=True
+    )
+    request = drive_service.files().create(body={'name': reader.name}, media_body=upload)
+    response = None
+    while response is None:
+        status, response = request.next_chunk()
+    return reader.size
+
+
+def is_public_host(hostname):
+    '''
+    Returns True if every address the hostname resolves to is globally 
+    routable (i.e. not a private, loopback, or link-local address such as
+    the metadata server)
+    '''
+    try:
+        infos = socket.getaddrinfo(hostname, None)
+    except socket.gaierror:
+        return False
+    for info in infos:
+        # scoped IPv6 addresses look like fe80::1%eth0
+        address = ipaddress.ip_address(info[4][0].split('%')[0])
+        if not address.is_global:
+            return False
+    return len(infos) > 0
+
+
+def check_public_urls(urls):
+    '''
+    Raises an exception if any of the URLs is not on a public host
+    '''
+    for url in urls:
+        hostname = urllib.parse.urlparse(url).hostname
+        if (hostname is None) or (not is_public_host(hostname)):
+            raise Exception('%s is not a public address' % url)
+
+
+def probe_url_size(source_url, headers=None):
+    '''
+    Returns the size reported (as the Content-Length) by a HEAD request for
+    the URL, or None if it could not be determined or the URL (or any 
+    redirect) is not on a public host
+    '''
+    try:
+        check_public_urls([source_url,])
+        response = requests.head(source_url, headers=headers, allow_redirects=True, timeout=DEFAULT_TIMEOUT)
+        response.raise_for_status()
+        check_public_urls([r.url for r in response.history] + [response.url,])
+        return int(response.headers['Content-Length'])
+    except Exception as ex:
+        print('Could not determine the size of %s: %s' % (source_url, ex))
+        return None
+
+
+def _remove_partial_object(blob):
+    try:
+        blob.delete()
+    except Exception as ex:
+        # commonly, nothing was written
+        print('Could not remove the partial object %s: %s' % (blob.name, ex))
+
+
+def url_to_gcs(source_url, destination, chunk_size, headers=None, max_size=None, public_only=False):
+    '''
+    Streams the content at source_url into Google storage at destination (which
+    includes the gs:// prefix).  The content is passed directly into a
+    resumable upload, so nothing is written to local disk.
+    If the server reported a Content-Length which does not match what was
+    received, the partial object is removed and an exception is raised.
+    Returns the number of bytes sent.
+
+    If max_size is given, content larger than that is not accepted (whatever
+    size the user claimed).  If public_only is True, the URL (and any redirect)
+    must be on a public host.
+    '''
+    if public_only:
+        check_public_urls([source_url,])
+    response = requests.get(source_url, headers=headers, stream=True, timeout=DEFAULT_TIMEOUT)
+    response.raise_for_status()
+    if public_only:
+        check_public_urls([r.url for r in response.history] + [response.url,])
+    expected_size = response.headers.get('Content-Length')
+    if (max_size is not None) and (expected_size is not None) and (int(expected_size) > max_size):
+        response.close()
+        raise Exception('The content at %s (%s bytes) exceeds the maximum of %d bytes' % (source_url, expected_size, max_size))
+    response.raw.decode_content = True
+
+    bucket_name, object_name = split_bucket_path(destination)
+    storage_client = google_clients.get_storage_client()
+    bucket = storage_client.bucket(bucket_name)
+    blob = bucket.blob(object_name, chunk_size=chunk_size)
+    try:
+        blob.upload_from_file(HeartbeatReader(response.raw, max_size))
+    except Exception:
+        _remove_partial_object(blob)
+        raise
+    num_bytes = response.raw.tell()
+
+    if (expected_size is not None) and (int(expected_size) != num_bytes):
+        blob.delete()
+        raise Exception('Expected %s bytes from %s, but received %d' % (expected_size, source_url, num_bytes))
+    return num_bytes
+
+
+def run_in_worker_transfer(transfer_pk, stream_func, *args):
+    '''
+    Executes one of the streaming functions above and then records the outcome
+    exactly as we do when a worker VM reports back.  The elapsed time and
+    throughput are printed so that the tiers can be compared in the logs.
+    '''
+    # e.g. the watchdog gave up on the transfer while it was waiting in the queue
+    if Transfer.objects.filter(pk=transfer_pk, completed=True).exists():
+        print('Transfer %s was already completed.  Skipping.' % transfer_pk)
+        return False
+
+    start = time.time()
+    Transfer.objects.filter(pk=transfer_pk).update(last_progress_time=timezone.now())
+    _local.transfer_pk = transfer_pk
+    _local.last_heartbeat = start
+    try:
+        num_bytes = stream_func(*args)
+        success = True
+    except Exception as ex:
+        print('In-worker streaming for transfer %s failed: %s' % (transfer_pk, ex))
+        num_bytes = 0
+        success = False
+    finally:
+        _local.transfer_pk = None
+    elapsed = time.time() - start
+    if elapsed > 0:
+        print('In-worker transfer %s: %d bytes in %.2f seconds (%.1f bytes/s)'
+            % (transfer_pk, num_bytes, elapsed, num_bytes/elapsed))
+
+    transfer_obj = Transfer.objects.get(pk=transfer_pk)
+    tc_pk = transfer_obj.coordinator.pk
+    if transfer_obj.finalize(success, num_bytes if success else None):
+        tc = TransferCoordinator.objects.get(pk=tc_pk)
+        transfer_utils.post_completion(tc, tc.originator_emails())
+    return success
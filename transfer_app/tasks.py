@@ -1,6 +1,11 @@
+import json
+
 from celery.decorators import task
 
-from transfer_app import uploaders, downloaders
+import base.exceptions as exceptions
+from transfer_app import uploaders, downloaders, watchdog
+import transfer_app.utils as transfer_utils
+from transfer_app.models import Transfer
 
 @task(name='upload')
 def upload(upload_info, upload_source):
@@ -21,3 +26,75 @@ def download(download_info, download_destination):
     downloader_cls = downloaders.get_downloader(download_destination)
     downloader = downloader_cls(download_info)
     downloader.download()
+
+@task(name='download_archive')
+def download_archive(download_info, download_destination, archive_options):
+    '''
+    download_info is a list as for download above, but the files are
+    delivered together as a single zip archive
+    '''
+    downloader_cls = downloaders.get_downloader(download_destination)
+    downloader = downloader_cls(download_info)
+    downloader.download_archive(archive_options)
+
+@task(name='stream_upload')
+def stream_upload(upload_item, upload_source):
+    '''
+    upload_item is a single dictionary (as in the list passed to upload above)
+    for a file small enough to be streamed directly by this worker
+    '''
+    uploader_cls = uploaders.get_uploader(upload_source)
+    uploader = uploader_cls([upload_item,])
+    uploader.stream_single_upload(upload_item)
+
+@task(name='stream_download')
+def stream_download(download_item, download_destination):
+    '''
+    download_item is a single dictionary (as in the list passed to download above)
+    for a file small enough to be streamed directly by this worker
+    '''
+    downloader_cls = downloaders.get_downloader(download_destination)
+    downloader = downloader_cls([download_item,])
+    downloader.stream_single_download(download_item)
+
+@task(name='resume_transfer')
+def resume_transfer(transfer_pk):
+    '''
+    Launches a new worker for an interrupted download.  The worker 
+    resumes from the last checkpoint reported by its predecessor.
+    '''
+    transfer_obj = Transfer.objects.get(pk=transfer_pk)
+    try:
+        download_item = json.loads(transfer_obj.launch_info)
+    except exceptions.ExceptionWithMessage as ex:
+        # e.g. the keys were changed since the transfer was launched
+        print('Could not read the launch info for transfer %s: %s' % (transfer_pk, ex.message))
+        if transfer_obj.finalize(False):
+            tc = transfer_obj.coordinator
+            transfer_utils.post_completion(tc, tc.originator_emails())
+        return
+    download_item['resumable_session'] = transfer_obj.resumable_session
+    download_item['committed_offset'] = transfer_obj.committed_offset
+    download_item['chunk_boundaries'] = transfer_obj.chunk_boundaries
+    downloader_cls = downloaders.get_downloader(transfer_obj.destination)
+    downloader = downloader_cls([download_item,])
+    downloader.config_and_start_downloads()
+
+@task(name='reconcile_transfers')
+def reconcile_transfers():
+    '''
+    Periodically removes orphaned transfer VMs and reclaims
+    transfers whose VM has died (or, for uploads from the browser,
+    which were abandoned)
+    '''
+    summary = watchdog.reconcile_transfers()
+    summary['browser_uploads_expired'] = uploaders.expire_browser_uploads()
+    return summary
+
+@task(name='retry_deferred_downloads')
+def retry_deferred_downloads():
+    '''
+    Periodically starts downloads that were deferred because the user's
+    storage was full, if there is now room for them
+    '''
+    return downloaders.retry_deferred_downloads()
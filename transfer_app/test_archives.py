@@ -0,0 +1,294 @@
+import io
+import os
+import zipfile
+import unittest.mock as mock
+
+from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.conf import settings
+
+from base.models import Resource
+from transfer_app.models import Transfer, TransferCoordinator
+import transfer_app.archives as archives
+import transfer_app.downloaders as downloaders
+import base.exceptions as exceptions
+
+# the ZipStream class is patched below so that the archives are built from local data
+ZipStream = archives.ZipStream
+
+
+def make_members(contents):
+    '''
+    contents is a dict of the file name to its bytes.  Returns the members
+    for a ZipStream and a function which opens them
+    '''
+    members = [{'name': name, 'path': name, 'size_in_bytes': len(data)} for name, data in contents.items()]
+    open_member = lambda path: io.BytesIO(contents[path])
+    return members, open_member
+
+
+def read_all(stream, chunk_size):
+    chunks = []
+    while True:
+        data = stream.read(chunk_size)
+        if not data:
+            break
+        chunks.append(data)
+    return b''.join(chunks)
+
+
+class ZipStreamTestCase(TestCase):
+
+    def setUp(self):
+        self.contents = {
+            'a.txt': os.urandom(300000),
+            'b.txt': b'abcde'*30000,
+            'empty.txt': b''
+        }
+
+    def check_archive(self, archive_bytes):
+        zf = zipfile.ZipFile(io.BytesIO(archive_bytes))
+        self.assertIsNone(zf.testzip())
+        self.assertEqual(zf.namelist(), ['a.txt', 'b.txt', 'empty.txt', archives.MANIFEST_NAME])
+        for name, data in self.contents.items():
+            self.assertEqual(zf.read(name), data)
+        return zf
+
+    def test_stored_and_deflated_archives_are_valid(self):
+        for compression in [archives.STORED, archives.DEFLATED]:
+            members, open_member = make_members(self.contents)
+            stream = archives.ZipStream(members, compression, read_size=7000, open_member=open_member)
+            archive_bytes = read_all(stream, 65536)
+            self.assertEqual(len(archive_bytes), stream.tell())
+            zf = self.check_archive(archive_bytes)
+            expected_type = zipfile.ZIP_STORED if compression == archives.STORED else zipfile.ZIP_DEFLATED
+            self.assertTrue(all([info.compress_type == expected_type for info in zf.infolist()]))
+
+    def test_zip64_archive_is_valid(self):
+        members, open_member = make_members(self.contents)
+        stream = archives.ZipStream(members, archives.DEFLATED, open_member=open_member, force_zip64=True)
+        self.check_archive(read_all(stream, 1000))
+
+    def test_manifest_lists_files(self):
+        members, open_member = make_members(self.contents)
+        stream = archives.ZipStream(members, archives.STORED, open_member=open_member)
+        zf = zipfile.ZipFile(io.BytesIO(read_all(stream, 65536)))
+        lines = zf.read(archives.MANIFEST_NAME).decode('utf-8').strip().split('\n')
+        self.assertEqual(lines[0], 'name\tsize_in_bytes\tcrc32')
+        self.assertEqual(lines[1], 'a.txt\t300000\t%08x' % zf.getinfo('a.txt').CRC)
+        self.assertEqual(len(lines), 4)
+
+    def test_size_mismatch_raises(self):
+        members, open_member = make_members(self.contents)
+        members[0]['size_in_bytes'] += 1
+        stream = archives.ZipStream(members, archives.STORED, open_member=open_member)
+        with self.assertRaises(Exception):
+            read_all(stream, 65536)
+
+    def test_unique_member_names(self):
+        names = archives.unique_member_names(['a.txt', 'b.txt', 'a.txt', 'a.txt'])
+        self.assertEqual(names, ['a.txt', 'b.txt', 'a(1).txt', 'a(2).txt'])
+
+        # a file may not take the manifest's name
+        stem, ext = os.path.splitext(archives.MANIFEST_NAME)
+        names = archives.unique_member_names([archives.MANIFEST_NAME])
+        self.assertEqual(names, ['%s(1)%s' % (stem, ext)])
+
+    def test_check_archive_options(self):
+        options = archives.check_archive_options({'name': '../outputs'}, 'default.zip')
+        self.assertEqual(options, {'name': 'outputs.zip', 'compression': archives.DEFLATED})
+
+        options = archives.check_archive_options(True, 'default.zip')
+        self.assertEqual(options['name'], 'default.zip')
+
+        with self.assertRaises(exceptions.ExceptionWithMessage):
+            archives.check_archive_options({'compression': 'bzip2'}, 'default.zip')
+
+    @mock.patch('transfer_app.archives.dropbox_module')
+    def test_archive_to_dropbox_uses_upload_session(self, mock_dropbox_module):
+        members, open_member = make_members(self.contents)
+        mock_client = mock.MagicMock()
+        mock_dropbox_module.Dropbox.return_value = mock_client
+        sent = []
+        mock_client.files_upload_session_start.side_effect = lambda data: sent.append(data) or mock.MagicMock(session_id='abc')
+        mock_client.files_upload_session_append_v2.side_effect = lambda data, cursor: sent.append(data)
+        mock_client.files_upload_session_finish.side_effect = lambda data, cursor, commit: sent.append(data)
+
+        with mock.patch('transfer_app.archives.ZipStream', side_effect=lambda *args: ZipStream(*args, open_member=open_member)):
+            num_bytes = archives.archive_to_dropbox(members,
+                {'name': 'out.zip', 'compression': archives.DEFLATED},
+                'token', '/folder', 65536, 6)
+
+        self.assertTrue(mock_client.files_upload_session_finish.called)
+        self.assertEqual(num_bytes, sum([len(x) for x in sent]))
+        commit = mock_client.files_upload_session_finish.call_args[0][2]
+        self.assertEqual(commit.path, '/folder/out.zip')
+        self.check_archive(b''.join(sent))
+
+    @mock.patch('transfer_app.archives.requests')
+    def test_archive_to_drive_gives_total_with_final_chunk(self, mock_requests):
+        members, open_member = make_members(self.contents)
+        mock_requests.post.return_value.headers = {'Location': 'https://upload-session'}
+        sent = []
+        def put(url, data=None, headers=None, timeout=None):
+            sent.append((data, headers['Content-Range']))
+            return mock.MagicMock(status_code=308)
+        mock_requests.put.side_effect = put
+
+        with mock.patch('transfer_app.archives.ZipStream', side_effect=lambda *args: ZipStream(*args, open_member=open_member)):
+            num_bytes = archives.archive_to_drive(members,
+                {'name': 'out.zip', 'compression': archives.STORED},
+                'token', 300000, 6)
+
+        # the chunk size is rounded to a multiple of 256KB:
+        self.assertEqual(len(sent[0][0]), archives.DRIVE_CHUNK_MULTIPLE)
+        self.assertEqual(sent[0][1], 'bytes 0-%d/*' % (archives.DRIVE_CHUNK_MULTIPLE - 1))
+        self.assertTrue(sent[-1][1].endswith('/%d' % num_bytes))
+        self.check_archive(b''.join([x[0] for x in sent]))
+
+
+class ArchiveDownloadTestCase(TestCase):
+
+    def setUp(self):
+        self.regular_user = get_user_model().objects.create_user(email=settings.REGULAR_TEST_EMAIL, password='abcd123!')
+        self.resources = []
+        for i in range(3):
+            self.resources.append(Resource.objects.create(
+                source='google_storage',
+                path='gs://a/dir%d/f.txt' % i,
+                name='f.txt',
+                size=500,
+                owner=self.regular_user,
+            ))
+        self.config_patcher = mock.patch.dict(settings.CONFIG_PARAMS, {
+            'cloud_environment': settings.GOOGLE,
+            'maximum_downloads': '2'
+        })
+        self.config_patcher.start()
+
+    def tearDown(self):
+        self.config_patcher.stop()
+
+    def download_info(self):
+        download_info, error_messages = downloaders.GoogleDropboxDownloader.check_format(
+            [r.pk for r in self.resources], self.regular_user.pk)
+        for item in download_info:
+            item['access_token'] = 'token'
+        return download_info
+
+    @mock.patch('transfer_app.streaming.transfer_utils')
+    @mock.patch('transfer_app.downloaders.archives.archive_to_dropbox')
+    def test_archive_download_uses_single_transfer(self, mock_archive_to_dropbox, mock_transfer_utils):
+        mock_archive_to_dropbox.return_value = 1500
+        downloader = downloaders.GoogleDropboxDownloader(self.download_info())
+        downloader.download_archive({'name': 'out.zip', 'compression': archives.STORED})
+
+        self.assertEqual(Transfer.objects.count(), 1)
+        self.assertEqual(TransferCoordinator.objects.count(), 1)
+        t = Transfer.objects.all()[0]
+        self.assertEqual(t.archive_name, 'out.zip')
+        self.assertTrue(t.completed)
+        self.assertTrue(t.success)
+        self.assertEqual(t.transfer_size(), 1500)
+        self.assertTrue(mock_transfer_utils.post_completion.called)
+
+        # the members were given unique names within the archive:
+        members = mock_archive_to_dropbox.call_args[0][0]
+        self.assertEqual([m['name'] for m in members], ['f.txt', 'f(1).txt', 'f(2).txt'])
+        self.assertEqual([m['path'] for m in members], [r.path for r in self.resources])
+
+        # each of the archived files counts as downloaded:
+        for r in Resource.objects.filter(pk__in=[r.pk for r in self.resources]):
+            self.assertEqual(r.total_downloads, 1)
+
+    @mock.patch('transfer_app.streaming.transfer_utils')
+    @mock.patch('transfer_app.downloaders.archives.archive_to_dropbox')
+    def test_removed_resources_left_out_of_archive(self, mock_archive_to_dropbox, mock_transfer_utils):
+        mock_archive_to_dropbox.return_value = 1000
+        download_info = self.download_info()
+        self.resources[1].delete()
+        downloader = downloaders.GoogleDropboxDownloader(download_info)
+        downloader.download_archive({'name': 'out.zip', 'compression': archives.STORED})
+        members = mock_archive_to_dropbox.call_args[0][0]
+        self.assertEqual([m['path'] for m in members], [self.resources[0].path, self.resources[2].path])
+        self.assertEqual(Transfer.objects.count(), 1)
+
+        # if none remain, nothing is set up:
+        mock_archive_to_dropbox.reset_mock()
+        Resource.objects.all().delete()
+        downloader = downloaders.GoogleDropboxDownloader(download_info)
+        downloader.download_archive({'name': 'out.zip', 'compression': archives.STORED})
+        self.assertFalse(mock_archive_to_dropbox.called)
+        self.assertEqual(Transfer.objects.count(), 0)
+
+    @mock.patch('transfer_app.streaming.transfer_utils')
+    @mock.patch('transfer_app.downloaders.archives.archive_to_dropbox')
+    def test_archived_files_block_new_downloads_until_complete(self, mock_archive_to_dropbox, mock_transfer_utils):
+        tc = TransferCoordinator.objects.create()
+        t = Transfer.objects.create(download=True,
+            resource=self.resources[0],
+            archive_name='out.zip',
+            destination=settings.DROPBOX,
+            coordinator=tc,
+            originator=self.regular_user)
+        t.archive_resources.set(self.resources)
+
+        download_info, error_messages = downloaders.GoogleDropboxDownloader.check_format(
+            [self.resources[2].pk], self.regular_user.pk)
+        self.assertEqual(len(download_info), 0)
+        self.assertEqual(len(error_messages), 1)
+
+    def limit_archive_size(self, max_size):
+        '''
+        Patches the config so that archives are limited to max_size bytes
+        '''
+        get_config = downloaders.DropboxDownloader.get_config
+        def patched_get_config(config_filepath):
+            config_params = get_config(config_filepath)
+            config_params['archive_max_size_in_bytes'] = str(max_size)
+            return config_params
+        return mock.patch.object(downloaders.DropboxDownloader, 'get_config', side_effect=patched_get_config)
+
+    @mock.patch('transfer_app.downloaders.archives.archive_to_dropbox')
+    def test_archive_over_size_limit_not_started(self, mock_archive_to_dropbox):
+        with self.limit_archive_size(1000):
+            with self.assertRaises(exceptions.ExceptionWithMessage):
+                downloaders.GoogleDropboxDownloader.check_archive_options({'name': 'out.zip'}, self.download_info())
+
+            downloader = downloaders.GoogleDropboxDownloader(self.download_info())
+            with self.assertRaises(exceptions.ExceptionWithMessage):
+                downloader.download_archive({'name': 'out.zip', 'compression': archives.STORED})
+        self.assertFalse(mock_archive_to_dropbox.called)
+        self.assertEqual(Transfer.objects.count(), 0)
+
+        options = downloaders.GoogleDropboxDownloader.check_archive_options({'name': 'out.zip'}, self.download_info())
+        self.assertEqual(options['name'], 'out.zip')
+
+    def test_unsupported_archive_not_started(self):
+        '''
+        If the destination cannot receive archives, nothing is set up
+        '''
+        with self.assertRaises(exceptions.ExceptionWithMessage):
+            downloaders.AWSDropboxDownloader.check_archive_options({'name': 'out.zip'}, self.download_info())
+        with mock.patch.object(downloaders.GoogleDropboxDownloader, 'supports_archives', False):
+            downloader = downloaders.GoogleDropboxDownloader(self.download_info())
+            with self.assertRaises(exceptions.ExceptionWithMessage):
+                downloader.download_archive({'name': 'out.zip', 'compression': archives.STORED})
+        self.assertEqual(Transfer.objects.count(), 0)
+
+    def test_archive_rejected_when_space_is_insufficient(self):
+        mock_request = mock.MagicMock()
+        mock_request.session = {'download_archive': {'name': 'out.zip', 'compression': archives.STORED},
+            'download_destination': settings.DROPBOX}
+        with mock.patch('transfer_app.downloaders.transfer_tasks') as mock_tasks, \
+            mock.patch('transfer_app.downloaders.render') as mock_render:
+            downloaders.DropboxDownloader.start_downloads_within_quota(mock_request,
+                self.download_info(), 'token', 1000)
+            self.assertFalse(mock_tasks.download_archive.delay.called)
+            context = mock_render.call_args[0][2]
+            self.assertTrue(context['problem'])
+
+            downloaders.DropboxDownloader.start_downloads_within_quota(mock_request,
+                self.download_info(), 'token', 2000)
+            self.assertTrue(mock_tasks.download_archive.delay.called)
+            self.assertFalse(mock_tasks.download.delay.called)
@@ -0,0 +1,145 @@
+import os
+import json
+import datetime
+import tempfile
+import urllib
+import unittest.mock as mock
+
+import rsa
+
+from django.test import TestCase
+from django.urls import reverse
+from django.contrib.auth import get_user_model
+from django.conf import settings
+from rest_framework.test import APIClient
+
+from base.models import Resource
+from transfer_app.models import Transfer
+import transfer_app.browser_downloads as browser_downloads
+import base.exceptions as exceptions
+
+
+def write_service_account_key(directory):
+    '''
+    Creates a service account key file with a freshly generated private key, so 
+    that URLs can be signed without any Google credentials.
+    '''
+    public_key, private_key = rsa.newkeys(1024)
+    key_info = {
+        'type': 'service_account',
+        'project_id': 'proj',
+        'private_key_id': 'abc123',
+        'private_key': private_key.save_pkcs1().decode('ascii'),
+        'client_email': 'signer@proj.iam.gserviceaccount.com',
+        'client_id': '1234',
+        'token_uri': 'https://oauth2.googleapis.com/token'
+    }
+    key_path = os.path.join(directory, 'key.json')
+    with open(key_path, 'w') as fout:
+        json.dump(key_info, fout)
+    return key_path
+
+
+class BrowserDownloadTestCase(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.key_dir = tempfile.TemporaryDirectory()
+        cls.key_path = write_service_account_key(cls.key_dir.name)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.key_dir.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.regular_user = get_user_model().objects.create_user(email=settings.REGULAR_TEST_EMAIL, password='abcd123!')
+        self.other_user = get_user_model().objects.create_user(email=settings.OTHER_TEST_EMAIL, password='abcd123!')
+        self.r1 = Resource.objects.create(
+            source='google_storage',
+            path='gs://a/b/reg_owned1.txt',
+            name='reg_owned1.txt',
+            size=500,
+            owner=self.regular_user,
+        )
+        self.r2 = Resource.objects.create(
+            source='google_storage',
+            path='gs://a/b/other_owned1.txt',
+            name='other_owned1.txt',
+            size=500,
+            owner=self.other_user,
+        )
+        self.config_patcher = mock.patch.dict(settings.CONFIG_PARAMS, {
+            'cloud_environment': settings.GOOGLE,
+            'google_signing_credentials': self.key_path,
+            'signed_url_lifetime_seconds': '600',
+            'maximum_downloads': '2'
+        })
+        self.config_patcher.start()
+
+    def tearDown(self):
+        self.config_patcher.stop()
+
+    def test_signed_url_generated_offline(self):
+        credentials = browser_downloads.get_signing_credentials()
+        url = browser_downloads.generate_signed_url(self.r1, credentials, 600)
+        parsed = urllib.parse.urlparse(url)
+        query = urllib.parse.parse_qs(parsed.query)
+        self.assertEqual(parsed.netloc, 'storage.googleapis.com')
+        self.assertEqual(parsed.path, '/a/b/reg_owned1.txt')
+        self.assertEqual(query['X-Goog-Algorithm'], ['GOOG4-RSA-SHA256'])
+        self.assertEqual(query['X-Goog-Expires'], ['600'])
+        self.assertTrue(query['X-Goog-Credential'][0].startswith('signer@proj.iam.gserviceaccount.com/'))
+        self.assertEqual(query['response-content-disposition'], ['attachment; filename="reg_owned1.txt"'])
+        self.assertEqual(len(query['X-Goog-Signature'][0]), 256) # hex-encoded, 1024-bit key
+
+    def test_download_is_counted(self):
+        downloads = browser_downloads.issue_browser_downloads([self.r1.pk], self.regular_user.pk)
+        self.assertEqual(len(downloads), 1)
+        self.assertEqual(downloads[0]['resource_pk'], self.r1.pk)
+
+        r = Resource.objects.get(pk=self.r1.pk)
+        self.assertEqual(r.total_downloads, 1)
+        self.assertTrue(r.is_active)
+        t = Transfer.objects.get(resource=self.r1)
+        self.assertTrue(t.completed)
+        self.assertTrue(t.success)
+        self.assertEqual(t.destination, settings.BROWSER)
+        self.assertTrue(t.coordinator.completed)
+
+        # using the final download deactivates the resource and blocks further requests:
+        browser_downloads.issue_browser_downloads([self.r1.pk], self.regular_user.pk)
+        r = Resource.objects.get(pk=self.r1.pk)
+        self.assertEqual(r.total_downloads, 2)
+        self.assertFalse(r.is_active)
+        with self.assertRaises(exceptions.ExceptionWithMessage):
+            browser_downloads.issue_browser_downloads([self.r1.pk], self.regular_user.pk)
+
+    def test_rejects_resource_owned_by_other_user(self):
+        with self.assertRaises(exceptions.ExceptionWithMessage):
+            browser_downloads.issue_browser_downloads([self.r1.pk, self.r2.pk], self.regular_user.pk)
+        self.assertEqual(Transfer.objects.count(), 0)
+        self.assertEqual(Resource.objects.get(pk=self.r1.pk).total_downloads, 0)
+
+    def test_rejects_expired_resource(self):
+        Resource.objects.filter(pk=self.r1.pk).update(expiration_date=datetime.date.today() - datetime.timedelta(days=1))
+        with self.assertRaises(exceptions.ExceptionWithMessage):
+            browser_downloads.issue_browser_downloads([self.r1.pk], self.regular_user.pk)
+
+    def test_rejects_if_signing_not_configured(self):
+        settings.CONFIG_PARAMS['google_signing_credentials'] = ''
+        with self.assertRaises(exceptions.ExceptionWithMessage):
+            browser_downloads.issue_browser_downloads([self.r1.pk], self.regular_user.pk)
+        self.assertEqual(Resource.objects.get(pk=self.r1.pk).total_downloads, 0)
+
+    def test_browser_download_endpoint(self):
+        client = APIClient()
+        client.login(email=settings.REGULAR_TEST_EMAIL, password='abcd123!')
+        url = reverse('browser-download')
+        response = client.post(url, data={'resource_pks': [self.r1.pk]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['downloads'][0]['url'].startswith('https://storage.googleapis.com/a/b/reg_owned1.txt?'))
+
+        response = client.post(url, data={'resource_pks': [self.r2.pk]}, format='json')
+        self.assertEqual(response.status_code, 400)
@@ -1,5 +1,6 @@
 import json
 import urllib
+import datetime
 
 from django.test import TestCase
 from django.contrib.sites.models import Site
@@ -12,9 +13,10 @@ from django.urls import reverse
 from django.contrib.auth import get_user_model
 from django.contrib.sites.models import Site
 from django.conf import settings
+from django.utils import timezone
 
 from base.models import Resource, AvailableZones, CurrentZone
-from transfer_app.models import Transfer, TransferCoordinator
+from transfer_app.models import Transfer, TransferCoordinator, DeferredDownload
 import transfer_app.downloaders as downloaders
 import base.exceptions as exceptions
 
@@ -307,8 +309,8 @@ class GoogleEnvironmentDownloadTestCase(TestCase):
 
     #@mock.patch('transfer_app.downloaders.os')
     @mock.patch.dict('transfer_app.downloaders.os.environ', {'GCLOUD': '/mock/bin/gcloud'})
-    @mock.patch('transfer_app.downloaders.build')
-    def _test_dropbox_downloader_on_google_params(self, mock_build):
+    @mock.patch('transfer_app.downloaders.google_clients')
+    def _test_dropbox_downloader_on_google_params(self, mock_google_clients):
         '''
         This test takes a properly formatted request and checks that the database objects have been properly
         created.  
@@ -354,6 +356,128 @@ class GoogleEnvironmentDownloadTestCase(TestCase):
         self.assertTrue(all([not x.completed for x in all_transfers])) # no transfer is complete
         self.assertFalse(all_tc[0].completed) # the transfer coord is also not completed
 
+    @mock.patch.dict('transfer_app.downloaders.os.environ', {'GCLOUD': '/mock/bin/gcloud'})
+    def _test_resumed_download_passes_checkpoint(self):
+        '''
+        When an interrupted transfer is relaunched, the new worker is told 
+        the session and offset to resume from.  The launch info is saved so
+        that the transfer can be relaunched.
+        '''
+        downloader_cls = downloaders.get_downloader(self.destination)
+        originator = self.regular_user
+        large_resource = Resource.objects.get(path='gs://a/b/reg_owned1.txt')
+        download_info = [{
+                'resource_pk':large_resource.pk,  
+                'originator':originator.pk,
+                'destination':self.destination,
+                'access_token': 'abc123'
+             },]
+
+        downloader = downloader_cls(download_info)
+        downloader.config_params['preemptible'] = 'True'
+        m = mock.MagicMock()
+        downloader.launcher = m
+        downloader.download()
+
+        first_call = str(m.go.call_args)
+        self.assertTrue('-checkpoint_url' in first_call)
+        self.assertFalse('-session' in first_call)
+        self.assertTrue('--preemptible' in first_call)
+        t = Transfer.objects.get(resource=large_resource)
+        launch_info = json.loads(t.launch_info)
+        self.assertEqual(launch_info['access_token'], 'abc123')
+
+        # the launch info (which has the token) is not stored as plain text:
+        self.assertFalse('abc123' in t.encrypted_launch_info)
+
+        # now relaunch as we would after receiving a checkpoint
+        launch_info['resumable_session'] = 'session-xyz'
+        launch_info['committed_offset'] = 4096
+        launch_info['chunk_boundaries'] = '8192,12288'
+        downloader = downloader_cls([launch_info,])
+        m = mock.MagicMock()
+        downloader.launcher = m
+        downloader.config_and_start_downloads()
+        second_call = str(m.go.call_args)
+        self.assertTrue('--container-arg=-session --container-arg=session-xyz' in second_call)
+        self.assertTrue('--container-arg=-offset --container-arg=4096' in second_call)
+        self.assertTrue('--container-arg=-boundaries --container-arg=8192,12288' in second_call)
+
+    @mock.patch.dict('transfer_app.downloaders.os.environ', {'GCLOUD': '/mock/bin/gcloud'})
+    @mock.patch('transfer_app.downloaders.google_clients')
+    def _test_download_vm_uses_minimum_disk_size(self, mock_google_clients):
+        '''
+        The file is streamed from storage by the worker VM, so the disk does not depend
+        on the file size and we do not need to query the bucket contents
+        '''
+        downloader_cls = downloaders.get_downloader(self.destination)
+
+        originator = self.regular_user
+        large_resource = Resource.objects.get(path='gs://a/b/reg_owned1.txt')
+        download_info = [{
+                'resource_pk':large_resource.pk,  
+                'originator':originator.pk,
+                'destination':self.destination,
+                'access_token': 'abc123'
+             },]
+
+        downloader = downloader_cls(download_info)
+        m = mock.MagicMock()
+        downloader.launcher = m
+        downloader.download()
+
+        self.assertEqual(1, m.go.call_count)
+        the_call = str(m.go.call_args)
+        min_disk_size = int(float(downloader.config_params['min_disk_size']))
+        self.assertTrue('--boot-disk-size=%dGB' % min_disk_size in the_call)
+        self.assertFalse('--container-privileged' in the_call)
+        self.assertFalse(mock_google_clients.get_storage_client.called)
+
+    @mock.patch.dict('transfer_app.downloaders.os.environ', {'GCLOUD': '/mock/bin/gcloud'})
+    @mock.patch('transfer_app.downloaders.google_clients')
+    @mock.patch('transfer_app.downloaders.transfer_tasks')
+    def _test_small_files_streamed_in_worker(self, mock_tasks, mock_google_clients):
+        '''
+        Files below the size threshold should be streamed by a worker process
+        rather than starting a VM.  Larger files still go to a VM.
+        '''
+        downloader_cls = downloaders.get_downloader(self.destination)
+
+        originator = self.regular_user
+        small_resource = Resource.objects.create(
+            source='google_storage',
+            path='gs://a/b/reg_owned_small.txt',
+            size=1000,
+            owner=originator,
+        )
+        large_resource = Resource.objects.get(path='gs://a/b/reg_owned1.txt')
+
+        download_info = [
+            {
+                'resource_pk':x.pk,  
+                'originator':originator.pk,
+                'destination':self.destination,
+                'access_token': 'abc123'
+             } for x in [small_resource, large_resource]]
+
+        downloader = downloader_cls(download_info)
+        m = mock.MagicMock()
+        downloader.launcher = m
+        downloader.download()
+
+        # only the large file should have started a VM:
+        self.assertEqual(1, m.go.call_count)
+        self.assertEqual(1, mock_tasks.stream_download.delay.call_count)
+        streamed_item = mock_tasks.stream_download.delay.call_args[0][0]
+        self.assertEqual(streamed_item['resource_pk'], small_resource.pk)
+
+        small_transfer = Transfer.objects.get(resource=small_resource)
+        large_transfer = Transfer.objects.get(resource=large_resource)
+        self.assertTrue(small_transfer.started)
+        self.assertTrue(small_transfer.in_worker)
+        self.assertTrue(large_transfer.started)
+        self.assertFalse(large_transfer.in_worker)
+
     def _test_warn_of_conflict_case1(self):
         '''
         Here, we pretend that a user has previously started a download that is still going.
@@ -418,6 +542,66 @@ class GoogleEnvironmentDownloadTestCase(TestCase):
         self.assertTrue(len(download_info) == 2)
         self.assertTrue(len(errors) == 0)
 
+    def _test_check_format_query_budget(self):
+        '''
+        The ownership and conflict checks are performed in the database, so
+        the number of queries does not depend on how many resources the user 
+        owns, how many they request, or how many transfers are ongoing.
+        '''
+        downloader_cls = downloaders.get_downloader(self.destination)
+
+        tc = TransferCoordinator.objects.create()
+        requested_pks = []
+        for i in range(20):
+            r = Resource.objects.create(
+                source='google_storage',
+                path='gs://a/b/many_%d.txt' % i,
+                size=1000,
+                owner=self.regular_user,
+            )
+            requested_pks.append(r.pk)
+            if i % 2 == 0:
+                Transfer.objects.create(
+                    download=True,
+                    resource = r,
+                    destination = 'dropbox',
+                    coordinator = tc,
+                    originator = self.regular_user
+                )
+
+        with self.assertNumQueries(3):
+            download_info, errors = downloader_cls.check_format(requested_pks, self.regular_user.pk)
+        self.assertEqual(len(download_info), 10)
+        self.assertEqual(len(errors), 10)
+
+    def _test_transfer_setup_query_budget(self):
+        '''
+        The Transfers for a request are created in bulk, so the number of 
+        queries does not depend on the number of files requested
+        '''
+        downloader_cls = downloaders.get_downloader(self.destination)
+        requested_pks = []
+        for i in range(20):
+            r = Resource.objects.create(
+                source='google_storage',
+                path='gs://a/b/many_%d.txt' % i,
+                size=1000 + i,
+                owner=self.regular_user,
+            )
+            requested_pks.append(r.pk)
+        download_info, errors = downloader_cls.check_format(requested_pks, self.regular_user.pk)
+        downloader = downloader_cls.downloader_cls(download_info)
+
+        with self.assertNumQueries(5):
+            downloader._transfer_setup()
+
+        for item in download_info:
+            t = Transfer.objects.get(pk=item['transfer_pk'])
+            self.assertEqual(t.resource.pk, item['resource_pk'])
+            self.assertEqual(item['size_in_bytes'], t.resource.size)
+        tc = Transfer.objects.get(pk=download_info[0]['transfer_pk']).coordinator
+        self.assertEqual(tc.total_transfers, 20)
+
 class GoogleDropboxDownloadTestCase(GoogleEnvironmentDownloadTestCase):
 
     def setUp(self):
@@ -589,12 +773,27 @@ class GoogleDropboxDownloadTestCase(GoogleEnvironmentDownloadTestCase):
     def test_dropbox_downloader_on_google_params(self):
         super()._test_dropbox_downloader_on_google_params()
 
+    def test_small_files_streamed_in_worker(self):
+        super()._test_small_files_streamed_in_worker()
+
+    def test_download_vm_uses_minimum_disk_size(self):
+        super()._test_download_vm_uses_minimum_disk_size()
+
+    def test_resumed_download_passes_checkpoint(self):
+        super()._test_resumed_download_passes_checkpoint()
+
     def test_warn_of_conflict_case1(self):
         super()._test_warn_of_conflict_case1()
 
     def test_simultaneous_download_by_two_originators(self):
         super()._test_simultaneous_download_by_two_originators()
 
+    def test_check_format_query_budget(self):
+        super()._test_check_format_query_budget()
+
+    def test_transfer_setup_query_budget(self):
+        super()._test_transfer_setup_query_budget()
+
     def test_rejects_download_request_based_on_upload_status(self):
         super()._test_rejects_download_request_based_on_upload_status()
 
@@ -685,14 +884,12 @@ class GoogleDriveDownloadTestCase(GoogleEnvironmentDownloadTestCase):
         self.assertEqual(mock_request.session['session_state'], state)
 
 
-    @mock.patch('transfer_app.downloaders.build')
-    @mock.patch('transfer_app.downloaders.google_credentials_module')
+    @mock.patch('transfer_app.downloaders.google_clients')
     @mock.patch('transfer_app.downloaders.httplib2')
     @mock.patch('transfer_app.downloaders.transfer_tasks')
     def test_download_finish_auth(self, mock_tasks, \
         mock_httplib, \
-        mock_google_credentials_module, \
-        mock_build):
+        mock_google_clients):
 
         reguser = get_user_model().objects.get(email=settings.REGULAR_TEST_EMAIL)
         resources = Resource.objects.filter(owner=reguser, originated_from_upload=False)
@@ -704,13 +901,11 @@ class GoogleDriveDownloadTestCase(GoogleEnvironmentDownloadTestCase):
         mock_parser.request.return_value = (None, content)
         mock_httplib.Http.return_value = mock_parser
 
-        mock_credentials_obj = mock.MagicMock()
-        mock_google_credentials_module.Credentials.return_value = mock_credentials_obj
         mock_service = mock.MagicMock()
         quota_dict = {'limit': 1e10, 'usage': 1000}
         about_dict = {'storageQuota': quota_dict}
         mock_service.about.return_value.get.return_value.execute.return_value = about_dict
-        mock_build.return_value = mock_service
+        mock_google_clients.get_drive_client.return_value = mock_service
 
         mock_download = mock.MagicMock()
         mock_tasks.download = mock_download
@@ -770,12 +965,211 @@ class GoogleDriveDownloadTestCase(GoogleEnvironmentDownloadTestCase):
     def test_download_wrong_auth_http_request(self):
         super()._test_download_wrong_auth_http_request()
 
+    def test_small_files_streamed_in_worker(self):
+        super()._test_small_files_streamed_in_worker()
+
+    def test_download_vm_uses_minimum_disk_size(self):
+        super()._test_download_vm_uses_minimum_disk_size()
+
+    def test_resumed_download_passes_checkpoint(self):
+        super()._test_resumed_download_passes_checkpoint()
+
     def test_warn_of_conflict_case1(self):
         super()._test_warn_of_conflict_case1()
 
     def test_simultaneous_download_by_two_originators(self):
         super()._test_simultaneous_download_by_two_originators()
 
+    def test_check_format_query_budget(self):
+        super()._test_check_format_query_budget()
 
+    def test_transfer_setup_query_budget(self):
+        super()._test_transfer_setup_query_budget()
+
+
+
+
+
+
+class QuotaSelectionTestCase(TestCase):
+
+    def setUp(self):
+        self.regular_user = get_user_model().objects.create_user(email=settings.REGULAR_TEST_EMAIL, password='abcd123!')
+        self.resources = []
+        for i, size in enumerate([600, 300, 300, 500]):
+            self.resources.append(Resource.objects.create(
+                source='google_storage',
+                path='gs://a/b/f%d.txt' % i,
+                size=size,
+                owner=self.regular_user,
+            ))
+
+    def test_count_strategy_maximizes_files(self):
+        items = ['a', 'b', 'c', 'd']
+        selected, deferred = downloaders.select_for_quota(items, [600, 300, 300, 500], 1000, 'count')
+        self.assertEqual(selected, ['b', 'c'])
+        self.assertEqual(deferred, ['a', 'd'])
+
+    def test_bytes_strategy_maximizes_bytes(self):
+        '''
+        Taking files in order or smallest-first leaves space unused here
+        '''
+        items = ['a', 'b', 'c', 'd']
+        sizes = [600, 300, 300, 500]
+        selected, deferred = downloaders.select_for_quota(items, sizes, 1100, 'bytes')
+        self.assertEqual(selected, ['a', 'd'])
+        self.assertEqual(deferred, ['b', 'c'])
+
+        # a coarse resolution never exceeds the quota:
+        selected, deferred = downloaders.select_for_quota(items, sizes, 1100, 'bytes', 3)
+        self.assertTrue(sum([sizes[items.index(x)] for x in selected]) <= 1100)
+        self.assertEqual(len(selected) + len(deferred), 4)
+
+    def test_everything_selected_if_room_or_unlimited(self):
+        items = ['a', 'b']
+        self.assertEqual(downloaders.select_for_quota(items, [600, 300], None), (['a', 'b'], []))
+        self.assertEqual(downloaders.select_for_quota(items, [600, 300], 900, 'bytes'), (['a', 'b'], []))
+
+    def test_unknown_strategy_raises_exception(self):
+        with self.assertRaises(exceptions.ExceptionWithMessage):
+            downloaders.select_for_quota(['a', 'b'], [600, 300], 100, 'foo')
+
+    @mock.patch('transfer_app.downloaders.render')
+    @mock.patch('transfer_app.downloaders.transfer_tasks')
+    def test_files_which_do_not_fit_are_deferred(self, mock_tasks, mock_render):
+        download_info = [{'resource_pk': r.pk, 'originator': self.regular_user.pk, 'destination': settings.DROPBOX} 
+            for r in self.resources]
+        mock_request = mock.MagicMock()
+        mock_request.session = {'download_destination': settings.DROPBOX}
+
+        downloaders.DropboxDownloader.start_downloads_within_quota(mock_request, download_info, 'foo', 1000)
+
+        started = mock_tasks.download.delay.call_args[0][0]
+        self.assertEqual([x['resource_pk'] for x in started], [self.resources[1].pk, self.resources[2].pk])
+        self.assertTrue(all([x['access_token'] == 'foo' for x in started]))
+        deferred_pks = set(DeferredDownload.objects.values_list('resource_id', flat=True))
+        self.assertEqual(deferred_pks, set([self.resources[0].pk, self.resources[3].pk]))
+        context = mock_render.call_args[0][2]
+        self.assertTrue(context['problem'])
+        self.assertTrue(context['at_least_one_transfer'])
+        self.assertEqual(len(context['warnings']), 2)
+        self.assertTrue(self.resources[0].name in context['warnings'][0])
+
+    @mock.patch('transfer_app.downloaders.render')
+    @mock.patch('transfer_app.downloaders.transfer_tasks')
+    def test_removed_resources_are_skipped(self, mock_tasks, mock_render):
+        '''
+        A Resource may be removed while the user is authenticating.  The
+        other files are still sent, and the user is told about the missing one.
+        '''
+        download_info = [{'resource_pk': r.pk, 'originator': self.regular_user.pk, 'destination': settings.DROPBOX} 
+            for r in self.resources]
+        mock_request = mock.MagicMock()
+        mock_request.session = {'download_destination': settings.DROPBOX}
+        removed_pk = self.resources[1].pk
+        self.resources[1].delete()
+
+        downloaders.DropboxDownloader.start_downloads_within_quota(mock_request, download_info, 'foo', None)
+        started = mock_tasks.download.delay.call_args[0][0]
+        self.assertEqual([x['resource_pk'] for x in started], [x['resource_pk'] for x in download_info if x['resource_pk'] != removed_pk])
+        context = mock_render.call_args[0][2]
+        self.assertTrue(context['problem'])
+        self.assertTrue(context['at_least_one_transfer'])
+        self.assertEqual(len(context['warnings']), 1)
+        self.assertEqual(DeferredDownload.objects.count(), 0)
+
+        # if all of them were removed, nothing is started:
+        mock_tasks.reset_mock()
+        Resource.objects.all().delete()
+        downloaders.DropboxDownloader.start_downloads_within_quota(mock_request, download_info, 'foo', None)
+        self.assertFalse(mock_tasks.download.delay.called)
+        context = mock_render.call_args[0][2]
+        self.assertFalse(context['at_least_one_transfer'])
+        self.assertEqual(len(context['warnings']), 4)
+
+    def test_transfer_setup_skips_removed_resources(self):
+        download_info = [{'resource_pk': r.pk, 'originator': self.regular_user.pk, 'destination': settings.DROPBOX} 
+            for r in self.resources]
+        self.resources[0].delete()
+        downloader = downloaders.DropboxDownloader(download_info)
+        downloader._transfer_setup()
+
+        self.assertEqual(len(downloader.download_data), 3)
+        self.assertTrue(all(['transfer_pk' in item for item in downloader.download_data]))
+        self.assertEqual(Transfer.objects.count(), 3)
+        self.assertEqual(TransferCoordinator.objects.get().total_transfers, 3)
+
+    @mock.patch('transfer_app.downloaders.DropboxDownloader.get_space_remaining')
+    @mock.patch('transfer_app.downloaders.transfer_tasks')
+    def test_retry_deferred_downloads(self, mock_tasks, mock_space):
+        mock_space.return_value = 700
+        for r in self.resources[:2]:
+            DeferredDownload.objects.create(resource=r, 
+                destination=settings.DROPBOX, 
+                access_token='foo', 
+                originator=self.regular_user)
+        expired = DeferredDownload.objects.create(resource=self.resources[3], 
+            destination=settings.DROPBOX, 
+            access_token='foo', 
+            originator=self.regular_user)
+        DeferredDownload.objects.filter(pk=expired.pk).update(created=timezone.now() - datetime.timedelta(days=7))
+
+        summary = downloaders.retry_deferred_downloads()
+
+        mock_space.assert_called_once_with('foo')
+        started = mock_tasks.download.delay.call_args[0][0]
+        self.assertEqual([x['resource_pk'] for x in started], [self.resources[1].pk])
+        self.assertEqual(list(DeferredDownload.objects.values_list('resource_id', flat=True)), [self.resources[0].pk])
+        self.assertEqual(summary, {'started': 1, 'still_deferred': 1, 'dropped': 1})
+
+    @mock.patch('transfer_app.downloaders.DropboxDownloader.get_space_remaining')
+    @mock.patch('transfer_app.downloaders.transfer_tasks')
+    def test_retry_accounts_for_downloads_in_progress(self, mock_tasks, mock_space):
+        '''
+        Files which are still being sent to the same destination take up
+        space which get_space_remaining does not know about yet
+        '''
+        mock_space.return_value = 700
+        DeferredDownload.objects.create(resource=self.resources[1], 
+            destination=settings.DROPBOX, 
+            access_token='foo', 
+            originator=self.regular_user)
+        tc = TransferCoordinator.objects.create()
+        Transfer.objects.create(download=True,
+            resource=self.resources[3],
+            destination=settings.DROPBOX,
+            coordinator=tc,
+            originator=self.regular_user)
+        self.assertEqual(downloaders.get_in_flight_bytes(self.regular_user.pk, settings.DROPBOX), self.resources[3].size)
+
+        summary = downloaders.retry_deferred_downloads()
+        self.assertFalse(mock_tasks.download.delay.called)
+        self.assertEqual(summary['still_deferred'], 1)
+
+    def test_deferred_access_token_is_encrypted(self):
+        d = DeferredDownload.objects.create(resource=self.resources[0], 
+            destination=settings.DROPBOX, 
+            access_token='foo', 
+            originator=self.regular_user)
+        d = DeferredDownload.objects.get(pk=d.pk)
+        self.assertFalse('foo' in d.encrypted_access_token)
+        self.assertEqual(d.access_token, 'foo')
+
+        # an altered value is rejected:
+        d.encrypted_access_token = d.encrypted_access_token[:-4] + 'AAAA'
+        with self.assertRaises(exceptions.ExceptionWithMessage):
+            d.access_token
+
+    @mock.patch('transfer_app.downloaders.DropboxDownloader.get_space_remaining')
+    @mock.patch('transfer_app.downloaders.transfer_tasks')
+    def test_deferred_downloads_dropped_if_token_fails(self, mock_tasks, mock_space):
+        mock_space.side_effect = Exception('Expired token')
+        DeferredDownload.objects.create(resource=self.resources[0], 
+            destination=settings.DROPBOX, 
+            access_token='foo', 
+            originator=self.regular_user)
 
+        downloaders.retry_deferred_downloads()
 
+        self.assertFalse(mock_tasks.download.delay.called)
+        self.assertEqual(DeferredDownload.objects.count(), 0)
@@ -0,0 +1,191 @@
+import threading
+import unittest.mock as mock
+
+import google.api_core.exceptions
+from django.test import TestCase
+
+from helpers import google_clients
+from helpers import testing
+from helpers import storage_utils
+from transfer_app import streaming
+
+
+class GoogleClientFactoryTestCase(TestCase):
+
+    def setUp(self):
+        # start each test without any clients cached by this thread
+        google_clients._local.pid = None
+
+    @mock.patch('helpers.google_clients.storage')
+    def test_storage_client_reused_within_thread(self, mock_storage):
+        mock_storage.Client.side_effect = lambda: mock.MagicMock()
+        c1 = google_clients.get_storage_client()
+        c2 = google_clients.get_storage_client()
+        self.assertIs(c1, c2)
+        self.assertEqual(mock_storage.Client.call_count, 1)
+
+        other_thread_clients = []
+        t = threading.Thread(target=lambda: other_thread_clients.append(google_clients.get_storage_client()))
+        t.start()
+        t.join()
+        self.assertIsNot(other_thread_clients[0], c1)
+
+    @mock.patch('helpers.google_clients.os')
+    @mock.patch('helpers.google_clients.storage')
+    def test_clients_recreated_after_fork(self, mock_storage, mock_os):
+        mock_storage.Client.side_effect = lambda: mock.MagicMock()
+        mock_os.getpid.return_value = 100
+        c1 = google_clients.get_storage_client()
+        mock_os.getpid.return_value = 101
+        c2 = google_clients.get_storage_client()
+        self.assertIsNot(c1, c2)
+
+    @mock.patch('helpers.google_clients.discovery')
+    @mock.patch('helpers.google_clients.httplib2')
+    def test_discovery_document_fetched_once(self, mock_httplib2, mock_discovery):
+        mock_discovery.DISCOVERY_URI = 'https://discovery/{api}/{apiVersion}/rest'
+        mock_discovery.V2_DISCOVERY_URI = 'https://discovery-v2/{api}/{apiVersion}/rest'
+        mock_httplib2.Http.return_value.request.return_value = (mock.MagicMock(status=200), b'{"name": "drive"}')
+        with mock.patch.dict(google_clients._documents, clear=True):
+            google_clients.get_drive_client('token1')
+            google_clients.get_drive_client('token2')
+        mock_httplib2.Http.return_value.request.assert_called_once_with('https://discovery/drive/v3/rest')
+        self.assertEqual(mock_discovery.build_from_document.call_count, 2)
+        self.assertEqual(mock_discovery.build_from_document.call_args[0][0], '{"name": "drive"}')
+
+    def test_fake_clients_are_used_within_context(self):
+        fake_storage = testing.FakeStorageClient()
+        fake_compute = mock.MagicMock()
+        with google_clients.use_fake_clients(storage=fake_storage, compute=fake_compute):
+            self.assertIs(google_clients.get_storage_client(), fake_storage)
+            self.assertIs(google_clients.get_compute_client(), fake_compute)
+        self.assertFalse(google_clients.STORAGE in google_clients._fake_clients)
+
+
+class FakeStorageClientTestCase(TestCase):
+
+    def setUp(self):
+        self.client = testing.FakeStorageClient()
+        self.client.create_bucket('bucket-a')
+
+    def test_upload_and_range_download(self):
+        blob = self.client.bucket('bucket-a').blob('dir/f.txt')
+        blob.upload_from_string(b'0123456789')
+        stored = self.client.get_bucket('bucket-a').get_blob('dir/f.txt')
+        self.assertEqual(stored.size, 10)
+        self.assertEqual(stored.md5_hash, 'eB5eJF1ptWaXm4bijSPyxw==')
+        self.assertEqual(stored.download_as_string(start=2, end=4), b'234')
+        self.assertEqual([b.name for b in self.client.list_blobs('bucket-a', prefix='dir/')], ['dir/f.txt'])
+
+    def test_missing_bucket_raises(self):
+        with self.assertRaises(google.api_core.exceptions.NotFound):
+            self.client.get_bucket('bucket-b')
+        with self.assertRaises(google.api_core.exceptions.Conflict):
+            self.client.create_bucket('bucket-a')
+
+    def test_rename_and_copy(self):
+        bucket = self.client.get_bucket('bucket-a')
+        bucket.blob('f.txt').upload_from_string('abc')
+        bucket.rename_blob(bucket.get_blob('f.txt'), 'g.txt')
+        self.assertIsNone(bucket.get_blob('f.txt'))
+        other = self.client.create_bucket('bucket-b')
+        bucket.copy_blob(bucket.get_blob('g.txt'), other, 'h.txt')
+        self.assertEqual(other.get_blob('h.txt').download_as_string(), b'abc')
+
+    def test_range_reader_with_fake_storage(self):
+        self.client.bucket('bucket-a').blob('f.txt').upload_from_string(b'x'*1000)
+        with google_clients.use_fake_clients(storage=self.client):
+            reader = streaming.GoogleStorageRangeReader('gs://bucket-a/f.txt')
+            self.assertEqual(reader.size, 1000)
+            self.assertEqual(len(reader.read(300)), 300)
+            self.assertEqual(len(reader.read()), 700)
+
+
+class BucketCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.fake_client = testing.FakeStorageClient()
+        self.fake_client.create_bucket('bucket-a')
+        self.fake_client.buckets['bucket-a'].location = 'US-EAST4'
+        # counts the calls which would be API requests with a real client:
+        self.storage_client = mock.MagicMock(wraps=self.fake_client)
+        self.cache_patcher = mock.patch('helpers.storage_utils._bucket_cache', 
+            storage_utils.BucketCache(300, 2))
+        self.cache_patcher.start()
+
+    def tearDown(self):
+        self.cache_patcher.stop()
+
+    def test_repeated_lookups_use_cache(self):
+        b1 = storage_utils.get_bucket('bucket-a', self.storage_client)
+        b2 = storage_utils.get_bucket('bucket-a', self.storage_client)
+        self.assertIs(b1, b2)
+        self.assertEqual(b2.location, 'US-EAST4')
+        self.assertEqual(self.storage_client.get_bucket.call_count, 1)
+
+        # a different client does not receive the handle loaded by the first
+        other_client = mock.MagicMock(wraps=self.fake_client)
+        storage_utils.get_bucket('bucket-a', other_client)
+        self.assertEqual(other_client.get_bucket.call_count, 1)
+
+    def test_missing_bucket_not_cached(self):
+        '''
+        Other processes may create the bucket at any time, so a missing bucket
+        is looked up again each time
+        '''
+        with self.assertRaises(google.api_core.exceptions.NotFound):
+            storage_utils.get_bucket('bucket-b', self.storage_client)
+        self.assertIsNone(storage_utils.lookup_bucket('bucket-b', self.storage_client))
+
+        # another process creates the bucket:
+        self.fake_client.create_bucket('bucket-b')
+        self.assertIsNotNone(storage_utils.lookup_bucket('bucket-b', self.storage_client))
+        storage_utils.get_bucket('bucket-b', self.storage_client)
+        self.assertEqual(self.storage_client.get_bucket.call_count, 1)
+        self.assertEqual(self.storage_client.lookup_bucket.call_count, 2)
+
+    def test_created_bucket_is_cached(self):
+        new_bucket = mock.MagicMock()
+        new_bucket.name = 'bucket-b'
+        new_bucket.location = 'US-EAST4'
+        storage_utils.create_bucket(new_bucket, self.storage_client)
+        b = storage_utils.get_bucket('bucket-b', self.storage_client)
+        self.assertEqual(b.location, 'US-EAST4')
+        self.assertEqual(self.storage_client.get_bucket.call_count, 0)
+
+    def test_create_existing_bucket(self):
+        '''
+        If another process created the bucket first, the existing bucket 
+        is returned only if exist_ok is True
+        '''
+        new_bucket = mock.MagicMock()
+        new_bucket.name = 'bucket-a'
+        new_bucket.location = 'US-EAST4'
+        with self.assertRaises(google.api_core.exceptions.Conflict):
+            storage_utils.create_bucket(new_bucket, self.storage_client)
+        b = storage_utils.create_bucket(new_bucket, self.storage_client, exist_ok=True)
+        self.assertIs(b, self.fake_client.buckets['bucket-a'])
+
+    @mock.patch('helpers.storage_utils.time')
+    def test_entries_expire(self, mock_time):
+        mock_time.time.return_value = 1000
+        storage_utils.get_bucket('bucket-a', self.storage_client)
+        mock_time.time.return_value = 1299
+        storage_utils.get_bucket('bucket-a', self.storage_client)
+        self.assertEqual(self.storage_client.get_bucket.call_count, 1)
+        mock_time.time.return_value = 1300
+        storage_utils.get_bucket('bucket-a', self.storage_client)
+        self.assertEqual(self.storage_client.get_bucket.call_count, 2)
+
+    def test_least_recently_used_evicted(self):
+        for name in ['bucket-b', 'bucket-c']:
+            self.fake_client.create_bucket(name)
+        storage_utils.get_bucket('bucket-a', self.storage_client)
+        storage_utils.get_bucket('bucket-b', self.storage_client)
+        storage_utils.get_bucket('bucket-a', self.storage_client)
+        storage_utils.get_bucket('bucket-c', self.storage_client) # evicts bucket-b
+        self.assertEqual(self.storage_client.get_bucket.call_count, 3)
+        storage_utils.get_bucket('bucket-a', self.storage_client)
+        self.assertEqual(self.storage_client.get_bucket.call_count, 3)
+        storage_utils.get_bucket('bucket-b', self.storage_client)
+        self.assertEqual(self.storage_client.get_bucket.call_count, 4)
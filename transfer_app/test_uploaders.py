@@ -1,5 +1,7 @@
+import os
 import json
 import uuid
+import shlex
 import datetime
 
 from django.test import TestCase
@@ -10,6 +12,7 @@ from rest_framework import status
 from django.urls import reverse
 from django.contrib.auth import get_user_model
 from django.conf import settings
+from django.utils import timezone
 
 from base.models import Resource, AvailableZones, CurrentZone
 from transfer_app.models import Transfer, TransferCoordinator
@@ -32,6 +35,16 @@ class GeneralUploadInitTestCase(TestCase):
         result_cls = uploaders.get_uploader(source)
         self.assertEqual(result_cls, uploaders.GoogleDriveUploader)
 
+        settings.CONFIG_PARAMS['cloud_environment'] = settings.GOOGLE
+        source = settings.BROWSER
+        result_cls = uploaders.get_uploader(source)
+        self.assertEqual(result_cls, uploaders.GoogleBrowserUploader)
+
+        settings.CONFIG_PARAMS['cloud_environment'] = settings.GOOGLE
+        source = settings.URL
+        result_cls = uploaders.get_uploader(source)
+        self.assertEqual(result_cls, uploaders.GoogleUrlUploader)
+
         settings.CONFIG_PARAMS['cloud_environment'] = settings.AWS
         source = settings.DROPBOX
         result_cls = uploaders.get_uploader(source)
@@ -212,6 +225,42 @@ class DropboxGoogleUploadInitTestCase(TestCase):
         response, error_messages = uploaders.GoogleDropboxUploader.check_format(upload_info, user_pk)
         self.assertEqual(response, expected)
 
+    def test_check_format_query_budget(self):
+        '''
+        The checks for existing files and ongoing transfers are performed in the 
+        database, so the number of queries does not depend on the number of 
+        files requested or the number of ongoing transfers.
+        '''
+        tc = TransferCoordinator.objects.create()
+        for i in range(20):
+            path = '%s-%s/%s/f%d.txt' % (self.bucket_name, 
+                str(self.other_user.user_uuid), 
+                settings.CONFIG_PARAMS['uploads_folder_name'], 
+                i
+            )
+            r = Resource.objects.create(
+                source='dropbox',
+                path=path,
+                size=1000,
+                owner=self.other_user,
+                is_active=False
+            )
+            Transfer.objects.create(
+                download=False,
+                resource = r,
+                destination = path,
+                coordinator = tc,
+                originator = self.other_user
+            )
+
+        upload_info = []
+        for i in range(20):
+            upload_info.append({'source_path': 'https://dropbox-link.com/%d' % i, 'name':'f%d.txt' % i})
+        with self.assertNumQueries(3):
+            response, error_messages = uploaders.GoogleDropboxUploader.check_format(upload_info, self.regular_user.pk)
+        self.assertEqual(len(response), 20)
+        self.assertEqual(len(error_messages), 0)
+
     @mock.patch('transfer_app.uploaders.datetime')
     def test_handle_upload_duplicated_filename_case1(self, mock_datetime):
         '''
@@ -271,6 +320,79 @@ class DropboxGoogleUploadInitTestCase(TestCase):
         response, error_messages = uploaders.GoogleDropboxUploader.check_format(upload_info, user_pk)
         self.assertEqual(response, expected_list)
 
+    @mock.patch('transfer_app.uploaders.datetime')
+    def test_expired_resource_path_not_reused(self, mock_datetime):
+        '''
+        The file for an expired (inactive) Resource may still be in storage
+        awaiting removal, so a new upload with the same name is renamed
+        rather than taking its path
+        '''
+        d = datetime.datetime(2019, 4, 15, 21, 3, 7, 0)
+        mock_datetime.datetime.now.return_value = d
+        expected_stamp = d.strftime('%m%d%Y-%H%M%S')
+
+        user = self.regular_user
+        resource_path = '%s-%s/%s/%s' % (self.bucket_name, 
+                str(user.user_uuid), 
+                settings.CONFIG_PARAMS['uploads_folder_name'], 
+                'f1.txt'
+        )
+        Resource.objects.create(source = 'google',
+                path = resource_path,
+                name = 'f1.txt',
+                owner = user,
+                size = 100,
+                is_active=False,
+                expiration_date=datetime.date(2019, 1, 1)
+        )
+
+        upload_info = [{'source_path': 'https://dropbox-link.com/1', 'name':'f1.txt'}]
+        response, error_messages = uploaders.GoogleDropboxUploader.check_format(upload_info, user.pk)
+        self.assertEqual(response[0]['name'], 'f1.' + expected_stamp + '.txt')
+        self.assertNotEqual(response[0]['destination'], resource_path)
+
+    @mock.patch.dict('transfer_app.uploaders.os.environ', {'GCLOUD': '/mock/bin/gcloud'})
+    @mock.patch('transfer_app.uploaders.transfer_utils')
+    def test_removed_resource_path_is_reused(self, mock_transfer_utils):
+        '''
+        Once the file of an expired Resource has been removed from storage, a 
+        new upload with the same name takes its path (and its Resource, since
+        paths are unique)
+        '''
+        mock_transfer_utils.check_for_transfer_availability.return_value = None
+        user = self.regular_user
+        resource_path = '%s-%s/%s/%s' % (self.bucket_name, 
+                str(user.user_uuid), 
+                settings.CONFIG_PARAMS['uploads_folder_name'], 
+                'f1.txt'
+        )
+        old_resource = Resource.objects.create(source = 'google',
+                path = resource_path,
+                name = 'f1.txt',
+                owner = user,
+                size = 100,
+                is_active=False,
+                expiration_date=datetime.date(2019, 1, 1),
+                file_deleted=True
+        )
+
+        upload_info = [{'source_path': 'https://dropbox-link.com/1', 'name':'f1.txt', 'owner': user.pk}]
+        upload_info, error_messages = uploaders.GoogleDropboxUploader.check_format(upload_info, user.pk)
+        self.assertEqual(upload_info[0]['destination'], resource_path)
+
+        uploader = uploaders.GoogleDropboxUploader(upload_info)
+        uploader.launcher = mock.MagicMock()
+        uploader.upload()
+
+        self.assertEqual(Resource.objects.count(), 1)
+        r = Resource.objects.get(path=resource_path)
+        self.assertEqual(r.pk, old_resource.pk)
+        self.assertEqual(r.source, settings.DROPBOX)
+        self.assertFalse(r.file_deleted)
+        self.assertFalse(r.is_active)
+        self.assertTrue(r.expiration_date > datetime.date.today())
+        self.assertEqual(Transfer.objects.get().resource, r)
+
 
     def test_dropbox_upload_format_checker_rejects_poor_format_case1(self):
         '''
@@ -428,10 +550,14 @@ class DropboxGoogleUploadInitTestCase(TestCase):
         self.assertFalse(all_tc[0].completed) # the transfer coord is also not completed
 
     @mock.patch.dict('transfer_app.uploaders.os.environ', {'GCLOUD': '/mock/bin/gcloud'})
-    @mock.patch('transfer_app.uploaders.transfer_utils')
-    def test_dropbox_uploader_on_google_disk_sizing(self, mock_transfer_utils):
+    @mock.patch('transfer_app.uploaders.transfer_utils.check_for_transfer_availability')
+    def test_dropbox_uploader_on_google_disk_sizing(self, mock_check_for_transfer_availability):
+        '''
+        The Dropbox upload streams directly into storage, so the VM
+        uses the minimum disk size regardless of the file size
+        '''
 
-        mock_transfer_utils.check_for_transfer_availability.return_value = None
+        mock_check_for_transfer_availability.return_value = None
 
         source = settings.DROPBOX
         uploader_cls = uploaders.get_uploader(source)
@@ -459,10 +585,57 @@ class DropboxGoogleUploadInitTestCase(TestCase):
         call_arg = m.go.call_args
         the_call = call_arg.call_list()[0]
         import re
-        target = '--boot-disk-size=300GB'
+        target = '--boot-disk-size=%dGB' % int(float(uploader.config_params['min_disk_size']))
         matches = re.findall(target, str(the_call))
         self.assertEqual(len(matches), 1)
 
+    @mock.patch.dict('transfer_app.uploaders.os.environ', {'GCLOUD': '/mock/bin/gcloud'})
+    @mock.patch('transfer_app.uploaders.transfer_tasks')
+    @mock.patch('transfer_app.uploaders.transfer_utils')
+    def test_small_uploads_streamed_in_worker(self, mock_transfer_utils, mock_tasks):
+        '''
+        Files small enough are streamed by a worker process, while larger files and 
+        those with unknown size are sent to a VM.
+        '''
+        mock_transfer_utils.check_for_transfer_availability.return_value = None
+
+        source = settings.DROPBOX
+        uploader_cls = uploaders.get_uploader(source)
+        user_pk = self.regular_user.pk
+        upload_info = []
+        upload_info.append({
+                        'source_path': 'https://dropbox-link.com/1', 
+                        'name':'f1.txt', 
+                        'owner':user_pk, 
+                        'size_in_bytes': 1000})
+        upload_info.append({
+                        'source_path': 'https://dropbox-link.com/2', 
+                        'name':'f2.txt', 
+                        'owner':user_pk, 
+                        'size_in_bytes': 100e9})
+        upload_info.append({
+                        'source_path': 'https://dropbox-link.com/3', 
+                        'name':'f3.txt', 
+                        'owner':user_pk})
+
+        upload_info, error_messages = uploader_cls.check_format(upload_info, user_pk)
+
+        uploader = uploader_cls(upload_info)
+        m = mock.MagicMock()
+        uploader.launcher = m
+
+        uploader.upload()
+        self.assertEqual(2, m.go.call_count)
+        self.assertEqual(1, mock_tasks.stream_upload.delay.call_count)
+        streamed_item, streamed_source = mock_tasks.stream_upload.delay.call_args[0]
+        self.assertEqual(streamed_item['name'], 'f1.txt')
+        self.assertEqual(streamed_source, settings.DROPBOX)
+
+        in_worker_transfers = Transfer.objects.filter(in_worker=True)
+        self.assertEqual(len(in_worker_transfers), 1)
+        self.assertEqual(in_worker_transfers[0].resource.name, 'f1.txt')
+        self.assertTrue(in_worker_transfers[0].started)
+
 
 class DriveGoogleUploadInitTestCase(TestCase):
     '''
@@ -808,10 +981,10 @@ class DriveGoogleUploadInitTestCase(TestCase):
         self.assertFalse(all_tc[0].completed) # the transfer coord is also not completed
 
     @mock.patch.dict('transfer_app.uploaders.os.environ', {'GCLOUD': '/mock/bin/gcloud'})
-    @mock.patch('transfer_app.uploaders.transfer_utils')
-    def test_drive_uploader_on_google_disk_sizing(self, mock_transfer_utils):
+    @mock.patch('transfer_app.uploaders.transfer_utils.check_for_transfer_availability')
+    def test_drive_uploader_on_google_disk_sizing(self, mock_check_for_transfer_availability):
 
-        mock_transfer_utils.check_for_transfer_availability.return_value = None
+        mock_check_for_transfer_availability.return_value = None
 
         source = settings.GOOGLE_DRIVE
         uploader_cls = uploaders.get_uploader(source)
@@ -1035,3 +1208,222 @@ class GoogleEnvironmentUploadInitTestCase(TestCase):
         self.assertTrue(sum([not tc.completed for tc in all_tc])==1)
         self.assertTrue(sum([tc.completed for tc in all_tc])==1)
 
+
+
+class BrowserGoogleUploadTestCase(TestCase):
+    '''
+    This is the test suite for uploads sent directly from the browser into Google storage
+    '''
+
+    def setUp(self):
+        self.regular_user = get_user_model().objects.create_user(email=settings.REGULAR_TEST_EMAIL, password='abcd123!', user_uuid=uuid.uuid4())
+        self.other_user = get_user_model().objects.create_user(email=settings.OTHER_TEST_EMAIL, password='abcd123!', user_uuid=uuid.uuid4())
+
+        settings.CONFIG_PARAMS['cloud_environment'] = settings.GOOGLE
+        self.bucket_name = 'gs://cnap-storage-bucket'
+        settings.CONFIG_PARAMS['storage_bucket_prefix'] = self.bucket_name
+        self.uploads_path = '%s-%s/%s' % (self.bucket_name, 
+            self.regular_user.user_uuid, 
+            settings.CONFIG_PARAMS['uploads_folder_name'])
+
+    def _start_upload(self, mock_google_clients, upload_info):
+        mock_blob = mock.MagicMock()
+        mock_blob.create_resumable_upload_session.return_value = 'https://upload-session-url'
+        mock_google_clients.get_storage_client.return_value.bucket.return_value.blob.return_value = mock_blob
+
+        client = APIClient()
+        client.login(email=settings.REGULAR_TEST_EMAIL, password='abcd123!')
+        url = reverse('upload-transfer-initiation')
+        request_info = {'upload_source':settings.BROWSER, 'upload_info': json.dumps(upload_info)}
+        response = client.post(url, request_info, format='json')
+        return response, mock_blob
+
+    @mock.patch('transfer_app.uploaders.google_clients')
+    def test_upload_sessions_returned(self, mock_google_clients):
+        Resource.objects.create(
+            source=settings.BROWSER,
+            path=os.path.join(self.uploads_path, 'my_file.txt'),
+            name='my_file.txt',
+            owner=self.regular_user
+        )
+        response, mock_blob = self._start_upload(mock_google_clients, [{'name': 'my file.txt', 'size_in_bytes': 500}])
+
+        self.assertEqual(response.status_code, 200)
+        uploads = response.data['uploads']
+        self.assertEqual(len(uploads), 1)
+        self.assertEqual(uploads[0]['upload_url'], 'https://upload-session-url')
+        mock_blob.create_resumable_upload_session.assert_called_once_with(size=500, origin='https://example.com')
+
+        # the existing file was not overwritten:
+        t = Transfer.objects.get(pk=uploads[0]['transfer_pk'])
+        self.assertTrue(t.started)
+        self.assertEqual(t.resumable_session, 'https://upload-session-url')
+        self.assertNotEqual(t.destination, os.path.join(self.uploads_path, 'my_file.txt'))
+        self.assertTrue(t.destination.startswith(os.path.join(self.uploads_path, 'my_file.')))
+        self.assertFalse(t.resource.is_active)
+        self.assertEqual(t.resource.source_path, 'my file.txt')
+
+    @mock.patch('transfer_app.uploaders.transfer_utils')
+    @mock.patch('transfer_app.uploaders.google_clients')
+    def test_verified_upload_activates_resource(self, mock_google_clients, mock_utils):
+        response, mock_blob = self._start_upload(mock_google_clients, [{'name': 'a.txt', 'size_in_bytes': 500}])
+        transfer_pk = response.data['uploads'][0]['transfer_pk']
+        mock_google_clients.get_storage_client.return_value.bucket.return_value.get_blob.return_value = mock.MagicMock(md5_hash='abc==', size=500)
+
+        client = APIClient()
+        client.login(email=settings.REGULAR_TEST_EMAIL, password='abcd123!')
+        response = client.post(reverse('browser-upload-complete'), {'transfer_pk': transfer_pk, 'md5': 'abc=='}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        t = Transfer.objects.get(pk=transfer_pk)
+        self.assertTrue(t.completed)
+        self.assertTrue(t.success)
+        self.assertTrue(t.resource.is_active)
+        self.assertTrue(mock_utils.post_completion.called)
+
+    @mock.patch('transfer_app.uploaders.transfer_utils')
+    @mock.patch('transfer_app.uploaders.google_clients')
+    def test_checksum_mismatch_fails_upload(self, mock_google_clients, mock_utils):
+        response, mock_blob = self._start_upload(mock_google_clients, [{'name': 'a.txt', 'size_in_bytes': 500}])
+        transfer_pk = response.data['uploads'][0]['transfer_pk']
+        stored_blob = mock.MagicMock(md5_hash='xyz==', size=500)
+        mock_google_clients.get_storage_client.return_value.bucket.return_value.get_blob.return_value = stored_blob
+
+        client = APIClient()
+        client.login(email=settings.REGULAR_TEST_EMAIL, password='abcd123!')
+        response = client.post(reverse('browser-upload-complete'), {'transfer_pk': transfer_pk, 'md5': 'abc=='}, format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(stored_blob.delete.called)
+        self.assertEqual(Resource.objects.filter(name='a.txt').count(), 0)
+
+    @mock.patch('transfer_app.uploaders.google_clients')
+    def test_other_user_cannot_complete_upload(self, mock_google_clients):
+        response, mock_blob = self._start_upload(mock_google_clients, [{'name': 'a.txt', 'size_in_bytes': 500}])
+        transfer_pk = response.data['uploads'][0]['transfer_pk']
+
+        client = APIClient()
+        client.login(email=settings.OTHER_TEST_EMAIL, password='abcd123!')
+        response = client.post(reverse('browser-upload-complete'), {'transfer_pk': transfer_pk, 'md5': 'abc=='}, format='json')
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Transfer.objects.get(pk=transfer_pk).completed)
+
+    def test_rejects_invalid_size(self):
+        with self.assertRaises(exceptions.ExceptionWithMessage):
+            uploaders.BrowserUploader.check_format([{'name': 'a.txt', 'size_in_bytes': 'abc'}], self.regular_user.pk)
+
+    @mock.patch('transfer_app.uploaders.storage_utils')
+    @mock.patch('transfer_app.uploaders.requests')
+    @mock.patch('transfer_app.uploaders.transfer_utils')
+    @mock.patch('transfer_app.uploaders.google_clients')
+    def test_abandoned_uploads_expire(self, mock_google_clients, mock_utils, mock_requests, mock_storage_utils):
+        response, mock_blob = self._start_upload(mock_google_clients, [{'name': 'a.txt', 'size_in_bytes': 500}])
+        self.assertEqual(uploaders.expire_browser_uploads(), 0)
+
+        transfer_pk = response.data['uploads'][0]['transfer_pk']
+        t = Transfer.objects.get(pk=transfer_pk)
+        Transfer.objects.filter(pk=transfer_pk).update(start_time=timezone.now() - datetime.timedelta(days=7))
+        mock_requests.delete.return_value = mock.MagicMock(status_code=499)
+        mock_storage_utils.delete_blobs.return_value = []
+        self.assertEqual(uploaders.expire_browser_uploads(), 1)
+        self.assertEqual(Resource.objects.filter(name='a.txt').count(), 0)
+
+        # the upload session is cancelled and anything already sent is removed:
+        self.assertEqual(mock_requests.delete.call_args[0][0], t.resumable_session)
+        mock_storage_utils.delete_blobs.assert_called_with([t.destination,])
+
+
+class UrlGoogleUploadTestCase(TestCase):
+    '''
+    This is the test suite for uploads FROM arbitrary HTTPS links into Google storage
+    '''
+
+    def setUp(self):
+        self.regular_user = get_user_model().objects.create_user(email=settings.REGULAR_TEST_EMAIL, password='abcd123!')
+
+        settings.CONFIG_PARAMS['cloud_environment'] = settings.GOOGLE
+        self.bucket_name = 'gs://cnap-storage-bucket'
+        settings.CONFIG_PARAMS['storage_bucket_prefix'] = self.bucket_name
+
+        avail_zone = AvailableZones.objects.create(
+            cloud_environment = settings.GOOGLE,
+            zone = 'us-east-X'
+        )
+        CurrentZone.objects.create(zone=avail_zone)
+
+    def test_name_taken_from_link(self):
+        user_pk = self.regular_user.pk
+        upload_info = [
+            {'source_path': 'https://my-bucket.s3.amazonaws.com/dir/sample%20A.fastq.gz?X-Amz-Signature=abc', 'owner':user_pk},
+            {'source_path': 'https://example.com/x/1', 'name': 'f1.txt', 'owner':user_pk}
+        ]
+        upload_info, error_messages = uploaders.GoogleUrlUploader.check_format(upload_info, user_pk)
+        self.assertEqual(len(error_messages), 0)
+        self.assertEqual(upload_info[0]['name'], 'sample_A.fastq.gz')
+        self.assertEqual(upload_info[1]['name'], 'f1.txt')
+
+    def test_non_https_link_rejected(self):
+        user_pk = self.regular_user.pk
+        for link in ['http://example.com/f1.txt', 'ftp://example.com/f1.txt', 'f1.txt']:
+            upload_info = [{'source_path': link, 'owner':user_pk}]
+            with self.assertRaises(exceptions.ExceptionWithMessage):
+                uploaders.GoogleUrlUploader.check_format(upload_info, user_pk)
+
+    def test_link_with_shell_characters_rejected(self):
+        user_pk = self.regular_user.pk
+        for link in ['https://example.com/$(touch x)/f1.txt', 
+                'https://example.com/`touch x`/f1.txt',
+                'https://example.com/f1.txt";touch x;"',
+                "https://example.com/f1.txt';touch x;'"]:
+            upload_info = [{'source_path': link, 'owner':user_pk}]
+            with self.assertRaises(exceptions.ExceptionWithMessage):
+                uploaders.GoogleUrlUploader.check_format(upload_info, user_pk)
+
+    @mock.patch.dict('transfer_app.uploaders.os.environ', {'GCLOUD': '/mock/bin/gcloud'})
+    @mock.patch('transfer_app.uploaders.transfer_utils.check_for_transfer_availability')
+    def test_launch_quotes_link(self, mock_check_for_transfer_availability):
+        '''
+        Links with characters such as & or ; (which are permitted) are quoted
+        so that the shell passes them to the container unchanged
+        '''
+        mock_check_for_transfer_availability.return_value = None
+        user_pk = self.regular_user.pk
+        link = 'https://example.com/dir/f1.txt?a=1&b=2;c'
+        upload_info, error_messages = uploaders.GoogleUrlUploader.check_format([{'source_path': link, 'owner':user_pk}], user_pk)
+
+        uploader = uploaders.GoogleUrlUploader(upload_info)
+        m = mock.MagicMock()
+        uploader.launcher = m
+        uploader.upload()
+
+        cmd = m.go.call_args[0][0]
+        self.assertTrue("--container-arg=-path --container-arg='%s'" % link in cmd)
+        self.assertEqual(shlex.split(cmd).count('--container-arg=%s' % link), 1)
+
+    def test_link_without_name_rejected(self):
+        user_pk = self.regular_user.pk
+        upload_info = [{'source_path': 'https://example.com/', 'owner':user_pk}]
+        with self.assertRaises(exceptions.ExceptionWithMessage):
+            uploaders.GoogleUrlUploader.check_format(upload_info, user_pk)
+
+    @mock.patch.dict('transfer_app.uploaders.os.environ', {'GCLOUD': '/mock/bin/gcloud'})
+    @mock.patch('transfer_app.uploaders.transfer_utils.check_for_transfer_availability')
+    def test_launch_passes_link_and_workers(self, mock_check_for_transfer_availability):
+        mock_check_for_transfer_availability.return_value = None
+        user_pk = self.regular_user.pk
+        link = 'https://example.com/dir/f1.txt'
+        upload_info, error_messages = uploaders.GoogleUrlUploader.check_format([{'source_path': link, 'owner':user_pk}], user_pk)
+
+        uploader = uploaders.GoogleUrlUploader(upload_info)
+        m = mock.MagicMock()
+        uploader.launcher = m
+        uploader.upload()
+
+        self.assertEqual(1, m.go.call_count)
+        cmd = m.go.call_args[0][0]
+        self.assertTrue('--container-arg=-path --container-arg=%s' % link in cmd)
+        self.assertTrue('--container-arg=-workers --container-arg=4' in cmd)
+        self.assertTrue('docker.io/blawney/url_upload_to_google' in cmd)
+        t = Transfer.objects.get(resource__name='f1.txt')
+        self.assertTrue(t.started)
+        self.assertEqual(t.resource.source, settings.URL)
@@ -0,0 +1,217 @@
+import datetime
+import unittest.mock as mock
+
+from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.conf import settings
+from django.utils import timezone
+
+from base.models import Resource
+from transfer_app.models import Transfer, TransferCoordinator
+import transfer_app.watchdog as watchdog
+
+
+def instance_list_response(instances):
+    '''
+    Mimics the response from the compute API's aggregatedList.  instances
+    is a list of tuples of (name, creation timestamp)
+    '''
+    items = []
+    for name, creation_timestamp in instances:
+        items.append({
+            'name': name,
+            'zone': 'https://www.googleapis.com/compute/v1/projects/proj/zones/us-east1-b',
+            'creationTimestamp': creation_timestamp
+        })
+    return {'items': {'zones/us-east1-b': {'instances': items}}}
+
+
+def old_timestamp():
+    t = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+    return t.strftime('%Y-%m-%dT%H:%M:%S.000-00:00')
+
+
+def new_timestamp():
+    t = datetime.datetime.utcnow()
+    return t.strftime('%Y-%m-%dT%H:%M:%S.000-00:00')
+
+
+class TransferWatchdogTestCase(TestCase):
+
+    def setUp(self):
+        self.regular_user = get_user_model().objects.create_user(email=settings.REGULAR_TEST_EMAIL, password='abcd123!')
+        self.r1 = Resource.objects.create(
+            source='google_storage',
+            path='gs://a/b/reg_owned1.txt',
+            size=500,
+            owner=self.regular_user,
+        )
+        self.tc1 = TransferCoordinator.objects.create()
+        self.t1 = Transfer.objects.create(
+            download=True,
+            resource = self.r1,
+            destination = 'dropbox',
+            coordinator = self.tc1,
+            originator = self.regular_user,
+            started = True,
+            instance_name = 'dropbox-download-abc-0',
+            launch_time = timezone.now() - datetime.timedelta(days=1)
+        )
+        self.mock_compute = mock.MagicMock()
+        self.mock_compute.instances().aggregatedList_next.return_value = None
+
+    def set_running_instances(self, instances):
+        self.mock_compute.instances().aggregatedList().execute.return_value = instance_list_response(instances)
+
+    def test_parse_creation_timestamp(self):
+        t = watchdog.parse_creation_timestamp('2019-03-11T10:33:20.128-07:00')
+        self.assertEqual(t, datetime.datetime(2019, 3, 11, 17, 33, 20, tzinfo=datetime.timezone.utc))
+
+    @mock.patch('transfer_app.watchdog.transfer_utils')
+    @mock.patch('transfer_app.watchdog.google_clients')
+    def test_transfer_with_missing_instance_is_failed(self, mock_google_clients, mock_utils):
+        mock_google_clients.get_compute_client.return_value = self.mock_compute
+        self.set_running_instances([])
+
+        summary = watchdog.reconcile_transfers()
+
+        t = Transfer.objects.get(pk=self.t1.pk)
+        self.assertTrue(t.completed)
+        self.assertFalse(t.success)
+        self.assertIsNone(t.instance_name)
+        self.assertTrue(mock_utils.post_completion.called)
+        self.assertEqual(summary['transfers_failed'], 1)
+        self.assertEqual(summary['slots_reclaimed'], 1)
+
+    @mock.patch('transfer_app.watchdog.transfer_tasks')
+    @mock.patch('transfer_app.watchdog.google_clients')
+    def test_checkpointed_transfer_with_missing_instance_is_requeued(self, mock_google_clients, mock_tasks):
+        mock_google_clients.get_compute_client.return_value = self.mock_compute
+        self.set_running_instances([])
+        self.t1.resumable_session = 'abc123'
+        self.t1.launch_info = '{}'
+        self.t1.checkpoint_time = timezone.now() - datetime.timedelta(hours=2)
+        self.t1.save()
+
+        summary = watchdog.reconcile_transfers()
+
+        mock_tasks.resume_transfer.delay.assert_called_with(self.t1.pk)
+        t = Transfer.objects.get(pk=self.t1.pk)
+        self.assertFalse(t.completed)
+        self.assertEqual(t.relaunch_count, 1)
+        self.assertIsNone(t.instance_name)
+        self.assertEqual(summary['transfers_requeued'], 1)
+
+    @mock.patch('transfer_app.watchdog.google_clients')
+    def test_recently_launched_transfer_is_left_alone(self, mock_google_clients):
+        '''
+        The VM may not show up in the listing immediately
+        '''
+        mock_google_clients.get_compute_client.return_value = self.mock_compute
+        self.set_running_instances([])
+        self.t1.launch_time = timezone.now()
+        self.t1.save()
+
+        summary = watchdog.reconcile_transfers()
+
+        t = Transfer.objects.get(pk=self.t1.pk)
+        self.assertFalse(t.completed)
+        self.assertEqual(t.instance_name, 'dropbox-download-abc-0')
+        self.assertEqual(summary['slots_reclaimed'], 0)
+
+    @mock.patch('transfer_app.watchdog.google_clients')
+    def test_running_transfer_with_recent_heartbeat_is_left_alone(self, mock_google_clients):
+        mock_google_clients.get_compute_client.return_value = self.mock_compute
+        self.set_running_instances([('dropbox-download-abc-0', old_timestamp())])
+        self.t1.last_progress_time = timezone.now()
+        self.t1.save()
+
+        summary = watchdog.reconcile_transfers()
+
+        self.assertFalse(self.mock_compute.instances().delete.called)
+        t = Transfer.objects.get(pk=self.t1.pk)
+        self.assertFalse(t.completed)
+        self.assertEqual(summary['instances_deleted'], 0)
+
+    @mock.patch('transfer_app.watchdog.transfer_utils')
+    @mock.patch('transfer_app.watchdog.google_clients')
+    def test_stale_transfer_instance_is_deleted(self, mock_google_clients, mock_utils):
+        mock_google_clients.get_compute_client.return_value = self.mock_compute
+        self.set_running_instances([('dropbox-download-abc-0', old_timestamp())])
+
+        summary = watchdog.reconcile_transfers()
+
+        self.mock_compute.instances().delete.assert_called_with(
+            project=settings.CONFIG_PARAMS['google_project_id'],
+            zone='us-east1-b',
+            instance='dropbox-download-abc-0')
+        t = Transfer.objects.get(pk=self.t1.pk)
+        self.assertTrue(t.completed)
+        self.assertFalse(t.success)
+        self.assertEqual(summary['instances_deleted'], 1)
+        self.assertEqual(summary['transfers_failed'], 1)
+
+    @mock.patch('transfer_app.watchdog.google_clients')
+    def test_orphaned_instances_are_deleted(self, mock_google_clients):
+        '''
+        VMs which do not belong to an open transfer are removed, unless
+        they were just created.  VMs not created by the transfers are ignored.
+        '''
+        mock_google_clients.get_compute_client.return_value = self.mock_compute
+        self.t1.last_progress_time = timezone.now()
+        self.t1.save()
+        self.set_running_instances([
+            ('dropbox-download-abc-0', old_timestamp()),
+            ('dropbox-download-def-0', old_timestamp()),
+            ('dropbox-download-ghi-0', new_timestamp()),
+            ('some-other-vm', old_timestamp()),
+        ])
+
+        summary = watchdog.reconcile_transfers()
+
+        self.mock_compute.instances().delete.assert_called_once_with(
+            project=settings.CONFIG_PARAMS['google_project_id'],
+            zone='us-east1-b',
+            instance='dropbox-download-def-0')
+        self.assertEqual(summary['instances_deleted'], 1)
+        self.assertEqual(summary['slots_reclaimed'], 0)
+
+    @mock.patch('transfer_app.watchdog.transfer_utils')
+    @mock.patch('transfer_app.watchdog.google_clients')
+    def test_stalled_in_worker_transfer_is_failed(self, mock_google_clients, mock_utils):
+        '''
+        Transfers streamed by a worker have no VM, so they are checked 
+        only by their heartbeat
+        '''
+        mock_google_clients.get_compute_client.return_value = self.mock_compute
+        self.set_running_instances([('dropbox-download-abc-0', old_timestamp())])
+        self.t1.last_progress_time = timezone.now()
+        self.t1.save()
+        stalled = Transfer.objects.create(download=True,
+            resource = self.r1,
+            destination = 'dropbox',
+            coordinator = TransferCoordinator.objects.create(),
+            originator = self.regular_user,
+            started = True,
+            in_worker = True,
+            last_progress_time = timezone.now() - datetime.timedelta(days=1)
+        )
+        running = Transfer.objects.create(download=True,
+            resource = self.r1,
+            destination = 'dropbox',
+            coordinator = TransferCoordinator.objects.create(),
+            originator = self.regular_user,
+            started = True,
+            in_worker = True,
+            last_progress_time = timezone.now()
+        )
+
+        summary = watchdog.reconcile_transfers()
+
+        t = Transfer.objects.get(pk=stalled.pk)
+        self.assertTrue(t.completed)
+        self.assertFalse(t.success)
+        self.assertFalse(Transfer.objects.get(pk=running.pk).completed)
+        self.assertTrue(mock_utils.post_completion.called)
+        self.assertEqual(summary['transfers_failed'], 1)
+        self.assertFalse(self.mock_compute.instances().delete.called)
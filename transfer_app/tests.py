@@ -404,6 +404,39 @@ class TransferCoordinatorListTestCase(TestCase):
             result_set.add(item['id'])
         self.assertTrue(user_tc_pk == result_set)
 
+    def test_list_does_not_query_for_each_transfercoordinator(self):
+        '''
+        The progress of each TransferCoordinator is computed from prefetched
+        Transfers, so the number of queries does not grow with the listing
+        '''
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        admin_client = APIClient()
+        admin_client.login(email=settings.ADMIN_TEST_EMAIL, password='abcd123!') 
+        url = reverse('batch-list')
+        with CaptureQueriesContext(connection) as first:
+            response = admin_client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        resource = Resource.objects.get(path='gs://a/b/reg_owned1.txt')
+        for i in range(3):
+            tc = TransferCoordinator.objects.create()
+            Transfer.objects.create(download=True,
+                resource = resource,
+                destination = 'dropbox',
+                coordinator = tc,
+                originator = self.admin_user
+            )
+        with CaptureQueriesContext(connection) as second:
+            response = admin_client.get(url)
+        self.assertEqual(len(response.data), 7)
+        self.assertEqual(len(first), len(second))
+
+        # and the prefetched progress is the same as that computed directly:
+        for item in response.data:
+            tc = TransferCoordinator.objects.get(pk=item['id'])
+            self.assertEqual(item['progress'], tc.progress())
+
     def test_unauthenticated_user_gets_403_for_transfercoordinator_list(self):
         client = APIClient()
         url = reverse('batch-list')
@@ -593,6 +626,12 @@ Tests for completion marking:
 class CompletionMarkingTestCase(TestCase):
 
     def setUp(self):
+        # completed uploads look up their stored size in the bucket; keep
+        # these tests from reaching out to storage
+        size_patcher = mock.patch('transfer_app.views.storage_utils.get_object_size', return_value=None)
+        size_patcher.start()
+        self.addCleanup(size_patcher.stop)
+
         self.regular_user = get_user_model().objects.create_user(email=settings.REGULAR_TEST_EMAIL, password='abcd123!')
 
         # create a couple of resources owned by the regular user:
@@ -967,3 +1006,485 @@ class CompletionMarkingTestCase(TestCase):
 
         post_completion(empty_coordinator, [settings.REGULAR_TEST_EMAIL,])
         self.assertTrue(mock_email_send.called)
+
+    @mock.patch('transfer_app.streaming.transfer_utils')
+    def test_in_worker_transfers_mark_completion(self, mock_utils):
+        '''
+        Transfers streamed in the worker process go through the same bookkeeping
+        as those reporting back from a VM
+        '''
+        from transfer_app import streaming
+
+        mock_stream_func = mock.MagicMock(return_value=500)
+        success = streaming.run_in_worker_transfer(self.t1.pk, mock_stream_func, 'a', 'b')
+        self.assertTrue(success)
+        mock_stream_func.assert_called_with('a', 'b')
+        t1 = Transfer.objects.get(pk=self.t1.pk)
+        self.assertTrue(t1.completed)
+        self.assertTrue(t1.success)
+        self.assertFalse(TransferCoordinator.objects.get(pk=self.tc1.pk).completed)
+        self.assertFalse(mock_utils.post_completion.called)
+
+        # the second transfer fails, which completes the coordinator
+        mock_stream_func.side_effect = Exception('Problem!')
+        success = streaming.run_in_worker_transfer(self.t2.pk, mock_stream_func)
+        self.assertFalse(success)
+        t2 = Transfer.objects.get(pk=self.t2.pk)
+        self.assertTrue(t2.completed)
+        self.assertFalse(t2.success)
+        self.assertTrue(TransferCoordinator.objects.get(pk=self.tc1.pk).completed)
+        self.assertEqual(len(FailedTransfer.objects.filter(coordinator=self.tc1)), 1)
+        self.assertTrue(mock_utils.post_completion.called)
+
+    def _make_upload(self):
+        r = Resource.objects.create(
+            source='dropbox',
+            path='gs://a/b/uploaded.txt',
+            size=0,
+            owner=self.regular_user,
+            is_active=False
+        )
+        tc = TransferCoordinator.objects.create()
+        return Transfer.objects.create(
+            download=False,
+            resource = r,
+            destination = 'gs://a/b/uploaded.txt',
+            coordinator = tc,
+            originator = self.regular_user
+        )
+
+    @mock.patch('transfer_app.streaming.transfer_utils')
+    def test_in_worker_upload_records_size(self, mock_utils):
+        '''
+        The size given when an upload is requested may be missing, so the
+        number of bytes actually stored is recorded
+        '''
+        from transfer_app import streaming
+        t = self._make_upload()
+        streaming.run_in_worker_transfer(t.pk, mock.MagicMock(return_value=1234))
+        r = Resource.objects.get(pk=t.resource.pk)
+        self.assertTrue(r.is_active)
+        self.assertEqual(r.size, 1234)
+
+    @mock.patch('transfer_app.views.storage_utils')
+    @mock.patch('transfer_app.views.utils')
+    def test_upload_callback_records_size(self, mock_utils, mock_storage_utils):
+        t = self._make_upload()
+        mock_storage_utils.get_object_size.return_value = 4321
+        token = settings.CONFIG_PARAMS['token']
+        obj=DES.new(settings.CONFIG_PARAMS['enc_key'], DES.MODE_ECB)
+        d = {}
+        d['token'] = base64.encodestring(obj.encrypt(token))
+        d['transfer_pk'] = t.pk
+        d['success'] = True
+        with mock.patch.dict(settings.CONFIG_PARAMS, {'cloud_environment': settings.GOOGLE}):
+            response = APIClient().post(reverse('transfer-complete'), d, format='json')
+        self.assertEqual(response.status_code, 200)
+        mock_storage_utils.get_object_size.assert_called_with('gs://a/b/uploaded.txt')
+        r = Resource.objects.get(pk=t.resource.pk)
+        self.assertTrue(r.is_active)
+        self.assertEqual(r.size, 4321)
+
+    @mock.patch('transfer_app.streaming.transfer_utils')
+    def test_in_worker_transfers_record_heartbeat(self, mock_utils):
+        '''
+        While streaming, the Transfer records a heartbeat so the watchdog
+        can tell that the worker has not stopped
+        '''
+        from transfer_app import streaming
+
+        heartbeats = []
+        def stream_func():
+            streaming.heartbeat()
+            heartbeats.append(Transfer.objects.get(pk=self.t1.pk).last_progress_time)
+            return 500
+
+        with mock.patch('transfer_app.streaming.HEARTBEAT_INTERVAL_SECONDS', 0):
+            streaming.run_in_worker_transfer(self.t1.pk, stream_func)
+        self.assertIsNotNone(heartbeats[0])
+
+        # outside of run_in_worker_transfer, nothing is recorded:
+        Transfer.objects.filter(pk=self.t2.pk).update(last_progress_time=None)
+        streaming.heartbeat()
+        self.assertIsNone(Transfer.objects.get(pk=self.t2.pk).last_progress_time)
+
+    def test_tier_throughput_summary(self):
+        from transfer_app.utils import get_tier_throughput
+        import datetime
+
+        self.t1.completed = True
+        self.t1.success = True
+        self.t1.in_worker = True
+        self.t1.finish_time = self.t1.start_time + datetime.timedelta(seconds=5)
+        self.t1.save()
+
+        summary = get_tier_throughput()
+        self.assertEqual(summary['in_worker']['count'], 1)
+        self.assertEqual(summary['in_worker']['total_bytes'], 500)
+        self.assertEqual(summary['in_worker']['bytes_per_second'], 100)
+        self.assertEqual(summary['vm']['count'], 0)
+        self.assertIsNone(summary['vm']['bytes_per_second'])
+
+    def test_checkpoint_updates_transfer(self):
+        '''
+        Workers report their progress, which is saved on the Transfer
+        '''
+        d = {}
+        token = settings.CONFIG_PARAMS['token']
+        obj=DES.new(settings.CONFIG_PARAMS['enc_key'], DES.MODE_ECB)
+        enc_token = obj.encrypt(token)
+        b64_str = base64.encodestring(enc_token)
+        d['token'] = b64_str
+        d['transfer_pk'] = self.t1.pk
+        d['session'] = 'abc123'
+        d['offset'] = 1024
+
+        client = APIClient()
+        url = reverse('transfer-checkpoint')
+        response = client.post(url, d, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        t = Transfer.objects.get(pk=self.t1.pk)
+        self.assertEqual(t.resumable_session, 'abc123')
+        self.assertEqual(t.committed_offset, 1024)
+        self.assertIsNotNone(t.checkpoint_time)
+        self.assertFalse(t.completed)
+
+    def test_checkpoint_records_chunk_boundaries(self):
+        '''
+        Workers sending chunks concurrently also report the boundaries of the
+        chunks they may have sent beyond the committed offset
+        '''
+        d = {}
+        token = settings.CONFIG_PARAMS['token']
+        obj=DES.new(settings.CONFIG_PARAMS['enc_key'], DES.MODE_ECB)
+        enc_token = obj.encrypt(token)
+        b64_str = base64.encodestring(enc_token)
+        d['token'] = b64_str
+        d['transfer_pk'] = self.t1.pk
+        d['session'] = 'abc123'
+        d['offset'] = 1024
+        d['boundaries'] = '2048,4096'
+
+        client = APIClient()
+        url = reverse('transfer-checkpoint')
+        response = client.post(url, d, format='json')
+        self.assertEqual(response.status_code, 200)
+        t = Transfer.objects.get(pk=self.t1.pk)
+        self.assertEqual(t.chunk_boundaries, '2048,4096')
+
+        # a later checkpoint without any replaces them:
+        d['offset'] = 4096
+        d['boundaries'] = ''
+        response = client.post(url, d, format='json')
+        self.assertEqual(response.status_code, 200)
+        t = Transfer.objects.get(pk=self.t1.pk)
+        self.assertIsNone(t.chunk_boundaries)
+
+        d['boundaries'] = '2048,abc'
+        response = client.post(url, d, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_checkpoint_with_wrong_token_is_rejected(self):
+        d = {}
+        d['token'] = base64.encodestring(b'abcdefgh')
+        d['transfer_pk'] = self.t1.pk
+        d['session'] = 'abc123'
+        d['offset'] = 1024
+
+        client = APIClient()
+        url = reverse('transfer-checkpoint')
+        response = client.post(url, d, format='json')
+        self.assertEqual(response.status_code, 404)
+        t = Transfer.objects.get(pk=self.t1.pk)
+        self.assertIsNone(t.resumable_session)
+
+    def test_checkpoint_for_completed_transfer_is_rejected(self):
+        self.t1.completed = True
+        self.t1.save()
+
+        d = {}
+        token = settings.CONFIG_PARAMS['token']
+        obj=DES.new(settings.CONFIG_PARAMS['enc_key'], DES.MODE_ECB)
+        enc_token = obj.encrypt(token)
+        b64_str = base64.encodestring(enc_token)
+        d['token'] = b64_str
+        d['transfer_pk'] = self.t1.pk
+        d['session'] = 'abc123'
+        d['offset'] = 1024
+
+        client = APIClient()
+        url = reverse('transfer-checkpoint')
+        response = client.post(url, d, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    @mock.patch('transfer_app.views.transfer_tasks')
+    def test_failed_transfer_with_checkpoint_is_resumed(self, mock_tasks):
+        '''
+        If a worker fails after reporting a checkpoint, the transfer is
+        relaunched rather than marked as failed
+        '''
+        self.t1.resumable_session = 'abc123'
+        self.t1.committed_offset = 1024
+        self.t1.launch_info = '{}'
+        self.t1.save()
+
+        d = {}
+        token = settings.CONFIG_PARAMS['token']
+        obj=DES.new(settings.CONFIG_PARAMS['enc_key'], DES.MODE_ECB)
+        enc_token = obj.encrypt(token)
+        b64_str = base64.encodestring(enc_token)
+        d['token'] = b64_str
+        d['transfer_pk'] = self.t1.pk
+        d['success'] = False
+
+        client = APIClient()
+        url = reverse('transfer-complete')
+        response = client.post(url, d, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        mock_tasks.resume_transfer.delay.assert_called_with(self.t1.pk)
+        t = Transfer.objects.get(pk=self.t1.pk)
+        self.assertFalse(t.completed)
+        self.assertEqual(t.relaunch_count, 1)
+        self.assertEqual(len(FailedTransfer.objects.all()), 0)
+
+    @mock.patch('transfer_app.tasks.transfer_utils')
+    @mock.patch('transfer_app.tasks.downloaders')
+    def test_resume_with_unreadable_launch_info_fails_transfer(self, mock_downloaders, mock_utils):
+        '''
+        If the launch info can no longer be decrypted (e.g. the keys changed),
+        the transfer is failed rather than left waiting for a worker
+        '''
+        from transfer_app.tasks import resume_transfer
+        self.t1.resumable_session = 'abc123'
+        self.t1.encrypted_launch_info = 'not-encrypted'
+        self.t1.save()
+
+        resume_transfer(self.t1.pk)
+
+        self.assertFalse(mock_downloaders.get_downloader.called)
+        t = Transfer.objects.get(pk=self.t1.pk)
+        self.assertTrue(t.completed)
+        self.assertFalse(t.success)
+
+    @mock.patch('transfer_app.views.utils')
+    @mock.patch('transfer_app.views.transfer_tasks')
+    def test_failed_transfer_exceeding_relaunches_is_not_resumed(self, mock_tasks, mock_utils):
+        self.t1.resumable_session = 'abc123'
+        self.t1.committed_offset = 1024
+        self.t1.launch_info = '{}'
+        self.t1.relaunch_count = int(settings.CONFIG_PARAMS['max_transfer_relaunches'])
+        self.t1.save()
+
+        d = {}
+        token = settings.CONFIG_PARAMS['token']
+        obj=DES.new(settings.CONFIG_PARAMS['enc_key'], DES.MODE_ECB)
+        enc_token = obj.encrypt(token)
+        b64_str = base64.encodestring(enc_token)
+        d['token'] = b64_str
+        d['transfer_pk'] = self.t1.pk
+        d['success'] = False
+
+        client = APIClient()
+        url = reverse('transfer-complete')
+        response = client.post(url, d, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        self.assertFalse(mock_tasks.resume_transfer.delay.called)
+        t = Transfer.objects.get(pk=self.t1.pk)
+        self.assertTrue(t.completed)
+        self.assertFalse(t.success)
+        self.assertEqual(len(FailedTransfer.objects.all()), 1)
+
+    def test_progress_sample_updates_transfer(self):
+        '''
+        Workers periodically report their progress, which is saved on the Transfer
+        '''
+        d = {}
+        token = settings.CONFIG_PARAMS['token']
+        obj=DES.new(settings.CONFIG_PARAMS['enc_key'], DES.MODE_ECB)
+        enc_token = obj.encrypt(token)
+        b64_str = base64.encodestring(enc_token)
+        d['token'] = b64_str
+        d['transfer_pk'] = self.t1.pk
+        d['bytes_transferred'] = 200
+        d['bytes_per_second'] = 12.5
+        d['retries'] = 2
+
+        client = APIClient()
+        url = reverse('transfer-progress')
+        response = client.post(url, d, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        t = Transfer.objects.get(pk=self.t1.pk)
+        self.assertEqual(t.bytes_transferred, 200)
+        self.assertEqual(t.throughput, 12.5)
+        self.assertEqual(t.chunk_retries, 2)
+        self.assertIsNotNone(t.last_progress_time)
+
+    def test_negative_progress_sample_is_rejected(self):
+        token = settings.CONFIG_PARAMS['token']
+        obj=DES.new(settings.CONFIG_PARAMS['enc_key'], DES.MODE_ECB)
+        b64_str = base64.encodestring(obj.encrypt(token))
+        client = APIClient()
+        url = reverse('transfer-progress')
+        for key, value in [('bytes_transferred', -1), ('retries', -2), ('bytes_per_second', 'nan')]:
+            d = {}
+            d['token'] = b64_str
+            d['transfer_pk'] = self.t1.pk
+            d['bytes_transferred'] = 200
+            d['bytes_per_second'] = 12.5
+            d['retries'] = 2
+            d[key] = value
+            response = client.post(url, d, format='json')
+            self.assertEqual(response.status_code, 400)
+        t = Transfer.objects.get(pk=self.t1.pk)
+        self.assertEqual(t.bytes_transferred, 0)
+        self.assertEqual(t.chunk_retries, 0)
+
+    def test_progress_sample_with_wrong_token_is_rejected(self):
+        d = {}
+        d['token'] = base64.encodestring(b'abcdefgh')
+        d['transfer_pk'] = self.t1.pk
+        d['bytes_transferred'] = 200
+        d['bytes_per_second'] = 12.5
+        d['retries'] = 2
+
+        client = APIClient()
+        url = reverse('transfer-progress')
+        response = client.post(url, d, format='json')
+        self.assertEqual(response.status_code, 404)
+        t = Transfer.objects.get(pk=self.t1.pk)
+        self.assertEqual(t.bytes_transferred, 0)
+
+    def test_coordinator_progress_aggregate(self):
+        '''
+        Completed transfers count their full size, while those in progress
+        count their most recently reported sample
+        '''
+        self.t1.completed = True
+        self.t1.success = True
+        self.t1.save()
+        self.t2.started = True
+        self.t2.bytes_transferred = 100
+        self.t2.throughput = 10.0
+        self.t2.chunk_retries = 1
+        self.t2.save()
+
+        progress = self.tc1.progress()
+        self.assertEqual(progress['transfer_count'], 2)
+        self.assertEqual(progress['completed_count'], 1)
+        self.assertEqual(progress['total_bytes'], 1000)
+        self.assertEqual(progress['bytes_transferred'], 600)
+        self.assertEqual(progress['bytes_per_second'], 10.0)
+        self.assertEqual(progress['chunk_retries'], 1)
+
+    def test_coordinator_counts_transfers(self):
+        tc = TransferCoordinator.objects.get(pk=self.tc1.pk)
+        self.assertEqual(tc.total_transfers, 2)
+        self.assertEqual(tc.completed_transfers, 0)
+        self.assertEqual(tc.failed_transfers, 0)
+
+    @mock.patch('transfer_app.views.utils')
+    def test_repeated_completion_signal_counted_once(self, mock_utils):
+        '''
+        If a worker's callback is repeated, the Transfer is only counted once and 
+        the coordinator completion is only handled once
+        '''
+        token = settings.CONFIG_PARAMS['token']
+        obj=DES.new(settings.CONFIG_PARAMS['enc_key'], DES.MODE_ECB)
+        enc_token = obj.encrypt(token)
+        b64_str = base64.encodestring(enc_token)
+
+        d1 = {}
+        d1['token'] = b64_str
+        d1['transfer_pk'] = self.t1.pk
+        d1['success'] = False
+
+        d2 = {}
+        d2['token'] = b64_str
+        d2['transfer_pk'] = self.t2.pk
+        d2['success'] = True
+
+        client = APIClient()
+        url = reverse('transfer-complete')
+        for d in [d1, d1, d2, d2]:
+            response = client.post(url, d, format='json')
+            self.assertEqual(response.status_code, 200)
+
+        tc = TransferCoordinator.objects.get(pk=self.tc1.pk)
+        self.assertTrue(tc.completed)
+        self.assertEqual(tc.completed_transfers, 2)
+        self.assertEqual(tc.failed_transfers, 1)
+        self.assertEqual(len(FailedTransfer.objects.filter(coordinator=tc)), 1)
+        self.assertEqual(mock_utils.post_completion.call_count, 1)
+
+
+class UrlStreamingTestCase(TestCase):
+    '''
+    Tests for streaming the content of a link into storage from the worker process
+    '''
+    def setUp(self):
+        from helpers import google_clients, testing
+        self.storage_client = testing.FakeStorageClient()
+        self.fake_clients = google_clients.use_fake_clients(storage=self.storage_client)
+        self.fake_clients.__enter__()
+        self.addCleanup(self.fake_clients.__exit__, None, None, None)
+
+    def mock_response(self, content, content_length=None):
+        import io
+        response = mock.MagicMock()
+        response.raw = io.BytesIO(content)
+        response.headers = {} if content_length is None else {'Content-Length': str(content_length)}
+        response.history = []
+        response.url = 'https://example.com/f.txt'
+        return response
+
+    @mock.patch('transfer_app.streaming.requests')
+    def test_content_over_the_maximum_is_rejected(self, mock_requests):
+        from transfer_app import streaming
+
+        # the server reports the size up front:
+        mock_requests.get.return_value = self.mock_response(b'x'*100, 100)
+        with self.assertRaises(Exception):
+            streaming.url_to_gcs('https://example.com/f.txt', 'gs://bucket-a/f.txt', 10, None, 50)
+        self.assertIsNone(self.storage_client.bucket('bucket-a').get_blob('f.txt'))
+
+        # or does not, in which case we stop once the maximum is exceeded:
+        mock_requests.get.return_value = self.mock_response(b'x'*100)
+        with self.assertRaises(Exception):
+            streaming.url_to_gcs('https://example.com/f.txt', 'gs://bucket-a/f.txt', 10, None, 50)
+        self.assertIsNone(self.storage_client.bucket('bucket-a').get_blob('f.txt'))
+
+        mock_requests.get.return_value = self.mock_response(b'x'*50)
+        num_bytes = streaming.url_to_gcs('https://example.com/f.txt', 'gs://bucket-a/f.txt', 10, None, 50)
+        self.assertEqual(num_bytes, 50)
+
+    @mock.patch('transfer_app.streaming.requests')
+    @mock.patch('transfer_app.streaming.socket')
+    def test_private_hosts_are_not_fetched(self, mock_socket, mock_requests):
+        from transfer_app import streaming
+        mock_socket.getaddrinfo.return_value = [(None, None, None, '', ('169.254.169.254', 0))]
+        with self.assertRaises(Exception):
+            streaming.url_to_gcs('https://metadata/f.txt', 'gs://bucket-a/f.txt', 10, None, 50, True)
+        self.assertIsNone(streaming.probe_url_size('https://metadata/f.txt'))
+        self.assertFalse(mock_requests.get.called)
+        self.assertFalse(mock_requests.head.called)
+
+        mock_socket.getaddrinfo.return_value = [(None, None, None, '', ('8.8.8.8', 0))]
+        response = self.mock_response(b'')
+        response.headers = {'Content-Length': '40'}
+        mock_requests.head.return_value = response
+        self.assertEqual(streaming.probe_url_size('https://example.com/f.txt'), 40)
+
+    @mock.patch('transfer_app.uploaders.streaming.probe_url_size')
+    def test_links_streamed_in_worker_only_if_size_confirmed(self, mock_probe):
+        from transfer_app import uploaders
+        uploader = uploaders.GoogleUrlUploader([])
+        threshold = uploader.in_worker_max_size()
+        items = [{'source_path': 'https://example.com/%d' % i, 'size_in_bytes': 1} for i in range(3)]
+        mock_probe.side_effect = [100, threshold + 1, None]
+        confirmed, unconfirmed = uploader.confirm_in_worker_items(items)
+        self.assertEqual(confirmed, items[:1])
+        self.assertEqual(unconfirmed, items[1:])
@@ -1,18 +1,29 @@
 import os
 import datetime
 import copy
+import urllib
+
+import requests
 
 from django.conf import settings
+from django.utils import timezone
+from django.db.models import Q
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ObjectDoesNotExist
 from django.urls import reverse
 from django.contrib.sites.models import Site
 
+
 from transfer_app.base import GoogleBase, AWSBase
 import transfer_app.utils as transfer_utils
+from transfer_app import tasks as transfer_tasks
+from transfer_app import streaming
 import helpers.utils as utils
+from helpers import google_clients
+from helpers import storage_utils
+from helpers import runtime_settings
 
-from base.models import Resource, CurrentZone
+from base.models import Resource
 from transfer_app.models import Transfer, TransferCoordinator
 import transfer_app.serializers as serializers
 import base.exceptions as exceptions
@@ -104,16 +115,22 @@ class Uploader(object):
                 filesize_in_bytes =  0
                 item['size_in_bytes'] = 0
 
-            r = Resource(
-                source = self.source,
-                source_path = item['source_path'],
-                path = item['destination'],
-                name = item['name'],
-                owner = owner,
-                size = filesize_in_bytes,
-                originated_from_upload = True,
-                is_active=False # not uploaded yet, so not active.  Will be active if download completes
-            )
+            # the path may belong to an expired Resource whose file was removed
+            # from storage.  Paths are unique, so the upload takes over that Resource
+            r = Resource.objects.filter(path=item['destination'], is_active=False, file_deleted=True).first()
+            if r is None:
+                r = Resource(path = item['destination'])
+            else:
+                r.expiration_date = datetime.date.today() + settings.EXPIRATION_PERIOD
+                r.total_downloads = 0
+                r.file_deleted = False
+            r.source = self.source
+            r.source_path = item['source_path']
+            r.name = item['name']
+            r.owner = owner
+            r.size = filesize_in_bytes
+            r.originated_from_upload = True
+            r.is_active = False # not uploaded yet, so not active.  Will be active if download completes
             r.save()
 
             t = Transfer(
@@ -247,11 +264,85 @@ class DriveUploader(Uploader):
 
 
 
+class UrlUploader(Uploader):
+    '''
+    Files are fetched from arbitrary HTTPS links, such as presigned links to
+    files in another cloud provider's storage.  The front-end sends the links:
+        upload_data = [{'source_path':'https://...', 'name':'a.txt'}, ...]
+    If the name is not given, it is taken from the final part of the link's path.
+    '''
+
+    config_keys = ['url',]
+    source = settings.URL
+    required_keys = ['source_path',]
+
+    # characters which have a special meaning to the shell.  Links are passed
+    # on to the VM through a shell command, so we do not accept these.
+    disallowed_characters = ['"', "'", '`', '$', '\\']
+
+    @classmethod
+    def check_format(cls, upload_data, uploader_pk):
+        if isinstance(upload_data, dict):
+            upload_data = [upload_data,]
+        for item in upload_data:
+            try:
+                parsed_url = urllib.parse.urlparse(item['source_path'])
+            except (KeyError, AttributeError) as ex:
+                raise exceptions.ExceptionWithMessage('The request payload did not contain a valid source_path')
+            if (parsed_url.scheme != 'https') or (not parsed_url.netloc):
+                raise exceptions.ExceptionWithMessage('Only HTTPS links are accepted.  Received: %s' % item['source_path'])
+            if any(c in item['source_path'] for c in cls.disallowed_characters):
+                raise exceptions.ExceptionWithMessage('The link %s contains characters which are not permitted (%s).' % (item['source_path'], ' '.join(cls.disallowed_characters)))
+            if not item.get('name'):
+                name = os.path.basename(urllib.parse.unquote(parsed_url.path))
+                if not name:
+                    raise exceptions.ExceptionWithMessage('Could not determine a file name for the link %s' % item['source_path'])
+                item['name'] = name
+        return cls._check_format(upload_data, uploader_pk)
+
+
+class BrowserUploader(Uploader):
+    '''
+    Files are sent by the user's browser directly into our storage, using an
+    upload session that we create on its behalf.  The front-end sends the name
+    and size of each file:
+        upload_data = [{'name':'a.txt', 'size_in_bytes': 1000}, ...]
+    '''
+
+    config_keys = ['browser',]
+    source = settings.BROWSER
+    required_keys = ['size_in_bytes',]
+
+    @classmethod
+    def check_format(cls, upload_data, uploader_pk):
+        upload_data = cls._check_format(upload_data, uploader_pk)
+        for item in upload_data:
+            try:
+                item['size_in_bytes'] = int(item['size_in_bytes'])
+            except (TypeError, ValueError) as ex:
+                raise exceptions.ExceptionWithMessage('The size of the file %s was not an integer.' % item['name'])
+            if item['size_in_bytes'] < 0:
+                raise exceptions.ExceptionWithMessage('The size of the file %s was negative.' % item['name'])
+
+            # there is no location on the "source" side, so keep the original file name
+            item['source_path'] = item['name']
+        return upload_data
+
+
 class EnvironmentSpecificUploader(object):
 
     config_keys = []
     config_file = settings.UPLOADER_CONFIG['CONFIG_PATH']
 
+    # if True, small files are streamed by the worker process rather than
+    # on a dedicated VM.  Subclasses that can do this implement stream_single_upload
+    in_worker_streaming = False
+
+    # if True, the client (browser) sends the files into storage itself.  In that 
+    # case, upload() is called as part of the request and returns the info
+    # the client needs to perform the uploads
+    client_side_upload = False
+
     def __init__(self, upload_data):
         #instantiate the wrapped classes:
         self.uploader = self.uploader_cls(upload_data)
@@ -269,8 +360,38 @@ class EnvironmentSpecificUploader(object):
 
     def upload(self):
         self.uploader._transfer_setup()
+        if self.in_worker_streaming:
+            self.start_in_worker_uploads()
         self.config_and_start_uploads()     
 
+    def start_in_worker_uploads(self):
+        '''
+        Small files are streamed directly by a worker process, which avoids the
+        overhead of starting a VM.  Those items are removed from the upload
+        data so that only the larger files are handled by config_and_start_uploads
+        '''
+        in_worker_items, vm_items = streaming.split_transfer_tiers(
+            self.uploader.upload_data, 
+            self.config_params
+        )
+        in_worker_items, unconfirmed_items = self.confirm_in_worker_items(in_worker_items)
+        vm_items.extend(unconfirmed_items)
+        for item in in_worker_items:
+            Transfer.objects.filter(pk=item['transfer_pk']).update(started=True, in_worker=True)
+            transfer_tasks.stream_upload.delay(item, self.uploader.source)
+        self.uploader.upload_data = vm_items
+
+    def confirm_in_worker_items(self, items):
+        '''
+        The sizes used to choose the in-worker tier are given by the client.  Subclasses 
+        may check them independently.  Returns a tuple of the items which may be 
+        streamed by the worker and those which should be sent to a VM.
+        '''
+        return items, []
+
+    def in_worker_max_size(self):
+        return int(float(self.config_params['in_worker_max_size_in_bytes']))
+
 
 class GoogleEnvironmentUploader(EnvironmentSpecificUploader, GoogleBase):
 
@@ -308,25 +429,41 @@ class GoogleEnvironmentUploader(EnvironmentSpecificUploader, GoogleBase):
         # It places a 'destination' key in the dictionary for later use.
         # If the filenames are invalid, it throws an exception.
         path_list = [] # keep track of the destinations-- in case two files with the same name are selected (fringe case!)
+        bucket_names = []
         for item_dict in upload_info:
-            bucket_name = os.path.join('%s-%s' % (
+            bucket_names.append(os.path.join('%s-%s' % (
                 settings.CONFIG_PARAMS['storage_bucket_prefix'], 
                 str(item_dict['user_uuid'])),
                 settings.CONFIG_PARAMS['uploads_folder_name']
-                )
-            item_name = item_dict['name']
+                ))
 
             # for ease of dealing with spaces, reassign to a name that replaces spaces with underscores:
-            item_name = item_name.replace(' ', '_')
-            item_dict['name'] = item_name
+            item_dict['name'] = item_dict['name'].replace(' ', '_')
+
+        # find which of the intended locations are already taken using a single query.
+        # Expired Resources still hold their path until their files have been 
+        # removed from storage.  (Uploads which are still in progress are
+        # handled by the conflict check below)
+        taken = Q(is_active=True) | Q(expiration_date__lt=timezone.localdate(), file_deleted=False)
+        intended_paths = [os.path.join(b, x['name']) for b, x in zip(bucket_names, upload_info)]
+        existing_paths = set(Resource.objects.filter(taken, path__in=intended_paths) \
+            .values_list('path', flat=True))
+
+        for bucket_name, item_dict in zip(bucket_names, upload_info):
+            item_name = item_dict['name']
             full_item_name = os.path.join(bucket_name, item_name)
         
             # check that the file with the same name does not already exist.  If so, add a timestamp:
             is_unique = False
+            renamed = False
             while not is_unique:
-                r = Resource.objects.filter(path=full_item_name, is_active=True)
+                if renamed:
+                    # the timestamped name was not part of the query above
+                    path_taken = Resource.objects.filter(taken, path=full_item_name).exists()
+                else:
+                    path_taken = full_item_name in existing_paths
                 duplicate_name = full_item_name in path_list
-                if len(r) >= 1 or duplicate_name:
+                if path_taken or duplicate_name:
                     # TODO: message admins if >1? 
                     # already have a file at the location.  Add a timestamp prefix
                     now = datetime.datetime.now()
@@ -335,6 +472,7 @@ class GoogleEnvironmentUploader(EnvironmentSpecificUploader, GoogleBase):
                     newname = '.'.join(name_split[:-1]) + '.' + stamp + '.' + name_split[-1]
                     item_dict['name'] = newname
                     full_item_name = os.path.join(bucket_name, newname)
+                    renamed = True
                 else:
                     is_unique = True
 
@@ -365,8 +503,9 @@ class GoogleEnvironmentUploader(EnvironmentSpecificUploader, GoogleBase):
         Each item in self.upload_data has a key of 'destination'.  If any existing, INCOMPLETE
         transfers have the same destination, then we block it.
         '''
-        all_incomplete_transfers = Transfer.objects.filter(completed=False)
-        destinations = [x.destination for x in all_incomplete_transfers]
+        requested_destinations = [item['destination'] for item in upload_data]
+        destinations = set(Transfer.objects.filter(completed=False, 
+            destination__in=requested_destinations).values_list('destination', flat=True))
         new_transfers = []
         error_messages = []
         for item in upload_data:
@@ -380,6 +519,12 @@ class GoogleEnvironmentUploader(EnvironmentSpecificUploader, GoogleBase):
 
         return new_transfers, error_messages
 
+    in_worker_streaming = True
+
+    # if True, the worker VM writes the file to disk, so the disk is sized
+    # according to the file.  Otherwise, the minimum disk size is used.
+    stages_to_disk = True
+
     def __init__(self, upload_data):
         super().__init__(upload_data)
 
@@ -394,6 +539,9 @@ class GoogleEnvironmentUploader(EnvironmentSpecificUploader, GoogleBase):
         domain = current_site.domain
         full_callback_url = 'https://%s%s' % (domain, callback_url)
 
+        # the worker posts samples of its progress and throughput here:
+        full_progress_url = 'https://%s%s' % (domain, reverse('transfer-progress'))
+
         docker_image = custom_config['docker_image']
 
 
@@ -402,14 +550,22 @@ class GoogleEnvironmentUploader(EnvironmentSpecificUploader, GoogleBase):
            index
         )
 
-        # approx size in Gb so we can size the VM appropriately
-        size_in_gb = item['size_in_bytes']/1e9
-        target_disk_size = int(disk_size_factor*size_in_gb)
-        if target_disk_size < min_disk_size:
+        if self.stages_to_disk:
+            # approx size in Gb so we can size the VM appropriately
+            size_in_gb = item['size_in_bytes']/1e9
+            target_disk_size = int(disk_size_factor*size_in_gb)
+            if target_disk_size < min_disk_size:
+                target_disk_size = min_disk_size
+        else:
             target_disk_size = min_disk_size
 
+        # record the VM name so the watchdog can match the VM to this transfer:
+        item['instance_name'] = instance_name
+
         # fill out the template command:
-        current_zone = CurrentZone.objects.all()[0].zone
+        current_zone = runtime_settings.get_current_zone()
+        if current_zone is None:
+            raise Exception('A current zone has not been set.')
         if current_zone.cloud_environment != settings.GOOGLE:
             raise Exception('Incorrect configuration-- the current zone does not correspond to your cloud provider')
         zone_str = current_zone.zone
@@ -426,12 +582,13 @@ class GoogleEnvironmentUploader(EnvironmentSpecificUploader, GoogleBase):
         # Since these are passed via the gcloud command, the arg strings are a bit strange
         # These should be common to all google-environment activity.  
         # Args specific to the particular uploader should be handled in the subclass
-        cmd += ' --container-arg="-token" --container-arg="%s"' % settings.CONFIG_PARAMS['token']
-        cmd += ' --container-arg="-key" --container-arg="%s"' % settings.CONFIG_PARAMS['enc_key']
-        cmd += ' --container-arg="-pk" --container-arg="%s"' % item['transfer_pk']
-        cmd += ' --container-arg="-url" --container-arg="%s"' % full_callback_url
-        cmd += ' --container-arg="-proj" --container-arg="%s"' % settings.CONFIG_PARAMS['google_project_id']
-        cmd += ' --container-arg="-zone" --container-arg="%s"' % zone_str
+        cmd += transfer_utils.container_arg('-token', settings.CONFIG_PARAMS['token'])
+        cmd += transfer_utils.container_arg('-key', settings.CONFIG_PARAMS['enc_key'])
+        cmd += transfer_utils.container_arg('-pk', item['transfer_pk'])
+        cmd += transfer_utils.container_arg('-url', full_callback_url)
+        cmd += transfer_utils.container_arg('-proj', settings.CONFIG_PARAMS['google_project_id'])
+        cmd += transfer_utils.container_arg('-zone', zone_str)
+        cmd += transfer_utils.container_arg('-progress_url', full_progress_url)
         return cmd
 
 
@@ -441,6 +598,9 @@ class GoogleDropboxUploader(GoogleEnvironmentUploader):
     config_keys = ['dropbox_in_google',]
     config_keys.extend(GoogleEnvironmentUploader.config_keys)
 
+    # the file is streamed from Dropbox directly into storage
+    stages_to_disk = False
+
     def __init__(self, upload_data):
         super().__init__(upload_data)
 
@@ -453,8 +613,8 @@ class GoogleDropboxUploader(GoogleEnvironmentUploader):
         for i, item in enumerate(self.uploader.upload_data):
             try:
                 cmd = self._prep_single_upload(custom_config, i, item)
-                cmd += ' --container-arg="-path" --container-arg="%s"' % item['source_path'] # the special Dropbox link
-                cmd += ' --container-arg="-destination" --container-arg="%s"' % item['destination'] # the destination (in storage)
+                cmd += transfer_utils.container_arg('-path', item['source_path']) # the special Dropbox link
+                cmd += transfer_utils.container_arg('-destination', item['destination']) # the destination (in storage)
 
                 transfer_utils.check_for_transfer_availability(custom_config)
 
@@ -463,6 +623,8 @@ class GoogleDropboxUploader(GoogleEnvironmentUploader):
                 # mark the Transfer as started
                 transfer_obj = Transfer.objects.get(pk = item['transfer_pk'])
                 transfer_obj.started=True
+                transfer_obj.instance_name = item['instance_name']
+                transfer_obj.launch_time = timezone.now()
                 transfer_obj.save()
 
                 launch_count += 1
@@ -470,6 +632,18 @@ class GoogleDropboxUploader(GoogleEnvironmentUploader):
                 failed_pks.append(item['transfer_pk'])
         transfer_utils.handle_launch_problems(failed_pks, launch_count) 
 
+    def stream_single_upload(self, item):
+        chunk_size = int(float(self.config_params['in_worker_chunk_size_in_bytes']))
+        return streaming.run_in_worker_transfer(item['transfer_pk'], 
+            streaming.url_to_gcs,
+            item['source_path'], # the special Dropbox link
+            item['destination'],
+            chunk_size,
+            None,
+            self.in_worker_max_size(),
+            True
+        )
+
 
  
 
@@ -491,9 +665,63 @@ class GoogleDriveUploader(GoogleEnvironmentUploader):
         for i, item in enumerate(self.uploader.upload_data):
             try:
                 cmd = self._prep_single_upload(custom_config, i, item)
-                cmd += ' --container-arg="-drive_token" --container-arg="%s"' % item['drive_token'] # the token for accessing drive
-                cmd += ' --container-arg="-file_id" --container-arg="%s"' % item['file_id'] # the unique file ID
-                cmd += ' --container-arg="-destination" --container-arg="%s"' % item['destination'] # the destination (in storage)
+                cmd += transfer_utils.container_arg('-drive_token', item['drive_token']) # the token for accessing drive
+                cmd += transfer_utils.container_arg('-file_id', item['file_id']) # the unique file ID
+                cmd += transfer_utils.container_arg('-destination', item['destination']) # the destination (in storage)
+
+                transfer_utils.check_for_transfer_availability(custom_config)
+
+                self.launcher.go(cmd)
+
+                # mark the Transfer as started
+                transfer_obj = Transfer.objects.get(pk = item['transfer_pk'])
+                transfer_obj.started=True
+                transfer_obj.instance_name = item['instance_name']
+                transfer_obj.launch_time = timezone.now()
+                transfer_obj.save()
+
+                launch_count += 1
+            except Exception:
+                failed_pks.append(item['transfer_pk'])
+        transfer_utils.handle_launch_problems(failed_pks, launch_count) 
+
+    def stream_single_upload(self, item):
+        chunk_size = int(float(self.config_params['in_worker_chunk_size_in_bytes']))
+        return streaming.run_in_worker_transfer(item['transfer_pk'], 
+            streaming.url_to_gcs,
+            streaming.DRIVE_MEDIA_URL % item['file_id'],
+            item['destination'],
+            chunk_size,
+            {'Authorization': 'Bearer %s' % item['drive_token']},
+            self.in_worker_max_size()
+        )
+
+
+
+class GoogleUrlUploader(GoogleEnvironmentUploader):
+
+    uploader_cls = UrlUploader
+    config_keys = ['url_in_google',]
+    config_keys.extend(GoogleEnvironmentUploader.config_keys)
+
+    # the file is streamed from the URL directly into storage
+    stages_to_disk = False
+
+    def __init__(self, upload_data):
+        super().__init__(upload_data)
+
+    def config_and_start_uploads(self):
+
+        custom_config = copy.deepcopy(self.config_params)
+
+        launch_count = 0
+        failed_pks = []
+        for i, item in enumerate(self.uploader.upload_data):
+            try:
+                cmd = self._prep_single_upload(custom_config, i, item)
+                cmd += transfer_utils.container_arg('-path', item['source_path']) # the link to the file
+                cmd += transfer_utils.container_arg('-destination', item['destination']) # the destination (in storage)
+                cmd += transfer_utils.container_arg('-workers', custom_config['range_workers'])
 
                 transfer_utils.check_for_transfer_availability(custom_config)
 
@@ -502,6 +730,8 @@ class GoogleDriveUploader(GoogleEnvironmentUploader):
                 # mark the Transfer as started
                 transfer_obj = Transfer.objects.get(pk = item['transfer_pk'])
                 transfer_obj.started=True
+                transfer_obj.instance_name = item['instance_name']
+                transfer_obj.launch_time = timezone.now()
                 transfer_obj.save()
 
                 launch_count += 1
@@ -509,6 +739,142 @@ class GoogleDriveUploader(GoogleEnvironmentUploader):
                 failed_pks.append(item['transfer_pk'])
         transfer_utils.handle_launch_problems(failed_pks, launch_count) 
 
+    def confirm_in_worker_items(self, items):
+        '''
+        A link is only streamed by the worker if the server (on a public host)
+        reports that the file is small enough.  Otherwise it goes to a VM.
+        '''
+        threshold = self.in_worker_max_size()
+        confirmed_items = []
+        unconfirmed_items = []
+        for item in items:
+            size = streaming.probe_url_size(item['source_path'])
+            if (size is not None) and (0 < size <= threshold):
+                confirmed_items.append(item)
+            else:
+                unconfirmed_items.append(item)
+        return confirmed_items, unconfirmed_items
+
+    def stream_single_upload(self, item):
+        chunk_size = int(float(self.config_params['in_worker_chunk_size_in_bytes']))
+        return streaming.run_in_worker_transfer(item['transfer_pk'], 
+            streaming.url_to_gcs,
+            item['source_path'],
+            item['destination'],
+            chunk_size,
+            None,
+            self.in_worker_max_size(),
+            True
+        )
+
+
+class GoogleBrowserUploader(GoogleEnvironmentUploader):
+    '''
+    No VM is needed, since the browser sends the files directly into storage.  We 
+    create a resumable upload session for each file, restricted to our domain.  
+    The browser sends each file in chunks (resuming if interrupted) and then 
+    calls back so the file can be verified and its Resource activated.
+    '''
+
+    uploader_cls = BrowserUploader
+    config_keys = ['browser_in_google',]
+    config_keys.extend(GoogleEnvironmentUploader.config_keys)
+
+    in_worker_streaming = False
+    client_side_upload = True
+
+    def __init__(self, upload_data):
+        super().__init__(upload_data)
+
+    def upload(self):
+        self.uploader._transfer_setup()
+        return self.create_upload_sessions()
+
+    def create_upload_sessions(self):
+        '''
+        Returns a list of dicts, each giving the session URL the browser 
+        should send the file to and the size of the chunks to send
+        '''
+        chunk_size = int(float(self.config_params['browser_chunk_size_in_bytes']))
+        origin = 'https://%s' % Site.objects.get_current().domain
+        storage_client = google_clients.get_storage_client()
+
+        sessions = []
+        failed_pks = []
+        for item in self.uploader.upload_data:
+            try:
+                bucket_name, object_name = streaming.split_bucket_path(item['destination'])
+                blob = storage_client.bucket(bucket_name).blob(object_name)
+                session_url = blob.create_resumable_upload_session(
+                    size=item['size_in_bytes'] or None, 
+                    origin=origin
+                )
+                Transfer.objects.filter(pk=item['transfer_pk']).update(
+                    started=True,
+                    resumable_session=session_url,
+                    launch_time=timezone.now()
+                )
+                sessions.append({
+                    'transfer_pk': item['transfer_pk'],
+                    'name': item['name'],
+                    'upload_url': session_url,
+                    'chunk_size': chunk_size
+                })
+            except Exception as ex:
+                print('Could not create an upload session for transfer %s: %s' % (item['transfer_pk'], ex))
+                failed_pks.append(item['transfer_pk'])
+        transfer_utils.handle_launch_problems(failed_pks, len(sessions))
+        return sessions
+
+    @classmethod
+    def finish_upload(cls, transfer_obj, md5_hash):
+        '''
+        Called once the browser has sent the final chunk.  md5_hash is the 
+        base64-encoded MD5 checksum of the file, as computed by the browser.  The 
+        object in storage must match that checksum (and the expected size), otherwise
+        it is removed.  Returns True if the upload was verified.
+        '''
+        resource = transfer_obj.resource
+        bucket_name, object_name = streaming.split_bucket_path(transfer_obj.destination)
+        blob = google_clients.get_storage_client().bucket(bucket_name).get_blob(object_name)
+        if blob is None:
+            print('The object for transfer %s was not found in storage' % transfer_obj.pk)
+            success = False
+        elif (blob.md5_hash != md5_hash) or ((resource.size > 0) and (blob.size != resource.size)):
+            print('The object for transfer %s did not match.  Expected %s (%d bytes), found %s (%d bytes)' 
+                % (transfer_obj.pk, md5_hash, resource.size, blob.md5_hash, blob.size))
+            blob.delete()
+            success = False
+        else:
+            resource.size = blob.size
+            success = True
+
+        tc_pk = transfer_obj.coordinator.pk
+        if transfer_obj.finalize(success):
+            tc = TransferCoordinator.objects.get(pk=tc_pk)
+            transfer_utils.post_completion(tc, tc.originator_emails())
+        return success
+
+    @classmethod
+    def cancel_upload(cls, transfer_obj):
+        '''
+        Cancels the resumable upload session (which would otherwise remain usable
+        for about a week) and removes anything the browser already sent to the
+        destination.  Returns True if both succeeded.
+        '''
+        cancelled = True
+        try:
+            # a successfully cancelled session responds with status 499
+            response = requests.delete(transfer_obj.resumable_session, timeout=streaming.DEFAULT_TIMEOUT)
+            if response.status_code not in [404, 410, 499]:
+                print('Unexpected response (%s) when cancelling the upload session for transfer %s' 
+                    % (response.status_code, transfer_obj.pk))
+                cancelled = False
+        except requests.exceptions.RequestException as ex:
+            print('Could not cancel the upload session for transfer %s: %s' % (transfer_obj.pk, ex))
+            cancelled = False
+        failed_paths = storage_utils.delete_blobs([transfer_obj.destination,])
+        return cancelled and (len(failed_paths) == 0)
 
 
 class AWSEnvironmentUploader(EnvironmentSpecificUploader):
@@ -525,6 +891,11 @@ class AWSDriveUploader(AWSEnvironmentUploader):
     config_keys = ['drive_in_aws',]
 
 
+class AWSUrlUploader(AWSEnvironmentUploader):
+    uploader_cls = UrlUploader
+    config_keys = ['url_in_aws',]
+
+
 def get_uploader(source):
     '''
     Based on the compute environment and the source of the upload
@@ -539,10 +910,13 @@ def get_uploader(source):
         settings.GOOGLE : {
             settings.GOOGLE_DRIVE : GoogleDriveUploader,
             settings.DROPBOX : GoogleDropboxUploader,
+            settings.BROWSER : GoogleBrowserUploader,
+            settings.URL : GoogleUrlUploader,
         },
         settings.AWS : {
             settings.GOOGLE_DRIVE : AWSDriveUploader,
             settings.DROPBOX : AWSDropboxUploader,
+            settings.URL : AWSUrlUploader,
         }
     }
     environment = settings.CONFIG_PARAMS['cloud_environment']
@@ -555,3 +929,28 @@ def get_uploader(source):
                 Upload source: %s
         ''' % (environment, source))
 
+
+def expire_browser_uploads():
+    '''
+    If the browser never finishes an upload (e.g. the page was closed), the 
+    incomplete Transfer would block any new upload to the same location.  This 
+    marks those uploads as failed once they are too old, after cancelling their
+    upload sessions so that nothing more can be sent to that location.  Returns 
+    the number expired.
+    '''
+    config_params = utils.load_config(settings.UPLOADER_CONFIG['CONFIG_PATH'], BrowserUploader.config_keys)
+    timeout = datetime.timedelta(hours=float(config_params['browser_upload_timeout_hours']))
+    stale_transfers = Transfer.objects.filter(download=False, 
+        completed=False, 
+        resource__source=settings.BROWSER,
+        start_time__lt=timezone.now() - timeout).select_related('coordinator')
+    expired = 0
+    for transfer_obj in stale_transfers:
+        if transfer_obj.resumable_session:
+            GoogleBrowserUploader.cancel_upload(transfer_obj)
+        tc_pk = transfer_obj.coordinator.pk
+        if transfer_obj.finalize(False):
+            tc = TransferCoordinator.objects.get(pk=tc_pk)
+            transfer_utils.post_completion(tc, tc.originator_emails())
+        expired += 1
+    return expired
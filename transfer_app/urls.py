@@ -15,7 +15,9 @@ urlpatterns = [
     # endpoints related to querying Transfers:
     re_path(r'^$', views.TransferList.as_view(), name='transfer-list'),
     re_path(r'^upload/init/$', views.InitUpload.as_view(), name='upload-transfer-initiation'),
+    re_path(r'^upload/browser/complete/$', views.BrowserUploadComplete.as_view(), name='browser-upload-complete'),
     re_path(r'^download/init/$', views.InitDownload.as_view(), name='download-transfer-initiation'),
+    re_path(r'^download/browser/$', views.BrowserDownload.as_view(), name='browser-download'),
     re_path(r'^(?P<pk>[0-9]+)/$', views.TransferDetail.as_view(), name='transfer-detail'),
     re_path(r'^user/(?P<user_pk>[0-9]+)/$', views.UserTransferList.as_view(), name='user-transfer-list'),
     re_path(r'^transferred-resources/$', views.TransferredResourceList.as_view(), name='transferred-resource-list'),
@@ -30,6 +32,8 @@ urlpatterns = format_suffix_patterns(urlpatterns)
 urlpatterns.extend([
     # endpoints for communicating from worker machines:
     re_path(r'^complete/$', views.TransferComplete.as_view(), name='transfer-complete'),
+    re_path(r'^checkpoint/$', views.TransferCheckpoint.as_view(), name='transfer-checkpoint'),
+    re_path(r'^progress/$', views.TransferProgress.as_view(), name='transfer-progress'),
 
     # endpoints for callbacks:
     re_path(r'^dropbox/callback/$', DropboxDownloader.finish_authentication_and_start_download, name='dropbox_token_callback'),
@@ -3,8 +3,8 @@ import os
 import sys
 import datetime
 import time
+import shlex
 
-from jinja2 import Environment, FileSystemLoader
 
 from django.conf import settings
 from django.http import Http404
@@ -16,6 +16,16 @@ import transfer_app.launchers as _launchers
 
 sys.path.append(os.path.realpath('helpers'))
 from helpers.email_utils import send_email
+from helpers.utils import get_jinja_environment, get_email_subject
+
+
+def container_arg(flag, value):
+    '''
+    Returns the part of a gcloud command which passes the flag and its value
+    to the container.  The command is run by a shell and the values can come
+    from users (e.g. links or file names), so both are quoted.
+    '''
+    return ' --container-arg=%s --container-arg=%s' % (shlex.quote(flag), shlex.quote(str(value)))
 
 
 def check_for_transfer_availability(config):
@@ -47,27 +57,14 @@ def handle_launch_problems(failed_pks, launch_count):
     This function wraps common behavior for actions to take if one of the transfers did not launch 
     properly.
     '''
-    # for those that instantly failed, mark them complete:
-    tc_set = []
+    # for those that instantly failed, mark them complete.  If that completes the 
+    # coordinator (e.g. none were launched), send the notifications
     for transfer_pk in failed_pks:
         transfer_obj = Transfer.objects.get(pk=transfer_pk)
-        tc_set.append(transfer_obj.coordinator) # all the Transfers should have the same coordinator, but let's keep it general
-        transfer_obj.completed = True
-        transfer_obj.success = False
-        tz = transfer_obj.start_time.tzinfo
-        now = datetime.datetime.now(tz)
-        duration = now - transfer_obj.start_time
-        transfer_obj.duration = duration
-        transfer_obj.finish_time = now
-        transfer_obj.save()
-
-    tc_set_pks = set([x.pk for x in tc_set])
-    if launch_count == 0:
-        for tc_pk in tc_set_pks:
+        tc_pk = transfer_obj.coordinator.pk
+        if transfer_obj.finalize(False):
             tc = TransferCoordinator.objects.get(pk=tc_pk)
-            all_transfers = Transfer.objects.filter(coordinator = tc)
-            all_originators = list(set([x.originator.email for x in all_transfers]))
-            post_completion(tc, all_originators)
+            post_completion(tc, tc.originator_emails())
 
 
 def post_completion(transfer_coordinator, originator_emails):
@@ -78,7 +75,7 @@ def post_completion(transfer_coordinator, originator_emails):
     '''
 
     failed_transfers = FailedTransfer.objects.filter(coordinator = transfer_coordinator)
-    failed_transfers = [x.name for x in failed_transfers]
+    failed_transfers = [x.resource_name for x in failed_transfers]
 
     if settings.EMAIL_ENABLED:
         current_site = Site.objects.get_current()
@@ -86,12 +83,12 @@ def post_completion(transfer_coordinator, originator_emails):
     
         template_dir = os.path.join(settings.MAIN_TEMPLATE_DIR, 'transfer_app') 
 
-        email_subject = open(os.path.join( template_dir, 
+        email_subject = get_email_subject(os.path.join(template_dir, 
             'transfer_complete_subject.txt')
-        ).read().strip()
+        )
 
         # get the templates and fill them out:
-        env = Environment(loader=FileSystemLoader(template_dir))
+        env = get_jinja_environment(template_dir)
         plaintext_template = env.get_template('transfer_complete_message.txt')
         html_template = env.get_template('transfer_complete_message.html')
 
@@ -103,6 +100,33 @@ def post_completion(transfer_coordinator, originator_emails):
             send_email(plaintext_msg, html_msg, email, email_subject)
 
 
+def get_tier_throughput():
+    '''
+    Summarizes the successful transfers by how they were executed (streamed in a 
+    worker process or on a dedicated VM) so the size threshold between the two 
+    can be tuned.  Returns a dict keyed by 'in_worker' and 'vm', each giving
+    the number of transfers, total bytes, total seconds, and mean bytes/second.
+    '''
+    summary = {}
+    for tier_name, in_worker in [('in_worker', True), ('vm', False)]:
+        transfers = Transfer.objects.filter(completed=True, 
+            success=True, 
+            in_worker=in_worker,
+            duration__isnull=False).select_related('resource')
+        total_bytes = 0
+        total_seconds = 0.0
+        for t in transfers:
+            total_bytes += t.resource.size
+            total_seconds += t.duration.total_seconds()
+        summary[tier_name] = {
+            'count': len(transfers),
+            'total_bytes': total_bytes,
+            'total_seconds': total_seconds,
+            'bytes_per_second': total_bytes/total_seconds if total_seconds > 0 else None
+        }
+    return summary
+
+
 def get_or_create_upload_location(user):
     '''
     user is an instance of User
@@ -8,6 +8,8 @@ from django.contrib.sites.models import Site
 from django.core.exceptions import ObjectDoesNotExist
 from django.http import Http404
 from django.conf import settings
+from django.utils import timezone
+from django.db.models import F
 
 from rest_framework import generics, permissions, renderers, status
 from rest_framework.response import Response
@@ -24,10 +26,12 @@ from transfer_app.serializers import TransferSerializer, \
      TransferredResourceSerializer
 
 import transfer_app.utils as utils
+from helpers import storage_utils
 import base.exceptions as exceptions
 import transfer_app.tasks as transfer_tasks
 import transfer_app.uploaders as _uploaders
 import transfer_app.downloaders as _downloaders
+import transfer_app.browser_downloads as browser_downloads
 
 class TransferList(generics.ListAPIView):
     '''
@@ -135,7 +139,7 @@ class BatchList(generics.ListAPIView):
         queryset = super(BatchList, self).get_queryset()
         if not self.request.user.is_staff:
             queryset = TransferCoordinator.objects.user_transfer_coordinators(self.request.user)
-        return queryset
+        return TransferCoordinator.objects.with_progress(queryset)
 
 
 class BatchDetail(generics.RetrieveAPIView):
@@ -143,7 +147,7 @@ class BatchDetail(generics.RetrieveAPIView):
     Here we allow only retrieval of objects.  We have no reason to edit or destroy
     TransferCoordinators
     '''
-    queryset = TransferCoordinator.objects.all()
+    queryset = TransferCoordinator.objects.with_progress()
     serializer_class = TransferCoordinatorSerializer
     permission_classes = (permissions.IsAuthenticated,)
 
@@ -155,9 +159,9 @@ class BatchDetail(generics.RetrieveAPIView):
         does exist), return 404 if they are not allowed to access an object.
         '''
         obj = super(BatchDetail, self).get_object()
-        obj_owners = list(set([x.resource.owner for x in Transfer.objects.filter(coordinator = obj)]))
+        obj_owners = list(set([x.resource.owner_id for x in obj.prefetched_transfers]))
         if len(obj_owners) == 1:            
-            if (self.request.user.is_staff) or (obj_owners[0] == self.request.user):
+            if (self.request.user.is_staff) or (obj_owners[0] == self.request.user.pk):
                 return obj
             else:
                 raise Http404
@@ -181,93 +185,151 @@ class UserBatchList(generics.ListAPIView):
         user_pk = self.kwargs['user_pk']
         try:
             user = get_user_model().objects.get(pk=user_pk)
-            return TransferCoordinator.objects.user_transfer_coordinators(user)
+            return TransferCoordinator.objects.with_progress(
+                TransferCoordinator.objects.user_transfer_coordinators(user)
+            )
         except ObjectDoesNotExist as ex:
             raise Http404
 
 
+def has_worker_token(data):
+    '''
+    Returns True if the request data contains the encrypted token
+    which identifies the sender as one of our worker machines
+    '''
+    if 'token' in data:
+        b64_enc_token = data['token']
+        enc_token = base64.decodestring(b64_enc_token.encode('ascii'))
+        expected_token = settings.CONFIG_PARAMS['token'] 
+        obj=DES.new(settings.CONFIG_PARAMS['enc_key'], DES.MODE_ECB)
+        decrypted_token = obj.decrypt(enc_token)
+        return decrypted_token == expected_token.encode('ascii')
+    return False
+
+
 class TransferComplete(APIView):
 
     permission_classes = (permissions.AllowAny,)
 
     def post(self, request, format=None):    
         data = request.data
-        if 'token' in data:
-            b64_enc_token = data['token']
-            enc_token = base64.decodestring(b64_enc_token.encode('ascii'))
-            expected_token = settings.CONFIG_PARAMS['token'] 
-            obj=DES.new(settings.CONFIG_PARAMS['enc_key'], DES.MODE_ECB)
-            decrypted_token = obj.decrypt(enc_token)
-            if decrypted_token == expected_token.encode('ascii'):
-                # we can trust the content since it contained the proper token
-                try:
-                    transfer_pk = data['transfer_pk']
-                    success = bool(int(data['success']))
-                except KeyError as ex:
-                    raise exceptions.RequestError('The request did not have the correct formatting.')  
+        if has_worker_token(data):
+            # we can trust the content since it contained the proper token
+            try:
+                transfer_pk = data['transfer_pk']
+                success = bool(int(data['success']))
+            except KeyError as ex:
+                raise exceptions.RequestError('The request did not have the correct formatting.')  
+            try:
+                transfer_obj = Transfer.objects.get(pk=transfer_pk)
+
+                # get the transfer coordinator primary key.
+                tc_pk = transfer_obj.coordinator.pk
+
                 try:
-                    transfer_obj = Transfer.objects.get(pk=transfer_pk)
-                    transfer_obj.completed = True
-                    transfer_obj.success = success
-                    tz = transfer_obj.start_time.tzinfo
-                    now = datetime.datetime.now(tz)
-                    duration = now - transfer_obj.start_time
-                    transfer_obj.duration = duration
-                    transfer_obj.finish_time = now
-                    transfer_obj.save()
-
-                    # get the transfer coordinator primary key.
-                    tc_pk = transfer_obj.coordinator.pk
-
-                    try:
-                        tc = TransferCoordinator.objects.get(pk=tc_pk)
-                    except ObjectDoesNotExist as ex:
-                        raise exceptions.RequestError('TransferCoordinator with pk=%d did not exist' % tc_pk)
-
-                    if success:
-                        if transfer_obj.download:
-                            resource = transfer_obj.resource
-
-                            # did they use the last download?  If so, set the Resource inactive
-                            if (resource.total_downloads + 1) >= \
-                                int(settings.CONFIG_PARAMS['maximum_downloads']):
-                                resource.is_active = False                                
-                            resource.total_downloads += 1
-                            resource.save()
-                        else: # upload
-                            resource = transfer_obj.resource
-                            resource.is_active = True
-                            resource.save()
-                    else: # failed the transfer process somehow
-                        # note this failed transfer:
-                        ft = FailedTransfer(
-                            was_download = transfer_obj.download,
-                            intended_path = transfer_obj.destination,
-                            start_time = transfer_obj.start_time,
-                            resource_name = transfer_obj.resource.name,
-                            coordinator = tc
-                        )
-                        ft.save()
-
-                        if not transfer_obj.download:
-                            # if upload, we need to clean up the Resource since it was previously
-                            # saved as a placeholder.  
-                            resource = transfer_obj.resource
-                            resource.delete()
-
-                    # now check if all the Transfers belonging to this TransferCoordinator are complete:
-                    all_transfers = Transfer.objects.filter(coordinator = tc)
-                    if all([x.completed for x in all_transfers]):
-                        tc.completed = True
-                        tc.finish_time = datetime.datetime.now()
-                        tc.save()
-                        all_originators = list(set([x.originator.email for x in all_transfers]))
-                        utils.post_completion(tc, all_originators)
-                    return Response({'message': 'thanks'})
+                    tc = TransferCoordinator.objects.get(pk=tc_pk)
                 except ObjectDoesNotExist as ex:
-                    raise exceptions.RequestError('Transfer with pk=%s did not exist' % transfer_pk)
-            else:
-                raise Http404
+                    raise exceptions.RequestError('TransferCoordinator with pk=%d did not exist' % tc_pk)
+
+                # if the worker failed (or was preempted) after reporting a checkpoint,
+                # start a new worker which picks up where it left off
+                if (not success) and transfer_obj.can_resume():
+                    Transfer.objects.filter(pk=transfer_obj.pk).update(
+                        relaunch_count = F('relaunch_count') + 1,
+                        instance_name = None
+                    )
+                    transfer_tasks.resume_transfer.delay(transfer_obj.pk)
+                    return Response({'message': 'resuming'})
+
+                # the workers do not report the size of an upload, so take it 
+                # from the object itself:
+                size = None
+                if success and (not transfer_obj.download) and \
+                    (settings.CONFIG_PARAMS['cloud_environment'] == settings.GOOGLE):
+                    size = storage_utils.get_object_size(transfer_obj.destination)
+
+                # mark complete and check if all the Transfers belonging to 
+                # this TransferCoordinator are complete.  This is done atomically
+                # using the counts on the coordinator, so exactly one callback
+                # sends the notifications:
+                if transfer_obj.finalize(success, size):
+                    utils.post_completion(tc, tc.originator_emails())
+                return Response({'message': 'thanks'})
+            except ObjectDoesNotExist as ex:
+                raise exceptions.RequestError('Transfer with pk=%s did not exist' % transfer_pk)
+        else:
+            raise Http404
+
+
+class TransferCheckpoint(APIView):
+    '''
+    Worker machines periodically report the session they are sending to
+    and the number of bytes committed to it (and, optionally, the boundaries 
+    of chunks sent beyond that).  If the worker is interrupted, a relaunched 
+    worker can resume from that point.
+    '''
+    permission_classes = (permissions.AllowAny,)
+
+    def post(self, request, format=None):    
+        data = request.data
+        if has_worker_token(data):
+            try:
+                transfer_pk = data['transfer_pk']
+                session = data['session']
+                offset = int(data['offset'])
+                # optional; the boundaries of chunks which may have been sent beyond the offset
+                boundaries = data.get('boundaries') or None
+                if boundaries:
+                    boundaries = ','.join([str(int(x)) for x in boundaries.split(',')])
+            except (KeyError, ValueError) as ex:
+                raise exceptions.RequestError('The request did not have the correct formatting.')  
+
+            # only incomplete transfers can be checkpointed:
+            updated = Transfer.objects.filter(pk=transfer_pk, completed=False).update(
+                resumable_session = session,
+                committed_offset = offset,
+                chunk_boundaries = boundaries,
+                checkpoint_time = timezone.now()
+            )
+            if updated == 0:
+                raise exceptions.RequestError('Transfer with pk=%s did not exist or was already complete' % transfer_pk)
+            return Response({'message': 'thanks'})
+        else:
+            raise Http404
+
+
+class TransferProgress(APIView):
+    '''
+    Worker machines periodically post a sample of their progress: the number of bytes
+    transferred, the recent throughput (bytes/second), and the number of chunk retries.
+    Only the latest sample is kept.
+    '''
+    permission_classes = (permissions.AllowAny,)
+
+    def post(self, request, format=None):    
+        data = request.data
+        if has_worker_token(data):
+            try:
+                transfer_pk = data['transfer_pk']
+                bytes_transferred = int(data['bytes_transferred'])
+                throughput = float(data['bytes_per_second'])
+                chunk_retries = int(data['retries'])
+            except (KeyError, ValueError) as ex:
+                raise exceptions.RequestError('The request did not have the correct formatting.')  
+
+            # (the throughput comparison also rejects NaN)
+            if bytes_transferred < 0 or chunk_retries < 0 or not (0 <= throughput < float('inf')):
+                raise exceptions.RequestError('The progress sample cannot have negative (or non-numeric) values.')
+
+            updated = Transfer.objects.filter(pk=transfer_pk, completed=False).update(
+                bytes_transferred = bytes_transferred,
+                throughput = throughput,
+                chunk_retries = chunk_retries,
+                last_progress_time = timezone.now()
+            )
+            if updated == 0:
+                raise exceptions.RequestError('Transfer with pk=%s did not exist or was already complete' % transfer_pk)
+            return Response({'message': 'thanks'})
         else:
             raise Http404
 
@@ -306,12 +368,18 @@ class InitDownload(generics.CreateAPIView):
             # Check that the upload data has the required format to work with this uploader implementation:
             download_info, error_messages = downloader_cls.check_format(resource_pks, user_pk)
 
+            # the files may optionally be delivered as a single zip archive:
+            archive_options = None
+            if data.get('archive'):
+                archive_options = downloader_cls.check_archive_options(data['archive'], download_info)
+
             if len(error_messages) > 0:
                 return Response({'errors': error_messages}, status=409)
             else:
                 # stash the download info, since we will be redirecting through an authentication flow
                 request.session['download_info'] = download_info 
                 request.session['download_destination'] = download_destination
+                request.session['download_archive'] = archive_options
                 return Response({'success': True})
 
         except exceptions.ExceptionWithMessage as ex:
@@ -329,6 +397,28 @@ class InitDownload(generics.CreateAPIView):
         return downloader_cls.authenticate(request)
         
 
+class BrowserDownload(APIView):
+    '''
+    Returns short-lived signed URLs so that users can download their files
+    directly in the browser, without a transfer to Dropbox/Drive.
+    '''
+
+    def post(self, request, format=None):
+        try:
+            resource_pks = request.data['resource_pks']
+            if (type(resource_pks) is int) or (type(resource_pks) is str):
+                resource_pks = [resource_pks,]
+            resource_pks = [int(x) for x in resource_pks if x]
+        except (KeyError, TypeError, ValueError) as ex:
+            raise exceptions.RequestError('The request must contain a list of integers under "resource_pks".')
+
+        try:
+            downloads = browser_downloads.issue_browser_downloads(resource_pks, request.user.pk)
+        except exceptions.ExceptionWithMessage as ex:
+            raise exceptions.RequestError(ex.message)
+        return Response({'downloads': downloads})
+
+
 class InitUpload(generics.CreateAPIView):
 
     def post(self, request, *args, **kwargs):
@@ -356,6 +446,10 @@ class InitUpload(generics.CreateAPIView):
             if len(error_messages) > 0:
                 return Response({'errors': error_messages})
             elif len(upload_info) > 0:
+                if uploader_cls.client_side_upload:
+                    # the client sends the files itself, so it needs the upload info immediately
+                    uploader = uploader_cls(upload_info)
+                    return Response({'uploads': uploader.upload()})
                 # call async method:
                 transfer_tasks.upload.delay(upload_info, upload_source)
                 return Response({})
@@ -370,3 +464,36 @@ class InitUpload(generics.CreateAPIView):
             return response
 
 
+class BrowserUploadComplete(APIView):
+    '''
+    The browser calls this once it has sent all of a file directly to storage.  
+    The file is checked against the MD5 checksum computed by the browser (base64-encoded) 
+    before its Resource is activated.
+    '''
+
+    def post(self, request, format=None):
+        data = request.data
+        try:
+            transfer_pk = int(data['transfer_pk'])
+            md5_hash = data['md5']
+        except (KeyError, TypeError, ValueError) as ex:
+            raise exceptions.RequestError('The request did not have the correct formatting.')
+
+        try:
+            transfer_obj = Transfer.objects.select_related('resource').get(pk=transfer_pk, 
+                download=False, 
+                completed=False, 
+                resource__source=settings.BROWSER)
+        except ObjectDoesNotExist as ex:
+            raise exceptions.RequestError('Transfer with pk=%s did not exist or was already complete' % transfer_pk)
+
+        user = request.user
+        if (transfer_obj.originator != user) and (not user.is_staff):
+            raise Http404
+
+        uploader_cls = _uploaders.get_uploader(settings.BROWSER)
+        if uploader_cls.finish_upload(transfer_obj, md5_hash):
+            return Response({'success': True})
+        return Response({'success': False, 
+            'errors': ['The file %s did not upload correctly.  Please try again.' % transfer_obj.resource.name]}, 
+            status=status.HTTP_400_BAD_REQUEST)
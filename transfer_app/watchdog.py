@@ -0,0 +1,212 @@
+"""
+If a transfer VM dies before it calls back (e.g. the container crashes), its
+Transfer stays started but incomplete forever.  That occupies one of the
+max_transfers slots and blocks the user from retrying the same file.  Conversely,
+a VM that fails to delete itself keeps running (and costing money) indefinitely.
+
+The functions here reconcile the transfer VMs that are actually running against
+the open Transfer instances.  Orphaned VMs are removed, and transfers whose VM
+is gone (or has stopped reporting) are either relaunched from their last
+checkpoint or marked as failed.  Transfers streamed by the application's own
+worker processes are marked as failed once they stop reporting.
+"""
+import configparser
+import datetime
+
+from googleapiclient.errors import HttpError
+
+from django.conf import settings
+from django.utils import timezone
+
+from helpers import google_clients
+import transfer_app.utils as transfer_utils
+from transfer_app import tasks as transfer_tasks
+from transfer_app.models import Transfer, TransferCoordinator
+
+
+def get_instance_name_prefixes():
+    '''
+    Returns a list of the VM name prefixes used by the uploaders and downloaders
+    '''
+    prefixes = set()
+    for config_filepath in [settings.UPLOADER_CONFIG['CONFIG_PATH'], settings.DOWNLOADER_CONFIG['CONFIG_PATH']]:
+        config = configparser.ConfigParser()
+        config.read(config_filepath)
+        for section in config.sections():
+            if 'instance_name_prefix' in config[section]:
+                prefixes.add(config[section]['instance_name_prefix'])
+    return list(prefixes)
+
+
+def parse_creation_timestamp(timestamp):
+    '''
+    Compute Engine reports RFC3339 timestamps, e.g. 2019-03-11T10:33:20.128-07:00
+    Returns a timezone-aware datetime in UTC.
+    '''
+    naive = datetime.datetime.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S')
+    offset = timestamp[-6:]
+    if offset[0] in ['+', '-']:
+        hours, minutes = offset[1:].split(':')
+        delta = datetime.timedelta(hours=int(hours), minutes=int(minutes))
+        if offset[0] == '+':
+            naive = naive - delta
+        else:
+            naive = naive + delta
+    return naive.replace(tzinfo=datetime.timezone.utc)
+
+
+def list_transfer_instances(compute, prefixes):
+    '''
+    Returns a dict mapping the name of each transfer VM (in any zone) to a tuple
+    of its zone and creation time
+    '''
+    instances = {}
+    project = settings.CONFIG_PARAMS['google_project_id']
+    request = compute.instances().aggregatedList(project=project)
+    while request is not None:
+        response = request.execute()
+        for scope, scoped_list in response.get('items', {}).items():
+            for instance in scoped_list.get('instances', []):
+                name = instance['name']
+                if any([name.startswith(prefix + '-') for prefix in prefixes]):
+                    zone = instance['zone'].split('/')[-1]
+                    instances[name] = (zone, parse_creation_timestamp(instance['creationTimestamp']))
+        request = compute.instances().aggregatedList_next(previous_request=request, previous_response=response)
+    return instances
+
+
+def delete_instance(compute, zone, instance_name):
+    '''
+    Removes the VM.  Returns True if the delete request was accepted.
+    '''
+    try:
+        compute.instances().delete(project=settings.CONFIG_PARAMS['google_project_id'],
+            zone=zone,
+            instance=instance_name).execute()
+        return True
+    except HttpError as ex:
+        # e.g. the VM already removed itself
+        print('Could not delete instance %s: %s' % (instance_name, ex))
+        return False
+
+
+def handle_lost_transfer(transfer_obj):
+    '''
+    Called when the VM for this Transfer is gone or unresponsive.  Returns
+    True if the transfer was relaunched, False if it was marked as failed, and
+    None if the transfer was already handled elsewhere (e.g. the worker called
+    back while we were checking).
+    '''
+    # claim the transfer so that a late callback from the worker does not also act on it
+    claimed = Transfer.objects.filter(pk=transfer_obj.pk,
+        completed=False,
+        instance_name=transfer_obj.instance_name).update(instance_name=None)
+    if claimed == 0:
+        return None
+    transfer_obj.instance_name = None
+
+    if transfer_obj.can_resume():
+        transfer_obj.relaunch_count += 1
+        transfer_obj.save()
+        transfer_tasks.resume_transfer.delay(transfer_obj.pk)
+        return True
+
+    tc_pk = transfer_obj.coordinator.pk
+    if transfer_obj.finalize(False):
+        tc = TransferCoordinator.objects.get(pk=tc_pk)
+        transfer_utils.post_completion(tc, tc.originator_emails())
+    return False
+
+
+def reap_in_worker_transfers(now, heartbeat_timeout):
+    '''
+    Transfers streamed by a worker process have no VM, so they are only
+    checked by their heartbeat.  Those which have stopped reporting (e.g. the
+    worker was killed) cannot be resumed, so they are marked as failed.
+    Returns the number of transfers failed.
+    '''
+    num_failed = 0
+    open_transfers = Transfer.objects.filter(started=True,
+        completed=False,
+        in_worker=True,
+        instance_name__isnull=True)
+    for transfer_obj in open_transfers:
+        silent_time = now - transfer_obj.last_heartbeat()
+        if silent_time < heartbeat_timeout:
+            continue
+        print('In-worker transfer %s has not reported in %s.' % (transfer_obj.pk, silent_time))
+        tc_pk = transfer_obj.coordinator.pk
+        # finalize does nothing if the worker finished in the meantime
+        if transfer_obj.finalize(False):
+            tc = TransferCoordinator.objects.get(pk=tc_pk)
+            transfer_utils.post_completion(tc, tc.originator_emails())
+        num_failed += 1
+    return num_failed
+
+
+def reconcile_transfers():
+    '''
+    Compares the running transfer VMs against the open Transfers and cleans up
+    anything that is stuck.  Returns a dict summarizing what was reclaimed.
+    '''
+    summary = {
+        'instances_deleted': 0,
+        'transfers_requeued': 0,
+        'transfers_failed': 0,
+        'slots_reclaimed': 0
+    }
+    heartbeat_timeout = datetime.timedelta(seconds=int(settings.CONFIG_PARAMS['transfer_heartbeat_timeout_seconds']))
+    grace_period = datetime.timedelta(seconds=int(settings.CONFIG_PARAMS['missing_instance_grace_seconds']))
+    summary['transfers_failed'] += reap_in_worker_transfers(timezone.now(), heartbeat_timeout)
+
+    if settings.CONFIG_PARAMS['cloud_environment'] != settings.GOOGLE:
+        summary['slots_reclaimed'] = summary['transfers_failed']
+        return summary
+
+    # list the VMs prior to querying the transfers.  A VM only removes itself after
+    # its transfer is marked complete, so a VM missing from this list which
+    # still has an open transfer really is gone.
+    compute = google_clients.get_compute_client()
+    instances = list_transfer_instances(compute, get_instance_name_prefixes())
+    now = timezone.now()
+
+    open_transfers = Transfer.objects.filter(started=True,
+        completed=False,
+        instance_name__isnull=False)
+    matched_instances = set()
+    for transfer_obj in open_transfers:
+        silent_time = now - transfer_obj.last_heartbeat()
+        if transfer_obj.instance_name in instances:
+            matched_instances.add(transfer_obj.instance_name)
+            if silent_time < heartbeat_timeout:
+                continue
+            print('Transfer %s has not reported in %s.  Removing instance %s'
+                % (transfer_obj.pk, silent_time, transfer_obj.instance_name))
+            zone = instances[transfer_obj.instance_name][0]
+            if delete_instance(compute, zone, transfer_obj.instance_name):
+                summary['instances_deleted'] += 1
+        else:
+            if silent_time < grace_period:
+                continue
+            print('The instance (%s) for transfer %s is gone.' % (transfer_obj.instance_name, transfer_obj.pk))
+
+        outcome = handle_lost_transfer(transfer_obj)
+        if outcome is True:
+            summary['transfers_requeued'] += 1
+        elif outcome is False:
+            summary['transfers_failed'] += 1
+
+    # VMs that do not belong to any open transfer:
+    for instance_name, (zone, creation_time) in instances.items():
+        if (instance_name not in matched_instances) and ((now - creation_time) >= grace_period):
+            print('Removing orphaned instance %s' % instance_name)
+            if delete_instance(compute, zone, instance_name):
+                summary['instances_deleted'] += 1
+
+    summary['slots_reclaimed'] = summary['transfers_requeued'] + summary['transfers_failed']
+    print('Transfer watchdog reclaimed %d transfer slot(s) (%d requeued, %d failed) and deleted %d instance(s)'
+        % (summary['slots_reclaimed'],
+        summary['transfers_requeued'],
+        summary['transfers_failed'],
+        summary['instances_deleted']))
+    return summary
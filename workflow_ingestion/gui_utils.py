@@ -2,7 +2,6 @@ import os
 import sys
 import json
 
-from jinja2 import Environment, FileSystemLoader
 
 # for easy reference, determine the directory we are currently in
 THIS_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -17,6 +16,8 @@ import django
 from django.conf import settings
 django.setup()
 
+from helpers.utils import get_jinja_environment
+
 # Some constants (only referenced here):
 GUI_SCHEMA_PATH = 'gui_schema.json'
 GUI_ELEMENTS = 'gui_elements'
@@ -153,14 +154,11 @@ def check_element_parameters(display_element, element_schema):
 def get_jinja_template(template_path):
 
     # load the environment/template for the jinja template engine: 
-    template_dir = os.path.realpath(
-        os.path.abspath(
-            os.path.dirname(
-                os.path.join(THIS_DIR, template_path)
-            )
+    env = get_jinja_environment(
+        os.path.dirname(
+            os.path.join(THIS_DIR, template_path)
         )
     )
-    env = Environment(loader=FileSystemLoader(template_dir))
     return env.get_template(
         os.path.basename(template_path)
     )